@@ -12,7 +12,10 @@ import memory
 import copy
 import re
 import msgio_handler
+import slot_holds
 import locale
+import threading
+import time
 
 # Configurar logger PRIMERO para evitar NameError
 logger = logging.getLogger(config.TENANT_NAME)
@@ -222,29 +225,71 @@ def buscar_y_ofrecer_turnos(history, detalles, state_context=None, mensaje_compl
     
     return mostrar_opciones_turnos(history, detalles, state_context, mensaje_completo_usuario, author)
 
+# Menús fijos compilados una vez (ver msgio_handler.registrar_plantilla)
+_BOTONES_ERROR_TECNICO = [
+    {"id": "reintentar_turnos", "title": "🔄 Intentar de nuevo"},
+    {"id": "buscar_otra_fecha", "title": "📅 Buscar otra fecha"},
+    {"id": "salir_agenda", "title": "❌ Salir de agenda"}
+]
+msgio_handler.registrar_plantilla(
+    'agenda_error_tecnico',
+    message="⚠️ **Error técnico**\n\nTengo problemas para obtener los turnos disponibles. ¿Qué querés hacer?",
+    buttons=_BOTONES_ERROR_TECNICO
+)
+msgio_handler.registrar_plantilla(
+    'agenda_error_tecnico_reprogramacion',
+    message="⚠️ **Error técnico en reprogramación**\n\nTengo problemas para obtener los turnos. ¿Qué querés hacer?",
+    buttons=_BOTONES_ERROR_TECNICO
+)
+msgio_handler.registrar_plantilla(
+    'agenda_identificar_cita',
+    message="❓ **Para cancelar tu cita necesito identificarla**\n\n¿Qué información podés darme?",
+    buttons=[
+        {"id": "fecha_cita", "title": "📅 Decir fecha de la cita"},
+        {"id": "buscar_citas", "title": "🔍 Buscar mis citas"},
+        {"id": "salir_agenda", "title": "❌ Salir de agenda"}
+    ]
+)
+msgio_handler.registrar_plantilla(
+    'agenda_confirmar_cancelacion',
+    message="⚠️ **Confirmación de cancelación**\n\n¿Estás seguro de que querés cancelar tu cita?",
+    buttons=[
+        {"id": "cancelar_cita_si", "title": "✅ Sí, cancelar"},
+        {"id": "cancelar_cita_no", "title": "❌ No, mantener cita"}
+    ]
+)
+_BOTONES_NO_TURNOS = [
+    {"id": "buscar_otra_fecha", "title": "📅 Buscar en otra fecha"},
+    {"id": "preferencia_horario", "title": "⏰ Especificar horario"},
+    {"id": "salir_agenda", "title": "❌ Salir de agenda"}
+]
+msgio_handler.registrar_plantilla(
+    'agenda_no_turnos',
+    message="❌ **No hay turnos disponibles**\n\nEn los próximos días no encontré turnos libres. ¿Qué querés hacer?",
+    buttons=_BOTONES_NO_TURNOS
+)
+msgio_handler.registrar_plantilla(
+    'agenda_no_turnos_reprogramacion',
+    message="❌ **No hay turnos disponibles para reprogramación**\n\n¿Qué querés hacer?",
+    buttons=_BOTONES_NO_TURNOS
+)
+msgio_handler.registrar_plantilla(
+    'agenda_confirmar_turno',
+    message="✅ **Turno seleccionado:**\n{fecha}\n\n¿Confirmas este turno?",
+    buttons=[
+        {"id": "confirmar_turno_si", "title": "✅ Sí, confirmar"},
+        {"id": "confirmar_turno_no", "title": "❌ No, elegir otro"}
+    ]
+)
+
 def _mostrar_error_tecnico_con_botones(author, state_context, tipo_agenda="agendamiento"):
     """
     CORRECCIÓN V10: Mostrar error técnico con botones, nunca texto.
     """
     import msgio_handler
     
-    if tipo_agenda == "reprogramación":
-        mensaje = "⚠️ **Error técnico en reprogramación**\n\nTengo problemas para obtener los turnos. ¿Qué querés hacer?"
-    else:
-        mensaje = "⚠️ **Error técnico**\n\nTengo problemas para obtener los turnos disponibles. ¿Qué querés hacer?"
-    
-    # Crear botones de opciones
-    botones = [
-        {"id": "reintentar_turnos", "title": "🔄 Intentar de nuevo"},
-        {"id": "buscar_otra_fecha", "title": "📅 Buscar otra fecha"},
-        {"id": "salir_agenda", "title": "❌ Salir de agenda"}
-    ]
-    
-    success = msgio_handler.send_whatsapp_message(
-        phone_number=author,
-        message=mensaje,
-        buttons=botones
-    )
+    plantilla = 'agenda_error_tecnico_reprogramacion' if tipo_agenda == "reprogramación" else 'agenda_error_tecnico'
+    success = msgio_handler.enqueue_whatsapp_template(author, plantilla)
     
     if success:
         return None, state_context
@@ -259,20 +304,7 @@ def _mostrar_solicitud_identificacion_cita_con_botones(author, state_context):
     """
     import msgio_handler
     
-    mensaje = "❓ **Para cancelar tu cita necesito identificarla**\n\n¿Qué información podés darme?"
-    
-    # Crear botones de opciones
-    botones = [
-        {"id": "fecha_cita", "title": "📅 Decir fecha de la cita"},
-        {"id": "buscar_citas", "title": "🔍 Buscar mis citas"},
-        {"id": "salir_agenda", "title": "❌ Salir de agenda"}
-    ]
-    
-    success = msgio_handler.send_whatsapp_message(
-        phone_number=author,
-        message=mensaje,
-        buttons=botones
-    )
+    success = msgio_handler.enqueue_whatsapp_template(author, 'agenda_identificar_cita')
     
     if success:
         return None, state_context
@@ -287,19 +319,7 @@ def _mostrar_confirmacion_cancelacion_con_botones(author, state_context):
     """
     import msgio_handler
     
-    mensaje = "⚠️ **Confirmación de cancelación**\n\n¿Estás seguro de que querés cancelar tu cita?"
-    
-    # Crear botones de confirmación
-    botones = [
-        {"id": "cancelar_cita_si", "title": "✅ Sí, cancelar"},
-        {"id": "cancelar_cita_no", "title": "❌ No, mantener cita"}
-    ]
-    
-    success = msgio_handler.send_whatsapp_message(
-        phone_number=author,
-        message=mensaje,
-        buttons=botones
-    )
+    success = msgio_handler.enqueue_whatsapp_template(author, 'agenda_confirmar_cancelacion')
     
     if success:
         return None, state_context
@@ -314,23 +334,8 @@ def _mostrar_no_turnos_disponibles_con_botones(author, state_context, tipo_agend
     """
     import msgio_handler
     
-    if tipo_agenda == "reprogramación":
-        mensaje = "❌ **No hay turnos disponibles para reprogramación**\n\n¿Qué querés hacer?"
-    else:
-        mensaje = "❌ **No hay turnos disponibles**\n\nEn los próximos días no encontré turnos libres. ¿Qué querés hacer?"
-    
-    # Crear botones de opciones
-    botones = [
-        {"id": "buscar_otra_fecha", "title": "📅 Buscar en otra fecha"},
-        {"id": "preferencia_horario", "title": "⏰ Especificar horario"},
-        {"id": "salir_agenda", "title": "❌ Salir de agenda"}
-    ]
-    
-    success = msgio_handler.send_whatsapp_message(
-        phone_number=author,
-        message=mensaje,
-        buttons=botones
-    )
+    plantilla = 'agenda_no_turnos_reprogramacion' if tipo_agenda == "reprogramación" else 'agenda_no_turnos'
+    success = msgio_handler.enqueue_whatsapp_template(author, plantilla)
     
     if success:
         return None, state_context  # No devolver texto adicional
@@ -348,19 +353,7 @@ def _mostrar_confirmacion_turno_con_botones(slot_seleccionado, state_context, au
     
     fecha_formateada = slot_seleccionado.get('fecha_formateada', 'Turno seleccionado')
     
-    mensaje = f"✅ **Turno seleccionado:**\n{fecha_formateada}\n\n¿Confirmas este turno?"
-    
-    # Crear botones de confirmación
-    botones = [
-        {"id": "confirmar_turno_si", "title": "✅ Sí, confirmar"},
-        {"id": "confirmar_turno_no", "title": "❌ No, elegir otro"}
-    ]
-    
-    success = msgio_handler.send_whatsapp_message(
-        phone_number=author,
-        message=mensaje,
-        buttons=botones
-    )
+    success = msgio_handler.enqueue_whatsapp_template(author, 'agenda_confirmar_turno', fecha=fecha_formateada)
     
     if success:
         return None, state_context  # No devolver texto adicional
@@ -556,6 +549,13 @@ def ejecutar_reprogramacion_cita(history, detalles, state_context=None, mensaje_
     logger.info(f"[EJECUTAR_REPROG] Ejecutando búsqueda directa de turnos para reprogramación")
     return mostrar_opciones_turnos_reprogramacion(history, detalles, state_context, mensaje_completo_usuario)
 
+def _retener_turnos_ofrecidos(author, available_slots):
+    """Retiene para el usuario los turnos que se le van a mostrar; descarta los que ya retiene otro."""
+    clave = utils.clave_calendario(get_calendar_service())
+    retenidos = set(slot_holds.reservas.retener(author, clave, [s.get('slot_iso') for s in available_slots if isinstance(s, dict)]))
+    return [s for s in available_slots if isinstance(s, dict) and s.get('slot_iso') in retenidos]
+
+
 def mostrar_opciones_turnos_reprogramacion(history, detalles, state_context=None, mensaje_completo_usuario=None, author=None):
     """
     CORRECCIÓN CRÍTICA: Función específica para mostrar opciones de turnos en reprogramación.
@@ -623,6 +623,10 @@ def mostrar_opciones_turnos_reprogramacion(history, detalles, state_context=None
             # CORRECCIÓN V10: SIEMPRE BOTONES, NUNCA TEXTO
             return _mostrar_error_tecnico_con_botones(author, state_context, "reprogramación")
     
+    # Retener los turnos ofrecidos hasta que el usuario elija (evita dobles reservas)
+    if available_slots:
+        available_slots = _retener_turnos_ofrecidos(author, available_slots)
+    
     if not available_slots:
         # CORRECCIÓN V10: SIEMPRE BOTONES, NUNCA TEXTO
         return _mostrar_no_turnos_disponibles_con_botones(author, state_context, "reprogramación")
@@ -727,7 +731,7 @@ def mostrar_opciones_turnos_reprogramacion(history, detalles, state_context=None
     titulo_lista = "Ver Turnos"
     titulo_seccion = "Turnos Disponibles"
     
-    success = msgio_handler.send_whatsapp_message(
+    success = msgio_handler.enqueue_whatsapp_list(
         phone_number=author,
         message=mensaje_principal,
         list_title=titulo_lista,
@@ -954,6 +958,10 @@ def mostrar_opciones_turnos(history, detalles, state_context=None, mensaje_compl
             logger.warning(f"[MOSTRAR_TURNOS] Fallback de rango falló: {e}")
             available_slots = []
     
+    # Retener los turnos ofrecidos hasta que el usuario elija (evita dobles reservas)
+    if available_slots:
+        available_slots = _retener_turnos_ofrecidos(author, available_slots)
+    
     if not available_slots:
         # CORRECCIÓN V10: SIEMPRE BOTONES, NUNCA TEXTO
         return _mostrar_no_turnos_disponibles_con_botones(author, state_context, "agendamiento")
@@ -1061,7 +1069,7 @@ def mostrar_opciones_turnos(history, detalles, state_context=None, mensaje_compl
     titulo_lista = "Ver Turnos"
     titulo_seccion = "Turnos Disponibles"
     
-    success = msgio_handler.send_whatsapp_message(
+    success = msgio_handler.enqueue_whatsapp_list(
         phone_number=author,
         message=mensaje_principal,
         list_title=titulo_lista,
@@ -1277,6 +1285,16 @@ def finalizar_cita_automatico(history, detalles, state_context=None, mensaje_com
         # Obtener el servicio de calendario
         calendar_service = get_calendar_service()
         
+        # Confirmar el hold antes de tocar el calendario: si otro usuario lo tiene, no seguir
+        clave_calendario = utils.clave_calendario(calendar_service)
+        turnos_ofrecidos = [s.get('slot_iso') for s in state_context.get('available_slots_sent') or [] if isinstance(s, dict)]
+        if not slot_holds.reservas.confirmar(author, clave_calendario, slot_seleccionado['slot_iso']):
+            for k in ('available_slots', 'available_slots_sent'):
+                if isinstance(state_context.get(k), list):
+                    state_context[k] = [s for s in state_context[k] if not (isinstance(s, dict) and s.get('slot_iso') == slot_seleccionado['slot_iso'])]
+            state_context.pop('slot_seleccionado', None)
+            return "Uy, ese turno se acaba de ocupar 😕 Por favor, elegí otro de la lista.", state_context
+        
         # Preparar datos del slot para crear evento
         slot_datetime = datetime.fromisoformat(slot_seleccionado['slot_iso'])
         slot_end = slot_datetime + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
@@ -1305,6 +1323,7 @@ def finalizar_cita_automatico(history, detalles, state_context=None, mensaje_com
                 }
             else:
                 logger.error(f"[FINALIZAR_CITA] Error al reprogramar evento: {last_event_id}")
+                slot_holds.reservas.liberar(author, clave_calendario, [slot_seleccionado['slot_iso']])
                 return "Lo siento, hubo un error al reprogramar tu cita. Por favor, intenta de nuevo.", state_context
         else:
             # CREAR nuevo evento
@@ -1315,8 +1334,12 @@ def finalizar_cita_automatico(history, detalles, state_context=None, mensaje_com
                 logger.info(f"[FINALIZAR_CITA] Evento creado con ID: {event_id}")
             else:
                 logger.error("[FINALIZAR_CITA] Error al crear evento en Google Calendar")
+                slot_holds.reservas.liberar(author, clave_calendario, [slot_seleccionado['slot_iso']])
                 return "Lo siento, hubo un error al crear tu cita. Por favor, intenta de nuevo.", state_context
         
+        # Evento creado: el hold queda 'reservado' hasta que espejo e índice lo vean; se suelta el resto de los ofrecidos
+        slot_holds.reservas.convertir(author, clave_calendario, slot_seleccionado['slot_iso'], turnos_ofrecidos)
+        
         # PLAN DE ACCIÓN: Guardar turno confirmado en memoria a largo plazo
         try:
             import memory
@@ -1505,6 +1528,152 @@ def _filtrar_slots_por_restricciones(available_slots, restricciones_temporales,
     logger.info(f"[FILTRAR_SLOTS] Slots filtrados: {len(slots_filtrados)} de {len(available_slots)}")
     return slots_filtrados
 
+class PrefetchTurnos:
+    """
+    Mantiene calculadas las listas de turnos (utils.Turno) de los próximos N días
+    (AVAILABILITY_PREFETCH_DAYS), así "mañana", "esta semana" o un día de la semana
+    se responden sin esperar al calendario.
+
+    - Los días cercanos se refrescan más seguido: hoy y mañana cada
+      AVAILABILITY_PREFETCH_NEAR_INTERVAL segundos, y el intervalo se duplica por
+      cada día más lejano hasta AVAILABILITY_PREFETCH_FAR_INTERVAL.
+    - Cuando el índice de disponibilidad invalida días (reserva, reprogramación,
+      cancelación o cambio en el calendario) esos días quedan obsoletos: las
+      lecturas dejan de usarlos y el hilo los recalcula enseguida. Cada invalidación
+      sube la generación del día: un cálculo que empezó antes no pisa la entrada.
+    """
+
+    def __init__(self, dias=7, intervalo_cercano=60.0, intervalo_lejano=900.0, tick=5.0):
+        self.dias = max(0, int(dias))
+        self.intervalo_cercano = float(intervalo_cercano)
+        self.intervalo_lejano = float(intervalo_lejano)
+        self.tick = float(tick)
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._dias_calculados = {}   # 'YYYY-MM-DD' -> {'slots': [Turno...], 'calculado_en': ts, 'obsoleto': bool}
+        self._generaciones = {}      # 'YYYY-MM-DD' -> invalidaciones recibidas (existan o no en _dias_calculados)
+        self._generacion_global = 0  # invalidaciones sin fechas (todo el calendario)
+        self._hilo = None
+        self._stats = {'hits': 0, 'misses': 0, 'recalculos': 0, 'obsoletos': 0, 'errores': 0,
+                       'calculos_descartados': 0}
+        utils.indice_disponibilidad.suscribir(self._al_invalidar)
+
+    def intervalo(self, desplazamiento_dias):
+        return min(self.intervalo_lejano, self.intervalo_cercano * (2 ** max(0, desplazamiento_dias - 1)))
+
+    def iniciar(self):
+        if self.dias <= 0 or self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name='prefetch_turnos', daemon=True)
+        self._hilo.start()
+        logger.info(f"[PREFETCH_TURNOS] Prefetch de {self.dias} días iniciado")
+
+    def _al_invalidar(self, clave, fechas):
+        with self._lock:
+            if fechas:
+                for fecha in fechas:
+                    self._generaciones[fecha] = self._generaciones.get(fecha, 0) + 1
+            else:
+                self._generacion_global += 1
+            for fecha, entrada in self._dias_calculados.items():
+                if not fechas or fecha in fechas:
+                    entrada['obsoleto'] = True
+                    self._stats['obsoletos'] += 1
+        self._despertar.set()
+
+    def _pendientes(self):
+        hoy = datetime.now(TIMEZONE).date()
+        ahora = time.time()
+        pendientes = []
+        with self._lock:
+            for d in range(self.dias):
+                fecha = (hoy + timedelta(days=d)).isoformat()
+                entrada = self._dias_calculados.get(fecha)
+                if entrada is None or entrada['obsoleto'] or ahora - entrada['calculado_en'] >= self.intervalo(d):
+                    pendientes.append(fecha)
+            # Olvidar días que ya pasaron
+            for fecha in [f for f in self._dias_calculados if f < hoy.isoformat()]:
+                del self._dias_calculados[fecha]
+            for fecha in [f for f in self._generaciones if f < hoy.isoformat()]:
+                del self._generaciones[fecha]
+        return pendientes
+
+    def _bucle(self):
+        while True:
+            try:
+                pendientes = self._pendientes()
+                if pendientes:
+                    self._calcular(get_calendar_service(), pendientes)
+            except Exception as e:
+                with self._lock:
+                    self._stats['errores'] += 1
+                logger.error(f"[PREFETCH_TURNOS] Error refrescando turnos: {e}")
+                self._despertar.wait(self.intervalo_cercano)
+            self._despertar.wait(self.tick)
+            self._despertar.clear()
+
+    def _calcular(self, calendar_service, fechas):
+        """
+        Calcula y guarda los días pedidos (un solo tramo contiguo contra el índice). Si un día se
+        invalidó durante el cálculo, el resultado se devuelve pero no se guarda: queda obsoleto.
+        """
+        with self._lock:
+            generaciones = {fecha: self._generacion(fecha) for fecha in fechas}
+        desde = TIMEZONE.localize(datetime.strptime(fechas[0], '%Y-%m-%d'))
+        hasta = TIMEZONE.localize(datetime.strptime(fechas[-1], '%Y-%m-%d')) + timedelta(days=1)
+        por_dia = {fecha: [] for fecha in fechas}
+        for turno in utils.indice_disponibilidad.turnos(calendar_service, desde, hasta):
+            if turno.fecha in por_dia:
+                por_dia[turno.fecha].append(turno)
+        ahora = time.time()
+        with self._lock:
+            for fecha, slots in por_dia.items():
+                if self._generacion(fecha) != generaciones[fecha]:
+                    self._stats['calculos_descartados'] += 1
+                    continue
+                self._dias_calculados[fecha] = {'slots': slots, 'calculado_en': ahora, 'obsoleto': False}
+            self._stats['recalculos'] += 1
+        return por_dia
+
+    def _generacion(self, fecha):
+        return (self._generacion_global, self._generaciones.get(fecha, 0))
+
+    def obtener(self, calendar_service, start_date, end_date):
+        """
+        Turnos (utils.Turno) de [start_date, end_date). Los días precalculados y vigentes se
+        leen al instante; el resto (o los obsoletos) se calculan en el momento.
+        """
+        primero = start_date.astimezone(TIMEZONE).date()
+        cantidad = max(1, (end_date.astimezone(TIMEZONE).date() - primero).days)
+        fechas = [(primero + timedelta(days=i)).isoformat() for i in range(cantidad)]
+        with self._lock:
+            listos = {f: e['slots'] for f in fechas
+                      if (e := self._dias_calculados.get(f)) is not None and not e['obsoleto']}
+            self._stats['hits'] += len(listos)
+            self._stats['misses'] += len(fechas) - len(listos)
+        faltantes = [f for f in fechas if f not in listos]
+        if faltantes:
+            listos.update(self._calcular(calendar_service, faltantes))
+        return [slot for fecha in fechas for slot in listos.get(fecha, [])]
+
+    def get_stats(self):
+        with self._lock:
+            dias = {fecha: {'turnos': len(e['slots']), 'obsoleto': e['obsoleto'],
+                            'edad_segundos': round(time.time() - e['calculado_en'], 1)}
+                    for fecha, e in sorted(self._dias_calculados.items())}
+            return {'dias_configurados': self.dias, 'activo': self._hilo is not None, 'dias': dias, **self._stats}
+
+
+turnos_precalculados = PrefetchTurnos(
+    dias=getattr(config, 'AVAILABILITY_PREFETCH_DAYS', 7),
+    intervalo_cercano=getattr(config, 'AVAILABILITY_PREFETCH_NEAR_INTERVAL', 60),
+    intervalo_lejano=getattr(config, 'AVAILABILITY_PREFETCH_FAR_INTERVAL', 900),
+)
+
+
 def get_available_slots_for_user(author, fecha_deseada=None, max_slots=5, hora_especifica=None, preferencia_horaria=None):
     """
     NUEVA FUNCIÓN: Obtiene slots disponibles usando el servicio de calendario configurado.
@@ -1535,11 +1704,16 @@ def get_available_slots_for_user(author, fecha_deseada=None, max_slots=5, hora_e
             start_date = datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
             end_date = start_date + timedelta(days=7)  # Buscar en la próxima semana
         
-        # Obtener slots disponibles del calendario
-        date_range = (start_date, end_date)
-        available_slots_iso = calendar_service.get_available_slots(date_range)
+        # Turnos compartidos: precalculados en segundo plano o calculados ahora desde el índice
+        turnos_precalculados.iniciar()
+        slots_del_rango = turnos_precalculados.obtener(calendar_service, start_date, end_date)
+        
+        # Descartar los turnos que otro usuario tiene retenidos (ofrecidos o confirmándose)
+        retenidos = slot_holds.reservas.retenidos_por_otros(author, utils.clave_calendario(calendar_service))
+        if retenidos:
+            slots_del_rango = [turno for turno in slots_del_rango if turno.slot_iso not in retenidos]
         
-        if not available_slots_iso:
+        if not slots_del_rango:
             logger.warning(f"[SLOTS_USER] No se encontraron slots disponibles para {author}")
             return []
         
@@ -1549,67 +1723,47 @@ def get_available_slots_for_user(author, fecha_deseada=None, max_slots=5, hora_e
         slots_cercanos = []
         slots_otros = []
         
-        for slot_iso in available_slots_iso:
+        for turno in slots_del_rango:
             try:
-                slot_datetime = datetime.fromisoformat(slot_iso)
-                
-                # NUEVA MEJORA: Formato corto y profesional para títulos de lista interactiva
-                dias_abreviados = {
-                    'Mon': 'Lun', 'Tue': 'Mar', 'Wed': 'Mié', 'Thu': 'Jue',
-                    'Fri': 'Vie', 'Sat': 'Sáb', 'Sun': 'Dom'
-                }
-                fecha_ingles = slot_datetime.strftime('%a %d/%m - %H:%M')  # Ej: "Thu 31/07 - 10:00"
-                fecha_para_titulo = fecha_ingles
-                for dia_eng, dia_esp in dias_abreviados.items():
-                    fecha_para_titulo = fecha_para_titulo.replace(dia_eng, dia_esp)  # Ej: "Jue 31/07 - 10:00"
-                
-                slot_formateado = {
-                    'slot_iso': slot_iso,
-                    'fecha_formateada': format_fecha_espanol(slot_datetime),  # Mantener formato completo para descripciones
-                    'fecha_para_titulo': fecha_para_titulo,  # NUEVO: Título corto para lista interactiva
-                    'fecha': slot_datetime.strftime('%Y-%m-%d'),  # Formato YYYY-MM-DD para lógica interna
-                    'hora': slot_datetime.strftime('%H:%M'),  # Formato HH:MM para lógica interna
-                    'fecha_completa_legible': slot_datetime.strftime('%A %d de %B a las %H:%M hs')  # Para mensajes de confirmación detallados
-                }
+                hora_slot = turno.hora
                 
                 # CORRECCIÓN CRÍTICA: Clasificar slots según prioridad
                 if hora_especifica:
-                    hora_slot = slot_datetime.strftime('%H:%M')
                     if hora_slot == hora_especifica:
                         # Turno exacto - máxima prioridad
-                        slots_exactos.append(slot_formateado)
+                        slots_exactos.append(turno)
                         logger.info(f"[SLOTS_USER] Encontrado turno exacto: {hora_slot}")
                     else:
                         # Calcular proximidad temporal
                         try:
                             hora_solicitada = datetime.strptime(hora_especifica, '%H:%M').time()
-                            hora_slot_time = slot_datetime.time()
+                            hora_slot_time = datetime.strptime(hora_slot, '%H:%M').time()
                             diferencia_minutos = abs((hora_slot_time.hour * 60 + hora_slot_time.minute) - 
                                                    (hora_solicitada.hour * 60 + hora_solicitada.minute))
                             
                             if diferencia_minutos <= 60:  # Dentro de 1 hora
-                                slots_cercanos.append((diferencia_minutos, slot_formateado))
+                                slots_cercanos.append((diferencia_minutos, turno))
                             else:
-                                slots_otros.append(slot_formateado)
+                                slots_otros.append(turno)
                         except ValueError:
-                            slots_otros.append(slot_formateado)
+                            slots_otros.append(turno)
                 else:
                     # Si no hay hora específica, usar preferencia horaria
                     if preferencia_horaria:
-                        hora_slot = slot_datetime.hour
+                        hora_slot = int(hora_slot[:2])
                         if preferencia_horaria == 'mañana' and 6 <= hora_slot < 12:
-                            slots_cercanos.append((0, slot_formateado))
+                            slots_cercanos.append((0, turno))
                         elif preferencia_horaria == 'tarde' and 12 <= hora_slot < 18:
-                            slots_cercanos.append((0, slot_formateado))
+                            slots_cercanos.append((0, turno))
                         elif preferencia_horaria == 'noche' and (hora_slot >= 18 or hora_slot < 6):
-                            slots_cercanos.append((0, slot_formateado))
+                            slots_cercanos.append((0, turno))
                         else:
-                            slots_otros.append(slot_formateado)
+                            slots_otros.append(turno)
                     else:
-                        slots_otros.append(slot_formateado)
+                        slots_otros.append(turno)
                         
             except ValueError as e:
-                logger.error(f"[SLOTS_USER] Error parseando slot {slot_iso}: {e}")
+                logger.error(f"[SLOTS_USER] Error clasificando slot {turno}: {e}")
                 continue
         
         # CORRECCIÓN CRÍTICA: Ordenar y combinar slots según prioridad
@@ -1623,8 +1777,8 @@ def get_available_slots_for_user(author, fecha_deseada=None, max_slots=5, hora_e
         # 3. Otros turnos
         formatted_slots.extend(slots_otros)
         
-        # Limitar a max_slots
-        formatted_slots = formatted_slots[:max_slots]
+        # Limitar a max_slots; el contexto guarda dicts (los campos ya vienen memorizados del Turno)
+        formatted_slots = [turno.como_dict() for turno in formatted_slots[:max_slots]]
         
         logger.info(f"[SLOTS_USER] Retornando {len(formatted_slots)} slots priorizados para {author}")
         if hora_especifica:
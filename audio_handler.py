@@ -3,7 +3,13 @@ import requests
 import time
 import logging
 import config
+import http_transport
+import media_store
 import os
+import re
+import heapq
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import BoundedSemaphore, Condition, Thread
 
 # Define la URL base de la API de AssemblyAI para mantener el código limpio.
 API_URL = "https://api.assemblyai.com/v2"
@@ -19,101 +25,329 @@ if ASSEMBLYAI_API_KEY:
 else:
     logger.error("[AUDIO_HANDLER] ❌ NO SE ENCONTRÓ API KEY DE ASSEMBLYAI")
 
-def transcribe_audio_from_url(audio_url: str) -> str:
+# --- CLIENTE DE TRANSCRIPCIÓN (sesión compartida, polling adaptativo y webhook) ---
+# Un solo hilo "poller" sigue todas las transcripciones en curso: los hilos que
+# piden una transcripción no hacen sleep() entre consultas, solo esperan su Future.
+# Si ASSEMBLYAI_WEBHOOK_URL está configurada, AssemblyAI avisa al terminar y el
+# polling queda solo como red de seguridad (cada ASSEMBLYAI_WEBHOOK_SAFETY_POLL s).
+# Con varios workers el webhook puede caer en un proceso que no sigue esa
+# transcripción: ese proceso deja una señal en disco (ASSEMBLYAI_WEBHOOK_SIGNAL_DIR)
+# y el dueño la levanta en menos de un segundo.
+
+class TranscripcionError(Exception):
+    """AssemblyAI devolvió estado de error para la transcripción."""
+
+
+class _Trabajo:
+    __slots__ = ('transcript_id', 'futuro', 'intervalo', 'inicio', 'consultas', 'errores_red')
+
+    def __init__(self, transcript_id: str, intervalo: float):
+        self.transcript_id = transcript_id
+        self.futuro = Future()
+        self.intervalo = intervalo
+        self.inicio = time.monotonic()
+        self.consultas = 0
+        self.errores_red = 0
+
+
+class TranscriptionClient:
+    """Transcripciones concurrentes con tope de trabajos en vuelo y un único poller."""
+
+    def __init__(self, api_key: str, max_en_vuelo: int = 16, intervalo_inicial: float = 0.3,
+                 intervalo_max: float = 5.0, factor: float = 1.5, webhook_url: str = '',
+                 webhook_token: str = '', poll_seguridad: float = 10.0, hilos_consulta: int = 4,
+                 dir_senales: str = '', intervalo_senales: float = 0.25):
+        self.api_key = api_key
+        self.max_en_vuelo = max(1, int(max_en_vuelo))
+        self.intervalo_inicial = float(intervalo_inicial)
+        self.intervalo_max = float(intervalo_max)
+        self.factor = float(factor)
+        self.webhook_url = webhook_url
+        self.webhook_token = webhook_token
+        self.poll_seguridad = float(poll_seguridad)
+        self.dir_senales = dir_senales
+        self.intervalo_senales = float(intervalo_senales)
+        # Transporte compartido (pool keep-alive + reintentos); el polling maneja sus propios errores
+        self.session = http_transport.transporte
+        # La sesión también descarga audios de 360dialog: la API key va solo en los requests a AssemblyAI
+        self.headers = {"authorization": api_key or ''}
+        self._cupos = BoundedSemaphore(self.max_en_vuelo)
+        self._cond = Condition()
+        self._agenda = []          # heap de (proxima_consulta, secuencia, transcript_id)
+        self._trabajos = {}        # transcript_id -> _Trabajo
+        self._secuencia = 0
+        self._consultas = ThreadPoolExecutor(max_workers=max(1, int(hilos_consulta)), thread_name_prefix='assemblyai_poll')
+        self._poller = None
+        self._vigia_senales = None
+        self._stats = {'enviadas': 0, 'completadas': 0, 'errores': 0, 'timeouts': 0, 'rechazadas_cupo': 0,
+                       'consultas': 0, 'por_webhook': 0, 'webhooks_de_otro_worker': 0, 'latencia_total_s': 0.0}
+        if self.webhook_url and self.dir_senales:
+            os.makedirs(self.dir_senales, exist_ok=True)
+
+    # --- Envío ---
+
+    def intervalo_para(self, duracion_audio_s: float | None) -> float:
+        """Primera consulta dimensionada por la duración del audio (AssemblyAI tarda ~15-30% del audio)."""
+        if not duracion_audio_s:
+            return self.intervalo_inicial
+        return min(self.intervalo_max, max(self.intervalo_inicial, 0.15 * float(duracion_audio_s)))
+
+    def enviar(self, audio_url: str, duracion_audio_s: float | None = None, espera_cupo: float = 30.0) -> Future:
+        """Crea la transcripción y retorna un Future con el texto. No bloquea mientras AssemblyAI procesa."""
+        if not self._cupos.acquire(timeout=espera_cupo):
+            with self._cond:
+                self._stats['rechazadas_cupo'] += 1
+            raise TimeoutError(f"Sin cupo para transcribir ({self.max_en_vuelo} en vuelo)")
+        try:
+            transcript_request = {
+                "audio_url": audio_url,
+                "language_code": "es"  # Español
+            }
+            if self.webhook_url:
+                transcript_request["webhook_url"] = self.webhook_url
+                if self.webhook_token:
+                    transcript_request["webhook_auth_header_name"] = "X-Webhook-Token"
+                    transcript_request["webhook_auth_header_value"] = self.webhook_token
+            logger.info(f"[AUDIO_HANDLER] 📤 Enviando request a AssemblyAI: {audio_url[:100]}")
+            response = self.session.post(f"{API_URL}/transcript", json=transcript_request, headers=self.headers, timeout=20)
+            logger.info(f"[AUDIO_HANDLER] 📥 Response status: {response.status_code}")
+            if response.status_code != 200:
+                logger.error(f"[AUDIO_HANDLER] ❌ Error creando transcripción: {response.status_code} - {response.text}")
+                raise TranscripcionError(f"HTTP {response.status_code}")
+            transcript_id = response.json()["id"]
+        except Exception:
+            self._cupos.release()
+            raise
+        logger.info(f"[AUDIO_HANDLER] ✅ Transcripción creada con ID: {transcript_id}")
+        trabajo = _Trabajo(transcript_id, self.intervalo_para(duracion_audio_s))
+        trabajo.futuro.transcript_id = transcript_id
+        primera = self.poll_seguridad if self.webhook_url else trabajo.intervalo
+        with self._cond:
+            self._stats['enviadas'] += 1
+            self._trabajos[transcript_id] = trabajo
+            self._agendar(transcript_id, primera)
+            self._asegurar_poller()
+        return trabajo.futuro
+
+    # --- Poller ---
+
+    def _agendar(self, transcript_id: str, espera: float):
+        self._secuencia += 1
+        heapq.heappush(self._agenda, (time.monotonic() + espera, self._secuencia, transcript_id))
+        self._cond.notify()
+
+    def _asegurar_poller(self):
+        if self._poller is None or not self._poller.is_alive():
+            self._poller = Thread(target=self._bucle_poller, name='assemblyai_poller', daemon=True)
+            self._poller.start()
+        if self.webhook_url and self.dir_senales and (self._vigia_senales is None or not self._vigia_senales.is_alive()):
+            self._vigia_senales = Thread(target=self._bucle_senales, name='assemblyai_senales', daemon=True)
+            self._vigia_senales.start()
+
+    # --- Señales de webhook entre workers ---
+
+    def _ruta_senal(self, transcript_id: str) -> str:
+        return os.path.join(self.dir_senales, re.sub(r'[^A-Za-z0-9_-]', '_', transcript_id))
+
+    def _dejar_senal(self, transcript_id: str):
+        ruta = self._ruta_senal(transcript_id)
+        try:
+            temporal = f"{ruta}.{os.getpid()}.tmp"
+            with open(temporal, 'w') as f:
+                f.write(transcript_id)
+            os.replace(temporal, ruta)
+        except OSError as e:
+            logger.warning(f"[AUDIO_HANDLER] No se pudo dejar la señal de webhook de {transcript_id}: {e}")
+
+    def _bucle_senales(self):
+        """Levanta las señales que dejó otro worker para las transcripciones de este proceso."""
+        proxima_limpieza = time.monotonic() + 600
+        while True:
+            time.sleep(self.intervalo_senales)
+            if time.monotonic() >= proxima_limpieza:
+                proxima_limpieza = time.monotonic() + 600
+                self._limpiar_senales_viejas()
+            for transcript_id in list(self._trabajos):
+                ruta = self._ruta_senal(transcript_id)
+                try:
+                    os.remove(ruta)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning(f"[AUDIO_HANDLER] No se pudo leer la señal de {transcript_id}: {e}")
+                    continue
+                with self._cond:
+                    self._stats['webhooks_de_otro_worker'] += 1
+                self._consultas.submit(self._consultar, transcript_id, True)
+
+    def _bucle_poller(self):
+        while True:
+            with self._cond:
+                while not self._agenda or self._agenda[0][0] > time.monotonic():
+                    espera = (self._agenda[0][0] - time.monotonic()) if self._agenda else None
+                    self._cond.wait(timeout=espera)
+                _, _, transcript_id = heapq.heappop(self._agenda)
+                if transcript_id not in self._trabajos:
+                    continue
+            self._consultas.submit(self._consultar, transcript_id, False)
+
+    def _consultar(self, transcript_id: str, desde_webhook: bool):
+        trabajo = self._trabajos.get(transcript_id)
+        if trabajo is None or trabajo.futuro.done():
+            return
+        trabajo.consultas += 1
+        try:
+            datos = self.session.get(f"{API_URL}/transcript/{transcript_id}", headers=self.headers, timeout=20,
+                                     reintentos=0).json()
+        except (requests.RequestException, ValueError) as e:
+            trabajo.errores_red += 1
+            logger.error(f"[AUDIO_HANDLER] ❌ Error en polling de {transcript_id} (#{trabajo.errores_red}): {e}")
+            if trabajo.errores_red >= 3:
+                self._terminar(trabajo, error=requests.RequestException("Máximo de errores de polling alcanzado"))
+            else:
+                with self._cond:
+                    self._agendar(transcript_id, self.intervalo_max)
+            return
+        with self._cond:
+            self._stats['consultas'] += 1
+            if desde_webhook:
+                self._stats['por_webhook'] += 1
+        status = datos.get('status')
+        if status == 'completed':
+            texto = datos.get('text', '') or ''
+            logger.info(f"[AUDIO_HANDLER] ✅ Transcripción completada en {time.monotonic() - trabajo.inicio:.1f}s "
+                        f"({trabajo.consultas} consultas): '{texto[:100]}...'")
+            self._terminar(trabajo, texto=texto)
+        elif status in ('error', 'failed'):
+            error = datos.get('error', 'Error desconocido')
+            logger.error(f"[AUDIO_HANDLER] ❌ Error en AssemblyAI: {error}")
+            self._terminar(trabajo, error=TranscripcionError(error))
+        elif not desde_webhook:
+            if status not in ('queued', 'processing'):
+                logger.warning(f"[AUDIO_HANDLER] ⚠️ Estado desconocido: {status}")
+            if self.webhook_url:
+                siguiente = self.poll_seguridad
+            else:
+                trabajo.intervalo = min(self.intervalo_max, trabajo.intervalo * self.factor)
+                siguiente = trabajo.intervalo
+            with self._cond:
+                self._agendar(transcript_id, siguiente)
+
+    def _terminar(self, trabajo: _Trabajo, texto: str | None = None, error: Exception | None = None):
+        with self._cond:
+            if self._trabajos.pop(trabajo.transcript_id, None) is None:
+                return
+            if error is None:
+                self._stats['completadas'] += 1
+                self._stats['latencia_total_s'] += time.monotonic() - trabajo.inicio
+            else:
+                self._stats['errores'] += 1
+        self._cupos.release()
+        if self.webhook_url and self.dir_senales:
+            try:
+                os.remove(self._ruta_senal(trabajo.transcript_id))
+            except OSError:
+                pass
+        if error is None:
+            trabajo.futuro.set_result(texto)
+        else:
+            trabajo.futuro.set_exception(error)
+
+    def abandonar(self, transcript_id: str):
+        """Deja de seguir una transcripción (timeout del llamador) y libera su cupo."""
+        trabajo = self._trabajos.get(transcript_id)
+        if trabajo is not None:
+            with self._cond:
+                self._stats['timeouts'] += 1
+            self._terminar(trabajo, error=TimeoutError("Transcripción abandonada por timeout"))
+
+    # --- Webhook ---
+
+    def validar_token_webhook(self, token: str | None) -> bool:
+        return not self.webhook_token or token == self.webhook_token
+
+    def _limpiar_senales_viejas(self, edad_max: float = 3600.0):
+        """Señales que ningún worker levantó (transcripción ya resuelta o worker reiniciado)."""
+        limite = time.time() - edad_max
+        try:
+            with os.scandir(self.dir_senales) as entradas:
+                for entrada in entradas:
+                    try:
+                        if entrada.stat().st_mtime < limite:
+                            os.remove(entrada.path)
+                    except OSError:
+                        pass
+        except OSError as e:
+            logger.warning(f"[AUDIO_HANDLER] No se pudieron limpiar las señales de webhook: {e}")
+
+    def notificar_webhook(self, transcript_id: str, status: str) -> bool:
+        """
+        AssemblyAI avisó que la transcripción terminó: traer el resultado sin esperar al poller.
+        Si la transcripción no es de este proceso se deja una señal para el worker que la sigue.
+        """
+        final = status in ('completed', 'error', 'failed')
+        if transcript_id not in self._trabajos:
+            if final and self.dir_senales:
+                self._dejar_senal(transcript_id)
+            return False
+        if final:
+            self._consultas.submit(self._consultar, transcript_id, True)
+        return True
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            en_vuelo = len(self._trabajos)
+        completadas = stats['completadas'] or 1
+        return {
+            'modo': 'webhook' if self.webhook_url else 'polling',
+            'en_vuelo': en_vuelo,
+            'max_en_vuelo': self.max_en_vuelo,
+            **{k: v for k, v in stats.items() if k != 'latencia_total_s'},
+            'latencia_promedio_s': round(stats['latencia_total_s'] / completadas, 2),
+            'consultas_por_transcripcion': round(stats['consultas'] / completadas, 2),
+        }
+
+
+cliente_transcripcion = TranscriptionClient(
+    ASSEMBLYAI_API_KEY,
+    max_en_vuelo=getattr(config, 'ASSEMBLYAI_MAX_IN_FLIGHT', 16),
+    intervalo_inicial=getattr(config, 'ASSEMBLYAI_POLL_INITIAL', 0.3),
+    intervalo_max=getattr(config, 'ASSEMBLYAI_POLL_MAX', 5.0),
+    webhook_url=getattr(config, 'ASSEMBLYAI_WEBHOOK_URL', ''),
+    webhook_token=getattr(config, 'ASSEMBLYAI_WEBHOOK_TOKEN', ''),
+    poll_seguridad=getattr(config, 'ASSEMBLYAI_WEBHOOK_SAFETY_POLL', 10.0),
+    dir_senales=getattr(config, 'ASSEMBLYAI_WEBHOOK_SIGNAL_DIR', './assemblyai_webhooks'),
+)
+
+# Opus de notas de voz de WhatsApp: ~16 kbps
+_BYTES_POR_SEGUNDO_OPUS = 2000
+
+
+def transcribe_audio_from_url(audio_url: str, duracion_audio_s: float | None = None, timeout: float = 120) -> str:
     """
     Toma una URL de un archivo de audio, lo envía a AssemblyAI para transcribirlo
     y devuelve el texto resultante.
 
     Args:
         audio_url: La URL pública del archivo de audio a transcribir.
+        duracion_audio_s: Duración estimada (si se conoce) para dimensionar el polling.
+        timeout: Espera máxima del llamador en segundos.
 
     Returns:
-        El texto transcrito como una cadena de caracteres, o una cadena vacía si ocurre un error.
+        El texto transcrito, un texto "[Error ...]" / "[Audio recibido - timeout ...]", o None.
     """
+    logger.info(f"[AUDIO_HANDLER] 🎯 Iniciando transcripción de URL: {audio_url[:100]}...")
+    if not ASSEMBLYAI_API_KEY:
+        logger.error("[AUDIO_HANDLER] ❌ No hay API key de AssemblyAI configurada")
+        return None
     try:
-        logger.info(f"[AUDIO_HANDLER] 🎯 Iniciando transcripción de URL: {audio_url[:100]}...")
-        
-        # Verificar que tenemos API key
-        if not ASSEMBLYAI_API_KEY:
-            logger.error("[AUDIO_HANDLER] ❌ No hay API key de AssemblyAI configurada")
-            return None
-            
-        # Configurar headers
-        headers = {
-            "authorization": ASSEMBLYAI_API_KEY,
-            "content-type": "application/json"
-        }
-        
-        # Crear transcripción
-        transcript_request = {
-            "audio_url": audio_url,
-            "language_code": "es"  # Español
-        }
-        
-        logger.info(f"[AUDIO_HANDLER] 📤 Enviando request a AssemblyAI: {transcript_request}")
-        
-        response = requests.post(
-            f"{API_URL}/transcript",
-            json=transcript_request,
-            headers=headers,
-            timeout=20
-        )
-        
-        logger.info(f"[AUDIO_HANDLER] 📥 Response status: {response.status_code}")
-        logger.info(f"[AUDIO_HANDLER] 📥 Response body: {response.text[:500]}")
-        
-        if response.status_code != 200:
-            logger.error(f"[AUDIO_HANDLER] ❌ Error creando transcripción: {response.status_code} - {response.text}")
-            return None
-            
-        transcript_id = response.json()["id"]
-        logger.info(f"[AUDIO_HANDLER] ✅ Transcripción creada con ID: {transcript_id}")
-        
-        # Polling para obtener resultado CON TIMEOUT
-        polling_endpoint = f"{API_URL}/transcript/{transcript_id}"
-        
-        max_attempts = 24  # 24 intentos x 5 segundos = 2 minutos máximo
-        attempt = 0
-        
-        while attempt < max_attempts:
-            attempt += 1
-            
-            try:
-                polling_response = requests.get(polling_endpoint, headers=headers, timeout=20)
-                polling_data = polling_response.json()
-                
-                status = polling_data.get('status')
-                logger.info(f"[AUDIO_HANDLER] 🔄 Intento {attempt}/{max_attempts} - Status: {status}")
-                
-                if status == 'completed':
-                    text = polling_data.get('text', '')
-                    logger.info(f"[AUDIO_HANDLER] ✅ Transcripción completada: '{text[:100]}...'")
-                    return text
-                    
-                elif status == 'error' or status == 'failed':
-                    error = polling_data.get('error', 'Error desconocido')
-                    logger.error(f"[AUDIO_HANDLER] ❌ Error en AssemblyAI: {error}")
-                    logger.error(f"[AUDIO_HANDLER] ❌ Detalles completos: {polling_data}")
-                    return f"[Error al transcribir audio: {error}]"
-                    
-                elif status == 'queued' or status == 'processing':
-                    logger.info(f"[AUDIO_HANDLER] ⏳ Audio en cola/procesando... esperando 5 segundos")
-                    time.sleep(5)
-                else:
-                    logger.warning(f"[AUDIO_HANDLER] ⚠️ Estado desconocido: {status}")
-                    logger.warning(f"[AUDIO_HANDLER] ⚠️ Response completa: {polling_data}")
-                    time.sleep(5)
-                    
-            except requests.RequestException as e:
-                logger.error(f"[AUDIO_HANDLER] ❌ Error en polling intento {attempt}: {e}")
-                if attempt >= 3:  # Si fallan 3 intentos de polling, rendirse
-                    logger.error(f"[AUDIO_HANDLER] ❌ Máximo de errores de polling alcanzado")
-                    return "[Error de red al obtener transcripción]"
-                time.sleep(5)
-        
-        logger.error(f"[AUDIO_HANDLER] ⏰ TIMEOUT después de {max_attempts} intentos (2 minutos)")
+        futuro = cliente_transcripcion.enviar(audio_url, duracion_audio_s)
+    except TranscripcionError:
+        return None
+    except TimeoutError as e:
+        logger.error(f"[AUDIO_HANDLER] ⏰ {e}")
         return "[Audio recibido - timeout en transcripción]"
-        
     except requests.RequestException as e:
         logger.error(f"[AUDIO_HANDLER] ❌ Error de red al comunicarse con AssemblyAI: {e}")
         return "[Error de red al transcribir audio]"
@@ -121,31 +355,55 @@ def transcribe_audio_from_url(audio_url: str) -> str:
         logger.error(f"[AUDIO_HANDLER] 💥 Error general en transcripción: {e}", exc_info=True)
         return None
 
+    try:
+        return futuro.result(timeout=timeout)
+    except FutureTimeoutError:
+        logger.error(f"[AUDIO_HANDLER] ⏰ TIMEOUT después de {timeout:.0f}s")
+        cliente_transcripcion.abandonar(futuro.transcript_id)
+        return "[Audio recibido - timeout en transcripción]"
+    except TranscripcionError as e:
+        return f"[Error al transcribir audio: {e}]"
+    except requests.RequestException:
+        return "[Error de red al obtener transcripción]"
+    except TimeoutError:
+        return "[Audio recibido - timeout en transcripción]"
+
 def transcribe_audio_from_url_with_download(audio_url: str) -> str:
     """
     FUNCIÓN ALTERNATIVA: Descarga el audio primero y luego lo sube a AssemblyAI
     Útil cuando las URLs de 360dialog expiran muy rápido (5 minutos)
     """
     try:
-        # Descargar audio
+        # Descargar audio (en streaming al media store, deduplicado por SHA-256)
         logger.info("[AUDIO_HANDLER] 📥 Descargando audio primero...")
         headers = {}
         if 'waba-v2.360dialog.io' in audio_url:
             headers = {"D360-API-KEY": os.getenv('D360_API_KEY')}
-            
-        response = requests.get(audio_url, headers=headers, timeout=30)
-        if response.status_code != 200:
-            logger.error(f"[AUDIO_HANDLER] Error descargando audio: {response.status_code}")
+
+        try:
+            entrada = media_store.store.descargar(audio_url, headers=headers, session=cliente_transcripcion.session)
+        except media_store.MediaDemasiadoGrandeError as e:
+            logger.error(f"[AUDIO_HANDLER] Audio demasiado grande: {e}")
             return None
-            
-        # Subir a AssemblyAI
+        except requests.exceptions.RequestException as e:
+            logger.error(f"[AUDIO_HANDLER] Error descargando audio: {e}")
+            return None
+
+        # El mismo audio reenviado reutiliza la transcripción guardada junto al blob
+        transcripcion = media_store.store.obtener_artefacto('transcripcion', sha256=entrada.sha256)
+        if transcripcion:
+            logger.info(f"[AUDIO_HANDLER] ♻️ Transcripción reutilizada ({entrada.sha256[:12]})")
+            return transcripcion
+
+        # Subir a AssemblyAI directo desde disco
         logger.info("[AUDIO_HANDLER] 📤 Subiendo audio a AssemblyAI...")
-        upload_response = requests.post(
-            f"{API_URL}/upload",
-            headers={"authorization": ASSEMBLYAI_API_KEY},
-            data=response.content,
-            timeout=60
-        )
+        with media_store.store.en_uso(entrada.sha256), open(entrada.ruta, 'rb') as archivo:
+            upload_response = cliente_transcripcion.session.post(
+                f"{API_URL}/upload",
+                headers=cliente_transcripcion.headers,
+                data=archivo,
+                timeout=60
+            )
         
         if upload_response.status_code != 200:
             logger.error(f"[AUDIO_HANDLER] Error subiendo: {upload_response.text}")
@@ -154,8 +412,11 @@ def transcribe_audio_from_url_with_download(audio_url: str) -> str:
         upload_url = upload_response.json()["upload_url"]
         logger.info(f"[AUDIO_HANDLER] ✅ Audio subido a: {upload_url}")
         
-        # Ahora transcribir con la URL de AssemblyAI
-        return transcribe_audio_from_url(upload_url)
+        # Ahora transcribir con la URL de AssemblyAI (el tamaño da una estimación de la duración)
+        transcripcion = transcribe_audio_from_url(upload_url, duracion_audio_s=entrada.bytes / _BYTES_POR_SEGUNDO_OPUS)
+        if transcripcion and not transcripcion.startswith('['):
+            media_store.store.guardar_artefacto('transcripcion', transcripcion, sha256=entrada.sha256)
+        return transcripcion
         
     except Exception as e:
         logger.error(f"[AUDIO_HANDLER] Error en descarga+upload: {e}", exc_info=True)
@@ -22,6 +22,7 @@ import config
 import memory
 import utils
 import llm_handler
+import intent_classifier
 import verification_handler
 import ballester_notifications
 import ballester_agendamiento_adapter
@@ -207,10 +208,10 @@ Se produjo un problema técnico. Por favor:
     def _detect_ballester_commands(self, mensaje: str) -> Optional[Dict]:
         """Detecta comandos específicos del Centro Pediátrico Ballester"""
         
-        mensaje_lower = mensaje.lower().strip()
+        # Comandos específicos de Ballester (fast-path compilado compartido)
+        intencion = intent_classifier.clasificador.intencion_resuelta(mensaje, 'ballester_comandos')
         
-        # Comandos específicos de Ballester
-        if any(cmd in mensaje_lower for cmd in ["quiero agendar", "necesito turno", "pedir cita"]):
+        if intencion == "BALLESTER_MEDICAL_VERIFICATION":
             return {
                 "decision": "BALLESTER_MEDICAL_VERIFICATION",
                 "dominio": "BALLESTER_MEDICAL",
@@ -218,7 +219,7 @@ Se produjo un problema técnico. Por favor:
                 "datos_extraidos": self._extract_medical_data(mensaje)
             }
         
-        if any(cmd in mensaje_lower for cmd in ["consultar cobertura", "que cubre mi obra social", "cuanto cuesta"]):
+        if intencion == "BALLESTER_COVERAGE_CHECK":
             return {
                 "decision": "BALLESTER_COVERAGE_CHECK",
                 "dominio": "BALLESTER_MEDICAL",
@@ -226,7 +227,7 @@ Se produjo un problema técnico. Por favor:
                 "datos_extraidos": self._extract_medical_data(mensaje)
             }
         
-        if any(cmd in mensaje_lower for cmd in ["cancelar turno", "cancelar cita"]):
+        if intencion == "BALLESTER_CANCEL_APPOINTMENT":
             return {
                 "decision": "BALLESTER_CANCEL_APPOINTMENT",
                 "dominio": "BALLESTER_MEDICAL",
@@ -234,7 +235,7 @@ Se produjo un problema técnico. Por favor:
                 "datos_extraidos": {}
             }
         
-        if any(cmd in mensaje_lower for cmd in ["reprogramar turno", "cambiar turno"]):
+        if intencion == "BALLESTER_RESCHEDULE_APPOINTMENT":
             return {
                 "decision": "BALLESTER_RESCHEDULE_APPOINTMENT",
                 "dominio": "BALLESTER_MEDICAL", 
@@ -0,0 +1,142 @@
+"""
+benchmark_slots.py - Micro-benchmark de la generación de turnos libres
+
+Compara el chequeo anterior (cada slot contra todos los bloques ocupados,
+re-parseando los ISO) con el barrido de calendar_services.intervalos, sobre
+un calendario sintético de varias semanas. Verifica que ambos den la misma
+salida antes de medir.
+
+Uso:
+  python benchmark_slots.py --semanas 1 2 4 8 --ocupados-por-dia 12 --repeticiones 5
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from calendar_services.intervalos import Ocupados, slots_libres
+
+TZ = ZoneInfo('America/Argentina/Buenos_Aires')
+
+
+# === Datos sintéticos ===
+def generar_calendario(dias: int, ocupados_por_dia: int, semilla: int = 7):
+    """Ventanas de atención (9-13 y 14-19) y bloques ocupados aleatorios, en el formato de Google."""
+    rnd = random.Random(semilla)
+    inicio = datetime(2025, 3, 3, tzinfo=TZ)
+    ventanas, freebusy, eventos = [], [], []
+    for d in range(dias):
+        dia = inicio + timedelta(days=d)
+        for h_ini, h_fin in ((9, 13), (14, 19)):
+            ventanas.append({'start': {'dateTime': (dia + timedelta(hours=h_ini)).isoformat()},
+                             'end': {'dateTime': (dia + timedelta(hours=h_fin)).isoformat()}})
+        for _ in range(ocupados_por_dia):
+            b_ini = dia + timedelta(hours=8, minutes=rnd.randrange(0, 11 * 60, 15))
+            b_fin = b_ini + timedelta(minutes=rnd.choice((15, 30, 45, 60, 90)))
+            # freebusy devuelve UTC; events.list devuelve la zona del calendario
+            freebusy.append({'start': b_ini.astimezone(ZoneInfo('UTC')).isoformat(),
+                             'end': b_fin.astimezone(ZoneInfo('UTC')).isoformat()})
+            eventos.append({'start': {'dateTime': b_ini.isoformat()}, 'end': {'dateTime': b_fin.isoformat()}})
+    return inicio, inicio + timedelta(days=dias), ventanas, freebusy, eventos
+
+
+# === Implementaciones anteriores (referencia) ===
+def citas_referencia(ventanas, busy_blocks, slot_min=30):
+    def _overlaps(slot_start, slot_end):
+        for b in busy_blocks:
+            try:
+                b_start = datetime.fromisoformat(b['start']).astimezone(TZ)
+                b_end = datetime.fromisoformat(b['end']).astimezone(TZ)
+                if max(slot_start, b_start) < min(slot_end, b_end):
+                    return True
+            except Exception:
+                continue
+        return False
+
+    slots_iso = []
+    for vent in ventanas:
+        v_start = datetime.fromisoformat(vent['start']['dateTime']).astimezone(TZ)
+        v_end = datetime.fromisoformat(vent['end']['dateTime']).astimezone(TZ)
+        current = v_start
+        while current + timedelta(minutes=slot_min) <= v_end:
+            slot_end = current + timedelta(minutes=slot_min)
+            if not _overlaps(current, slot_end):
+                slots_iso.append(current.isoformat())
+            current += timedelta(minutes=slot_min)
+    return slots_iso
+
+
+def calendario_referencia(start, end, busy_times, duracion_min=60):
+    available_slots = []
+    current_time = start
+    while current_time + timedelta(minutes=duracion_min) <= end:
+        is_free = True
+        slot_end_time = current_time + timedelta(minutes=duracion_min)
+        if not (9 <= current_time.hour < 18):
+            is_free = False
+        if is_free:
+            for event in busy_times:
+                event_start = datetime.fromisoformat(event['start']['dateTime']).astimezone(TZ)
+                event_end = datetime.fromisoformat(event['end']['dateTime']).astimezone(TZ)
+                if max(current_time, event_start) < min(slot_end_time, event_end):
+                    is_free = False
+                    break
+        if is_free:
+            available_slots.append(current_time.isoformat())
+        current_time += timedelta(minutes=30)
+    return available_slots
+
+
+# === Implementaciones con barrido (mismo código que los servicios) ===
+def citas_barrido(ventanas, busy_blocks, slot_min=30):
+    ocupados = Ocupados.desde_iso(busy_blocks, TZ, lambda b: (b['start'], b['end']))
+    paso = timedelta(minutes=slot_min)
+    slots_iso = []
+    for vent in ventanas:
+        v_start = datetime.fromisoformat(vent['start']['dateTime']).astimezone(TZ)
+        v_end = datetime.fromisoformat(vent['end']['dateTime']).astimezone(TZ)
+        slots_iso.extend(s.isoformat() for s in slots_libres(v_start, v_end, paso, paso, ocupados))
+    return slots_iso
+
+
+def calendario_barrido(start, end, busy_times, duracion_min=60):
+    ocupados = Ocupados.desde_iso(busy_times, TZ, lambda e: (e['start']['dateTime'], e['end']['dateTime']))
+    return [s.isoformat() for s in slots_libres(start, end, timedelta(minutes=30), timedelta(minutes=duracion_min),
+                                                ocupados, admitir=lambda dt: 9 <= dt.hour < 18)]
+
+
+def _medir(funcion, repeticiones):
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark de generación de turnos")
+    parser.add_argument('--semanas', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--ocupados-por-dia', type=int, default=12)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'semanas':>8} {'ocupados':>9} {'servicio':>16} {'anterior ms':>12} {'barrido ms':>11} {'x':>6}")
+    for semanas in args.semanas:
+        inicio, fin, ventanas, freebusy, eventos = generar_calendario(semanas * 7, args.ocupados_por_dia)
+        casos = (
+            ('appointments', lambda: citas_referencia(ventanas, freebusy), lambda: citas_barrido(ventanas, freebusy)),
+            ('calendar', lambda: calendario_referencia(inicio, fin, eventos), lambda: calendario_barrido(inicio, fin, eventos)),
+        )
+        for nombre, anterior, barrido in casos:
+            if anterior() != barrido():
+                raise SystemExit(f"❌ Salida distinta en {nombre} ({semanas} semanas)")
+            t_anterior = _medir(anterior, args.repeticiones)
+            t_barrido = _medir(barrido, args.repeticiones)
+            print(f"{semanas:>8} {len(freebusy):>9} {nombre:>16} {t_anterior:>12.1f} {t_barrido:>11.1f} {t_anterior / t_barrido:>6.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Cliente de Google Calendar compartido por proceso.
+
+Antes cada servicio (y cada get_calendar_service()) cargaba las credenciales
+de la cuenta de servicio y armaba el cliente con build(). Acá se arma una vez
+por worker y por (archivo de credenciales, scopes):
+
+- El documento de discovery se guarda en disco (CALENDAR_DISCOVERY_CACHE_PATH)
+  y el cliente se construye con build_from_document, sin ir a la red.
+- httplib2.Http no es thread-safe: cada hilo tiene su AuthorizedHttp (con su
+  conexión keep-alive), todos sobre las mismas credenciales.
+- Un hilo de fondo renueva el token antes de que venza
+  (CALENDAR_TOKEN_REFRESH_MARGIN segundos), así ningún request paga el refresh.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+SCOPES_CALENDAR = ('https://www.googleapis.com/auth/calendar',)
+
+
+class ClienteCalendar:
+    """Cliente de la API armado una vez; credenciales y transporte compartidos."""
+
+    def __init__(self, archivo_credenciales, scopes=SCOPES_CALENDAR, ruta_discovery='calendar_v3_discovery.json',
+                 margen_refresh=300.0, timeout=30):
+        self.archivo_credenciales = archivo_credenciales
+        self.scopes = tuple(scopes)
+        self.ruta_discovery = ruta_discovery
+        self.margen_refresh = float(margen_refresh)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock_refresh = threading.Lock()
+        self._hilo_refresh = None
+        self._stats = {'discovery_origen': None, 'refrescos_token': 0, 'errores_refresh': 0,
+                       'transportes_creados': 0, 'construido_en': None}
+        self.credenciales = self._cargar_credenciales()
+        self.service = self._construir()
+        self._stats['construido_en'] = time.time()
+        self._iniciar_refresco()
+
+    def _cargar_credenciales(self):
+        from google.oauth2 import service_account
+        return service_account.Credentials.from_service_account_file(self.archivo_credenciales, scopes=list(self.scopes))
+
+    # --- Discovery ---
+    def _documento_discovery(self):
+        """Discovery de calendar v3: caché en disco, luego el que trae la librería, por último la red."""
+        if self.ruta_discovery and os.path.exists(self.ruta_discovery):
+            try:
+                with open(self.ruta_discovery, 'r', encoding='utf-8') as f:
+                    documento = f.read()
+                json.loads(documento)
+                self._stats['discovery_origen'] = 'disco'
+                return documento
+            except (OSError, ValueError) as e:
+                logger.warning(f"[GCAL_CLIENTE] Discovery en caché ilegible ({self.ruta_discovery}), se descarta: {e}")
+        documento = None
+        try:
+            from googleapiclient.discovery_cache import get_static_doc
+            documento = get_static_doc('calendar', 'v3')
+            self._stats['discovery_origen'] = 'libreria'
+        except ImportError:
+            pass
+        if not documento:
+            from googleapiclient.discovery import build
+            documento = json.dumps(build('calendar', 'v3', credentials=self.credenciales)._rootDesc)
+            self._stats['discovery_origen'] = 'red'
+        self._guardar_discovery(documento)
+        return documento
+
+    def _guardar_discovery(self, documento):
+        if not self.ruta_discovery:
+            return
+        try:
+            temporal = f"{self.ruta_discovery}.tmp"
+            with open(temporal, 'w', encoding='utf-8') as f:
+                f.write(documento)
+            os.replace(temporal, self.ruta_discovery)
+        except OSError as e:
+            logger.warning(f"[GCAL_CLIENTE] No se pudo guardar el discovery en {self.ruta_discovery}: {e}")
+
+    # --- Transporte ---
+    def _http(self):
+        """AuthorizedHttp del hilo actual (httplib2.Http no se comparte entre hilos)."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import google_auth_httplib2
+            import httplib2
+            http = self._local.http = google_auth_httplib2.AuthorizedHttp(
+                self.credenciales, http=httplib2.Http(timeout=self.timeout))
+            self._stats['transportes_creados'] += 1
+        return http
+
+    def _construir(self):
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.http import HttpRequest
+
+        def _request(_http, *args, **kwargs):
+            return HttpRequest(self._http(), *args, **kwargs)
+
+        return build_from_document(self._documento_discovery(), http=self._http(), requestBuilder=_request)
+
+    # --- Refresco de token ---
+    def _vence_en(self):
+        expiry = getattr(self.credenciales, 'expiry', None)
+        if not expiry or not self.credenciales.token:
+            return 0.0
+        # google-auth guarda expiry como datetime UTC naive
+        return (expiry.replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+
+    def refrescar_token(self):
+        from google.auth.transport.requests import Request
+        with self._lock_refresh:
+            self.credenciales.refresh(Request())
+            self._stats['refrescos_token'] += 1
+        logger.debug(f"[GCAL_CLIENTE] Token renovado, vence en {self._vence_en():.0f}s")
+
+    def _iniciar_refresco(self):
+        if self.margen_refresh <= 0:
+            return
+        self._hilo_refresh = threading.Thread(target=self._bucle_refresco, name='gcal_token_refresh', daemon=True)
+        self._hilo_refresh.start()
+
+    def _bucle_refresco(self):
+        while True:
+            try:
+                if self._vence_en() <= self.margen_refresh:
+                    self.refrescar_token()
+                espera = max(30.0, self._vence_en() - self.margen_refresh)
+            except Exception as e:
+                self._stats['errores_refresh'] += 1
+                logger.warning(f"[GCAL_CLIENTE] Error renovando token de Google, reintento en 60s: {e}")
+                espera = 60.0
+            time.sleep(espera)
+
+    def get_stats(self):
+        return {
+            'archivo_credenciales': os.path.basename(self.archivo_credenciales or ''),
+            'scopes': list(self.scopes),
+            'token_vence_en_segundos': round(self._vence_en(), 1),
+            'refresco_activo': self._hilo_refresh is not None,
+            **self._stats,
+        }
+
+
+_clientes = {}
+_clientes_lock = threading.Lock()
+
+
+def obtener_cliente_calendar(archivo_credenciales=None, scopes=SCOPES_CALENDAR):
+    """Service de calendar v3 compartido por el proceso; se construye la primera vez."""
+    archivo_credenciales = archivo_credenciales or config.GOOGLE_SERVICE_ACCOUNT_FILE
+    llave = (archivo_credenciales, tuple(scopes))
+    with _clientes_lock:
+        cliente = _clientes.get(llave)
+        if cliente is None:
+            inicio = time.monotonic()
+            cliente = _clientes[llave] = ClienteCalendar(
+                archivo_credenciales, scopes,
+                ruta_discovery=getattr(config, 'CALENDAR_DISCOVERY_CACHE_PATH', 'calendar_v3_discovery.json'),
+                margen_refresh=getattr(config, 'CALENDAR_TOKEN_REFRESH_MARGIN', 300),
+            )
+            logger.info(f"[GCAL_CLIENTE] Cliente de Google Calendar construido en {(time.monotonic() - inicio) * 1000:.0f}ms "
+                        f"(discovery: {cliente.get_stats()['discovery_origen']})")
+        return cliente.service
+
+
+def get_client_stats() -> dict:
+    with _clientes_lock:
+        clientes = list(_clientes.values())
+    return {'clientes': [cliente.get_stats() for cliente in clientes]}
@@ -0,0 +1,345 @@
+"""
+Espejo en memoria de calendarios de Google, sincronizado con syncToken.
+
+Antes cada búsqueda de turnos listaba el calendario de ventanas y consultaba
+freebusy para el rango. Ahora cada proceso mantiene, por calendario, una copia
+de los eventos con horario (inicio, fin, transparencia):
+
+- Sync completo inicial (desde ayer hasta hoy + AVAILABILITY_PREFETCH_DAYS +
+  un margen) y después incrementales con el nextSyncToken, en un hilo de fondo
+  cada CALENDAR_SYNC_INTERVAL segundos. Cuando el margen se consume, o se
+  consulta un rango más allá del horizonte, se rehace el completo.
+- Un 410 (token vencido) descarta la copia y rehace el sync completo.
+- Los turnos se calculan leyendo solo del espejo; las escrituras propias
+  (crear/reprogramar/cancelar) se aplican al espejo en el momento.
+- Cuando un sync trae cambios, `al_cambiar(fechas)` avisa qué días locales
+  cambiaron (el servicio invalida el índice de disponibilidad).
+
+FakeEventsAPI reproduce la semántica de events.list con syncToken (páginas,
+eventos cancelados, 410) para probar sin Google.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+
+class SyncTokenExpirado(Exception):
+    """El servidor respondió 410 Gone: hay que rehacer el sync completo."""
+
+
+class GoogleEventsAPI:
+    """Adaptador mínimo sobre el cliente de googleapiclient: solo events.list."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def listar(self, calendar_id: str, **params) -> dict:
+        from googleapiclient.errors import HttpError
+        try:
+            return self.service.events().list(calendarId=calendar_id, **params).execute()
+        except HttpError as e:
+            if getattr(e, 'resp', None) is not None and e.resp.status == 410:
+                raise SyncTokenExpirado(str(e)) from e
+            raise
+
+
+class FakeEventsAPI:
+    """
+    Calendario falso con la semántica de syncToken de Google:
+    `insertar/actualizar/borrar` generan cambios; `listar` sin token devuelve todo
+    (paginado) y un nextSyncToken; con token devuelve solo lo cambiado desde ese
+    token, incluyendo borrados con status 'cancelled'. `expirar_tokens()` hace que
+    el próximo incremental falle con SyncTokenExpirado.
+    """
+
+    def __init__(self, tam_pagina: int = 50):
+        self.tam_pagina = tam_pagina
+        self._version = 0
+        self._eventos = {}          # calendar_id -> {event_id: (version, evento)}
+        self._token_minimo = 0
+        self.llamadas = 0
+
+    def _guardar(self, calendar_id, evento):
+        self._version += 1
+        self._eventos.setdefault(calendar_id, {})[evento['id']] = (self._version, dict(evento))
+
+    def insertar(self, calendar_id: str, evento: dict):
+        self._guardar(calendar_id, dict(evento, status='confirmed'))
+
+    actualizar = insertar
+
+    def borrar(self, calendar_id: str, event_id: str):
+        self._guardar(calendar_id, {'id': event_id, 'status': 'cancelled'})
+
+    def expirar_tokens(self):
+        self._token_minimo = self._version + 1
+
+    @staticmethod
+    def _en_rango(evento, time_min, time_max):
+        # Como Google: timeMin acota el fin del evento y timeMax su inicio (ambos exclusivos)
+        inicio = (evento.get('start') or {}).get('dateTime')
+        fin = (evento.get('end') or {}).get('dateTime')
+        if time_min and fin and datetime.fromisoformat(fin) <= datetime.fromisoformat(time_min):
+            return False
+        if time_max and inicio and datetime.fromisoformat(inicio) >= datetime.fromisoformat(time_max):
+            return False
+        return True
+
+    def listar(self, calendar_id: str, **params) -> dict:
+        self.llamadas += 1
+        token = params.get('syncToken')
+        desde = 0
+        if token is not None:
+            desde = int(token)
+            if desde < self._token_minimo:
+                raise SyncTokenExpirado('410 Gone')
+        cambios = sorted((v, e) for v, e in self._eventos.get(calendar_id, {}).values() if v > desde)
+        if token is None:
+            cambios = [(v, e) for v, e in cambios
+                       if e.get('status') != 'cancelled' and self._en_rango(e, params.get('timeMin'), params.get('timeMax'))]
+        inicio = int(params.get('pageToken') or 0)
+        pagina = [e for _, e in cambios[inicio:inicio + self.tam_pagina]]
+        respuesta = {'items': pagina}
+        if inicio + self.tam_pagina < len(cambios):
+            respuesta['nextPageToken'] = str(inicio + self.tam_pagina)
+        else:
+            respuesta['nextSyncToken'] = str(self._version)
+        return respuesta
+
+
+class CalendarMirror:
+    """Copia incremental de los eventos con horario de un calendario."""
+
+    def __init__(self, api, calendar_id: str, timezone, logger=None, intervalo_sync: float = 30.0,
+                 dias_pasados: int = 1, dias_futuros: int = 7, dias_margen: int = 7, al_cambiar=None,
+                 iniciar_hilo: bool = True):
+        self.api = api
+        self.calendar_id = calendar_id
+        self.timezone = timezone
+        self.logger = logger or logging.getLogger(__name__)
+        self.intervalo_sync = float(intervalo_sync)
+        self.dias_pasados = int(dias_pasados)
+        self.dias_futuros = max(0, int(dias_futuros))
+        self.dias_margen = max(1, int(dias_margen))
+        self.al_cambiar = al_cambiar
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._eventos = {}          # event_id -> (inicio, fin, transparente)
+        self._orden = []            # [(inicio, fin, event_id)] ordenado por inicio
+        self._sync_token = None
+        self._horizonte = None      # timeMax del último sync completo: más allá el espejo no sabe nada
+        self._ultimo_sync = None
+        self._stats = {'sync_completos': 0, 'sync_incrementales': 0, 'resync_410': 0, 'errores': 0,
+                       'cambios_aplicados': 0}
+        self._hilo = None
+        if iniciar_hilo:
+            self._hilo = threading.Thread(target=self._bucle, name=f"espejo_cal_{calendar_id[:12]}", daemon=True)
+            self._hilo.start()
+
+    # --- Sincronización ---
+    def _bucle(self):
+        while True:
+            try:
+                self.sincronizar()
+            except Exception as e:
+                self.logger.error(f"[ESPEJO_CAL] Error sincronizando {self.calendar_id}: {e}")
+            time.sleep(self.intervalo_sync)
+
+    def listo(self) -> bool:
+        return self._sync_token is not None
+
+    def _hoy(self) -> datetime:
+        return datetime.now(self.timezone).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def _cubre(self, hasta: datetime) -> bool:
+        return self._horizonte is not None and hasta <= self._horizonte
+
+    def sincronizar(self, hasta: datetime = None):
+        """
+        Incremental si hay token; completo si no lo hay, el token venció (410) o el horizonte
+        ya no cubre los próximos dias_futuros días (o `hasta`, si se pide un rango más lejano).
+        """
+        with self._sync_lock:
+            try:
+                necesario = self._hoy() + timedelta(days=self.dias_futuros + 1)
+                if hasta is not None and hasta > necesario:
+                    necesario = hasta
+                if self._sync_token is None or not self._cubre(necesario):
+                    self._sync_completo(necesario)
+                else:
+                    try:
+                        self._sync_incremental()
+                    except SyncTokenExpirado:
+                        self._stats['resync_410'] += 1
+                        self.logger.warning(f"[ESPEJO_CAL] syncToken vencido (410) en {self.calendar_id}: sync completo")
+                        self._sync_completo(necesario)
+            except Exception:
+                self._stats['errores'] += 1
+                raise
+            self._ultimo_sync = time.time()
+            self._podar()
+
+    def _paginar(self, **params):
+        items, page_token = [], None
+        while True:
+            respuesta = self.api.listar(self.calendar_id, pageToken=page_token, **params) if page_token \
+                else self.api.listar(self.calendar_id, **params)
+            items.extend(respuesta.get('items', []))
+            page_token = respuesta.get('nextPageToken')
+            if not page_token:
+                return items, respuesta.get('nextSyncToken')
+
+    def _sync_completo(self, necesario: datetime):
+        # Acotado: singleEvents expande las recurrencias y sin timeMax traería años de instancias
+        desde = (datetime.now(self.timezone) - timedelta(days=self.dias_pasados)).isoformat()
+        horizonte = necesario + timedelta(days=self.dias_margen)
+        items, token = self._paginar(singleEvents=True, timeMin=desde, timeMax=horizonte.isoformat())
+        nuevos = {}
+        for item in items:
+            parsed = self._parsear(item)
+            if parsed:
+                nuevos[item['id']] = parsed
+        with self._lock:
+            anteriores = self._eventos
+            self._eventos = nuevos
+            self._orden = sorted((i, f, ev_id) for ev_id, (i, f, _) in nuevos.items())
+            self._sync_token = token
+            self._horizonte = horizonte
+            self._stats['sync_completos'] += 1
+        cambiados = {ev for ev in set(anteriores) | set(nuevos) if anteriores.get(ev) != nuevos.get(ev)}
+        self.logger.info(f"[ESPEJO_CAL] Sync completo de {self.calendar_id}: {len(nuevos)} eventos")
+        if anteriores:
+            self._notificar([anteriores.get(ev) for ev in cambiados] + [nuevos.get(ev) for ev in cambiados])
+
+    def _sync_incremental(self):
+        items, token = self._paginar(singleEvents=True, syncToken=self._sync_token)
+        with self._lock:
+            self._stats['sync_incrementales'] += 1
+            afectados = [self._aplicar(item) for item in items]
+            self._sync_token = token or self._sync_token
+        if items:
+            self.logger.debug(f"[ESPEJO_CAL] {len(items)} cambios en {self.calendar_id}")
+            self._notificar([par for pares in afectados for par in pares])
+
+    # --- Aplicación de cambios ---
+    def _parsear(self, item):
+        """(inicio, fin, transparente) para eventos confirmados con horario; None si no aplica."""
+        if item.get('status') == 'cancelled':
+            return None
+        inicio = (item.get('start') or {}).get('dateTime')
+        fin = (item.get('end') or {}).get('dateTime')
+        if not inicio or not fin:
+            return None  # eventos de día completo: no bloquean turnos (igual que antes)
+        try:
+            return (datetime.fromisoformat(inicio).astimezone(self.timezone),
+                    datetime.fromisoformat(fin).astimezone(self.timezone),
+                    item.get('transparency') == 'transparent')
+        except (TypeError, ValueError) as e:
+            self.logger.warning(f"[ESPEJO_CAL] Evento {item.get('id')} con fechas inválidas: {e}")
+            return None
+
+    def _aplicar(self, item):
+        """Aplica un evento (nuevo, modificado o cancelado). Retorna (anterior, nuevo). Requiere _lock."""
+        ev_id = item.get('id')
+        if not ev_id:
+            return (None, None)
+        anterior = self._eventos.pop(ev_id, None)
+        if anterior:
+            posicion = bisect_left(self._orden, (anterior[0], anterior[1], ev_id))
+            if posicion < len(self._orden) and self._orden[posicion][2] == ev_id:
+                del self._orden[posicion]
+        nuevo = self._parsear(item)
+        if nuevo:
+            self._eventos[ev_id] = nuevo
+            insort(self._orden, (nuevo[0], nuevo[1], ev_id))
+        self._stats['cambios_aplicados'] += 1
+        return (anterior, nuevo)
+
+    def aplicar_escritura(self, item: dict):
+        """Refleja en el momento un evento que este proceso creó o modificó (respuesta de insert/update)."""
+        with self._lock:
+            anterior, nuevo = self._aplicar(item)
+        self._notificar([anterior, nuevo])
+
+    def quitar(self, event_id: str):
+        """Refleja en el momento la cancelación de un evento propio."""
+        self.aplicar_escritura({'id': event_id, 'status': 'cancelled'})
+
+    def _podar(self):
+        limite = datetime.now(self.timezone) - timedelta(days=self.dias_pasados)
+        with self._lock:
+            viejos = [ev_id for ev_id, (_, fin, _) in self._eventos.items() if fin < limite]
+            for ev_id in viejos:
+                self._aplicar({'id': ev_id, 'status': 'cancelled'})
+
+    def _notificar(self, intervalos):
+        if not self.al_cambiar:
+            return
+        fechas = set()
+        for par in intervalos:
+            if par:
+                dia = par[0].date()
+                while dia <= par[1].date():
+                    fechas.add(dia.isoformat())
+                    dia += timedelta(days=1)
+        if fechas:
+            try:
+                self.al_cambiar(fechas)
+            except Exception as e:
+                self.logger.warning(f"[ESPEJO_CAL] Error notificando cambios de {self.calendar_id}: {e}")
+
+    # --- Lecturas ---
+    def intervalos(self, desde: datetime, hasta: datetime, solo_opacos: bool = False) -> list:
+        """Eventos que se solapan con [desde, hasta) como (inicio, fin), ordenados por inicio."""
+        if not self.listo() or not self._cubre(hasta):
+            self.sincronizar(hasta)
+        with self._lock:
+            tope = bisect_left(self._orden, (hasta,))
+            resultado = []
+            for inicio, fin, ev_id in self._orden[:tope]:
+                if fin <= desde:
+                    continue
+                if solo_opacos and self._eventos[ev_id][2]:
+                    continue
+                resultado.append((inicio, fin))
+            return resultado
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'calendar_id': self.calendar_id,
+                'eventos': len(self._eventos),
+                'listo': self.listo(),
+                'horizonte': self._horizonte.isoformat() if self._horizonte else None,
+                'ultimo_sync': datetime.fromtimestamp(self._ultimo_sync).isoformat() if self._ultimo_sync else None,
+                'intervalo_sync_segundos': self.intervalo_sync,
+                **self._stats,
+            }
+
+
+# --- Registro por proceso: un espejo por calendario ---
+_espejos = {}
+_espejos_lock = threading.Lock()
+
+
+def obtener_espejo(service, calendar_id: str, timezone, logger=None, al_cambiar=None) -> CalendarMirror:
+    """Espejo compartido del calendario; lo crea (y arranca su hilo) la primera vez."""
+    with _espejos_lock:
+        espejo = _espejos.get(calendar_id)
+        if espejo is None:
+            import config
+            espejo = _espejos[calendar_id] = CalendarMirror(
+                GoogleEventsAPI(service), calendar_id, timezone, logger=logger,
+                intervalo_sync=getattr(config, 'CALENDAR_SYNC_INTERVAL', 30),
+                dias_futuros=getattr(config, 'AVAILABILITY_PREFETCH_DAYS', 7), al_cambiar=al_cambiar,
+            )
+        return espejo
+
+
+def get_mirror_stats() -> dict:
+    with _espejos_lock:
+        espejos = list(_espejos.values())
+    return {espejo.calendar_id: espejo.get_stats() for espejo in espejos}
@@ -1,11 +1,11 @@
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 import pytz
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 import config
+from calendar_services.cliente_google import obtener_cliente_calendar
+from calendar_services.intervalos import Ocupados, slots_libres
+from calendar_services.espejo_calendario import obtener_espejo
 
 
 class GoogleAppointmentsService:
@@ -13,7 +13,8 @@ class GoogleAppointmentsService:
     Provider de "Citas" sobre Google Calendar.
     - Lee ventanas de atención desde un calendario (GOOGLE_APPOINTMENTS_CALENDAR_ID)
     - Genera slots de tamaño fijo (APPOINTMENTS_SLOT_MINUTES)
-    - Filtra con free/busy del calendario principal (GOOGLE_CALENDAR_ID)
+    - Filtra con lo ocupado (eventos opacos) del calendario principal (GOOGLE_CALENDAR_ID)
+    - Ambos calendarios se leen de un espejo incremental (espejo_calendario), no de la API
     - Crea eventos en el calendario principal con placeholders de identidad
     """
 
@@ -28,45 +29,17 @@ class GoogleAppointmentsService:
 
     def _get_calendar_service(self):
         try:
-            creds = service_account.Credentials.from_service_account_file(
-                config.GOOGLE_SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/calendar']
-            )
-            return build('calendar', 'v3', credentials=creds)
+            # Cliente compartido por el worker (discovery en caché, token renovado en segundo plano)
+            return obtener_cliente_calendar(config.GOOGLE_SERVICE_ACCOUNT_FILE)
         except Exception as e:
             self.logger.critical(f"[APPTS] Error inicializando Google API: {e}", exc_info=True)
             return None
 
     # --- Utilidades internas ---
-    def _list_events(self, calendar_id: str, time_min_iso: str, time_max_iso: str) -> list:
-        if not self.service:
-            return []
-        try:
-            items = self.service.events().list(
-                calendarId=calendar_id,
-                timeMin=time_min_iso,
-                timeMax=time_max_iso,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute().get('items', [])
-            return items
-        except HttpError as e:
-            self.logger.error(f"[APPTS] Error listando eventos en {calendar_id}: {e}")
-            return []
-
-    def _freebusy(self, time_min_iso: str, time_max_iso: str) -> list:
-        if not self.service:
-            return []
-        try:
-            body = {
-                "timeMin": time_min_iso,
-                "timeMax": time_max_iso,
-                "items": [{"id": self.MAIN_CAL_ID}],
-            }
-            resp = self.service.freebusy().query(body=body).execute()
-            return resp.get('calendars', {}).get(self.MAIN_CAL_ID, {}).get('busy', [])
-        except HttpError as e:
-            self.logger.error(f"[APPTS] Error en freebusy: {e}")
-            return []
+    def _espejo(self, calendar_id: str):
+        """Espejo incremental (syncToken) del calendario; las lecturas no van a Google."""
+        return obtener_espejo(self.service, calendar_id, self.TIMEZONE, logger=self.logger,
+                              al_cambiar=lambda fechas: self._invalidar_disponibilidad(*fechas))
 
     # --- API esperada por el handler ---
     def get_available_slots(self, date_range: tuple, time_preference: str | None = None) -> list:
@@ -77,49 +50,36 @@ class GoogleAppointmentsService:
         end_dt = end_dt.astimezone(self.TIMEZONE)
         self.logger.info(f"[APPTS] Generando slots {start_dt} -> {end_dt} (slot={self.SLOT_MIN}m)")
 
-        # 1) Ventanas de atención (calendario de ventanas)
-        ventanas = self._list_events(self.WINDOWS_CAL_ID, start_dt.isoformat(), end_dt.isoformat())
-        if not ventanas:
-            self.logger.warning("[APPTS] Sin ventanas de atención configuradas en el rango solicitado")
+        try:
+            # 1) Ventanas de atención (calendario de ventanas)
+            ventanas = self._espejo(self.WINDOWS_CAL_ID).intervalos(start_dt, end_dt)
+            if not ventanas:
+                self.logger.warning("[APPTS] Sin ventanas de atención configuradas en el rango solicitado")
+                return []
+
+            # 2) Ocupado del calendario principal (como freebusy: sin eventos transparentes)
+            ocupados = Ocupados(self._espejo(self.MAIN_CAL_ID).intervalos(start_dt, end_dt, solo_opacos=True))
+        except Exception as e:
+            self.logger.error(f"[APPTS] Error leyendo el espejo de calendarios: {e}")
             return []
-
-        # 2) Busy principal para evitar choques
-        busy_blocks = self._freebusy(start_dt.isoformat(), end_dt.isoformat())
-
-        def _overlaps(slot_start: datetime, slot_end: datetime) -> bool:
-            for b in busy_blocks:
-                try:
-                    b_start = datetime.fromisoformat(b['start']).astimezone(self.TIMEZONE)
-                    b_end = datetime.fromisoformat(b['end']).astimezone(self.TIMEZONE)
-                    if max(slot_start, b_start) < min(slot_end, b_end):
-                        return True
-                except Exception:
-                    continue
-            return False
+        paso = timedelta(minutes=self.SLOT_MIN)
 
         slots_iso: list[str] = []
-        for vent in ventanas:
-            try:
-                v_start_raw = vent.get('start', {}).get('dateTime')
-                v_end_raw = vent.get('end', {}).get('dateTime')
-                if not v_start_raw or not v_end_raw:
-                    continue
-                v_start = datetime.fromisoformat(v_start_raw).astimezone(self.TIMEZONE)
-                v_end = datetime.fromisoformat(v_end_raw).astimezone(self.TIMEZONE)
-                # Cortar la ventana en slots regulares
-                current = v_start
-                while current + timedelta(minutes=self.SLOT_MIN) <= v_end:
-                    slot_end = current + timedelta(minutes=self.SLOT_MIN)
-                    if not _overlaps(current, slot_end):
-                        slots_iso.append(current.isoformat())
-                    current += timedelta(minutes=self.SLOT_MIN)
-            except Exception as e:
-                self.logger.warning(f"[APPTS] Error procesando ventana: {e}")
-                continue
+        for v_start, v_end in ventanas:
+            # Cortar la ventana en slots regulares (barrido contra los ocupados)
+            slots_iso.extend(s.isoformat() for s in slots_libres(v_start, v_end, paso, paso, ocupados))
 
         self.logger.info(f"[APPTS] Slots disponibles generados: {len(slots_iso)}")
         return slots_iso
 
+    def _invalidar_disponibilidad(self, *fechas_iso):
+        """Invalida el índice global de disponibilidad (utils) para los días tocados; sin fechas, todo el calendario."""
+        try:
+            import utils
+            utils.invalidar_disponibilidad(self, fechas_iso)
+        except Exception as e:
+            self.logger.warning(f"[APPTS] No se pudo invalidar el índice de disponibilidad: {e}")
+
     def create_event(self, client_name: str, slot: dict) -> str | None:
         if not self.service:
             return None
@@ -134,6 +94,8 @@ class GoogleAppointmentsService:
                 'end': {'dateTime': end_time, 'timeZone': str(self.TIMEZONE)},
             }
             created = self.service.events().insert(calendarId=self.MAIN_CAL_ID, body=event).execute()
+            self._espejo(self.MAIN_CAL_ID).aplicar_escritura(created)
+            self._invalidar_disponibilidad(start_time)
             return created.get('id')
         except Exception as e:
             self.logger.error(f"[APPTS] Error creando evento: {e}")
@@ -144,9 +106,12 @@ class GoogleAppointmentsService:
             return False
         try:
             ev = self.service.events().get(calendarId=self.MAIN_CAL_ID, eventId=event_id).execute()
+            fecha_anterior = ev.get('start', {}).get('dateTime')
             ev['start']['dateTime'] = new_slot['start_time']
             ev['end']['dateTime'] = new_slot['end_time']
-            self.service.events().update(calendarId=self.MAIN_CAL_ID, eventId=event_id, body=ev).execute()
+            actualizado = self.service.events().update(calendarId=self.MAIN_CAL_ID, eventId=event_id, body=ev).execute()
+            self._espejo(self.MAIN_CAL_ID).aplicar_escritura(actualizado)
+            self._invalidar_disponibilidad(fecha_anterior, new_slot['start_time'])
             return True
         except Exception as e:
             self.logger.error(f"[APPTS] Error reprogramando evento: {e}")
@@ -157,6 +122,8 @@ class GoogleAppointmentsService:
             return False
         try:
             self.service.events().delete(calendarId=self.MAIN_CAL_ID, eventId=event_id).execute()
+            self._espejo(self.MAIN_CAL_ID).quitar(event_id)
+            self._invalidar_disponibilidad()
             return True
         except Exception as e:
             self.logger.error(f"[APPTS] Error cancelando evento: {e}")
@@ -2,11 +2,12 @@ import logging
 import os
 from datetime import datetime, timedelta
 import pytz
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 import config
+from calendar_services.cliente_google import obtener_cliente_calendar
+from calendar_services.intervalos import Ocupados, slots_libres
+from calendar_services.espejo_calendario import obtener_espejo
 # from interfaces.calendar_interface import CalendarInterface # Asumiendo que esta interfaz existe
 
 class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
@@ -20,9 +21,8 @@ class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
 
     def _get_calendar_service(self):
         try:
-            creds = service_account.Credentials.from_service_account_file(
-                config.GOOGLE_SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/calendar'])
-            service = build('calendar', 'v3', credentials=creds)
+            # Cliente compartido por el worker (discovery en caché, token renovado en segundo plano)
+            service = obtener_cliente_calendar(config.GOOGLE_SERVICE_ACCOUNT_FILE)
             self.logger.info("Google Calendar conectado.")
             return service
         except Exception as e:
@@ -62,51 +62,41 @@ class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
         self.logger.info(f"[GCAL] Buscando slots entre {start.isoformat()} y {end.isoformat()}")
 
         try:
-            events_result = self.service.events().list(
-                calendarId=self.CALENDAR_ID, timeMin=start.isoformat(), timeMax=end.isoformat(),
-                singleEvents=True, orderBy='startTime'
-            ).execute()
-            busy_times = events_result.get('items', [])
-        except HttpError as e:
+            # Eventos desde el espejo incremental (syncToken): sin llamada a Google por búsqueda
+            ocupados = Ocupados(self._espejo().intervalos(start, end))
+        except Exception as e:
             self.logger.error(f"Error al obtener eventos de Google Calendar: {e}")
             return []
 
-        available_slots = []
         current_time = start
         
         if current_time.minute not in [0, 30]:
             current_time = current_time.replace(second=0, microsecond=0) + timedelta(minutes=(30 - current_time.minute % 30))
 
-        while current_time + timedelta(minutes=self.APPOINTMENT_DURATION_MINUTES) <= end:
-            is_free = True
-            slot_end_time = current_time + timedelta(minutes=self.APPOINTMENT_DURATION_MINUTES)
-            
-            if not (9 <= current_time.hour < 18): is_free = False
-
-            if is_free:
-                for event in busy_times:
-                    try:
-                        start_dt = event['start'].get('dateTime')
-                        end_dt = event['end'].get('dateTime')
-                        
-                        if start_dt and end_dt:
-                            event_start = datetime.fromisoformat(start_dt).astimezone(self.TIMEZONE)
-                            event_end = datetime.fromisoformat(end_dt).astimezone(self.TIMEZONE)
-                            if max(current_time, event_start) < min(slot_end_time, event_end):
-                                is_free = False
-                                break
-                        else:
-                            self.logger.warning(f"[GCAL] Evento sin fechas válidas: {event}")
-                    except (ValueError, TypeError) as e:
-                        self.logger.warning(f"[GCAL] Error parseando fechas del evento: {e}")
-                        continue
-            
-            if is_free: available_slots.append(current_time.isoformat())
-            current_time += timedelta(minutes=30)
+        # Barrido lineal contra los eventos ya ordenados y fusionados
+        available_slots = [
+            slot.isoformat() for slot in slots_libres(
+                current_time, end, timedelta(minutes=30), timedelta(minutes=self.APPOINTMENT_DURATION_MINUTES),
+                ocupados, admitir=lambda dt: 9 <= dt.hour < 18
+            )
+        ]
 
         self.logger.info(f"[GCAL] Encontrados {len(available_slots)} slots disponibles.")
         return available_slots
 
+    def _espejo(self):
+        """Espejo incremental (syncToken) del calendario; las lecturas no van a Google."""
+        return obtener_espejo(self.service, self.CALENDAR_ID, self.TIMEZONE, logger=self.logger,
+                              al_cambiar=lambda fechas: self._invalidar_disponibilidad(*fechas))
+
+    def _invalidar_disponibilidad(self, *fechas_iso):
+        """Invalida el índice global de disponibilidad (utils) para los días tocados; sin fechas, todo el calendario."""
+        try:
+            import utils
+            utils.invalidar_disponibilidad(self, fechas_iso)
+        except Exception as e:
+            self.logger.warning(f"[GCAL] No se pudo invalidar el índice de disponibilidad: {e}")
+
     def create_event(self, client_name: str, slot: dict) -> str:
         """
         Crea un evento en Google Calendar.
@@ -130,6 +120,8 @@ class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
             
             event = self.service.events().insert(calendarId=self.CALENDAR_ID, body=event).execute()
             self.logger.info(f"Evento creado: {event.get('id')}")
+            self._espejo().aplicar_escritura(event)
+            self._invalidar_disponibilidad(slot['start_time'])
             return event.get('id')
             
         except Exception as e:
@@ -145,6 +137,7 @@ class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
             
         try:
             event = self.service.events().get(calendarId=self.CALENDAR_ID, eventId=event_id).execute()
+            fecha_anterior = event.get('start', {}).get('dateTime')
             
             event['start']['dateTime'] = new_slot['start_time']
             event['end']['dateTime'] = new_slot['end_time']
@@ -154,6 +147,8 @@ class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
             ).execute()
             
             self.logger.info(f"Evento reprogramado: {event_id}")
+            self._espejo().aplicar_escritura(updated_event)
+            self._invalidar_disponibilidad(fecha_anterior, new_slot['start_time'])
             return True
             
         except Exception as e:
@@ -170,6 +165,8 @@ class GoogleCalendarService(): # class GoogleCalendarService(CalendarInterface):
         try:
             self.service.events().delete(calendarId=self.CALENDAR_ID, eventId=event_id).execute()
             self.logger.info(f"Evento cancelado: {event_id}")
+            self._espejo().quitar(event_id)
+            self._invalidar_disponibilidad()
             return True
             
         except Exception as e:
@@ -1,9 +1,15 @@
-import requests
 import json
 import os
 import logging
 from datetime import datetime
 import time
+import random
+import socket
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread, Timer, local
+import http_transport
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +65,184 @@ def _format_bot_message_for_chatwoot(original: str) -> str:
 
     return f"{BOT_ICON} {bold_label}: {bold_text}"
 
+# Rechazos de Chatwoot que reintentar no arregla (contenido o datos inválidos). 401/403/404/408/429
+# y 5xx no entran: dependen de la configuración, de la conversación o del estado del servidor.
+ESTADOS_RECHAZO_PERMANENTE = {400, 413, 422}
+
+
+class ChatwootIdCache:
+    """
+    Cache acotado teléfono -> (contact_id, source_id, conversation_id).
+
+    Dos niveles: LRU en memoria con TTL y una tabla SQLite local que sobrevive a
+    reinicios y comparten los workers del mismo host. Un miss completo cuesta
+    2-4 llamadas a la API de Chatwoot (contacts/search, conversations x2).
+    """
+
+    def __init__(self, max_entradas=2000, ttl=21600, ruta=None):
+        self.max_entradas = max(1, int(max_entradas))
+        self.ttl = float(ttl)
+        self.ruta = ruta
+        self._lock = Lock()
+        self._memoria = OrderedDict()   # telefono -> dict(contact_id, source_id, conversation_id, guardado_en)
+        self._stats = {'hits_memoria': 0, 'hits_disco': 0, 'misses': 0, 'expirados': 0,
+                       'invalidaciones': 0, 'desalojos': 0}
+        self._db = None
+        if ruta:
+            try:
+                self._db = sqlite3.connect(ruta, check_same_thread=False, timeout=5)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS ids ("
+                    " telefono TEXT PRIMARY KEY, contact_id INTEGER, source_id TEXT,"
+                    " conversation_id INTEGER, guardado_en REAL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ [CHATWOOT] Cache de IDs sin persistencia ({ruta}): {e}")
+                self._db = None
+
+    def _vigente(self, entrada):
+        return time.time() - entrada['guardado_en'] < self.ttl
+
+    def _recordar(self, telefono, entrada):
+        self._memoria[telefono] = entrada
+        self._memoria.move_to_end(telefono)
+        while len(self._memoria) > self.max_entradas:
+            self._memoria.popitem(last=False)
+            self._stats['desalojos'] += 1
+
+    def _persistir(self, telefono, entrada):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO ids (telefono, contact_id, source_id, conversation_id, guardado_en)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (telefono, entrada['contact_id'], entrada['source_id'], entrada['conversation_id'], entrada['guardado_en'])
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ [CHATWOOT] No se pudo persistir IDs de {telefono}: {e}")
+
+    def _leer_fila(self, telefono):
+        try:
+            fila = self._db.execute(
+                "SELECT contact_id, source_id, conversation_id, guardado_en FROM ids WHERE telefono = ?",
+                (telefono,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ [CHATWOOT] Error leyendo cache de IDs: {e}")
+            return None
+        return dict(zip(('contact_id', 'source_id', 'conversation_id', 'guardado_en'), fila)) if fila else None
+
+    @staticmethod
+    def _misma(fila, entrada):
+        # SQLite puede devolver los IDs con otro tipo (afinidad INTEGER/TEXT): se compara como texto
+        campos = ('contact_id', 'source_id', 'conversation_id', 'guardado_en')
+        return fila is not None and all(str(fila[c]) == str(entrada.get(c)) for c in campos)
+
+    def obtener(self, telefono, contar=True):
+        """
+        Entrada vigente del teléfono o None. contar=False para consultas internas sin afectar el hit rate.
+
+        Con persistencia, la tabla SQLite es la fuente de verdad: un hit en memoria solo vale si la
+        fila compartida sigue igual (otro worker pudo invalidarla al recibir el webhook).
+        """
+        with self._lock:
+            entrada = self._memoria.get(telefono)
+            fila = self._leer_fila(telefono) if self._db is not None else None
+            if entrada is not None:
+                if self._db is not None and not self._misma(fila, entrada):
+                    # Invalidada o reescrita por otro worker: se descarta la copia local
+                    del self._memoria[telefono]
+                    entrada = None
+                elif self._vigente(entrada):
+                    self._memoria.move_to_end(telefono)
+                    self._stats['hits_memoria'] += contar
+                    return dict(entrada)
+                else:
+                    del self._memoria[telefono]
+                    self._stats['expirados'] += contar
+                    entrada = fila = None
+            if fila and entrada is None:
+                if self._vigente(fila):
+                    self._recordar(telefono, fila)
+                    self._stats['hits_disco'] += contar
+                    return dict(fila)
+                self._stats['expirados'] += contar
+            self._stats['misses'] += contar
+            return None
+
+    def guardar_contacto(self, telefono, contact_id, source_id):
+        with self._lock:
+            anterior = self._memoria.get(telefono) or {}
+            # Si cambió el contacto, la conversación cacheada ya no aplica
+            conversation_id = anterior.get('conversation_id') if anterior.get('contact_id') == contact_id else None
+            entrada = {'contact_id': contact_id, 'source_id': source_id,
+                       'conversation_id': conversation_id, 'guardado_en': time.time()}
+            self._recordar(telefono, entrada)
+            self._persistir(telefono, entrada)
+
+    def guardar_conversacion(self, telefono, conversation_id):
+        with self._lock:
+            entrada = self._memoria.get(telefono)
+            if entrada is None:
+                return
+            entrada = dict(entrada, conversation_id=conversation_id, guardado_en=time.time())
+            self._recordar(telefono, entrada)
+            self._persistir(telefono, entrada)
+
+    def invalidar(self, telefono=None, conversation_id=None, solo_conversacion=False):
+        """
+        Descarta la entrada del teléfono y/o la que apunta a conversation_id.
+        Con solo_conversacion=True conserva contacto y source_id.
+        """
+        with self._lock:
+            telefonos = set()
+            if telefono:
+                telefonos.add(telefono)
+            if conversation_id is not None:
+                telefonos.update(t for t, e in self._memoria.items() if str(e.get('conversation_id')) == str(conversation_id))
+                if self._db is not None:
+                    try:
+                        telefonos.update(fila[0] for fila in self._db.execute(
+                            "SELECT telefono FROM ids WHERE conversation_id = ?", (conversation_id,)))
+                    except sqlite3.Error:
+                        pass
+            for t in telefonos:
+                entrada = self._memoria.pop(t, None)
+                if solo_conversacion and entrada:
+                    self._recordar(t, dict(entrada, conversation_id=None))
+            if telefonos:
+                self._stats['invalidaciones'] += len(telefonos)
+                if self._db is not None:
+                    try:
+                        marcas = ','.join('?' * len(telefonos))
+                        if solo_conversacion:
+                            self._db.execute(f"UPDATE ids SET conversation_id = NULL WHERE telefono IN ({marcas})", tuple(telefonos))
+                        else:
+                            self._db.execute(f"DELETE FROM ids WHERE telefono IN ({marcas})", tuple(telefonos))
+                        self._db.commit()
+                    except sqlite3.Error as e:
+                        logger.warning(f"⚠️ [CHATWOOT] Error invalidando cache de IDs: {e}")
+            return len(telefonos)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            entradas = len(self._memoria)
+        consultas = stats['hits_memoria'] + stats['hits_disco'] + stats['misses']
+        return {
+            'entradas_memoria': entradas,
+            'max_entradas': self.max_entradas,
+            'ttl_segundos': self.ttl,
+            'persistente': self._db is not None,
+            'hit_rate': round((stats['hits_memoria'] + stats['hits_disco']) / consultas, 3) if consultas else None,
+            **stats,
+        }
+
+
 class ChatwootIntegration:
     def __init__(self):
         self.enabled = os.getenv('CHATWOOT_ENABLED', 'false').lower() == 'true'
@@ -66,10 +250,14 @@ class ChatwootIntegration:
         self.api_token = os.getenv('CHATWOOT_API_TOKEN', '')
         self.account_id = os.getenv('CHATWOOT_ACCOUNT_ID', '1')
         self.inbox_id = os.getenv('CHATWOOT_INBOX_ID', '2')
+        self._hilo = local()   # estado HTTP de la última petición fallida, por hilo
         
-        # Cache para conversations
-        self.conversation_cache = {}
-        self.contact_cache = {}
+        # Cache acotado y persistente de contact_id / source_id / conversation_id
+        self.ids = ChatwootIdCache(
+            max_entradas=int(os.getenv('CHATWOOT_ID_CACHE_SIZE', '2000')),
+            ttl=float(os.getenv('CHATWOOT_ID_CACHE_TTL', '21600')),
+            ruta=os.getenv('CHATWOOT_ID_CACHE_PATH', 'chatwoot_ids.sqlite3') if self.enabled else None,
+        )
         
         if self.enabled:
             logger.info(f"✅ Chatwoot integración activa")
@@ -91,8 +279,9 @@ class ChatwootIntegration:
         if data:
             logger.debug(f"🔍 [CHATWOOT] Data: {json.dumps(data, indent=2)}")
 
+        self._hilo.ultimo_estado = None
         try:
-            response = requests.request(
+            response = http_transport.transporte.request(
                 method, url, 
                 headers=headers, 
                 json=data, 
@@ -109,6 +298,7 @@ class ChatwootIntegration:
             
             if response.status_code >= 400:
                 logger.error(f"❌ [CHATWOOT] Error: {response.text}")
+                self._hilo.ultimo_estado = response.status_code
                 return None
                 
             return response.json() if response.text else {}
@@ -117,58 +307,80 @@ class ChatwootIntegration:
             logger.error(f"❌ [CHATWOOT] Error en petición: {e}")
             return None
 
+    def fallo_permanente(self):
+        """True si la última petición fallida de este hilo fue un rechazo permanente (4xx de datos, no de conexión ni 5xx)."""
+        return getattr(self._hilo, 'ultimo_estado', None) in ESTADOS_RECHAZO_PERMANENTE
+
+    def resolver_conversacion(self, phone, sender_name="Usuario"):
+        """PASOS 1 y 2: contacto (con source_id) y conversación. Retorna conversation_id o None."""
+        phone_clean = phone.replace('+', '').replace(' ', '').replace('-', '')
+        phone_e164 = f"+{phone_clean}" if not phone_clean.startswith('+') else phone_clean
+        
+        logger.debug(f"📱 Procesando mensaje para: {phone_e164}")
+        
+        cached = self.ids.obtener(phone_clean)
+        if cached and cached.get('conversation_id'):
+            logger.debug(f"📋 Contacto y conversación desde cache: ID {cached['conversation_id']}")
+            return cached['conversation_id']
+        
+        # PASO 1: OBTENER O CREAR CONTACTO Y OBTENER SOURCE_ID
+        contact_id, source_id = self._get_or_create_contact_with_source_id(phone_clean, phone_e164, sender_name)
+        if not contact_id or not source_id:
+            logger.error(f"❌ PASO 1 FALLÓ: No se pudo obtener contact_id o source_id para {phone}")
+            return None
+        
+        logger.debug(f"✅ PASO 1 COMPLETO: Contact ID: {contact_id}, Source ID: {source_id}")
+        
+        # PASO 2: OBTENER O CREAR CONVERSACIÓN
+        conversation_id = self._get_or_create_conversation_with_source_id(phone_clean, contact_id, source_id)
+        if not conversation_id:
+            logger.error(f"❌ PASO 2 FALLÓ: No se pudo crear conversación para {phone}")
+            return None
+        
+        logger.debug(f"✅ PASO 2 COMPLETO: Conversation ID: {conversation_id}")
+        return conversation_id
+
+    def publicar_mensaje(self, conversation_id, message_content, message_type):
+        """PASO 3: publicar el mensaje en una conversación ya resuelta."""
+        # IMPORTANTE: Todos los mensajes van como "incoming"
+        if message_type == 'outgoing':
+            # Formatear SIEMPRE los mensajes del bot para destacarlos en la UI
+            message_content = _format_bot_message_for_chatwoot(message_content)
+        
+        message_data = {
+            'content': message_content,
+            'message_type': 'incoming',  # SIEMPRE incoming según la documentación
+            'private': False
+        }
+        
+        message_response = self._make_request(
+            'POST', 
+            f'conversations/{conversation_id}/messages', 
+            message_data
+        )
+        
+        if message_response:
+            # Solo logear el resultado final exitoso como un único mensaje INFO
+            logger.info(f"✅ [CHATWOOT] Mensaje {'del bot' if message_type == 'outgoing' else 'del usuario'} registrado exitosamente")
+            return True
+        logger.error(f"❌ PASO 3 FALLÓ: Error enviando mensaje a Chatwoot")
+        return False
+
+    def olvidar_conversacion(self, phone):
+        """Descarta contacto/conversación cacheados del teléfono (p. ej. la conversación ya no existe)."""
+        phone_clean = phone.replace('+', '').replace(' ', '').replace('-', '')
+        self.ids.invalidar(telefono=phone_clean)
+
     def log_message_to_chatwoot(self, phone, message_content, message_type, sender_name="Usuario"):
         """Registrar mensaje en Chatwoot siguiendo EXACTAMENTE los 3 pasos"""
         if not self.enabled:
             return False
 
         try:
-            phone_clean = phone.replace('+', '').replace(' ', '').replace('-', '')
-            phone_e164 = f"+{phone_clean}" if not phone_clean.startswith('+') else phone_clean
-            
-            logger.debug(f"📱 Procesando mensaje para: {phone_e164}")
-            
-            # PASO 1: OBTENER O CREAR CONTACTO Y OBTENER SOURCE_ID
-            contact_id, source_id = self._get_or_create_contact_with_source_id(phone_clean, phone_e164, sender_name)
-            if not contact_id or not source_id:
-                logger.error(f"❌ PASO 1 FALLÓ: No se pudo obtener contact_id o source_id para {phone}")
-                return False
-            
-            logger.debug(f"✅ PASO 1 COMPLETO: Contact ID: {contact_id}, Source ID: {source_id}")
-            
-            # PASO 2: OBTENER O CREAR CONVERSACIÓN
-            conversation_id = self._get_or_create_conversation_with_source_id(contact_id, source_id)
+            conversation_id = self.resolver_conversacion(phone, sender_name)
             if not conversation_id:
-                logger.error(f"❌ PASO 2 FALLÓ: No se pudo crear conversación para {phone}")
-                return False
-            
-            logger.debug(f"✅ PASO 2 COMPLETO: Conversation ID: {conversation_id}")
-            
-            # PASO 3: ENVIAR MENSAJE
-            # IMPORTANTE: Todos los mensajes van como "incoming"
-            if message_type == 'outgoing':
-                # Formatear SIEMPRE los mensajes del bot para destacarlos en la UI
-                message_content = _format_bot_message_for_chatwoot(message_content)
-            
-            message_data = {
-                'content': message_content,
-                'message_type': 'incoming',  # SIEMPRE incoming según la documentación
-                'private': False
-            }
-            
-            message_response = self._make_request(
-                'POST', 
-                f'conversations/{conversation_id}/messages', 
-                message_data
-            )
-            
-            if message_response:
-                # Solo logear el resultado final exitoso como un único mensaje INFO
-                logger.info(f"✅ [CHATWOOT] Mensaje {'del bot' if message_type == 'outgoing' else 'del usuario'} registrado exitosamente")
-                return True
-            else:
-                logger.error(f"❌ PASO 3 FALLÓ: Error enviando mensaje a Chatwoot")
                 return False
+            return self.publicar_mensaje(conversation_id, message_content, message_type)
 
         except Exception as e:
             logger.error(f"❌ Error en log_message_to_chatwoot: {e}", exc_info=True)
@@ -177,8 +389,8 @@ class ChatwootIntegration:
     def _get_or_create_contact_with_source_id(self, phone_clean, phone_e164, sender_name):
         """PASO 1: Obtener o crear contacto con inbox_id y obtener source_id"""
         # Verificar cache primero
-        if phone_clean in self.contact_cache:
-            cached = self.contact_cache[phone_clean]
+        cached = self.ids.obtener(phone_clean, contar=False)
+        if cached:
             logger.debug(f"📋 Usando contacto desde cache: ID {cached['contact_id']}")
             return cached['contact_id'], cached['source_id']
         
@@ -206,10 +418,7 @@ class ChatwootIntegration:
                     
                     if source_id:
                         # Guardar en cache y retornar
-                        self.contact_cache[phone_clean] = {
-                            'contact_id': contact_id,
-                            'source_id': source_id
-                        }
+                        self.ids.guardar_contacto(phone_clean, contact_id, source_id)
                         return contact_id, source_id
                     else:
                         logger.warning(f"⚠️ Contacto existe pero sin source_id para inbox {self.inbox_id}")
@@ -255,20 +464,17 @@ class ChatwootIntegration:
             return None, None
         
         # Guardar en cache
-        self.contact_cache[phone_clean] = {
-            'contact_id': contact_id,
-            'source_id': source_id
-        }
+        self.ids.guardar_contacto(phone_clean, contact_id, source_id)
         
         logger.debug(f"✅ Contacto creado exitosamente: ID {contact_id}, Source ID: {source_id}")
         return contact_id, source_id
 
-    def _get_or_create_conversation_with_source_id(self, contact_id, source_id):
+    def _get_or_create_conversation_with_source_id(self, phone_clean, contact_id, source_id):
         """PASO 2: Obtener conversación existente o crear nueva usando source_id"""
         # Verificar cache
-        cache_key = f"{contact_id}_{source_id}"
-        if cache_key in self.conversation_cache:
-            conversation_id = self.conversation_cache[cache_key]
+        cached = self.ids.obtener(phone_clean, contar=False)
+        if cached and cached['contact_id'] == contact_id and cached.get('conversation_id'):
+            conversation_id = cached['conversation_id']
             logger.debug(f"📋 Usando conversación desde cache: ID {conversation_id}")
             return conversation_id
         
@@ -294,7 +500,7 @@ class ChatwootIntegration:
                     logger.debug(f"✅ Conversación existente encontrada: ID {conversation_id}")
                     
                     # Guardar en cache
-                    self.conversation_cache[cache_key] = conversation_id
+                    self.ids.guardar_conversacion(phone_clean, conversation_id)
                     return conversation_id
         
         # SEGUNDO: Si no hay conversación abierta, buscar la más reciente cerrada
@@ -331,7 +537,7 @@ class ChatwootIntegration:
             
             if reopen_response:
                 # Guardar en cache
-                self.conversation_cache[cache_key] = most_recent_conv_id
+                self.ids.guardar_conversacion(phone_clean, most_recent_conv_id)
                 return most_recent_conv_id
         
         # TERCERO: Si no hay ninguna conversación, crear nueva
@@ -358,7 +564,7 @@ class ChatwootIntegration:
         conversation_id = conv_response['id']
         
         # Guardar en cache
-        self.conversation_cache[cache_key] = conversation_id
+        self.ids.guardar_conversacion(phone_clean, conversation_id)
         
         logger.debug(f"✅ Nueva conversación creada: ID {conversation_id}")
         return conversation_id
@@ -366,57 +572,267 @@ class ChatwootIntegration:
 # Instancia global
 chatwoot = ChatwootIntegration()
 
-def log_to_chatwoot(phone, user_message, bot_response, sender_name="Usuario"):
+
+class ChatwootMirror:
+    """
+    Espejado a Chatwoot fuera del camino caliente del turno.
+
+    - Backlog persistente en SQLite: lo que no llegó a Chatwoot sobrevive a un reinicio.
+      El archivo lo comparten los workers de gunicorn: cada fila tiene dueño (host:pid)
+      y un lease que el dueño renueva; un worker solo drena sus filas y reclama
+      (UPDATE atómico) las huérfanas o con lease vencido, así nada se publica dos veces.
+    - Orden por conversación: cada teléfono tiene su cola y a lo sumo un worker drenándola.
+    - Coalescencia: el worker resuelve contacto/conversación una vez y publica seguidos
+      todos los mensajes pendientes (mensaje del usuario + respuesta del bot).
+    - Reintentos con backoff exponencial + jitter; tras varios fallos seguidos la
+      conversación se reprograma más tarde sin perder mensajes. Los fallos de conexión
+      y los 5xx nunca descartan: solo un mensaje rechazado descartar_tras veces con un
+      4xx permanente (ESTADOS_RECHAZO_PERMANENTE) sale del backlog.
+    """
+
+    def __init__(self, cliente, max_workers=4, max_reintentos=4, backoff_base=1.0, backoff_max=60.0,
+                 descartar_tras=3, ruta_backlog='chatwoot_backlog.sqlite3', lease=60.0):
+        self.cliente = cliente
+        self.max_reintentos = max(0, int(max_reintentos))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.descartar_tras = max(1, int(descartar_tras))
+        self.ruta_backlog = ruta_backlog
+        self.lease = float(lease)
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix='chatwoot_espejo')
+        self._lock = Lock()
+        self._colas = {}        # telefono -> deque de (id, contenido, tipo, remitente, rechazos, encolado_en)
+        self._activos = set()
+        self._latencias_ms = deque(maxlen=1000)
+        self._stats = {'encolados': 0, 'publicados': 0, 'fallos': 0, 'reprogramados': 0, 'descartados': 0,
+                       'lotes': 0, 'reclamados': 0}
+        self._db = None
+        if self.cliente.enabled:
+            self._db = sqlite3.connect(ruta_backlog, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS backlog ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, telefono TEXT, contenido TEXT, tipo TEXT,"
+                " remitente TEXT, intentos INTEGER DEFAULT 0, creado_en REAL, owner TEXT, lease_hasta REAL)"
+            )
+            # Backlogs creados antes de que existieran dueño y lease
+            columnas = {fila[1] for fila in self._db.execute("PRAGMA table_info(backlog)")}
+            for columna, tipo in (('owner', 'TEXT'), ('lease_hasta', 'REAL')):
+                if columna not in columnas:
+                    try:
+                        self._db.execute(f"ALTER TABLE backlog ADD COLUMN {columna} {tipo}")
+                    except sqlite3.OperationalError:
+                        pass  # Otro worker la agregó al mismo tiempo
+            self._db.commit()
+            self._reclamar_backlog()
+            latido = Thread(target=self._latido, name='chatwoot_backlog_lease', daemon=True)
+            latido.start()
+
+    def _reclamar_backlog(self):
+        """
+        Toma (UPDATE atómico) las filas sin dueño o con lease vencido y las encola en
+        orden de llegada. Las filas de otro worker vivo no se tocan.
+        """
+        ahora = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE backlog SET owner = ?, lease_hasta = ? WHERE owner IS NULL OR lease_hasta IS NULL OR lease_hasta < ?",
+                (self.owner_id, ahora + self.lease, ahora)
+            )
+            self._db.commit()
+            if cursor.rowcount <= 0:
+                return
+            en_cola = {item[0] for cola in self._colas.values() for item in cola}
+            filas = self._db.execute(
+                "SELECT id, telefono, contenido, tipo, remitente, intentos FROM backlog WHERE owner = ? ORDER BY id",
+                (self.owner_id,)
+            ).fetchall()
+            monotonic = time.monotonic()
+            nuevas = 0
+            for id_, telefono, contenido, tipo, remitente, intentos in filas:
+                if id_ in en_cola:
+                    continue
+                self._colas.setdefault(telefono, deque()).append([id_, contenido, tipo, remitente, intentos, monotonic])
+                nuevas += 1
+            self._stats['reclamados'] += nuevas
+            telefonos = list(self._colas)
+        if nuevas:
+            logger.info(f"[CHATWOOT_ESPEJO] {nuevas} mensajes pendientes reclamados del backlog por {self.owner_id}")
+        for telefono in telefonos:
+            self._activar(telefono)
+
+    def _latido(self):
+        """Renueva el lease de las filas propias y reclama las de workers que murieron."""
+        while True:
+            time.sleep(max(1.0, self.lease / 3))
+            try:
+                with self._lock:
+                    self._db.execute("UPDATE backlog SET lease_hasta = ? WHERE owner = ?",
+                                     (time.time() + self.lease, self.owner_id))
+                    self._db.commit()
+                self._reclamar_backlog()
+            except sqlite3.Error as e:
+                logger.warning(f"[CHATWOOT_ESPEJO] Error renovando el lease del backlog: {e}")
+
+    def registrar(self, phone, mensajes):
+        """mensajes: lista de (contenido, tipo, remitente) en orden. No bloquea."""
+        if not mensajes or self._db is None:
+            return
+        telefono = phone.replace('+', '').replace(' ', '').replace('-', '')
+        ahora = time.time()
+        with self._lock:
+            items = []
+            for contenido, tipo, remitente in mensajes:
+                cursor = self._db.execute(
+                    "INSERT INTO backlog (telefono, contenido, tipo, remitente, intentos, creado_en, owner, lease_hasta)"
+                    " VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
+                    (telefono, contenido, tipo, remitente, ahora, self.owner_id, ahora + self.lease)
+                )
+                items.append([cursor.lastrowid, contenido, tipo, remitente, 0, time.monotonic()])
+            self._db.commit()
+            self._colas.setdefault(telefono, deque()).extend(items)
+            self._stats['encolados'] += len(items)
+        self._activar(telefono)
+
+    def _activar(self, telefono):
+        with self._lock:
+            if telefono in self._activos or not self._colas.get(telefono):
+                return
+            self._activos.add(telefono)
+        self._pool.submit(self._drenar, telefono)
+
+    def _publicar_lote(self, telefono, lote):
+        """Publica en orden; retorna cuántos del principio del lote quedaron publicados."""
+        remitente = next((item[3] for item in lote if item[2] == 'incoming'), None) or "Usuario"
+        conversation_id = self.cliente.resolver_conversacion(telefono, remitente)
+        if not conversation_id:
+            return 0
+        publicados = 0
+        for _, contenido, tipo, _, _, _ in lote:
+            if not self.cliente.publicar_mensaje(conversation_id, contenido, tipo):
+                # La conversación pudo cerrarse o borrarse: resolver de nuevo en el reintento
+                self.cliente.olvidar_conversacion(telefono)
+                break
+            publicados += 1
+        return publicados
+
+    def _drenar(self, telefono):
+        fallos_seguidos = 0
+        while True:
+            with self._lock:
+                cola = self._colas.get(telefono)
+                if not cola:
+                    self._colas.pop(telefono, None)
+                    self._activos.discard(telefono)
+                    return
+                lote = list(cola)
+            permanente = False
+            try:
+                publicados = self._publicar_lote(telefono, lote)
+                permanente = publicados < len(lote) and self.cliente.fallo_permanente()
+            except Exception as e:
+                logger.error(f"[CHATWOOT_ESPEJO] Error publicando para {telefono}: {e}", exc_info=True)
+                publicados = 0
+            ahora = time.monotonic()
+            with self._lock:
+                hechos = [cola.popleft() for _ in range(publicados)]
+                if hechos:
+                    self._db.executemany("DELETE FROM backlog WHERE id = ?", [(item[0],) for item in hechos])
+                    self._stats['publicados'] += len(hechos)
+                    self._stats['lotes'] += 1
+                    self._latencias_ms.extend((ahora - item[5]) * 1000 for item in hechos)
+                if publicados < len(lote):
+                    self._stats['fallos'] += 1
+                    if permanente:
+                        # Solo los rechazos permanentes cuentan para descartar; una caída se espera sin límite
+                        cabeza = cola[0]
+                        cabeza[4] += 1
+                        if cabeza[4] >= self.descartar_tras:
+                            cola.popleft()
+                            self._db.execute("DELETE FROM backlog WHERE id = ?", (cabeza[0],))
+                            self._stats['descartados'] += 1
+                            logger.error(f"[CHATWOOT_ESPEJO] Mensaje para {telefono} descartado: Chatwoot lo rechazó {cabeza[4]} veces")
+                        else:
+                            self._db.execute("UPDATE backlog SET intentos = ? WHERE id = ?", (cabeza[4], cabeza[0]))
+                self._db.commit()
+            if publicados == len(lote):
+                fallos_seguidos = 0
+                continue
+            fallos_seguidos += 1
+            if fallos_seguidos > self.max_reintentos:
+                # Chatwoot sigue fallando: liberar el worker y volver a intentar más tarde
+                with self._lock:
+                    self._activos.discard(telefono)
+                    self._stats['reprogramados'] += 1
+                logger.warning(f"[CHATWOOT_ESPEJO] {telefono}: {fallos_seguidos} fallos seguidos. "
+                               f"Reintento en {self.backoff_max:.0f}s")
+                temporizador = Timer(self.backoff_max, self._activar, args=(telefono,))
+                temporizador.daemon = True
+                temporizador.start()
+                return
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (fallos_seguidos - 1)))))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            latencias = sorted(self._latencias_ms)
+            pendientes = sum(len(cola) for cola in self._colas.values())
+            activos = len(self._activos)
+
+        def _p(q):
+            return round(latencias[min(len(latencias) - 1, int(round(q * (len(latencias) - 1))))], 1) if latencias else None
+
+        return {
+            'backlog_pendiente': pendientes,
+            'conversaciones_activas': activos,
+            'backlog_path': self.ruta_backlog,
+            'backlog_owner': self.owner_id,
+            'latencia_espejo_p50_ms': _p(0.5),
+            'latencia_espejo_p95_ms': _p(0.95),
+            **stats,
+        }
+
+
+espejo = ChatwootMirror(
+    chatwoot,
+    max_workers=int(os.getenv('CHATWOOT_MIRROR_WORKERS', '4')),
+    max_reintentos=int(os.getenv('CHATWOOT_MIRROR_MAX_RETRIES', '4')),
+    backoff_base=float(os.getenv('CHATWOOT_MIRROR_BACKOFF_BASE', '1.0')),
+    backoff_max=float(os.getenv('CHATWOOT_MIRROR_BACKOFF_MAX', '60')),
+    ruta_backlog=os.getenv('CHATWOOT_BACKLOG_PATH', 'chatwoot_backlog.sqlite3'),
+    lease=float(os.getenv('CHATWOOT_BACKLOG_LEASE', '60')),
+)
+
+def log_to_chatwoot(phone, user_message, bot_response, sender_name="Usuario", sincronico=False):
     """
     Función helper para registrar conversación completa en Chatwoot.
-    Sigue EXACTAMENTE los 3 pasos de la documentación.
+    Encola en el espejo de fondo (mensaje del usuario y respuesta del bot, en ese orden)
+    y retorna enseguida: True si quedó encolado. Con sincronico=True publica en el
+    momento y retorna si Chatwoot aceptó los mensajes (diagnóstico).
     """
     if not chatwoot.enabled:
         return False
 
-    success = True
-
     try:
-        # Limpiar cache si crece mucho
-        if len(chatwoot.conversation_cache) > 100:
-            logger.debug("🧹 Limpiando cache...")
-            chatwoot.conversation_cache.clear()
-            chatwoot.contact_cache.clear()
-        
-        # Registrar mensaje del usuario
+        if sincronico:
+            ok = True
+            if user_message:
+                ok = chatwoot.log_message_to_chatwoot(phone, user_message, 'incoming', sender_name) and ok
+            if bot_response:
+                ok = chatwoot.log_message_to_chatwoot(phone, bot_response, 'outgoing', "OPTI BOT") and ok
+            return ok
+
+        mensajes = []
         if user_message:
-            logger.debug(f"📨 Registrando mensaje del usuario: {user_message[:50]}...")
-            user_success = chatwoot.log_message_to_chatwoot(
-                phone, 
-                user_message, 
-                'incoming',  # Mensaje del cliente
-                sender_name
-            )
-            success = success and user_success
-            
-            if not user_success:
-                logger.error("❌ Falló el registro del mensaje del usuario")
-                return False
-            
-            # Pequeña pausa entre mensajes para evitar race conditions
-            time.sleep(0.5)
-            
-        # Registrar respuesta del bot
-        if bot_response and success:
-            logger.debug(f"🤖 Registrando respuesta del bot: {bot_response[:50]}...")
-            bot_success = chatwoot.log_message_to_chatwoot(
-                phone, 
-                bot_response, 
-                'outgoing',  # Se convertirá a incoming con prefijo "🤖 Bot:"
-                "OPTI BOT"
-            )
-            success = success and bot_success
-            
-            if not bot_success:
-                logger.error("❌ Falló el registro de la respuesta del bot")
-        
-        return success
-        
+            logger.debug(f"📨 Encolando mensaje del usuario: {user_message[:50]}...")
+            mensajes.append((user_message, 'incoming', sender_name))  # Mensaje del cliente
+        if bot_response:
+            logger.debug(f"🤖 Encolando respuesta del bot: {bot_response[:50]}...")
+            mensajes.append((bot_response, 'outgoing', "OPTI BOT"))  # Se convertirá a incoming con prefijo
+        espejo.registrar(phone, mensajes)
+        return True
+
     except Exception as e:
         logger.error(f"❌ Error en log_to_chatwoot: {e}", exc_info=True)
         return False
@@ -450,7 +866,9 @@ def test_chatwoot_connection():
         
         # Test 3: Crear conversación
         logger.info("🧪 Test 3: Creando conversación de prueba...")
-        conversation_id = chatwoot._get_or_create_conversation_with_source_id(contact_id, source_id)
+        conversation_id = chatwoot._get_or_create_conversation_with_source_id(
+            test_phone.replace('+', ''), contact_id, source_id
+        )
         
         if not conversation_id:
             return "❌ Error: No se pudo crear conversación de prueba"
@@ -491,7 +909,7 @@ def debug_chatwoot_flow(phone_number):
     
     # PASO 2
     logger.info("🔵 PASO 2: Creando conversación...")
-    conversation_id = chatwoot._get_or_create_conversation_with_source_id(contact_id, source_id)
+    conversation_id = chatwoot._get_or_create_conversation_with_source_id(phone_clean, contact_id, source_id)
     
     if not conversation_id:
         logger.error("❌ PASO 2 FALLÓ")
@@ -60,6 +60,136 @@ try:
     META_AGENTE_VERBOSITY = os.getenv("META_AGENTE_VERBOSITY", "low")
     INTENCION_VERBOSITY = os.getenv("INTENCION_VERBOSITY", "low")
     
+    # NUEVO: Clasificador rápido de intenciones (fast-path previo al LLM)
+    # Solo decide sin LLM si la confianza de la regla alcanza este umbral.
+    INTENT_FASTPATH_MIN_CONFIDENCE = float(os.getenv("INTENT_FASTPATH_MIN_CONFIDENCE", "0.9"))
+
+    # NUEVO: Ventana de historial con presupuesto de tokens por agente
+    # JSON opcional, ej: {"agente_cero": 1500}
+    HISTORY_TOKEN_BUDGETS_JSON = os.getenv("HISTORY_TOKEN_BUDGETS", "")
+    # Modelo económico para el resumen incremental de turnos viejos
+    HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-5-nano")
+    # Estimación de latencia de prefill para reportar la latencia ahorrada
+    HISTORY_PREFILL_MS_PER_1K_TOKENS = float(os.getenv("HISTORY_PREFILL_MS_PER_1K_TOKENS", "40"))
+
+    # NUEVO: Planificador de llamadas LLM (cupos por modelo, TPM y manejo de 429)
+    LLM_MAX_CONCURRENCY_PER_MODEL = int(os.getenv("LLM_MAX_CONCURRENCY_PER_MODEL", "8"))
+    # JSON opcionales por modelo, ej: {"gpt-5-mini": 16} y {"gpt-5-mini": 200000}
+    LLM_CONCURRENCY_BY_MODEL_JSON = os.getenv("LLM_CONCURRENCY_BY_MODEL", "")
+    LLM_TPM_LIMITS_JSON = os.getenv("LLM_TPM_LIMITS", "")
+    # Cupos por modelo que el trabajo de fondo nunca ocupa
+    LLM_INTERACTIVE_RESERVED_SLOTS = int(os.getenv("LLM_INTERACTIVE_RESERVED_SLOTS", "2"))
+    LLM_INTERACTIVE_MAX_WAIT = float(os.getenv("LLM_INTERACTIVE_MAX_WAIT", "20"))
+    LLM_BACKGROUND_MAX_WAIT = float(os.getenv("LLM_BACKGROUND_MAX_WAIT", "300"))
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+
+    # NUEVO: Hedged requests y circuit breaker por modelo
+    # Si la llamada no terminó tras el p95 reciente (acotado), se lanza una segunda.
+    LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "true").lower() == "true"
+    LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+    LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+    LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", "20"))
+    LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "8"))
+    LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+    # JSON opcional modelo -> modelo de respaldo, ej: {"gpt-5": "gpt-5-mini"}
+    LLM_FALLBACK_MODELS_JSON = os.getenv("LLM_FALLBACK_MODELS", "")
+    LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+    LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+    LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+    # NUEVO: Trazas de llamadas LLM (anillo en memoria + JSONL rotativo opcional)
+    LLM_TRACE_RING_SIZE = int(os.getenv("LLM_TRACE_RING_SIZE", "2000"))
+    LLM_TRACE_JSONL_PATH = os.getenv("LLM_TRACE_JSONL_PATH", "")
+    LLM_TRACE_JSONL_MAX_BYTES = int(os.getenv("LLM_TRACE_JSONL_MAX_BYTES", str(10 * 1024 * 1024)))
+    LLM_TRACE_JSONL_BACKUPS = int(os.getenv("LLM_TRACE_JSONL_BACKUPS", "5"))
+    # JSON opcional de precios USD por millón de tokens: {"gpt-5-mini": [0.25, 2.0, 0.025]}
+    LLM_PRICES_JSON = os.getenv("LLM_PRICES", "")
+
+    # NUEVO: Backend LLM intercambiable (openai | record | replay) para benchmarks sin red
+    LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+    LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "llm_cassette.sqlite3")
+    # none | recorded | fixed:<ms> | uniform:<min_ms>,<max_ms> | lognormal:<mediana_ms>,<sigma>
+    LLM_REPLAY_LATENCY = os.getenv("LLM_REPLAY_LATENCY", "recorded")
+
+    # NUEVO: Pipeline de leads en lote (análisis concurrente + upserts por tramos)
+    LEAD_ANALYSIS_CONCURRENCY = int(os.getenv("LEAD_ANALYSIS_CONCURRENCY", "4"))
+    LEAD_PIPELINE_CHUNK_SIZE = int(os.getenv("LEAD_PIPELINE_CHUNK_SIZE", "50"))
+    # Presupuesto por ciclo, por debajo del tick de 900s del demonio
+    LEAD_PIPELINE_TIME_BUDGET = float(os.getenv("LEAD_PIPELINE_TIME_BUDGET", "780"))
+    LEAD_PIPELINE_FAILURE_COOLDOWN = float(os.getenv("LEAD_PIPELINE_FAILURE_COOLDOWN", "3600"))
+    LEAD_BACKLOG_RETRY_SLEEP = float(os.getenv("LEAD_BACKLOG_RETRY_SLEEP", "30"))
+
+    # NUEVO: Pre-procesamiento de imágenes para el Agente Lector
+    # "high" (lado corto <= 768px) para comprobantes y órdenes médicas; "low" (<= 512px) más barato
+    IMAGE_LECTOR_DETAIL = os.getenv("IMAGE_LECTOR_DETAIL", "high")
+    IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+    IMAGE_MAX_INPUT_BYTES = int(os.getenv("IMAGE_MAX_INPUT_BYTES", str(20 * 1024 * 1024)))
+    # Caché de análisis por hash de contenido (imágenes reenviadas)
+    IMAGE_ANALYSIS_CACHE_SIZE = int(os.getenv("IMAGE_ANALYSIS_CACHE_SIZE", "512"))
+    IMAGE_ANALYSIS_CACHE_TTL = float(os.getenv("IMAGE_ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+
+    # NUEVO: Media store direccionado por contenido (SHA-256) para audios e imágenes entrantes.
+    # Descarga en streaming, deduplica reenvíos y guarda artefactos derivados (transcripción, visión).
+    MEDIA_STORE_DIR = os.getenv("MEDIA_STORE_DIR", "./media_store")
+    MEDIA_STORE_MAX_BYTES = int(os.getenv("MEDIA_STORE_MAX_BYTES", str(1024 ** 3)))
+    MEDIA_MAX_FILE_BYTES = int(os.getenv("MEDIA_MAX_FILE_BYTES", str(32 * 1024 ** 2)))
+    # Los blobs accedidos hace menos de esto (segundos) no se desalojan: otro worker puede estar usándolos
+    MEDIA_STORE_EVICTION_GRACE = float(os.getenv("MEDIA_STORE_EVICTION_GRACE", "300"))
+    # Caché de resolución media_id -> URL de descarga de 360dialog (las URLs valen ~5 min)
+    MEDIA_URL_TTL = float(os.getenv("MEDIA_URL_TTL", "240"))
+    MEDIA_URL_CACHE_SIZE = int(os.getenv("MEDIA_URL_CACHE_SIZE", "1024"))
+
+    # NUEVO: Transporte HTTP saliente compartido (360dialog, Chatwoot, HubSpot, AssemblyAI).
+    # El pool es por proceso: cubre los hilos de cada worker de gunicorn (--threads=4) más los pools de fondo
+    # (multimedia, leads, polling de AssemblyAI) que hacen llamadas salientes.
+    HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+    HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+    HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.3"))
+    HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "5.0"))
+
+    # NUEVO: Cola de salida asíncrona (FIFO por destinatario) para los mensajes del turno
+    OUTBOUND_MAX_CONCURRENCY = int(os.getenv("OUTBOUND_MAX_CONCURRENCY", "8"))
+    OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "4"))
+    OUTBOUND_RETRY_BASE = float(os.getenv("OUTBOUND_RETRY_BASE", "0.5"))
+    OUTBOUND_RETRY_MAX = float(os.getenv("OUTBOUND_RETRY_MAX", "15"))
+    OUTBOUND_DEAD_LETTER_PATH = os.getenv("OUTBOUND_DEAD_LETTER_PATH", "outbound_dead_letter.jsonl")
+
+    # NUEVO: Procesamiento paralelo de multimedia dentro de un turno del buffer.
+    # La deadline de cada item corre desde que arranca en el pool; la espera en cola
+    # tiene su propio tope. Los items que no terminan entran con un marcador y su
+    # resultado se agrega al contexto del turno siguiente.
+    MULTIMEDIA_MAX_WORKERS = int(os.getenv("MULTIMEDIA_MAX_WORKERS", "4"))
+    MULTIMEDIA_TURN_DEADLINE = float(os.getenv("MULTIMEDIA_TURN_DEADLINE", "25"))
+    MULTIMEDIA_QUEUE_WAIT_MAX = float(os.getenv("MULTIMEDIA_QUEUE_WAIT_MAX", "25"))
+
+    # NUEVO: Índice global de disponibilidad (bitmap por calendario y día, compartido entre usuarios).
+    # Cada día se refresca desde el calendario pasado este TTL o al crear/reprogramar/cancelar.
+    AVAILABILITY_INDEX_TTL = float(os.getenv("AVAILABILITY_INDEX_TTL", "60"))
+
+    # NUEVO: Espejo incremental de Google Calendar (syncToken). Segundos entre syncs de fondo.
+    CALENDAR_SYNC_INTERVAL = float(os.getenv("CALENDAR_SYNC_INTERVAL", "30"))
+
+    # NUEVO: Prefetch en segundo plano de los turnos de los próximos N días (0 lo desactiva).
+    # Hoy y mañana se refrescan cada NEAR segundos; el intervalo se duplica por día hasta FAR.
+    AVAILABILITY_PREFETCH_DAYS = int(os.getenv("AVAILABILITY_PREFETCH_DAYS", "7"))
+    AVAILABILITY_PREFETCH_NEAR_INTERVAL = float(os.getenv("AVAILABILITY_PREFETCH_NEAR_INTERVAL", "60"))
+    AVAILABILITY_PREFETCH_FAR_INTERVAL = float(os.getenv("AVAILABILITY_PREFETCH_FAR_INTERVAL", "900"))
+
+    # NUEVO: Holds de turnos (reserva temporal entre que se ofrecen y se confirman).
+    # 'firestore' comparte los holds entre workers; 'local' solo sirve con un único proceso.
+    SLOT_HOLDS_BACKEND = os.getenv("SLOT_HOLDS_BACKEND", "firestore")
+    SLOT_HOLDS_COLLECTION = os.getenv("SLOT_HOLDS_COLLECTION", "slot_holds")
+    SLOT_HOLD_TTL = float(os.getenv("SLOT_HOLD_TTL", "180"))
+    SLOT_HOLD_CONFIRM_TTL = float(os.getenv("SLOT_HOLD_CONFIRM_TTL", "60"))
+    # Con el evento creado el hold queda 'reservado' hasta que el espejo y el índice lo vean
+    # (un sync + un TTL del índice, con margen). Debe superar CALENDAR_SYNC_INTERVAL + AVAILABILITY_INDEX_TTL.
+    SLOT_HOLD_BOOKED_TTL = float(os.getenv("SLOT_HOLD_BOOKED_TTL", str(CALENDAR_SYNC_INTERVAL + AVAILABILITY_INDEX_TTL + 60)))
+
+    # NUEVO: Cliente de Google Calendar compartido por worker. El discovery de calendar v3 se
+    # guarda en disco y el token se renueva en segundo plano MARGIN segundos antes de vencer.
+    CALENDAR_DISCOVERY_CACHE_PATH = os.getenv("CALENDAR_DISCOVERY_CACHE_PATH", "calendar_v3_discovery.json")
+    CALENDAR_TOKEN_REFRESH_MARGIN = float(os.getenv("CALENDAR_TOKEN_REFRESH_MARGIN", "300"))
+
     # NUEVO: Configuración del buffer de mensajes (tiempo de espera antes de procesar)
     # Por defecto 4.0 segundos, pero personalizable por cliente
     BUFFER_WAIT_TIME = float(os.getenv("BUFFER_WAIT_TIME", "1.0"))
@@ -159,6 +289,16 @@ Ejemplo JSON: {"accion_recomendada": "iniciar_verificacion_medica", "detalles":
 
     # Transcripción de audio OBLIGATORIA: requerida para que el Lector alimente al Agente Cero
     ASSEMBLYAI_API_KEY = os.environ['ASSEMBLYAI_API_KEY']
+    # Cliente de transcripción: tope de trabajos en vuelo y polling adaptativo
+    ASSEMBLYAI_MAX_IN_FLIGHT = int(os.getenv('ASSEMBLYAI_MAX_IN_FLIGHT', '16'))
+    ASSEMBLYAI_POLL_INITIAL = float(os.getenv('ASSEMBLYAI_POLL_INITIAL', '0.3'))
+    ASSEMBLYAI_POLL_MAX = float(os.getenv('ASSEMBLYAI_POLL_MAX', '5'))
+    # Modo webhook opcional: URL pública de /webhook/assemblyai (vacía = solo polling)
+    ASSEMBLYAI_WEBHOOK_URL = os.getenv('ASSEMBLYAI_WEBHOOK_URL', '')
+    ASSEMBLYAI_WEBHOOK_TOKEN = os.getenv('ASSEMBLYAI_WEBHOOK_TOKEN', '')
+    ASSEMBLYAI_WEBHOOK_SAFETY_POLL = float(os.getenv('ASSEMBLYAI_WEBHOOK_SAFETY_POLL', '10'))
+    # Webhooks que caen en otro worker: señal en disco compartido que el dueño levanta cada 0.25s
+    ASSEMBLYAI_WEBHOOK_SIGNAL_DIR = os.getenv('ASSEMBLYAI_WEBHOOK_SIGNAL_DIR', './assemblyai_webhooks')
     SERVICE_PRICES_JSON = os.environ.get('SERVICE_PRICES_JSON', '{}')
 
     # Proveedores configurables para pagos y calendarios
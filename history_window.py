@@ -0,0 +1,322 @@
+"""
+Ventana de historial con presupuesto de tokens y resumen incremental.
+
+Los prompts del Agente Cero (y de cualquier agente que reciba historial)
+enviaban el historial crudo completo: una transcripción de audio larga o un
+texto pegado inflaba todos los prompts siguientes. Este módulo:
+
+- Cuenta tokens con un tokenizador local (tiktoken si está instalado; si no,
+  una estimación por caracteres).
+- Conserva textualmente los turnos más recientes que entran en el presupuesto
+  del agente (HISTORY_TOKEN_BUDGETS).
+- Los turnos más viejos se pliegan en un resumen acumulado que vive en el
+  documento de la conversación (campo raíz `history_summary`). El resumen se
+  actualiza de forma incremental en segundo plano: solo se resumen los
+  mensajes nuevos que salieron de la ventana desde la última actualización.
+  Hasta que el resumen los cubre, esos mensajes siguen en la ventana.
+- Métricas por agente: tokens de entrada ahorrados y latencia estimada ahorrada.
+"""
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Lock, Thread
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+# Tokenizador local opcional
+try:
+    import tiktoken
+    _ENCODER = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODER = None
+
+CHARS_POR_TOKEN_ESTIMADO = 4
+MARCA_TRUNCADO = " [...] "
+MAX_RESUMENES_EN_CACHE = 2000
+
+DEFAULT_BUDGETS = {'agente_cero': 1500}
+try:
+    HISTORY_TOKEN_BUDGETS = {**DEFAULT_BUDGETS, **json.loads(getattr(config, 'HISTORY_TOKEN_BUDGETS_JSON', '') or '{}')}
+except (TypeError, ValueError):
+    logger.error("[HISTORY_WINDOW] HISTORY_TOKEN_BUDGETS no es un JSON válido. Usando valores por defecto.")
+    HISTORY_TOKEN_BUDGETS = dict(DEFAULT_BUDGETS)
+
+# Un mensaje individual nunca ocupa más que esta fracción del presupuesto
+FRACCION_MAX_POR_MENSAJE = 0.4
+
+
+def contar_tokens(texto: str) -> int:
+    if not texto:
+        return 0
+    if _ENCODER is not None:
+        try:
+            return len(_ENCODER.encode(texto))
+        except Exception:
+            pass
+    return max(1, len(texto) // CHARS_POR_TOKEN_ESTIMADO)
+
+
+def _truncar_a_tokens(texto: str, max_tokens: int) -> str:
+    """Recorta el centro del texto (conserva inicio y final) para que entre en max_tokens."""
+    if contar_tokens(texto) <= max_tokens:
+        return texto
+    if _ENCODER is not None:
+        tokens = _ENCODER.encode(texto)
+        mitad = max(1, max_tokens // 2)
+        return _ENCODER.decode(tokens[:mitad]) + MARCA_TRUNCADO + _ENCODER.decode(tokens[-mitad:])
+    mitad = max(1, (max_tokens * CHARS_POR_TOKEN_ESTIMADO) // 2)
+    return texto[:mitad] + MARCA_TRUNCADO + texto[-mitad:]
+
+
+def formatear_mensaje(msg: dict) -> str:
+    """Mismo formato que usan los prompts: 'rol: contenido'."""
+    rol = msg.get('role', msg.get('name', 'asistente'))
+    return f"{rol}: {msg.get('content', '')}"
+
+
+def _timestamp(msg: dict):
+    ts = msg.get('timestamp')
+    if isinstance(ts, datetime):
+        return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+    if isinstance(ts, str):
+        try:
+            parsed = datetime.fromisoformat(ts.replace('Z', '+00:00'))
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+    return None
+
+
+class HistoryWindowBuilder:
+    """Construye ventanas de historial por agente y mantiene los resúmenes acumulados."""
+
+    def __init__(self, budgets: dict, max_mensajes: int):
+        self.budgets = budgets
+        self.max_mensajes = max_mensajes
+        self._lock = Lock()
+        self._resumenes = OrderedDict()   # author -> (marca del historial, history_summary) (LRU)
+        self._plegando = set()
+        self._stats = {}
+
+    # --- Resumen acumulado ---
+
+    @staticmethod
+    def marca_historial(history: list) -> tuple:
+        """Largo + timestamp del último mensaje: cambia cuando la conversación crece (en cualquier worker)."""
+        if not history:
+            return (0, None)
+        ultimo = history[-1]
+        return (len(history), str(ultimo.get('timestamp') or ultimo.get('content', ''))[:200])
+
+    def obtener_resumen(self, author: str, marca: tuple = None) -> dict | None:
+        """Resumen de la caché si se leyó para este mismo historial; si no, de Firestore."""
+        if not author:
+            return None
+        with self._lock:
+            cacheado = self._resumenes.get(author)
+            if cacheado is not None and cacheado[0] == marca:
+                self._resumenes.move_to_end(author)
+                return cacheado[1] or None
+        import memory
+        resumen = memory.get_history_summary(author) or {}
+        self._guardar_en_cache(author, resumen, marca)
+        return resumen or None
+
+    def _guardar_en_cache(self, author: str, resumen: dict, marca: tuple = None):
+        with self._lock:
+            self._resumenes[author] = (marca, resumen)
+            self._resumenes.move_to_end(author)
+            while len(self._resumenes) > MAX_RESUMENES_EN_CACHE:
+                self._resumenes.popitem(last=False)
+
+    @staticmethod
+    def _cubiertos(history: list, resumen: dict | None) -> int:
+        """
+        Cantidad de mensajes del inicio del historial que ya están en el resumen: hasta el más
+        nuevo con timestamp <= hasta_ts. Un mensaje sin timestamp solo cuenta como cubierto si
+        hay uno cubierto después (los plegados son siempre prefijos contiguos).
+        """
+        hasta = _timestamp({'timestamp': (resumen or {}).get('hasta_ts')})
+        if hasta is None:
+            return 0
+        for i in range(len(history) - 1, -1, -1):
+            ts = _timestamp(history[i])
+            if ts is not None and ts <= hasta:
+                return i + 1
+        return 0
+
+    @staticmethod
+    def _plegables(sin_resumir: list) -> list:
+        """Prefijo a plegar: hasta el último mensaje con timestamp (si no, hasta_ts no podría marcarlo como cubierto)."""
+        for i in range(len(sin_resumir) - 1, -1, -1):
+            if _timestamp(sin_resumir[i]) is not None:
+                return sin_resumir[:i + 1]
+        return []
+
+    def _plegar(self, author: str, pendientes: list, resumen_previo: dict | None, marca: tuple = None):
+        """Actualiza el resumen con SOLO los mensajes nuevos (incremental)."""
+        try:
+            texto_previo = (resumen_previo or {}).get('texto', '')
+            nuevos = "\n".join(formatear_mensaje(m) for m in pendientes)
+            texto = None
+            try:
+                import llm_handler
+                prompt = (
+                    "Actualiza el resumen de una conversación de WhatsApp entre un paciente y el "
+                    "Centro Pediátrico Ballester. Conserva datos concretos (nombres, obra social, "
+                    "estudios, fechas, turnos, pagos, pedidos pendientes). Máximo 120 palabras, "
+                    "en español, sin inventar nada.\n\n"
+                    f"RESUMEN ACTUAL:\n{texto_previo or '(vacío)'}\n\n"
+                    f"MENSAJES NUEVOS A INCORPORAR:\n{nuevos}\n\n"
+                    "RESUMEN ACTUALIZADO:"
+                )
+                respuesta = llm_handler._llamar_api_openai(
+                    messages=[{"role": "user", "content": prompt}],
+                    model=getattr(config, 'HISTORY_SUMMARY_MODEL', config.OPENAI_MODEL),
+                    temperature=1.0,
+                    max_completion_tokens=300,
+                    agent_context="resumen_historial",
+                    prioridad=llm_handler.PRIORIDAD_FONDO,
+                )
+                if respuesta and not respuesta.startswith("Lo siento"):
+                    texto = respuesta.strip()
+            except Exception as e:
+                logger.warning(f"[HISTORY_WINDOW] Resumen por LLM no disponible: {e}")
+            if not texto:
+                # Respaldo extractivo: agregar los mensajes nuevos recortados
+                recortes = [_truncar_a_tokens(formatear_mensaje(m), 40) for m in pendientes]
+                texto = "\n".join(filter(None, [texto_previo] + recortes))
+                texto = _truncar_a_tokens(texto, 400)
+
+            ultimo_ts = max((t for t in (_timestamp(m) for m in pendientes) if t), default=None)
+            resumen = {
+                'texto': texto,
+                'hasta_ts': ultimo_ts or (resumen_previo or {}).get('hasta_ts'),
+                'mensajes_resumidos': int((resumen_previo or {}).get('mensajes_resumidos', 0)) + len(pendientes),
+                'tokens': contar_tokens(texto),
+                'actualizado': datetime.now(timezone.utc),
+            }
+            import memory
+            memory.save_history_summary(author, resumen)
+            self._guardar_en_cache(author, resumen, marca)
+        except Exception as e:
+            logger.error(f"[HISTORY_WINDOW] Error plegando historial de {author}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._plegando.discard(author)
+
+    def _programar_plegado(self, author: str, pendientes: list, resumen_previo: dict | None, marca: tuple = None):
+        with self._lock:
+            if author in self._plegando:
+                return
+            self._plegando.add(author)
+        Thread(target=self._plegar, args=(author, pendientes, resumen_previo, marca), daemon=True).start()
+
+    # --- Ventana ---
+
+    @staticmethod
+    def _recortar(msg: dict, max_tokens: int) -> dict:
+        if contar_tokens(formatear_mensaje(msg)) <= max_tokens:
+            return msg
+        return {**msg, 'content': _truncar_a_tokens(str(msg.get('content', '')), max_tokens)}
+
+    def construir(self, history: list, agente: str, author: str = None) -> dict:
+        """
+        Retorna {'mensajes': [...], 'resumen': str, 'tokens_ventana': int, 'tokens_original': int}.
+        'mensajes' son los turnos recientes textuales (en orden cronológico, posiblemente
+        con el contenido de algún mensaje muy largo recortado en el centro).
+        """
+        inicio = time.perf_counter()
+        history = [m for m in (history or []) if isinstance(m, dict)]
+        presupuesto = int(self.budgets.get(agente, self.budgets.get('agente_cero', 1500)))
+        max_por_mensaje = max(50, int(presupuesto * FRACCION_MAX_POR_MENSAJE))
+
+        tokens_original = sum(contar_tokens(formatear_mensaje(m)) for m in history)
+        marca = self.marca_historial(history)
+        resumen = self.obtener_resumen(author, marca) if author else None
+        texto_resumen = (resumen or {}).get('texto', '')
+        restante = presupuesto - contar_tokens(texto_resumen)
+
+        # Lo que ya está incorporado al resumen no se repite textualmente
+        candidatos = history[self._cubiertos(history, resumen):]
+        ventana = []
+        # Tope de mensajes: los dos más viejos del historial guardado siempre quedan fuera
+        # para que se plieguen antes de que add_to_conversation_history los descarte.
+        limite = max(1, self.max_mensajes - 2)
+        for msg in reversed(candidatos):
+            if len(ventana) >= limite:
+                break
+            msg = self._recortar(msg, max_por_mensaje)
+            tokens = contar_tokens(formatear_mensaje(msg))
+            if ventana and tokens > restante:
+                break
+            ventana.append(msg)
+            restante -= tokens
+        ventana.reverse()
+
+        sin_resumir = candidatos[:len(candidatos) - len(ventana)]
+        if sin_resumir and author:
+            pendientes = self._plegables(sin_resumir)
+            if pendientes:
+                self._programar_plegado(author, pendientes, resumen, marca)
+            # El plegado corre en segundo plano: hasta que el resumen los cubra siguen en la
+            # ventana (recortados), aunque excedan el presupuesto, para no perderlos del prompt.
+            ventana = [self._recortar(m, max_por_mensaje) for m in sin_resumir] + ventana
+
+        tokens_ventana = sum(contar_tokens(formatear_mensaje(m)) for m in ventana) + contar_tokens(texto_resumen)
+        self._registrar(agente, tokens_original, tokens_ventana, time.perf_counter() - inicio)
+        return {
+            'mensajes': ventana,
+            'resumen': texto_resumen,
+            'tokens_ventana': tokens_ventana,
+            'tokens_original': tokens_original,
+        }
+
+    # --- Métricas ---
+
+    def _registrar(self, agente: str, tokens_original: int, tokens_ventana: int, segundos: float):
+        with self._lock:
+            stats = self._stats.setdefault(agente, {
+                'llamadas': 0, 'tokens_original': 0, 'tokens_ventana': 0, 'segundos_construccion': 0.0
+            })
+            stats['llamadas'] += 1
+            stats['tokens_original'] += tokens_original
+            stats['tokens_ventana'] += tokens_ventana
+            stats['segundos_construccion'] += segundos
+
+    def get_stats(self) -> dict:
+        ms_por_mil = float(getattr(config, 'HISTORY_PREFILL_MS_PER_1K_TOKENS', 40.0))
+        with self._lock:
+            por_agente = {}
+            for agente, s in self._stats.items():
+                llamadas = s['llamadas'] or 1
+                ahorrados = max(0, s['tokens_original'] - s['tokens_ventana'])
+                por_agente[agente] = {
+                    'presupuesto_tokens': self.budgets.get(agente),
+                    'llamadas': s['llamadas'],
+                    'tokens_entrada_ahorrados_por_llamada': round(ahorrados / llamadas, 1),
+                    'latencia_ahorrada_estimada_ms_por_llamada': round((ahorrados / llamadas) / 1000 * ms_por_mil, 1),
+                    'costo_construccion_ms_por_llamada': round(s['segundos_construccion'] / llamadas * 1000, 3),
+                }
+            return {
+                'tokenizador': 'tiktoken' if _ENCODER is not None else 'estimado_por_caracteres',
+                'resumenes_en_cache': len(self._resumenes),
+                'plegados_en_curso': len(self._plegando),
+                'por_agente': por_agente,
+            }
+
+
+def _max_mensajes_historial() -> int:
+    try:
+        import memory
+        return memory.MAX_HISTORY_PAIRS * 2
+    except Exception:
+        return 20
+
+
+ventanas = HistoryWindowBuilder(HISTORY_TOKEN_BUDGETS, _max_mensajes_historial())
@@ -0,0 +1,198 @@
+"""
+Transporte HTTP saliente compartido (360dialog, Chatwoot, HubSpot, AssemblyAI).
+
+Antes cada envío hacía `requests.post` sin sesión: DNS + TCP + TLS nuevos por
+mensaje. Acá hay una única requests.Session con:
+
+- Pool de conexiones keep-alive por host (HTTP_POOL_MAXSIZE, dimensionado para
+  los hilos de cada worker de gunicorn más los pools de fondo que hacen llamadas
+  salientes).
+- Reintentos con backoff exponencial + jitter. Métodos idempotentes: 429
+  (respetando Retry-After), cualquier 5xx, timeouts y errores de conexión.
+  POST/PATCH solo ante 429, 503 y errores al establecer la conexión: con un
+  500/502/504 o un timeout de lectura el upstream pudo haber hecho el trabajo
+  (mensaje enviado, transcripción creada) y reintentar lo duplicaría.
+- Métricas de latencia por endpoint (host + ruta con los IDs normalizados).
+
+La interfaz (get/post/patch/head/request) es la de requests.Session, así que los
+módulos que recibían una sesión pueden recibir `transporte` directamente.
+"""
+
+import logging
+import random
+import re
+import time
+from collections import deque
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+_IDEMPOTENTES = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+# El upstream no procesó el request: se puede reintentar aunque no sea idempotente
+REINTENTABLES_NO_IDEMPOTENTES = frozenset({429, 503})
+_SEGMENTO_ID = re.compile(r'^(\d+|[0-9a-fA-F-]{16,}|[A-Za-z0-9_-]{24,})$')
+
+
+def _percentil(valores, p: float):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p * (len(ordenados) - 1)))))
+    return ordenados[indice]
+
+
+def etiqueta_endpoint(metodo: str, url: str) -> str:
+    """'POST waba-v2.360dialog.io/messages', con los IDs de la ruta reemplazados por ':id'."""
+    partes = urlsplit(url)
+    segmentos = [':id' if _SEGMENTO_ID.match(s) else s for s in partes.path.split('/') if s]
+    return f"{metodo.upper()} {partes.netloc}/{'/'.join(segmentos[:5])}"
+
+
+def no_enviado(error) -> bool:
+    """True si el error ocurrió antes de enviar el request (conexión no establecida)."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ReadTimeout) or not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    # ConnectionError envuelve un MaxRetryError; solo NewConnectionError (incluye DNS) es pre-envío.
+    # Un 'Connection aborted' / RemoteDisconnected puede llegar después de que el upstream recibió el body.
+    causa = error.args[0] if error.args else None
+    causa = getattr(causa, 'reason', causa)
+    return isinstance(causa, NewConnectionError)
+
+
+def _espera_retry_after(response) -> float | None:
+    try:
+        valor = response.headers.get('Retry-After')
+        return float(valor) if valor else None
+    except (TypeError, ValueError):
+        return None
+
+
+class _MetricasEndpoint:
+    __slots__ = ('llamadas', 'errores', 'reintentos', 'por_estado', 'latencias_ms')
+
+    def __init__(self, ventana: int):
+        self.llamadas = 0
+        self.errores = 0
+        self.reintentos = 0
+        self.por_estado = {}
+        self.latencias_ms = deque(maxlen=ventana)
+
+
+class HTTPTransport:
+    """Sesión compartida con pool keep-alive, reintentos con jitter y métricas por endpoint."""
+
+    def __init__(self, pool_por_host: int = 16, hosts: int = 8, reintentos: int = 2,
+                 backoff_base: float = 0.3, backoff_max: float = 5.0, ventana_metricas: int = 500):
+        self.pool_por_host = max(1, int(pool_por_host))
+        self.reintentos = max(0, int(reintentos))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.ventana_metricas = max(10, int(ventana_metricas))
+        self.session = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=max(1, int(hosts)), pool_maxsize=self.pool_por_host,
+                                pool_block=False, max_retries=0)
+        self.session.mount('https://', adaptador)
+        self.session.mount('http://', adaptador)
+        self._lock = Lock()
+        self._metricas = {}
+
+    def _backoff(self, intento: int, response=None) -> float:
+        retry_after = _espera_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after)
+        # Jitter completo: evita que varios hilos reintenten todos a la vez
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** intento)))
+
+    def _registrar(self, etiqueta: str, estado, latencia_ms: float, reintentos: int, error: bool):
+        with self._lock:
+            metricas = self._metricas.get(etiqueta)
+            if metricas is None:
+                metricas = self._metricas[etiqueta] = _MetricasEndpoint(self.ventana_metricas)
+            metricas.llamadas += 1
+            metricas.reintentos += reintentos
+            metricas.errores += int(error)
+            metricas.por_estado[estado] = metricas.por_estado.get(estado, 0) + 1
+            metricas.latencias_ms.append(latencia_ms)
+
+    def request(self, method: str, url: str, reintentos: int | None = None, **kwargs):
+        """Igual que requests.Session.request, con reintentos y métricas."""
+        metodo = method.upper()
+        idempotente = metodo in _IDEMPOTENTES
+        maximo = self.reintentos if reintentos is None else max(0, int(reintentos))
+        etiqueta = etiqueta_endpoint(metodo, url)
+        inicio = time.perf_counter()
+        intento = 0
+        while True:
+            try:
+                response = self.session.request(metodo, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Sin conexión establecida el request no salió; lo demás solo si es idempotente
+                if intento < maximo and (idempotente or no_enviado(e)):
+                    espera = self._backoff(intento)
+                    logger.warning(f"[HTTP] {etiqueta}: {type(e).__name__}. Reintento {intento + 1}/{maximo} en {espera:.2f}s")
+                    time.sleep(espera)
+                    intento += 1
+                    continue
+                self._registrar(etiqueta, type(e).__name__, (time.perf_counter() - inicio) * 1000, intento, True)
+                raise
+            estado = response.status_code
+            reintentable = estado in REINTENTABLES_NO_IDEMPOTENTES or (idempotente and estado >= 500)
+            if reintentable and intento < maximo:
+                espera = self._backoff(intento, response)
+                logger.warning(f"[HTTP] {etiqueta}: HTTP {estado}. Reintento {intento + 1}/{maximo} en {espera:.2f}s")
+                response.close()
+                time.sleep(espera)
+                intento += 1
+                continue
+            self._registrar(etiqueta, estado, (time.perf_counter() - inicio) * 1000, intento, estado >= 500 or estado == 429)
+            return response
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url: str, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            copia = {etiqueta: (m.llamadas, m.errores, m.reintentos, dict(m.por_estado), list(m.latencias_ms))
+                     for etiqueta, m in self._metricas.items()}
+        endpoints = {}
+        for etiqueta, (llamadas, errores, reintentos, por_estado, latencias) in sorted(copia.items()):
+            endpoints[etiqueta] = {
+                'llamadas': llamadas,
+                'errores': errores,
+                'reintentos': reintentos,
+                'por_estado': {str(k): v for k, v in por_estado.items()},
+                'p50_ms': round(_percentil(latencias, 0.5), 1) if latencias else None,
+                'p95_ms': round(_percentil(latencias, 0.95), 1) if latencias else None,
+                'p99_ms': round(_percentil(latencias, 0.99), 1) if latencias else None,
+            }
+        return {
+            'pool_por_host': self.pool_por_host,
+            'reintentos_max': self.reintentos,
+            'endpoints': endpoints,
+        }
+
+
+transporte = HTTPTransport(
+    pool_por_host=getattr(config, 'HTTP_POOL_MAXSIZE', 16),
+    reintentos=getattr(config, 'HTTP_MAX_RETRIES', 2),
+    backoff_base=getattr(config, 'HTTP_BACKOFF_BASE', 0.3),
+    backoff_max=getattr(config, 'HTTP_BACKOFF_MAX', 5.0),
+)
@@ -2,6 +2,7 @@
 import requests
 import logging
 import json
+import http_transport
 from config import HUBSPOT_API_KEY
 
 # Usamos el logger para este módulo
@@ -10,6 +11,39 @@ logger = logging.getLogger(__name__)
 # La URL base se mantiene como una constante global para el módulo
 BASE_URL = "https://api.hubapi.com/crm/v3/objects/contacts"
 
+def _construir_propiedades(clean_phone_number: str, name: str, last_message: str, lead_data: dict) -> dict:
+    """Propiedades de HubSpot a partir del nombre, último mensaje y datos del Agente Analista."""
+    properties_to_update = {
+        'phone': clean_phone_number,
+    }
+
+    # El `last_message` ya no es relevante en el flujo asíncrono,
+    # pero lo mantenemos por si se usa en el futuro.
+    if last_message:
+        properties_to_update['whatsapp_last_message'] = last_message
+
+    if name and name.strip():
+        properties_to_update['firstname'] = name
+
+    # --- ¡TRADUCTOR DE PROPIEDADES MEJORADO! ---
+    # Mapea las claves del JSON de la IA a los nombres internos de HubSpot.
+    if lead_data:
+        # ¡VERIFICAR! Asegúrate de que estos nombres internos coincidan con tu HubSpot.
+        # El nombre interno para el email suele ser simplemente 'email'.
+        prop_map = {
+            "email": "email", # ¡NUEVO! Añadido para manejar el email.
+            "customer_sector": "customer_sector_ia",
+            "purchase_potential": "purchase_potential_ia",
+            "lead_status": "lead_status_ia",
+            "next_recommended_action": "next_recommended_action_ia" # Añadido para ser completo
+        }
+        for key, value in lead_data.items():
+            # Solo actualizamos el campo si la IA encontró un valor y no es "Desconocido"
+            if key in prop_map and value and value.lower() != "desconocido":
+                hubspot_key = prop_map[key]
+                properties_to_update[hubspot_key] = value
+    return properties_to_update
+
 def update_hubspot_contact(phone_number: str, name: str, last_message: str, lead_data: dict):
     """
     Busca un contacto en HubSpot por su número de teléfono. Si existe, lo actualiza.
@@ -41,7 +75,7 @@ def update_hubspot_contact(phone_number: str, name: str, last_message: str, lead
     }
 
     try:
-        response = requests.post(search_url, headers=headers, json=search_payload, timeout=10)
+        response = http_transport.transporte.post(search_url, headers=headers, json=search_payload, timeout=10)
         response.raise_for_status()
         search_results = response.json()
 
@@ -51,35 +85,7 @@ def update_hubspot_contact(phone_number: str, name: str, last_message: str, lead
             logger.info(f"Contacto encontrado en HubSpot con ID: {contact_id}")
 
         # --- 2. Preparar los datos a actualizar/crear ---
-        properties_to_update = {
-            'phone': clean_phone_number,
-        }
-        
-        # El `last_message` ya no es relevante en el flujo asíncrono,
-        # pero lo mantenemos por si se usa en el futuro.
-        if last_message:
-            properties_to_update['whatsapp_last_message'] = last_message
-        
-        if name and name.strip():
-            properties_to_update['firstname'] = name
-
-        # --- ¡TRADUCTOR DE PROPIEDADES MEJORADO! ---
-        # Mapea las claves del JSON de la IA a los nombres internos de HubSpot.
-        if lead_data:
-            # ¡VERIFICAR! Asegúrate de que estos nombres internos coincidan con tu HubSpot.
-            # El nombre interno para el email suele ser simplemente 'email'.
-            prop_map = {
-                "email": "email", # ¡NUEVO! Añadido para manejar el email.
-                "customer_sector": "customer_sector_ia",
-                "purchase_potential": "purchase_potential_ia",
-                "lead_status": "lead_status_ia",
-                "next_recommended_action": "next_recommended_action_ia" # Añadido para ser completo
-            }
-            for key, value in lead_data.items():
-                # Solo actualizamos el campo si la IA encontró un valor y no es "Desconocido"
-                if key in prop_map and value and value.lower() != "desconocido":
-                    hubspot_key = prop_map[key]
-                    properties_to_update[hubspot_key] = value
+        properties_to_update = _construir_propiedades(clean_phone_number, name, last_message, lead_data)
 
         # --- 3. Crear o Actualizar el contacto (Lógica sin cambios) ---
         payload = {"properties": properties_to_update}
@@ -87,12 +93,12 @@ def update_hubspot_contact(phone_number: str, name: str, last_message: str, lead
         if contact_id:
             # Actualizar contacto existente
             update_url = f"{BASE_URL}/{contact_id}"
-            update_response = requests.patch(update_url, headers=headers, json=payload, timeout=10)
+            update_response = http_transport.transporte.patch(update_url, headers=headers, json=payload, timeout=10)
             update_response.raise_for_status()
             logger.info(f"Contacto {contact_id} actualizado en HubSpot con: {properties_to_update}")
         else:
             # Crear nuevo contacto
-            create_response = requests.post(BASE_URL, headers=headers, json=payload, timeout=10)
+            create_response = http_transport.transporte.post(BASE_URL, headers=headers, json=payload, timeout=10)
             create_response.raise_for_status()
             logger.info(f"Nuevo contacto para {clean_phone_number} creado en HubSpot con: {properties_to_update}")
 
@@ -102,3 +108,144 @@ def update_hubspot_contact(phone_number: str, name: str, last_message: str, lead
         logger.error(f"Error de conexión o timeout con la API de HubSpot para {clean_phone_number}: {e}")
     except Exception as e:
         logger.error(f"Error inesperado en la integración con HubSpot: {e}", exc_info=True)
+
+
+# --- Upsert en lote (pipeline de leads) ---
+# La API de búsqueda acepta hasta 100 valores en un filtro IN y los endpoints
+# batch/create y batch/update hasta 100 contactos por llamada.
+LOTE_MAXIMO = 100
+
+
+def _normalizar_telefono(telefono: str) -> str:
+    """Solo dígitos: '+54 9 11-1234' y '549111234' son el mismo contacto."""
+    return ''.join(c for c in (telefono or '').split('@')[0] if c.isdigit())
+
+
+def _buscar_ids_por_telefono(telefonos: list, headers: dict) -> dict:
+    """
+    Retorna {telefono normalizado: contact_id} para los teléfonos que ya existen en HubSpot.
+    El filtro IN compara el texto exacto, así que se busca cada número sin y con '+'
+    (dos filterGroups, unidos por OR) y lo que vuelve se compara normalizado.
+    """
+    normalizados = list(dict.fromkeys(_normalizar_telefono(t) for t in telefonos if _normalizar_telefono(t)))
+    encontrados = {}
+    if not normalizados:
+        return encontrados
+    payload = {
+        "filterGroups": [
+            {"filters": [{"propertyName": "phone", "operator": "IN", "values": normalizados}]},
+            {"filters": [{"propertyName": "phone", "operator": "IN", "values": [f"+{t}" for t in normalizados]}]},
+        ],
+        "properties": ["phone"],
+        "limit": LOTE_MAXIMO
+    }
+    while True:
+        response = http_transport.transporte.post(f"{BASE_URL}/search", headers=headers, json=payload, timeout=15)
+        response.raise_for_status()
+        resultados = response.json()
+        for contacto in resultados.get("results", []):
+            telefono = _normalizar_telefono((contacto.get("properties") or {}).get("phone"))
+            if telefono and telefono not in encontrados:
+                encontrados[telefono] = contacto["id"]
+        siguiente = (resultados.get("paging") or {}).get("next", {}).get("after")
+        if not siguiente:
+            return encontrados
+        payload["after"] = siguiente
+
+
+def _upsert_individual(limpio: str, propiedades: dict, headers: dict, contact_id: str = None) -> bool:
+    """Fallback de un contacto cuando falla su lote: busca (si hace falta) y actualiza o crea."""
+    try:
+        if contact_id is None:
+            contact_id = _buscar_ids_por_telefono([limpio], headers).get(limpio)
+        if contact_id:
+            response = http_transport.transporte.patch(f"{BASE_URL}/{contact_id}", headers=headers,
+                                                       json={"properties": propiedades}, timeout=10)
+        else:
+            response = http_transport.transporte.post(BASE_URL, headers=headers,
+                                                      json={"properties": propiedades}, timeout=10)
+        response.raise_for_status()
+        return True
+    except requests.exceptions.HTTPError as e:
+        logger.error(f"Error en la API de HubSpot para {limpio}: {e.response.status_code} - {e.response.text}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error de conexión o timeout con la API de HubSpot para {limpio}: {e}")
+    except Exception as e:
+        logger.error(f"Error inesperado en el upsert individual de HubSpot para {limpio}: {e}", exc_info=True)
+    return False
+
+
+def _enviar_lote(endpoint: str, inputs: list, headers: dict) -> bool:
+    try:
+        response = http_transport.transporte.post(f"{BASE_URL}/{endpoint}", headers=headers,
+                                                  json={"inputs": inputs}, timeout=30)
+        response.raise_for_status()
+        return True
+    except requests.exceptions.HTTPError as e:
+        logger.error(f"Error en HubSpot {endpoint} (lote de {len(inputs)}): {e.response.status_code} - {e.response.text}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error de conexión o timeout en HubSpot {endpoint} (lote de {len(inputs)}): {e}")
+    return False
+
+
+def batch_upsert_contacts(contactos: list) -> list:
+    """
+    Crea o actualiza varios contactos con una búsqueda + un batch/update + un batch/create
+    por cada 100 contactos (en vez de 2 llamadas por contacto). Si falla la búsqueda o
+    uno de los batch, los contactos de esa parte se reintentan de a uno.
+
+    contactos: lista de dicts con phone_number, name, last_message y lead_data.
+    Retorna la lista de phone_numbers (tal como llegaron) cuyo upsert terminó bien.
+    """
+    if not contactos:
+        return []
+    if not HUBSPOT_API_KEY:
+        logger.warning("No se ha configurado la clave de API de HubSpot. Saltando la actualización.")
+        return [c["phone_number"] for c in contactos]
+
+    headers = {
+        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    exitosos = []
+    for inicio in range(0, len(contactos), LOTE_MAXIMO):
+        lote = contactos[inicio:inicio + LOTE_MAXIMO]
+        por_telefono = {}
+        for contacto in lote:
+            limpio = _normalizar_telefono(contacto["phone_number"])
+            if limpio:
+                por_telefono.setdefault(limpio, []).append(contacto)
+            else:
+                logger.warning(f"Teléfono inválido para HubSpot, se omite: {contacto['phone_number']!r}")
+        propiedades = {
+            limpio: _construir_propiedades(limpio, grupo[-1].get("name", ""), grupo[-1].get("last_message", ""),
+                                           grupo[-1].get("lead_data") or {})
+            for limpio, grupo in por_telefono.items()
+        }
+        ok = set()
+        try:
+            existentes = _buscar_ids_por_telefono(list(por_telefono), headers)
+        except Exception as e:
+            logger.error(f"Error buscando contactos en HubSpot (lote de {len(lote)}), se sigue de a uno: {e}")
+            existentes = None
+
+        if existentes is None:
+            ok.update(limpio for limpio in por_telefono if _upsert_individual(limpio, propiedades[limpio], headers))
+        else:
+            actualizar = [limpio for limpio in por_telefono if limpio in existentes]
+            crear = [limpio for limpio in por_telefono if limpio not in existentes]
+            if actualizar:
+                if _enviar_lote("batch/update", [{"id": existentes[t], "properties": propiedades[t]} for t in actualizar], headers):
+                    ok.update(actualizar)
+                else:
+                    ok.update(t for t in actualizar if _upsert_individual(t, propiedades[t], headers, existentes[t]))
+            if crear:
+                if _enviar_lote("batch/create", [{"properties": propiedades[t]} for t in crear], headers):
+                    ok.update(crear)
+                else:
+                    # Se vuelve a buscar cada uno: no duplicar si parte del lote llegó a crearse
+                    ok.update(t for t in crear if _upsert_individual(t, propiedades[t], headers))
+            logger.info(f"HubSpot upsert en lote: {len(actualizar)} a actualizar, {len(crear)} a crear, "
+                        f"{len(ok)}/{len(por_telefono)} OK.")
+        exitosos.extend(c["phone_number"] for limpio in ok for c in por_telefono[limpio])
+    return exitosos
@@ -0,0 +1,204 @@
+"""
+Pre-procesamiento de imágenes antes del Agente Lector (visión).
+
+WhatsApp entrega fotos de celular a resolución completa (3-12 MP). El modelo de
+visión las reescala igual del lado del servidor, así que mandarlas enteras solo
+agrega tiempo de subida y tokens de imagen. Antes de llamar al lector:
+
+1. Decodificar y auto-orientar según EXIF (fotos de comprobantes giradas).
+2. Reducir al tamaño que usa el nivel de detalle configurado
+   (IMAGE_LECTOR_DETAIL: "high" -> entra en 2048x2048 con el lado corto <= 768;
+   "low" -> lado largo <= 512).
+3. Re-codificar como JPEG (calidad IMAGE_JPEG_QUALITY) sin metadatos.
+
+Además, un caché por hash SHA-256 del contenido original permite que un
+comprobante reenviado reutilice el análisis ya hecho en vez de volver a llamar
+al modelo.
+
+Pillow es opcional: si no está instalado, la imagen se envía tal cual (pero el
+caché por hash sigue funcionando).
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+    logger.warning("[IMAGE_PREPROC] Pillow no instalado: las imágenes se enviarán al lector sin pre-procesar.")
+
+_FIRMAS_MIME = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'RIFF', 'image/webp'),
+)
+
+
+def _mime_por_firma(contenido: bytes) -> str:
+    for firma, mime in _FIRMAS_MIME:
+        if contenido.startswith(firma):
+            return mime
+    return 'image/jpeg'
+
+
+def _tamano_objetivo(ancho: int, alto: int, detalle: str) -> tuple:
+    """Dimensiones finales según las reglas de escalado del nivel de detalle."""
+    if detalle == 'low':
+        escala = min(1.0, 512 / max(ancho, alto))
+    else:
+        escala = min(1.0, 2048 / max(ancho, alto), 768 / max(1, min(ancho, alto)))
+    return max(1, int(round(ancho * escala))), max(1, int(round(alto * escala)))
+
+
+class ImagenPreparada:
+    __slots__ = ('sha256', 'contenido', 'mime', 'bytes_originales', 'dimensiones', 'procesada', 'ms')
+
+    def __init__(self, sha256, contenido, mime, bytes_originales, dimensiones, procesada, ms):
+        self.sha256 = sha256
+        self.contenido = contenido
+        self.mime = mime
+        self.bytes_originales = bytes_originales
+        self.dimensiones = dimensiones
+        self.procesada = procesada
+        self.ms = ms
+
+    def parte_lector(self, detalle: str | None = None) -> dict:
+        """Bloque image_url listo para llm_handler.llamar_agente_lector."""
+        datos = base64.b64encode(self.contenido).decode('utf-8')
+        return {"type": "image_url", "image_url": {
+            "url": f"data:{self.mime};base64,{datos}",
+            "detail": detalle or getattr(config, 'IMAGE_LECTOR_DETAIL', 'high'),
+        }}
+
+
+class PreprocesadorImagenes:
+    """Normaliza imágenes para el lector y cachea análisis por hash de contenido."""
+
+    def __init__(self, detalle: str = 'high', calidad_jpeg: int = 85, max_bytes_entrada: int = 20 * 1024 * 1024,
+                 cache_max: int = 512, cache_ttl: float = 7 * 24 * 3600):
+        self.detalle = detalle if detalle in ('high', 'low') else 'high'
+        self.calidad_jpeg = int(calidad_jpeg)
+        self.max_bytes_entrada = int(max_bytes_entrada)
+        self.cache_max = max(1, int(cache_max))
+        self.cache_ttl = float(cache_ttl)
+        self._cache = OrderedDict()   # sha256 -> (analisis, guardado_en)
+        self._lock = Lock()
+        self._stats = {'imagenes': 0, 'procesadas': 0, 'sin_procesar': 0, 'bytes_originales': 0,
+                       'bytes_enviados': 0, 'ms_total': 0.0, 'cache_hits': 0, 'cache_misses': 0}
+
+    @staticmethod
+    def huella(contenido: bytes) -> str:
+        """Hash SHA-256 del contenido original (clave del caché de análisis)."""
+        return hashlib.sha256(contenido).hexdigest()
+
+    def preparar(self, contenido: bytes, sha256: str | None = None) -> ImagenPreparada:
+        """Decodifica, orienta, reduce y re-codifica. Ante cualquier error devuelve el original."""
+        inicio = time.perf_counter()
+        sha256 = sha256 or self.huella(contenido)
+        resultado = None
+        if Image is not None and len(contenido) <= self.max_bytes_entrada:
+            try:
+                with Image.open(io.BytesIO(contenido)) as imagen:
+                    if imagen.format == 'JPEG':
+                        # Decodificar directo a una escala reducida (DCT) cuando alcanza para el destino
+                        lado = max(_tamano_objetivo(imagen.width, imagen.height, self.detalle))
+                        imagen.draft('RGB', (lado, lado))
+                    imagen = ImageOps.exif_transpose(imagen)
+                    if imagen.mode in ('RGBA', 'LA', 'P'):
+                        imagen = imagen.convert('RGBA')
+                        fondo = Image.new('RGB', imagen.size, (255, 255, 255))
+                        fondo.paste(imagen, mask=imagen.split()[-1])
+                        imagen = fondo
+                    elif imagen.mode != 'RGB':
+                        imagen = imagen.convert('RGB')
+                    destino = _tamano_objetivo(imagen.width, imagen.height, self.detalle)
+                    if destino != imagen.size:
+                        imagen = imagen.resize(destino, Image.LANCZOS)
+                    salida = io.BytesIO()
+                    imagen.save(salida, format='JPEG', quality=self.calidad_jpeg, optimize=True)
+                    nuevo = salida.getvalue()
+                # Si re-codificar no achicó (imagen chica ya comprimida), mandar el original
+                if len(nuevo) < len(contenido):
+                    resultado = ImagenPreparada(sha256, nuevo, 'image/jpeg', len(contenido), destino, True, 0.0)
+            except Exception as e:
+                logger.warning(f"[IMAGE_PREPROC] No se pudo pre-procesar la imagen ({sha256[:12]}): {e}")
+        if resultado is None:
+            resultado = ImagenPreparada(sha256, contenido, _mime_por_firma(contenido), len(contenido), None, False, 0.0)
+        resultado.ms = (time.perf_counter() - inicio) * 1000
+        with self._lock:
+            self._stats['imagenes'] += 1
+            self._stats['procesadas' if resultado.procesada else 'sin_procesar'] += 1
+            self._stats['bytes_originales'] += resultado.bytes_originales
+            self._stats['bytes_enviados'] += len(resultado.contenido)
+            self._stats['ms_total'] += resultado.ms
+        if resultado.procesada:
+            logger.info(f"[IMAGE_PREPROC] {resultado.bytes_originales // 1024}KB -> {len(resultado.contenido) // 1024}KB "
+                        f"({resultado.dimensiones[0]}x{resultado.dimensiones[1]}) en {resultado.ms:.0f}ms")
+        return resultado
+
+    # --- Caché de análisis por hash de contenido ---
+
+    def analisis_cacheado(self, sha256: str) -> str | None:
+        with self._lock:
+            entrada = self._cache.get(sha256)
+            if entrada is not None and time.time() - entrada[1] <= self.cache_ttl:
+                self._cache.move_to_end(sha256)
+                self._stats['cache_hits'] += 1
+                return entrada[0]
+            if entrada is not None:
+                del self._cache[sha256]
+            self._stats['cache_misses'] += 1
+            return None
+
+    def guardar_analisis(self, sha256: str, analisis: str):
+        if not analisis or analisis.startswith("Lo siento"):
+            return
+        with self._lock:
+            self._cache[sha256] = (analisis, time.time())
+            self._cache.move_to_end(sha256)
+            while len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            entradas = len(self._cache)
+        imagenes = stats['imagenes'] or 1
+        consultas = stats['cache_hits'] + stats['cache_misses']
+        return {
+            'pillow_disponible': Image is not None,
+            'detalle': self.detalle,
+            'imagenes': stats['imagenes'],
+            'procesadas': stats['procesadas'],
+            'sin_procesar': stats['sin_procesar'],
+            'bytes_ahorrados': stats['bytes_originales'] - stats['bytes_enviados'],
+            'ratio_bytes': round(stats['bytes_enviados'] / stats['bytes_originales'], 3) if stats['bytes_originales'] else None,
+            'ms_promedio': round(stats['ms_total'] / imagenes, 1),
+            'cache': {
+                'entradas': entradas,
+                'hits': stats['cache_hits'],
+                'misses': stats['cache_misses'],
+                'hit_rate': round(stats['cache_hits'] / consultas, 3) if consultas else None,
+            },
+        }
+
+
+preprocesador = PreprocesadorImagenes(
+    detalle=getattr(config, 'IMAGE_LECTOR_DETAIL', 'high'),
+    calidad_jpeg=getattr(config, 'IMAGE_JPEG_QUALITY', 85),
+    max_bytes_entrada=getattr(config, 'IMAGE_MAX_INPUT_BYTES', 20 * 1024 * 1024),
+    cache_max=getattr(config, 'IMAGE_ANALYSIS_CACHE_SIZE', 512),
+    cache_ttl=getattr(config, 'IMAGE_ANALYSIS_CACHE_TTL', 7 * 24 * 3600),
+)
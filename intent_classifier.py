@@ -0,0 +1,303 @@
+"""
+Clasificador rápido de intenciones (fast-path) previo al LLM.
+
+Reemplaza las búsquedas encadenadas con `in` que estaban repartidas entre
+llm_handler.llamar_meta_agente, ballester_main_extensions._detect_ballester_commands,
+la lista de palabras clave BALLESTER_V11 de main.process_message_logic y
+verification_handler._detectar_estudios_ballester.
+
+- Un único autómata Aho–Corasick compilado una sola vez sobre texto
+  normalizado (minúsculas, sin acentos, espacios colapsados).
+- Tabla de reglas con confianza: cada regla pertenece a un grupo (un llamador),
+  tiene una intención, una confianza y una prioridad (orden en la tabla).
+- Si la mejor regla no supera INTENT_FASTPATH_MIN_CONFIDENCE, el llamador sigue
+  por el camino lento (LLM).
+- Estadísticas por grupo: consultas y resueltas. La fracción de turnos
+  servidos sin LLM cuenta cada turno una vez (iniciar_turno), aunque consulte
+  varios grupos decisivos o el mismo grupo varias veces.
+"""
+
+import logging
+import time
+import unicodedata
+from collections import deque
+from functools import lru_cache
+from threading import Lock, local
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+# Palabras que, inmediatamente antes de un comando, lo vuelven dudoso ("no quiero agendar")
+NEGACIONES = ('no', 'nunca', 'tampoco', 'ni')
+PENALIZACION_NEGACION = 0.5
+
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sin acentos y con espacios colapsados."""
+    if not texto:
+        return ""
+    texto = unicodedata.normalize('NFKD', str(texto).lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.split())
+
+
+class AhoCorasick:
+    """Autómata Aho–Corasick mínimo sobre cadenas ya normalizadas."""
+
+    def __init__(self, patrones):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self.patrones = []
+        for patron in patrones:
+            self._agregar(patron)
+        self._compilar()
+
+    def _agregar(self, patron: str):
+        indice = len(self.patrones)
+        self.patrones.append(patron)
+        estado = 0
+        for caracter in patron:
+            siguiente = self._goto[estado].get(caracter)
+            if siguiente is None:
+                siguiente = len(self._goto)
+                self._goto[estado][caracter] = siguiente
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            estado = siguiente
+        self._out[estado].append(indice)
+
+    def _compilar(self):
+        cola = deque(self._goto[0].values())
+        while cola:
+            estado = cola.popleft()
+            for caracter, siguiente in self._goto[estado].items():
+                cola.append(siguiente)
+                fallo = self._fail[estado]
+                while fallo and caracter not in self._goto[fallo]:
+                    fallo = self._fail[fallo]
+                destino = self._goto[fallo].get(caracter, 0)
+                self._fail[siguiente] = destino if destino != siguiente else 0
+                self._out[siguiente] = self._out[siguiente] + self._out[self._fail[siguiente]]
+
+    def buscar(self, texto: str):
+        """Retorna lista de (inicio, indice_patron) para todas las coincidencias."""
+        resultados = []
+        estado = 0
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        for posicion, caracter in enumerate(texto):
+            while estado and caracter not in goto[estado]:
+                estado = fail[estado]
+            estado = goto[estado].get(caracter, 0)
+            if out[estado]:
+                for indice in out[estado]:
+                    resultados.append((posicion - len(self.patrones[indice]) + 1, indice))
+        return resultados
+
+
+class ReglaIntencion:
+    """Regla de la tabla: frases que disparan una intención dentro de un grupo."""
+
+    __slots__ = ('grupo', 'intencion', 'frases', 'confianza', 'prioridad')
+
+    def __init__(self, grupo: str, intencion: str, frases, confianza: float = 1.0, prioridad: int = 0):
+        self.grupo = grupo
+        self.intencion = intencion
+        self.frases = [normalizar_texto(f) for f in frases]
+        self.confianza = confianza
+        self.prioridad = prioridad
+
+
+# Tabla de reglas. El orden dentro de cada grupo es la prioridad ante empates de confianza
+# (respeta el orden en que los llamadores originales evaluaban sus `if`).
+REGLAS = [
+    # --- llm_handler.llamar_meta_agente ---
+    ('meta_agente', 'SALIR_PAGOS', ['salir de pago', 'salir de pagos'], 1.0),
+    ('meta_agente', 'SALIR_AGENDAMIENTO', ['salir de agenda', 'salir de agendamiento'], 1.0),
+    ('meta_agente', 'AGENDAMIENTO', ['quiero agendar'], 1.0),
+    ('meta_agente', 'REPROGRAMACION', ['quiero reprogramar'], 1.0),
+    ('meta_agente', 'PAGOS', ['quiero pagar'], 1.0),
+
+    # --- ballester_main_extensions._detect_ballester_commands ---
+    ('ballester_comandos', 'BALLESTER_MEDICAL_VERIFICATION', ['quiero agendar', 'necesito turno', 'pedir cita'], 1.0),
+    ('ballester_comandos', 'BALLESTER_COVERAGE_CHECK', ['consultar cobertura', 'que cubre mi obra social', 'cuanto cuesta'], 1.0),
+    ('ballester_comandos', 'BALLESTER_CANCEL_APPOINTMENT', ['cancelar turno', 'cancelar cita'], 1.0),
+    ('ballester_comandos', 'BALLESTER_RESCHEDULE_APPOINTMENT', ['reprogramar turno', 'cambiar turno'], 1.0),
+
+    # --- main.process_message_logic: inicio automático del flujo médico V11 ---
+    ('inicio_medico', 'INICIAR_VERIFICACION_MEDICA', [
+        'quiero agendar', 'consultar cobertura', 'obra social', 'neurologia', 'ecografia', 'eeg', 'cardiologia'
+    ], 1.0),
+]
+
+# Grupos en los que no resolver implica una llamada al LLM (para la métrica de turnos sin LLM)
+GRUPOS_DECISIVOS = ('meta_agente', 'inicio_medico')
+
+
+class ResultadoIntencion:
+    __slots__ = ('grupo', 'intencion', 'confianza', 'frase', 'resuelta')
+
+    def __init__(self, grupo, intencion, confianza, frase, resuelta):
+        self.grupo = grupo
+        self.intencion = intencion
+        self.confianza = confianza
+        self.frase = frase
+        self.resuelta = resuelta
+
+    def __repr__(self):
+        return (f"ResultadoIntencion(grupo={self.grupo!r}, intencion={self.intencion!r}, "
+                f"confianza={self.confianza:.2f}, frase={self.frase!r}, resuelta={self.resuelta})")
+
+
+class ClasificadorRapido:
+    """Tabla de reglas compilada en un único autómata compartido por todos los grupos."""
+
+    def __init__(self, reglas, umbral: float = 0.9):
+        self.umbral = umbral
+        self.reglas = []
+        frases = []
+        self._frase_a_reglas = []
+        indice_frase = {}
+        prioridades = {}
+        for grupo, intencion, lista_frases, confianza in reglas:
+            prioridad = prioridades.get(grupo, 0)
+            prioridades[grupo] = prioridad + 1
+            regla = ReglaIntencion(grupo, intencion, lista_frases, confianza, prioridad)
+            self.reglas.append(regla)
+            for frase in regla.frases:
+                if frase not in indice_frase:
+                    indice_frase[frase] = len(frases)
+                    frases.append(frase)
+                    self._frase_a_reglas.append([])
+                self._frase_a_reglas[indice_frase[frase]].append(regla)
+        self._automata = AhoCorasick(frases)
+        self._escanear = lru_cache(maxsize=1024)(self._escanear_sin_cache)
+        self._lock = Lock()
+        self._stats = {}
+        self._turno = local()
+        self._turnos = {'turnos': 0, 'sin_llm': 0}
+
+    def _escanear_sin_cache(self, texto_normalizado: str):
+        """Un único recorrido del texto; devuelve las coincidencias para todos los grupos."""
+        return tuple(self._automata.buscar(texto_normalizado))
+
+    @staticmethod
+    def _negada(texto: str, inicio: int) -> bool:
+        previo = texto[:inicio].rstrip().rsplit(' ', 1)[-1] if inicio > 0 else ''
+        return previo in NEGACIONES
+
+    def clasificar(self, texto: str, grupo: str) -> ResultadoIntencion | None:
+        """Retorna la mejor intención del grupo, o None si no hubo coincidencias.
+
+        `resultado.resuelta` es False cuando la confianza no alcanza el umbral y
+        el llamador debe seguir por el camino lento.
+        """
+        inicio_t = time.perf_counter()
+        normalizado = normalizar_texto(texto)
+        mejor = None
+        mejor_frase = None
+        mejor_confianza = 0.0
+        for inicio, indice in self._escanear(normalizado):
+            for regla in self._frase_a_reglas[indice]:
+                if regla.grupo != grupo:
+                    continue
+                confianza = regla.confianza
+                if self._negada(normalizado, inicio):
+                    confianza *= PENALIZACION_NEGACION
+                if (mejor is None or confianza > mejor_confianza
+                        or (confianza == mejor_confianza and regla.prioridad < mejor.prioridad)):
+                    mejor, mejor_frase, mejor_confianza = regla, self._automata.patrones[indice], confianza
+
+        resultado = None
+        if mejor is not None:
+            resultado = ResultadoIntencion(grupo, mejor.intencion, mejor_confianza, mejor_frase,
+                                           mejor_confianza >= self.umbral)
+        self._registrar(grupo, resultado, time.perf_counter() - inicio_t)
+        return resultado
+
+    def intencion_resuelta(self, texto: str, grupo: str) -> str | None:
+        """Atajo: intención del grupo solo si el fast-path está seguro."""
+        resultado = self.clasificar(texto, grupo)
+        return resultado.intencion if resultado and resultado.resuelta else None
+
+    def iniciar_turno(self):
+        """Marca el comienzo de un turno en este hilo (lo llama el orquestador)."""
+        self._turno.estado = {'contado': False, 'resuelto': False}
+
+    def terminar_turno(self):
+        self._turno.estado = None
+
+    def _registrar_turno(self, resuelta: bool):
+        """Requiere el lock. Sin iniciar_turno (otro llamador) cada consulta es su propio turno."""
+        estado = getattr(self._turno, 'estado', None) or {'contado': False, 'resuelto': False}
+        if not estado['contado']:
+            estado['contado'] = True
+            self._turnos['turnos'] += 1
+        if resuelta and not estado['resuelto']:
+            estado['resuelto'] = True
+            self._turnos['sin_llm'] += 1
+
+    def _registrar(self, grupo: str, resultado, segundos: float):
+        with self._lock:
+            if grupo in GRUPOS_DECISIVOS:
+                self._registrar_turno(resultado is not None and resultado.resuelta)
+            stats = self._stats.setdefault(grupo, {'consultas': 0, 'resueltas': 0, 'dudosas': 0, 'micros_total': 0.0})
+            stats['consultas'] += 1
+            stats['micros_total'] += segundos * 1_000_000
+            if resultado is not None:
+                if resultado.resuelta:
+                    stats['resueltas'] += 1
+                else:
+                    stats['dudosas'] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            por_grupo = {}
+            for grupo, stats in self._stats.items():
+                consultas = stats['consultas'] or 1
+                por_grupo[grupo] = {
+                    'consultas': stats['consultas'],
+                    'resueltas': stats['resueltas'],
+                    'dudosas': stats['dudosas'],
+                    'fraccion_sin_llm': round(stats['resueltas'] / consultas, 3),
+                    'micros_promedio': round(stats['micros_total'] / consultas, 2),
+                }
+            turnos = dict(self._turnos)
+        cache = self._escanear.cache_info()
+        return {
+            'umbral_confianza': self.umbral,
+            'patrones_compilados': len(self._automata.patrones),
+            'turnos': turnos['turnos'],
+            'fraccion_turnos_sin_llm': round(turnos['sin_llm'] / turnos['turnos'], 3) if turnos['turnos'] else None,
+            'por_grupo': por_grupo,
+            'cache_escaneos': {'hits': cache.hits, 'misses': cache.misses, 'size': cache.currsize},
+        }
+
+
+class MatcherDiccionario:
+    """Coincidencias de un diccionario palabra_clave -> valor con un solo recorrido.
+
+    Conserva la semántica de `for clave, valor in mapa.items(): if clave in texto`,
+    incluido el orden de los valores devueltos (orden del diccionario).
+    """
+
+    def __init__(self, mapa: dict):
+        self._claves = list(mapa.keys())
+        self._valores = list(mapa.values())
+        self._automata = AhoCorasick([normalizar_texto(k) for k in self._claves])
+
+    def buscar(self, texto: str) -> list:
+        indices = {indice for _inicio, indice in self._automata.buscar(normalizar_texto(texto))}
+        valores = []
+        for indice in sorted(indices):
+            valor = self._valores[indice]
+            if valor not in valores:
+                valores.append(valor)
+        return valores
+
+
+clasificador = ClasificadorRapido(REGLAS, umbral=getattr(config, 'INTENT_FASTPATH_MIN_CONFIDENCE', 0.9))
@@ -14,6 +14,7 @@ import config
 import memory # Usaremos funciones para leer desde Firebase
 import llm_handler # Usaremos al nuevo "Agente Analista de Leads"
 import hubspot_handler # Usaremos la función para actualizar HubSpot
+import lead_pipeline # Análisis concurrente y upserts en lote
 
 # --- Configuración del Logger ---
 logging.basicConfig(level=logging.INFO,
@@ -75,46 +76,15 @@ def analizar_conversaciones_recientes():
 
     logger.info(f"Se encontraron {len(conversaciones)} conversaciones para analizar.")
 
-    # 3. Procesar cada conversación de forma individual.
-    for autor, datos_conv in conversaciones.items():
-        logger.info(f"Procesando conversación de: {autor}...")
-        
-        try:
-            historial = datos_conv.get('history', [])
-            sender_name = datos_conv.get('senderName', '') # Recuperamos el nombre si existe
-            
-            if not historial:
-                logger.warning(f"La conversación de {autor} no tiene historial. Saltando.")
-                continue
-
-            # 4. Formatear el historial en una transcripción de texto.
-            transcripcion = formatear_transcripcion(historial)
-            
-            # 5. Llamar al Agente Analista de Leads.
-            respuesta_analista = llm_handler.llamar_analista_leads(transcripcion)
-            
-            # 6. Parsear la respuesta para obtener el JSON con los datos del lead.
-            datos_lead = parsear_json_del_analista(respuesta_analista)
-            
-            if not datos_lead:
-                logger.error(f"No se pudo generar el JSON para {autor}. Se reintentará en el próximo ciclo.")
-                continue
-
-            # 7. Actualizar HubSpot con la información obtenida.
-            logger.info(f"Actualizando HubSpot para {autor} con los siguientes datos: {datos_lead}")
-            clean_phone_number = autor.split('@')[0]
-            # Usamos una cadena vacía para `last_message` ya que no es relevante aquí.
-            hubspot_handler.update_hubspot_contact(
-                phone_number=clean_phone_number,
-                name=sender_name,
-                last_message="", 
-                lead_data=datos_lead
-            )
-            logger.info(f"Procesamiento para {autor} finalizado con éxito.")
-
-        except Exception as e:
-            logger.error(f"Ocurrió un error inesperado al procesar la conversación de {autor}: {e}", exc_info=True)
-            # El bucle continúa con la siguiente conversación.
+    # 3. Procesar las conversaciones con el pipeline por etapas:
+    #    análisis concurrente acotado + upsert en lote en HubSpot, por tramos.
+    #    Este cron no marca `lead_processed` (eso lo hace el demonio del bot).
+    lead_pipeline.pipeline.procesar(
+        conversaciones,
+        formatear_transcripcion,
+        lambda respuesta, autor: parsear_json_del_analista(respuesta),
+        marcar=False
+    )
 
     logger.info("--- Ciclo de análisis de leads finalizado ---")
 
@@ -0,0 +1,166 @@
+"""
+Pipeline por etapas para el análisis de leads en lote.
+
+Lo usan main.procesar_leads_inactivos (demonio cada 900s) y
+lead_generator.analizar_conversaciones_recientes (cron):
+
+1. Análisis: transcripción + Agente Analista + parseo del JSON, con
+   concurrencia acotada (LEAD_ANALYSIS_CONCURRENCY). Las llamadas al LLM van
+   con prioridad de fondo por el planificador de llm_handler.
+2. HubSpot: upsert en lote (búsqueda IN + batch/update + batch/create).
+3. Firestore: `lead_processed = True` en escrituras por lote, solo para los
+   leads cuyo upsert terminó bien.
+
+Los leads se procesan en tramos (LEAD_PIPELINE_CHUNK_SIZE). Al cerrar cada
+tramo se confirman HubSpot y Firestore, así que ese es el checkpoint: si el
+ciclo se corta o agota su presupuesto de tiempo (LEAD_PIPELINE_TIME_BUDGET),
+el siguiente retoma desde los leads que siguen sin marcar. Los leads que
+fallan en el análisis o en HubSpot quedan en enfriamiento para no bloquear a
+los demás ni repetir el análisis en cada ciclo.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import config
+import hubspot_handler
+import llm_handler
+import memory
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+
+class LeadPipeline:
+    """Análisis concurrente + upserts y marcas en lote, con checkpoint por tramo."""
+
+    def __init__(self, concurrencia: int = 4, tamano_tramo: int = 50, presupuesto_s: float = 780.0,
+                 enfriamiento_fallo_s: float = 3600.0):
+        self.concurrencia = max(1, int(concurrencia))
+        self.tamano_tramo = max(1, int(tamano_tramo))
+        self.presupuesto_s = float(presupuesto_s)
+        self.enfriamiento_fallo_s = float(enfriamiento_fallo_s)
+        self._lock = Lock()
+        self._fallidos = {}   # autor -> timestamp del último fallo (análisis o HubSpot). Protegido por _lock
+        self._ultimo_ciclo = {}
+        self._totales = {'ciclos': 0, 'analizados': 0, 'sin_datos': 0, 'errores': 0,
+                         'hubspot_ok': 0, 'hubspot_fallidos': 0, 'marcados': 0}
+
+    def _en_enfriamiento(self, autor: str, ahora: float) -> bool:
+        """Requiere _lock."""
+        fallo = self._fallidos.get(autor)
+        return fallo is not None and ahora - fallo < self.enfriamiento_fallo_s
+
+    def _podar_fallidos(self, ahora: float):
+        """Olvida los fallos con el enfriamiento cumplido (autores que ya no vuelven no se acumulan). Requiere _lock."""
+        for autor in [a for a, fallo in self._fallidos.items() if ahora - fallo >= self.enfriamiento_fallo_s]:
+            del self._fallidos[autor]
+
+    def _registrar_fallo(self, autor: str):
+        with self._lock:
+            self._fallidos[autor] = time.time()
+
+    def _analizar(self, autor: str, datos_conv: dict, formatear, parsear):
+        """Etapa 1 para una conversación. Retorna el contacto a upsertear o None."""
+        historial = datos_conv.get('history', [])
+        if not historial:
+            return None
+        transcripcion = formatear(historial)
+        respuesta_analista = llm_handler.llamar_analista_leads(transcripcion)
+        datos_lead = parsear(respuesta_analista, autor)
+        if not datos_lead:
+            return None
+        return {
+            'phone_number': autor.split('@')[0],
+            'autor': autor,
+            'name': datos_conv.get('senderName', ''),
+            'last_message': '',
+            'lead_data': datos_lead,
+        }
+
+    def procesar(self, conversaciones: dict, formatear, parsear, marcar: bool = True) -> dict:
+        """
+        Procesa las conversaciones por tramos. `parsear(respuesta, autor)` devuelve el dict del lead.
+        Retorna el resumen del ciclo; `pendientes` > 0 indica que se agotó el presupuesto de tiempo.
+        """
+        inicio = time.monotonic()
+        ahora = time.time()
+        with self._lock:
+            self._podar_fallidos(ahora)
+            candidatos = [(autor, datos) for autor, datos in conversaciones.items()
+                          if not self._en_enfriamiento(autor, ahora)]
+        # Los más viejos primero: son los que llevan más tiempo esperando
+        candidatos.sort(key=lambda item: str(item[1].get('last_updated') or ''))
+        resumen = {'candidatos': len(candidatos), 'en_enfriamiento': len(conversaciones) - len(candidatos),
+                   'analizados': 0, 'sin_datos': 0, 'errores': 0, 'hubspot_ok': 0, 'hubspot_fallidos': 0,
+                   'marcados': 0, 'tramos': 0, 'pendientes': 0}
+
+        with ThreadPoolExecutor(max_workers=self.concurrencia, thread_name_prefix='lead_analisis') as pool:
+            for desde in range(0, len(candidatos), self.tamano_tramo):
+                if time.monotonic() - inicio > self.presupuesto_s:
+                    resumen['pendientes'] = len(candidatos) - desde
+                    logger.warning(f"[LEAD_PIPELINE] Presupuesto de {self.presupuesto_s:.0f}s agotado. "
+                                   f"Quedan {resumen['pendientes']} leads para el próximo ciclo.")
+                    break
+                tramo = candidatos[desde:desde + self.tamano_tramo]
+                futuros = [(autor, pool.submit(self._analizar, autor, datos, formatear, parsear)) for autor, datos in tramo]
+                contactos = []
+                for autor, futuro in futuros:
+                    try:
+                        contacto = futuro.result()
+                    except Exception as e:
+                        logger.error(f"[LEAD_PIPELINE] Error analizando el lead de {autor}: {e}", exc_info=True)
+                        resumen['errores'] += 1
+                        self._registrar_fallo(autor)
+                        continue
+                    if contacto is None:
+                        resumen['sin_datos'] += 1
+                        self._registrar_fallo(autor)
+                        continue
+                    resumen['analizados'] += 1
+                    with self._lock:
+                        self._fallidos.pop(autor, None)
+                    contactos.append(contacto)
+
+                # Etapas 2 y 3: checkpoint del tramo
+                exitosos = set(hubspot_handler.batch_upsert_contacts(contactos))
+                resumen['hubspot_ok'] += len(exitosos)
+                # Sin upsert no se marcan: enfriamiento para no volver a analizarlos con el LLM en cada ciclo
+                for contacto in contactos:
+                    if contacto['phone_number'] not in exitosos:
+                        resumen['hubspot_fallidos'] += 1
+                        self._registrar_fallo(contacto['autor'])
+                if marcar:
+                    autores_ok = [c['autor'] for c in contactos if c['phone_number'] in exitosos]
+                    resumen['marcados'] += len(memory.marcar_leads_como_procesados(autores_ok))
+                resumen['tramos'] += 1
+
+        resumen['duracion_s'] = round(time.monotonic() - inicio, 2)
+        with self._lock:
+            self._ultimo_ciclo = dict(resumen, terminado_en=time.time())
+            self._totales['ciclos'] += 1
+            for clave in ('analizados', 'sin_datos', 'errores', 'hubspot_ok', 'hubspot_fallidos', 'marcados'):
+                self._totales[clave] += resumen[clave]
+        logger.info(f"[LEAD_PIPELINE] Ciclo terminado: {resumen}")
+        return resumen
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._podar_fallidos(time.time())
+            return {
+                'concurrencia': self.concurrencia,
+                'tamano_tramo': self.tamano_tramo,
+                'presupuesto_s': self.presupuesto_s,
+                'en_enfriamiento': len(self._fallidos),
+                'ultimo_ciclo': dict(self._ultimo_ciclo),
+                'totales': dict(self._totales),
+            }
+
+
+pipeline = LeadPipeline(
+    concurrencia=getattr(config, 'LEAD_ANALYSIS_CONCURRENCY', 4),
+    tamano_tramo=getattr(config, 'LEAD_PIPELINE_CHUNK_SIZE', 50),
+    presupuesto_s=getattr(config, 'LEAD_PIPELINE_TIME_BUDGET', 780.0),
+    enfriamiento_fallo_s=getattr(config, 'LEAD_PIPELINE_FAILURE_COOLDOWN', 3600.0),
+)
@@ -0,0 +1,249 @@
+"""
+Backends intercambiables para las llamadas al LLM.
+
+- OpenAIBackend: el cliente openai.OpenAI de siempre (modo por defecto).
+- RecordingBackend: llama al backend real y graba cada respuesta en un cassette.
+- ReplayBackend: sirve respuestas grabadas sin red, con latencia sintética.
+
+El cassette es un SQLite con una fila por huella de request: huella SHA-256 del
+request canónico (JSON con claves ordenadas, sin la línea de "FECHA Y HORA
+ACTUAL" que cambia en cada turno) -> respuesta serializada y comprimida con zlib
++ latencia observada al grabar.
+
+Selección con LLM_BACKEND=openai|record|replay y LLM_CASSETTE_PATH.
+Latencia de replay con LLM_REPLAY_LATENCY:
+  none | recorded | fixed:<ms> | uniform:<min_ms>,<max_ms> | lognormal:<mediana_ms>,<sigma>
+"""
+
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import sqlite3
+import time
+import zlib
+from threading import Lock
+from types import SimpleNamespace
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+_FECHA_VOLATIL = re.compile(r'FECHA Y HORA ACTUAL: [^\n]*')
+
+
+class CassetteMissError(Exception):
+    """El request no está grabado en el cassette (modo replay)."""
+
+
+def _sin_fecha(valor):
+    """Reemplaza la línea de fecha en los textos del request (antes de serializar: ahí el salto de línea es real)."""
+    if isinstance(valor, str):
+        return _FECHA_VOLATIL.sub('FECHA Y HORA ACTUAL: <fecha>', valor)
+    if isinstance(valor, dict):
+        return {k: _sin_fecha(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_sin_fecha(v) for v in valor]
+    return valor
+
+
+def huella_request(tipo: str, kwargs: dict) -> str:
+    """Huella estable del request: ignora solo la línea de fecha/hora inyectada en los prompts."""
+    canonico = json.dumps({'tipo': tipo, 'kwargs': _sin_fecha(kwargs)}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonico.encode('utf-8')).hexdigest()
+
+
+def _a_namespace(valor):
+    if isinstance(valor, dict):
+        return SimpleNamespace(**{k: _a_namespace(v) for k, v in valor.items()})
+    if isinstance(valor, list):
+        return [_a_namespace(v) for v in valor]
+    return valor
+
+
+def serializar_respuesta(response) -> dict:
+    """Convierte la respuesta del SDK en un dict JSON (incluye output_text, que es una propiedad)."""
+    if hasattr(response, 'model_dump'):
+        datos = response.model_dump(mode='json')
+    elif isinstance(response, SimpleNamespace):
+        datos = json.loads(json.dumps(response, default=lambda o: vars(o)))
+    else:
+        datos = dict(response)
+    output_text = getattr(response, 'output_text', None)
+    if isinstance(output_text, str):
+        datos['output_text'] = output_text
+    return datos
+
+
+class CassetteStore:
+    """Almacén en disco de respuestas grabadas (SQLite + zlib)."""
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cassette ("
+                " huella TEXT PRIMARY KEY, tipo TEXT, modelo TEXT, respuesta BLOB,"
+                " latencia_ms REAL, grabado_en REAL)"
+            )
+            self._conn.commit()
+
+    def guardar(self, huella: str, tipo: str, modelo: str, respuesta: dict, latencia_ms: float):
+        blob = zlib.compress(json.dumps(respuesta, ensure_ascii=False).encode('utf-8'), 6)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cassette VALUES (?, ?, ?, ?, ?, ?)",
+                (huella, tipo, modelo, blob, float(latencia_ms), time.time())
+            )
+            self._conn.commit()
+
+    def buscar(self, huella: str):
+        """Retorna (respuesta_dict, latencia_ms) o None."""
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT respuesta, latencia_ms FROM cassette WHERE huella = ?", (huella,)
+            ).fetchone()
+        if fila is None:
+            return None
+        return json.loads(zlib.decompress(fila[0]).decode('utf-8')), fila[1]
+
+    def resumen(self) -> dict:
+        with self._lock:
+            filas = self._conn.execute(
+                "SELECT modelo, COUNT(*), SUM(LENGTH(respuesta)), AVG(latencia_ms) FROM cassette GROUP BY modelo"
+            ).fetchall()
+        return {
+            modelo: {'respuestas': n, 'bytes': int(bytes_ or 0), 'latencia_grabada_ms_prom': round(lat or 0, 1)}
+            for modelo, n, bytes_, lat in filas
+        }
+
+
+class LatenciaSintetica:
+    """Distribución de latencia para el modo replay."""
+
+    def __init__(self, especificacion: str = 'recorded'):
+        self.especificacion = (especificacion or 'recorded').strip().lower()
+        tipo, _, parametros = self.especificacion.partition(':')
+        self.tipo = tipo
+        try:
+            self.parametros = [float(p) for p in parametros.split(',') if p.strip()]
+        except ValueError:
+            logger.error(f"[LLM_BACKEND] LLM_REPLAY_LATENCY inválida: {especificacion}. Usando 'recorded'.")
+            self.tipo, self.parametros = 'recorded', []
+
+    def muestra_ms(self, grabada_ms: float) -> float:
+        if self.tipo == 'none':
+            return 0.0
+        if self.tipo == 'fixed' and self.parametros:
+            return self.parametros[0]
+        if self.tipo == 'uniform' and len(self.parametros) >= 2:
+            return random.uniform(self.parametros[0], self.parametros[1])
+        if self.tipo == 'lognormal' and len(self.parametros) >= 2:
+            return random.lognormvariate(math.log(max(1.0, self.parametros[0])), self.parametros[1])
+        return grabada_ms or 0.0
+
+
+class OpenAIBackend:
+    """Backend real: delega en el cliente openai.OpenAI."""
+
+    nombre = 'openai'
+
+    def __init__(self, client):
+        self.client = client
+
+    def responses_create(self, **kwargs):
+        return self.client.responses.create(**kwargs)
+
+    def chat_create(self, **kwargs):
+        return self.client.chat.completions.create(**kwargs)
+
+    def get_stats(self) -> dict:
+        return {'backend': self.nombre}
+
+
+class RecordingBackend:
+    """Llama al backend real y graba cada respuesta en el cassette."""
+
+    nombre = 'record'
+
+    def __init__(self, interno, store: CassetteStore):
+        self.interno = interno
+        self.store = store
+        self.grabadas = 0
+        self.errores_grabacion = 0
+
+    def _grabar(self, tipo: str, kwargs: dict, llamada):
+        inicio = time.monotonic()
+        response = llamada(**kwargs)
+        latencia_ms = (time.monotonic() - inicio) * 1000
+        try:
+            self.store.guardar(huella_request(tipo, kwargs), tipo, kwargs.get('model', ''),
+                               serializar_respuesta(response), latencia_ms)
+            self.grabadas += 1
+        except Exception as e:
+            self.errores_grabacion += 1
+            logger.warning(f"[LLM_BACKEND] No se pudo grabar la respuesta en el cassette: {e}")
+        return response
+
+    def responses_create(self, **kwargs):
+        return self._grabar('responses', kwargs, self.interno.responses_create)
+
+    def chat_create(self, **kwargs):
+        return self._grabar('chat', kwargs, self.interno.chat_create)
+
+    def get_stats(self) -> dict:
+        return {'backend': self.nombre, 'cassette': self.store.ruta, 'grabadas': self.grabadas,
+                'errores_grabacion': self.errores_grabacion, 'contenido': self.store.resumen()}
+
+
+class ReplayBackend:
+    """Sirve respuestas grabadas sin red, con latencia sintética."""
+
+    nombre = 'replay'
+
+    def __init__(self, store: CassetteStore, latencia: LatenciaSintetica):
+        self.store = store
+        self.latencia = latencia
+        self.aciertos = 0
+        self.fallos = 0
+
+    def _servir(self, tipo: str, kwargs: dict):
+        encontrado = self.store.buscar(huella_request(tipo, kwargs))
+        if encontrado is None:
+            self.fallos += 1
+            raise CassetteMissError(f"Request {tipo} para {kwargs.get('model')} no grabado en {self.store.ruta}")
+        datos, grabada_ms = encontrado
+        self.aciertos += 1
+        espera_ms = self.latencia.muestra_ms(grabada_ms)
+        if espera_ms > 0:
+            time.sleep(espera_ms / 1000.0)
+        return _a_namespace(datos)
+
+    def responses_create(self, **kwargs):
+        return self._servir('responses', kwargs)
+
+    def chat_create(self, **kwargs):
+        return self._servir('chat', kwargs)
+
+    def get_stats(self) -> dict:
+        return {'backend': self.nombre, 'cassette': self.store.ruta, 'latencia': self.latencia.especificacion,
+                'aciertos': self.aciertos, 'fallos': self.fallos, 'contenido': self.store.resumen()}
+
+
+def crear_backend(client):
+    """Construye el backend según LLM_BACKEND; ante configuración inválida usa OpenAI."""
+    modo = (getattr(config, 'LLM_BACKEND', 'openai') or 'openai').lower()
+    ruta = getattr(config, 'LLM_CASSETTE_PATH', 'llm_cassette.sqlite3')
+    if modo == 'record' and client is not None:
+        logger.info(f"[LLM_BACKEND] Modo RECORD. Grabando respuestas en {ruta}")
+        return RecordingBackend(OpenAIBackend(client), CassetteStore(ruta))
+    if modo == 'replay':
+        logger.info(f"[LLM_BACKEND] Modo REPLAY desde {ruta}")
+        return ReplayBackend(CassetteStore(ruta), LatenciaSintetica(getattr(config, 'LLM_REPLAY_LATENCY', 'recorded')))
+    if client is None:
+        return None
+    return OpenAIBackend(client)
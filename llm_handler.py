@@ -2,30 +2,345 @@
 import openai
 import logging
 import config
+import json
+import time
+import heapq
+import random
+from collections import deque
+from threading import Condition
 import utils 
 import re  # <-- AÑADIDO para operaciones de regex
 from datetime import datetime # <-- AÑADIDO para obtener la fecha actual
 import locale # <-- AÑADIDO para formato de fecha en español
+import intent_classifier
+import llm_hedging
+import llm_tracing
+import llm_backends
 from utils import parsear_fecha_hora_natural  # <-- AÑADIDO para extracción de fechas
 
 # El logger se mantiene igual, usando el TENANT_NAME. ¡Perfecto!
 logger = logging.getLogger(config.TENANT_NAME)
 
 # --- Inicialización del Cliente OpenAI (Con organización para GPT-5) ---
-client = openai.OpenAI(
-    api_key=config.OPENAI_API_KEY,
-    organization=config.OPENAI_ORG_ID
+# En modo replay no hace falta red ni API key: las respuestas salen del cassette.
+if getattr(config, 'LLM_BACKEND', 'openai').lower() == 'replay':
+    client = None
+else:
+    # Sin reintentos del SDK: el planificador es la única capa que reintenta.
+    # Timeout propio: un hedge perdedor no retiene cupo ni hilo los 600s por defecto del SDK.
+    client = openai.OpenAI(
+        api_key=config.OPENAI_API_KEY,
+        organization=config.OPENAI_ORG_ID,
+        max_retries=0,
+        timeout=config.LLM_REQUEST_TIMEOUT
+    )
+
+# Backend activo (openai | record | replay). Todas las llamadas salen por aquí.
+backend = llm_backends.crear_backend(client)
+
+# --- PLANIFICADOR DE LLAMADAS (concurrencia por modelo, TPM y 429) ---
+# Todas las llamadas al modelo pasan por aquí. Los turnos interactivos tienen
+# prioridad sobre el trabajo de fondo (analista de leads, revival, resúmenes).
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_FONDO = 1
+_NOMBRES_PRIORIDAD = {PRIORIDAD_INTERACTIVA: 'interactiva', PRIORIDAD_FONDO: 'fondo'}
+
+
+class LLMSchedulerTimeout(TimeoutError):
+    """No se obtuvo turno en el planificador dentro del tiempo máximo de espera."""
+
+
+def _parse_json_config(valor: str, nombre: str) -> dict:
+    try:
+        return json.loads(valor) if valor else {}
+    except ValueError:
+        logger.error(f"[LLM_SCHEDULER] {nombre} no es un JSON válido. Se ignora.")
+        return {}
+
+
+def _extraer_retry_after(error) -> float | None:
+    """Lee retry-after / retry-after-ms de la respuesta de un error 429."""
+    try:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _es_rate_limit(error) -> bool:
+    rate_limit_cls = getattr(openai, 'RateLimitError', None)
+    if rate_limit_cls and isinstance(error, rate_limit_cls):
+        return True
+    return getattr(error, 'status_code', None) == 429
+
+
+def _es_error_transitorio(error) -> bool:
+    """Conexión caída o 5xx del proveedor: se reintenta sin pausar el modelo."""
+    conexion_cls = getattr(openai, 'APIConnectionError', None)
+    if conexion_cls and isinstance(error, conexion_cls):
+        return True
+    status = getattr(error, 'status_code', None)
+    return isinstance(status, int) and status >= 500
+
+
+def _tokens_de_respuesta(response) -> int:
+    uso = llm_tracing.extraer_uso(response)
+    return uso['input_tokens'] + uso['output_tokens']
+
+
+class _EstadoModelo:
+    def __init__(self, limite: int, tpm: int):
+        self.limite = limite
+        self.tpm = tpm
+        self.en_curso = 0
+        self.en_curso_fondo = 0
+        self.espera = []              # heap de (prioridad, secuencia)
+        self.tokens_ventana = deque() # (timestamp, tokens) del último minuto
+        self.pausado_hasta = 0.0
+        self.stats = {
+            'completadas': 0, 'rate_limits': 0, 'reintentos': 0, 'timeouts_cola': 0,
+            'espera_total_s': {'interactiva': 0.0, 'fondo': 0.0},
+            'admitidas': {'interactiva': 0, 'fondo': 0},
+        }
+
+    def tokens_ultimo_minuto(self, ahora: float) -> int:
+        while self.tokens_ventana and ahora - self.tokens_ventana[0][0] > 60:
+            self.tokens_ventana.popleft()
+        return sum(t for _, t in self.tokens_ventana)
+
+
+class LLMScheduler:
+    """
+    Semáforo con prioridad por modelo + presupuesto de tokens por minuto.
+    - Un pedido espera si el modelo está lleno, si hay alguien de mayor prioridad
+      esperando, si el presupuesto TPM no alcanza o si el modelo está pausado por 429.
+    - El trabajo de fondo nunca ocupa los cupos reservados para turnos interactivos.
+    - Ante 429 se respeta retry-after (pausa todo el modelo) y se reintenta.
+    - Conexión caída o 5xx: se reintenta solo ese pedido, con back-off exponencial.
+    Es la única capa de reintentos: los clientes de OpenAI van con max_retries=0.
+    """
+
+    def __init__(self, limite_default: int, limites: dict, tpm: dict, reserva_interactiva: int,
+                 espera_max: dict, max_reintentos: int):
+        self.limite_default = max(1, int(limite_default))
+        self.limites = limites
+        self.tpm = tpm
+        self.reserva_interactiva = max(0, int(reserva_interactiva))
+        self.espera_max = espera_max
+        self.max_reintentos = max(0, int(max_reintentos))
+        self._cond = Condition()
+        self._modelos = {}
+        self._secuencia = 0
+
+    def _estado(self, modelo: str) -> _EstadoModelo:
+        estado = self._modelos.get(modelo)
+        if estado is None:
+            estado = _EstadoModelo(int(self.limites.get(modelo, self.limite_default)), int(self.tpm.get(modelo, 0)))
+            self._modelos[modelo] = estado
+        return estado
+
+    def _puede_entrar(self, estado: _EstadoModelo, ticket, prioridad: int, tokens_estimados: int, ahora: float) -> bool:
+        if ahora < estado.pausado_hasta or estado.espera[0] != ticket:
+            return False
+        if estado.en_curso >= estado.limite:
+            return False
+        if prioridad != PRIORIDAD_INTERACTIVA and estado.en_curso_fondo >= max(1, estado.limite - self.reserva_interactiva):
+            return False
+        if estado.tpm and estado.tokens_ultimo_minuto(ahora) + tokens_estimados > estado.tpm and estado.en_curso > 0:
+            return False
+        return True
+
+    def _adquirir(self, modelo: str, prioridad: int, tokens_estimados: int):
+        nombre = _NOMBRES_PRIORIDAD.get(prioridad, 'fondo')
+        inicio = time.monotonic()
+        limite_espera = float(self.espera_max.get(nombre, 60.0))
+        with self._cond:
+            estado = self._estado(modelo)
+            self._secuencia += 1
+            ticket = (prioridad, self._secuencia)
+            heapq.heappush(estado.espera, ticket)
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    if self._puede_entrar(estado, ticket, prioridad, tokens_estimados, ahora):
+                        break
+                    restante = limite_espera - (ahora - inicio)
+                    if restante <= 0:
+                        estado.stats['timeouts_cola'] += 1
+                        raise LLMSchedulerTimeout(f"Sin turno para {modelo} tras {limite_espera:.0f}s ({nombre})")
+                    pausa = estado.pausado_hasta - ahora if ahora < estado.pausado_hasta else 1.0
+                    self._cond.wait(timeout=max(0.05, min(restante, pausa)))
+            finally:
+                estado.espera.remove(ticket)
+                heapq.heapify(estado.espera)
+                self._cond.notify_all()
+            estado.en_curso += 1
+            if prioridad != PRIORIDAD_INTERACTIVA:
+                estado.en_curso_fondo += 1
+            estado.stats['admitidas'][nombre] += 1
+            estado.stats['espera_total_s'][nombre] += time.monotonic() - inicio
+        return time.monotonic() - inicio
+
+    def _liberar(self, modelo: str, prioridad: int, tokens: int):
+        with self._cond:
+            estado = self._estado(modelo)
+            estado.en_curso -= 1
+            if prioridad != PRIORIDAD_INTERACTIVA:
+                estado.en_curso_fondo -= 1
+            if tokens:
+                estado.tokens_ventana.append((time.monotonic(), tokens))
+            self._cond.notify_all()
+
+    def _pausar(self, modelo: str, segundos: float):
+        with self._cond:
+            estado = self._estado(modelo)
+            estado.stats['rate_limits'] += 1
+            estado.pausado_hasta = max(estado.pausado_hasta, time.monotonic() + segundos)
+            self._cond.notify_all()
+
+    def en_pausa(self, modelo: str) -> bool:
+        """True si el modelo está pausado por un 429 (back-off en curso)."""
+        with self._cond:
+            estado = self._modelos.get(modelo)
+            return estado is not None and time.monotonic() < estado.pausado_hasta
+
+    def ejecutar(self, modelo: str, llamada, prioridad: int = PRIORIDAD_INTERACTIVA, tokens_estimados: int = 0,
+                 agente: str = None, esfuerzo: str = None, medicion=None):
+        """Ejecuta llamada() (que hace el request al proveedor) respetando cupos y 429.
+
+        Cada intento queda trazado en llm_tracing con su espera en cola y duración.
+        `medicion` (llm_hedging.MedicionVuelo) se marca en vuelo solo mientras dura cada intento.
+        """
+        intento = 0
+        nombre_prioridad = _NOMBRES_PRIORIDAD.get(prioridad, 'fondo')
+        while True:
+            espera_cola = self._adquirir(modelo, prioridad, tokens_estimados)
+            tokens = 0
+            diferido = 0.0
+            inicio = time.monotonic()
+            if medicion is not None:
+                medicion.iniciar()
+            try:
+                response = llamada()
+                tokens = _tokens_de_respuesta(response)
+                with self._cond:
+                    self._estado(modelo).stats['completadas'] += 1
+                llm_tracing.trazador.registrar(agente, modelo, esfuerzo, nombre_prioridad, espera_cola,
+                                               time.monotonic() - inicio, response=response, intento=intento)
+                return response
+            except Exception as e:
+                llm_tracing.trazador.registrar(agente, modelo, esfuerzo, nombre_prioridad, espera_cola,
+                                               time.monotonic() - inicio, error=e, intento=intento)
+                rate_limit = _es_rate_limit(e)
+                if not (rate_limit or _es_error_transitorio(e)) or intento >= self.max_reintentos:
+                    raise
+                espera = _extraer_retry_after(e) if rate_limit else None
+                if espera is None:
+                    espera = min(30.0, (2 ** intento) + random.uniform(0, 0.5))
+                intento += 1
+                with self._cond:
+                    self._estado(modelo).stats['reintentos'] += 1
+                if rate_limit:
+                    logger.warning(f"[LLM_SCHEDULER] 429 en {modelo}. Pausando {espera:.1f}s (reintento {intento}/{self.max_reintentos})")
+                    self._pausar(modelo, espera)
+                else:
+                    logger.warning(f"[LLM_SCHEDULER] Error transitorio en {modelo} ({type(e).__name__}). "
+                                   f"Reintento {intento}/{self.max_reintentos} en {espera:.1f}s")
+                    diferido = espera
+            finally:
+                if medicion is not None:
+                    medicion.terminar()
+                self._liberar(modelo, prioridad, tokens)
+            if diferido:
+                # Fuera del cupo: el back-off de un pedido no ocupa lugar de otros
+                time.sleep(diferido)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            ahora = time.monotonic()
+            modelos = {}
+            for modelo, estado in self._modelos.items():
+                admitidas = estado.stats['admitidas']
+                modelos[modelo] = {
+                    'limite_concurrencia': estado.limite,
+                    'tpm_limite': estado.tpm or None,
+                    'en_curso': estado.en_curso,
+                    'en_curso_fondo': estado.en_curso_fondo,
+                    'en_espera': len(estado.espera),
+                    'tokens_ultimo_minuto': estado.tokens_ultimo_minuto(ahora),
+                    'pausado_s_restantes': round(max(0.0, estado.pausado_hasta - ahora), 2),
+                    'completadas': estado.stats['completadas'],
+                    'rate_limits': estado.stats['rate_limits'],
+                    'reintentos': estado.stats['reintentos'],
+                    'timeouts_cola': estado.stats['timeouts_cola'],
+                    'espera_promedio_ms': {
+                        nombre: round(estado.stats['espera_total_s'][nombre] / admitidas[nombre] * 1000, 1) if admitidas[nombre] else 0.0
+                        for nombre in admitidas
+                    },
+                }
+            return {'reserva_interactiva': self.reserva_interactiva, 'modelos': modelos}
+
+
+planificador = LLMScheduler(
+    limite_default=config.LLM_MAX_CONCURRENCY_PER_MODEL,
+    limites=_parse_json_config(config.LLM_CONCURRENCY_BY_MODEL_JSON, 'LLM_CONCURRENCY_BY_MODEL'),
+    tpm=_parse_json_config(config.LLM_TPM_LIMITS_JSON, 'LLM_TPM_LIMITS'),
+    reserva_interactiva=config.LLM_INTERACTIVE_RESERVED_SLOTS,
+    espera_max={'interactiva': config.LLM_INTERACTIVE_MAX_WAIT, 'fondo': config.LLM_BACKGROUND_MAX_WAIT},
+    max_reintentos=config.LLM_MAX_RETRIES,
 )
 
+
+def _estimar_tokens(texto: str, max_salida: int = 0) -> int:
+    return len(texto or '') // 4 + int(max_salida or 0)
+
+def _parametros_modelo(model: str, agent_context: str = None) -> tuple:
+    """Retorna (reasoning_effort, text_verbosity) según el modelo y el agente."""
+    reasoning_effort = "minimal"  # Por defecto minimal para rapidez
+    text_verbosity = "medium"     # Por defecto medium
+
+    # Configuración específica según el agente/modelo
+    if agent_context == "meta_agente":
+        # Meta-agente: solo clasifica, necesita mínimo reasoning
+        reasoning_effort = config.META_AGENTE_REASONING if hasattr(config, 'META_AGENTE_REASONING') else "minimal"
+        text_verbosity = config.META_AGENTE_VERBOSITY if hasattr(config, 'META_AGENTE_VERBOSITY') else "low"
+    elif agent_context in ["intencion_agendamiento", "intencion_pagos"]:
+        # Agentes de intención: extraen datos estructurados
+        reasoning_effort = config.INTENCION_REASONING if hasattr(config, 'INTENCION_REASONING') else "low"
+        text_verbosity = config.INTENCION_VERBOSITY if hasattr(config, 'INTENCION_VERBOSITY') else "low"
+    elif model == config.AGENTE_CERO_MODEL:
+        # Usar configuración específica de Agente Cero desde variables de entorno
+        reasoning_effort = config.AGENTE_CERO_REASONING if hasattr(config, 'AGENTE_CERO_REASONING') else "low"
+        text_verbosity = config.AGENTE_CERO_VERBOSITY if hasattr(config, 'AGENTE_CERO_VERBOSITY') else "medium"
+    elif model == config.GENERATOR_MODEL:
+        # Usar configuración específica del Generador desde variables de entorno
+        reasoning_effort = config.GENERADOR_REASONING if hasattr(config, 'GENERADOR_REASONING') else "medium"
+        text_verbosity = config.GENERADOR_VERBOSITY if hasattr(config, 'GENERADOR_VERBOSITY') else "high"
+    elif "vision" in model.lower():
+        reasoning_effort = "minimal"  # Mínimo para visión (análisis rápido)
+        text_verbosity = "low"       # Baja verbosidad para respuestas concisas
+    elif "nano" in model.lower():
+        reasoning_effort = "minimal"  # Mínimo para nano (tareas simples)
+        text_verbosity = "low"       # Baja verbosidad
+    elif "mini" in model.lower():
+        reasoning_effort = "low"      # Bajo para mini (balance costo/capacidad)
+        text_verbosity = "medium"     # Media verbosidad
+
+    return reasoning_effort, text_verbosity
+
 # --- FUNCIÓN INTERNA REUTILIZABLE (GPT-5 Responses API) ---
-def _llamar_api_openai(messages: list, model: str, temperature: float, max_completion_tokens: int, agent_context: str = None) -> str:
+def _llamar_api_openai(messages: list, model: str, temperature: float, max_completion_tokens: int, agent_context: str = None, prioridad: int = PRIORIDAD_INTERACTIVA) -> str:
     """Función base para interactuar con la API de OpenAI.
     
     NOTA: GPT-5 usa la nueva Responses API con parámetros diferentes.
     Los parámetros temperature y max_completion_tokens se mantienen por compatibilidad
     pero se traducen internamente a los nuevos parámetros.
     """
-    if not client:
+    if not backend:
         return "Lo siento, el servicio de IA no está disponible en este momento."
     
     try:
@@ -60,48 +375,35 @@ def _llamar_api_openai(messages: list, model: str, temperature: float, max_compl
         logger.info(f"[LLM] Usando modelo={model}, org={config.OPENAI_ORG_ID}")
         logger.info(f"Enviando solicitud a OpenAI Responses API (Modelo: {model})")
         
-        # Configurar parámetros según el modelo y contexto
-        reasoning_effort = "minimal"  # Por defecto minimal para rapidez
-        text_verbosity = "medium"     # Por defecto medium
-        
-        # Configuración específica según el agente/modelo
-        if agent_context == "meta_agente":
-            # Meta-agente: solo clasifica, necesita mínimo reasoning
-            reasoning_effort = config.META_AGENTE_REASONING if hasattr(config, 'META_AGENTE_REASONING') else "minimal"
-            text_verbosity = config.META_AGENTE_VERBOSITY if hasattr(config, 'META_AGENTE_VERBOSITY') else "low"
-        elif agent_context in ["intencion_agendamiento", "intencion_pagos"]:
-            # Agentes de intención: extraen datos estructurados
-            reasoning_effort = config.INTENCION_REASONING if hasattr(config, 'INTENCION_REASONING') else "low"
-            text_verbosity = config.INTENCION_VERBOSITY if hasattr(config, 'INTENCION_VERBOSITY') else "low"
-        elif model == config.AGENTE_CERO_MODEL:
-            # Usar configuración específica de Agente Cero desde variables de entorno
-            reasoning_effort = config.AGENTE_CERO_REASONING if hasattr(config, 'AGENTE_CERO_REASONING') else "low"
-            text_verbosity = config.AGENTE_CERO_VERBOSITY if hasattr(config, 'AGENTE_CERO_VERBOSITY') else "medium"
-        elif model == config.GENERATOR_MODEL:
-            # Usar configuración específica del Generador desde variables de entorno
-            reasoning_effort = config.GENERADOR_REASONING if hasattr(config, 'GENERADOR_REASONING') else "medium"
-            text_verbosity = config.GENERADOR_VERBOSITY if hasattr(config, 'GENERADOR_VERBOSITY') else "high"
-        elif "vision" in model.lower():
-            reasoning_effort = "minimal"  # Mínimo para visión (análisis rápido)
-            text_verbosity = "low"       # Baja verbosidad para respuestas concisas
-        elif "nano" in model.lower():
-            reasoning_effort = "minimal"  # Mínimo para nano (tareas simples)
-            text_verbosity = "low"       # Baja verbosidad
-        elif "mini" in model.lower():
-            reasoning_effort = "low"      # Bajo para mini (balance costo/capacidad)
-            text_verbosity = "medium"     # Media verbosidad
-        
-        # Llamada a la nueva Responses API
-        response = client.responses.create(
-            model=model,
-            input=input_text,
-            reasoning={
-                "effort": reasoning_effort
-            },
-            text={
-                "verbosity": text_verbosity
-            }
+        # Llamada a la nueva Responses API (planificador + hedge/breaker por modelo).
+        # El modelo de respaldo puede diferir, así que los parámetros se calculan por modelo.
+        def _crear_respuesta(modelo_objetivo, medicion):
+            reasoning_effort, text_verbosity = _parametros_modelo(modelo_objetivo, agent_context)
+            return planificador.ejecutar(
+                modelo_objetivo,
+                lambda: backend.responses_create(
+                    model=modelo_objetivo,
+                    input=input_text,
+                    reasoning={
+                        "effort": reasoning_effort
+                    },
+                    text={
+                        "verbosity": text_verbosity
+                    }
+                ),
+                prioridad=prioridad,
+                tokens_estimados=_estimar_tokens(input_text, max_completion_tokens),
+                agente=agent_context or modelo_objetivo,
+                esfuerzo=reasoning_effort,
+                medicion=medicion,
+            )
+
+        response, modelo_usado = llm_hedging.coordinador.ejecutar(
+            model, _crear_respuesta, agente=agent_context or model,
+            hedge=prioridad == PRIORIDAD_INTERACTIVA, en_pausa=planificador.en_pausa
         )
+        if modelo_usado != model:
+            logger.info(f"[LLM] Respuesta servida por el modelo de respaldo {modelo_usado}")
         
         # La respuesta tiene una estructura diferente
         full_response = response.output_text
@@ -117,7 +419,7 @@ def llamar_agente_lector(contenido_usuario: list) -> str:
     """Agente 1: LECTOR. Analiza imágenes y texto para extraer datos."""
     logger.info("Invocando al Agente Lector...")
     
-    if not client:
+    if not backend:
         return "Lo siento, el servicio de IA no está disponible en este momento."
     
     try:
@@ -153,11 +455,17 @@ def llamar_agente_lector(contenido_usuario: list) -> str:
         logger.info(f"Enviando solicitud con imágenes a OpenAI Chat Completions API")
         
         # Usar la API de Chat Completions que sí soporta imágenes
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=1.0,
-            max_tokens=300
+        response = planificador.ejecutar(
+            "gpt-4o-mini",
+            lambda: backend.chat_create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=1.0,
+                max_tokens=300
+            ),
+            prioridad=PRIORIDAD_INTERACTIVA,
+            tokens_estimados=_estimar_tokens(system_message["content"], 300) + 1000,
+            agente="lector",
         )
         
         # Extraer la respuesta
@@ -338,7 +646,7 @@ def _ELIMINADO_llamar_rodi_generador_OBSOLETO():
     messages = [system_message] + conversation_history + [user_message]
     
     # El generador usa el modelo configurable con verbosidad alta
-    return _llamar_api_openai(messages=messages, model=config.GENERATOR_MODEL, temperature=1.0, max_completion_tokens=1000)
+    return _llamar_api_openai(messages=messages, model=config.GENERATOR_MODEL, temperature=1.0, max_completion_tokens=1000, agent_context="generador")
 
 # ELIMINADO: llamar_corrector_de_estilo - ya no se usa en el sistema
 
@@ -348,8 +656,8 @@ def llamar_analista_leads(transcripcion_completa: str) -> str:
     system_message = {"role": "system", "content": config.PROMPT_ANALISTA_LEADS}
     user_message = {"role": "user", "content": transcripcion_completa}
     messages = [system_message, user_message]
-    # Analista de leads usa el modelo por defecto
-    return _llamar_api_openai(messages=messages, model=config.OPENAI_MODEL, temperature=1.0, max_completion_tokens=500)
+    # Analista de leads usa el modelo por defecto (trabajo de fondo: cede cupo a turnos interactivos)
+    return _llamar_api_openai(messages=messages, model=config.OPENAI_MODEL, temperature=1.0, max_completion_tokens=500, agent_context="analista_leads", prioridad=PRIORIDAD_FONDO)
 
 # --- NUEVOS AGENTES MULTI-AGENTE (V10) ---
 from datetime import datetime
@@ -494,12 +802,15 @@ def llamar_meta_agente(mensaje_usuario, history, current_state=None):
     except Exception:
         texto_usuario = raw
 
-    texto_lower = texto_usuario.lower().strip()
-    
-    # ======== PASO 1: COMANDOS EXPLÍCITOS ========
+    # ======== PASO 1: COMANDOS EXPLÍCITOS (fast-path compilado) ========
+    # Una sola pasada Aho–Corasick sobre texto normalizado; solo decide si está seguro
+    comando = intent_classifier.clasificador.clasificar(texto_usuario, 'meta_agente')
+    if comando and not comando.resuelta:
+        logger.info(f"[META_AGENTE] Fast-path dudoso ({comando}) - sin decisión por comando")
+    intencion_comando = comando.intencion if comando and comando.resuelta else None
     
     # Comando SALIR
-    if "salir de pago" in texto_lower or "salir de pagos" in texto_lower:
+    if intencion_comando == "SALIR_PAGOS":
         logger.info("[META_AGENTE] ✅ Comando SALIR DE PAGOS detectado")
         return {
             "decision": "SALIR_PAGOS",
@@ -508,7 +819,7 @@ def llamar_meta_agente(mensaje_usuario, history, current_state=None):
             "accion_recomendada": "salir_flujo"
         }
     
-    if "salir de agenda" in texto_lower or "salir de agendamiento" in texto_lower:
+    if intencion_comando == "SALIR_AGENDAMIENTO":
         logger.info("[META_AGENTE] ✅ Comando SALIR DE AGENDAMIENTO detectado")
         return {
             "decision": "SALIR_AGENDAMIENTO", 
@@ -519,7 +830,7 @@ def llamar_meta_agente(mensaje_usuario, history, current_state=None):
     
     # Comandos ENTRADA EXPLÍCITA
     # V10: entrada EXPLÍCITA estricta (solo frases exactas)
-    if any(cmd in texto_lower for cmd in ["quiero agendar"]):
+    if intencion_comando == "AGENDAMIENTO":
         logger.info("[META_AGENTE] ✅ Comando QUIERO AGENDAR detectado")
         datos_extraidos = _extraer_datos_agendamiento(texto_usuario)
         return {
@@ -530,7 +841,7 @@ def llamar_meta_agente(mensaje_usuario, history, current_state=None):
         }
     
     # Reprogramación (solo si hay turno registrado) - detección estricta
-    if "quiero reprogramar" in texto_lower:
+    if intencion_comando == "REPROGRAMACION":
         logger.info("[META_AGENTE] ✅ Comando QUIERO REPROGRAMAR detectado")
         return {
             "decision": "REPROGRAMACION",
@@ -540,7 +851,7 @@ def llamar_meta_agente(mensaje_usuario, history, current_state=None):
         }
     
     # V10: entrada EXPLÍCITA estricta (solo frases exactas)
-    if any(cmd in texto_lower for cmd in ["quiero pagar"]):
+    if intencion_comando == "PAGOS":
         logger.info("[META_AGENTE] ✅ Comando QUIERO PAGAR detectado")
         datos_extraidos = _extraer_datos_pagos(texto_usuario)
         return {
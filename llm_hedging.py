@@ -0,0 +1,402 @@
+"""
+Hedged requests y circuit breaker por modelo para las llamadas al LLM.
+
+Una respuesta lenta de la cola (tail) del modelo puede retener un turno durante
+decenas de segundos. Este módulo:
+- Lanza la llamada principal y, si no terminó tras un retardo basado en el p95
+  reciente de (modelo, agente), dispara una segunda llamada (hedge) al modelo de
+  respaldo configurado o al mismo modelo. Gana la primera que termina bien.
+  El retardo y las muestras del p95 cuentan solo el tiempo del request en vuelo
+  (MedicionVuelo): no la espera en el planificador ni el back-off por 429, y
+  mientras un modelo está pausado por 429 no se lanza hedge.
+- Mantiene un circuit breaker por modelo: si la tasa de error reciente supera el
+  umbral, el modelo queda "abierto" y las llamadas van directo al respaldo hasta
+  que pase el enfriamiento (luego se deja pasar una prueba: semiabierto).
+- Estadísticas: tasa de hedge, tasa de victoria del hedge y mejora de la cola
+  (p95/p99 de la latencia efectiva frente a la que habría tenido la principal).
+
+La llamada perdedora no se puede abortar con el cliente síncrono: termina en el
+pool y su resultado se descarta.
+"""
+
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+
+def _percentil(valores, p: float) -> float | None:
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p * (len(ordenados) - 1)))))
+    return ordenados[indice]
+
+
+class MedicionVuelo:
+    """
+    Tiempo en vuelo de un request. El planificador llama iniciar() al despachar cada
+    intento y terminar() al volver; durante la cola y el back-off en_vuelo_desde es None.
+    """
+
+    def __init__(self):
+        self.en_vuelo_desde = None
+        self.duracion = None
+        self.despachado = False
+
+    def iniciar(self):
+        self.despachado = True
+        self.en_vuelo_desde = time.monotonic()
+
+    def terminar(self):
+        if self.en_vuelo_desde is not None:
+            self.duracion = time.monotonic() - self.en_vuelo_desde
+        self.en_vuelo_desde = None
+
+
+class CircuitoAbiertoError(Exception):
+    """El modelo tiene el circuito abierto y no hay modelo de respaldo."""
+
+
+class CircuitBreaker:
+    """Breaker por tasa de errores sobre una ventana de resultados recientes."""
+
+    CERRADO = 'cerrado'
+    ABIERTO = 'abierto'
+    SEMIABIERTO = 'semiabierto'
+
+    def __init__(self, tasa_error: float = 0.5, minimo_llamadas: int = 10,
+                 enfriamiento: float = 30.0, ventana: int = 50):
+        self.tasa_error = float(tasa_error)
+        self.minimo_llamadas = max(1, int(minimo_llamadas))
+        self.enfriamiento = float(enfriamiento)
+        self._resultados = deque(maxlen=max(1, int(ventana)))
+        self._estado = self.CERRADO
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self.aperturas = 0
+        self.rechazos = 0
+
+    def permitir(self) -> bool:
+        """True si se puede llamar al modelo (debe llamarse con el lock del dueño)."""
+        if self._estado == self.CERRADO:
+            return True
+        if self._estado == self.ABIERTO and time.monotonic() - self._abierto_desde >= self.enfriamiento:
+            self._estado = self.SEMIABIERTO
+            self._prueba_en_curso = False
+        if self._estado == self.SEMIABIERTO and not self._prueba_en_curso:
+            self._prueba_en_curso = True
+            return True
+        self.rechazos += 1
+        return False
+
+    @property
+    def en_prueba(self) -> bool:
+        return self._estado == self.SEMIABIERTO and self._prueba_en_curso
+
+    def liberar_prueba(self):
+        """La prueba semiabierta terminó sin resultado del modelo (no se despachó o timeout local): se permite otra."""
+        if self._estado == self.SEMIABIERTO:
+            self._prueba_en_curso = False
+
+    def registrar(self, exito: bool):
+        if self._estado == self.SEMIABIERTO:
+            self._prueba_en_curso = False
+            if exito:
+                self._estado = self.CERRADO
+                self._resultados.clear()
+            else:
+                self._abrir()
+            return
+        self._resultados.append(exito)
+        if len(self._resultados) >= self.minimo_llamadas:
+            errores = sum(1 for r in self._resultados if not r)
+            if errores / len(self._resultados) >= self.tasa_error and self._estado == self.CERRADO:
+                self._abrir()
+
+    def _abrir(self):
+        self._estado = self.ABIERTO
+        self._abierto_desde = time.monotonic()
+        self.aperturas += 1
+
+    def snapshot(self) -> dict:
+        errores = sum(1 for r in self._resultados if not r)
+        return {
+            'estado': self._estado,
+            'tasa_error_reciente': round(errores / len(self._resultados), 3) if self._resultados else 0.0,
+            'aperturas': self.aperturas,
+            'rechazos': self.rechazos,
+        }
+
+
+class HedgingCoordinator:
+    """Coordina llamada principal, hedge y breaker por modelo."""
+
+    def __init__(self, enabled: bool = True, percentil: float = 0.95, retardo_min: float = 1.0,
+                 retardo_max: float = 20.0, retardo_default: float = 8.0, timeout_total: float = 60.0,
+                 respaldos: dict | None = None, max_workers: int = 16, ventana: int = 200,
+                 breaker_kwargs: dict | None = None):
+        self.enabled = enabled
+        self.percentil = float(percentil)
+        self.retardo_min = float(retardo_min)
+        self.retardo_max = float(retardo_max)
+        self.retardo_default = float(retardo_default)
+        self.timeout_total = float(timeout_total)
+        self.respaldos = respaldos or {}
+        self.ventana = max(10, int(ventana))
+        self._breaker_kwargs = breaker_kwargs or {}
+        self._pool = ThreadPoolExecutor(max_workers=max(2, int(max_workers)), thread_name_prefix='llm_hedge')
+        self._lock = Lock()
+        self._latencias = {}   # (modelo, agente) -> deque de latencias de llamadas exitosas
+        self._breakers = {}    # modelo -> CircuitBreaker
+        self._stats = {}       # (modelo, agente) -> contadores
+
+    # --- Estado interno ---
+
+    def _breaker(self, modelo: str) -> CircuitBreaker:
+        breaker = self._breakers.get(modelo)
+        if breaker is None:
+            breaker = CircuitBreaker(**self._breaker_kwargs)
+            self._breakers[modelo] = breaker
+        return breaker
+
+    def _clave_stats(self, clave) -> dict:
+        stats = self._stats.get(clave)
+        if stats is None:
+            stats = {
+                'llamadas': 0, 'hedges': 0, 'hedges_ganadores': 0, 'directo_a_respaldo': 0,
+                'hedges_omitidos_429': 0, 'errores': 0,
+                'latencia_efectiva': deque(maxlen=self.ventana),
+                'latencia_principal': deque(maxlen=self.ventana),
+            }
+            self._stats[clave] = stats
+        return stats
+
+    def retardo_hedge(self, modelo: str, agente: str) -> float:
+        """p95 reciente de (modelo, agente), acotado; valor por defecto durante el calentamiento."""
+        with self._lock:
+            latencias = list(self._latencias.get((modelo, agente), ()))
+        if len(latencias) < 20:
+            return self.retardo_default
+        return min(self.retardo_max, max(self.retardo_min, _percentil(latencias, self.percentil)))
+
+    def _registrar_resultado(self, modelo: str, agente: str, exito: bool, latencia: float | None):
+        with self._lock:
+            self._breaker(modelo).registrar(exito)
+            if exito and latencia is not None:
+                self._latencias.setdefault((modelo, agente), deque(maxlen=self.ventana)).append(latencia)
+
+    def _llamar_medido(self, llamada, modelo: str, agente: str, medicion: MedicionVuelo, prueba: bool = False):
+        """
+        llamada(modelo, medicion) registrando en breaker y p95 solo lo que pasó en vuelo:
+        un fallo antes de despachar (timeout de cola) o un timeout local no es error del modelo.
+        Si la llamada era la prueba del breaker semiabierto y no hubo resultado, la prueba se libera.
+        """
+        registrado = False
+        try:
+            resultado = llamada(modelo, medicion)
+        except Exception as e:
+            if medicion.despachado and not isinstance(e, TimeoutError):
+                self._registrar_resultado(modelo, agente, False, None)
+                registrado = True
+            raise
+        else:
+            self._registrar_resultado(modelo, agente, True, medicion.duracion)
+            registrado = True
+            return resultado
+        finally:
+            if prueba and not registrado:
+                with self._lock:
+                    self._breaker(modelo).liberar_prueba()
+
+    def _lanzar(self, llamada, modelo: str, agente: str, clave_stats=None, prueba: bool = False):
+        """Ejecuta llamada(modelo, medicion) en el pool. Retorna (futuro, medicion)."""
+        inicio = time.monotonic()
+        medicion = MedicionVuelo()
+
+        def _tarea():
+            resultado = self._llamar_medido(llamada, modelo, agente, medicion, prueba)
+            if clave_stats is not None:
+                # Latencia que habría tenido el turno sin hedge (aunque haya perdido)
+                with self._lock:
+                    self._clave_stats(clave_stats)['latencia_principal'].append(time.monotonic() - inicio)
+            return resultado
+
+        return self._pool.submit(_tarea), medicion
+
+    def _esperar_para_hedge(self, principal, medicion: MedicionVuelo, retardo: float, limite: float,
+                            pausado, stats: dict) -> bool:
+        """
+        Espera a la principal hasta que lleve `retardo` segundos en vuelo. True = hay que
+        lanzar el hedge. En cola o en back-off el reloj no corre; con 429 activo no se hedgea.
+        """
+        omitido_429 = False
+        while not principal.done():
+            ahora = time.monotonic()
+            if ahora >= limite:
+                return False
+            desde = medicion.en_vuelo_desde
+            if desde is not None and ahora - desde >= retardo:
+                if not pausado():
+                    return True
+                if not omitido_429:
+                    omitido_429 = True
+                    with self._lock:
+                        stats['hedges_omitidos_429'] += 1
+                desde = None
+            espera = 0.25 if desde is None else min(0.25, desde + retardo - ahora)
+            wait([principal], timeout=max(0.01, min(espera, limite - ahora)))
+        return False
+
+    # --- API pública ---
+
+    def ejecutar(self, modelo: str, llamada, agente: str | None = None, hedge: bool = True, en_pausa=None):
+        """
+        Ejecuta llamada(modelo_objetivo, medicion) con breaker y, si corresponde, hedge.
+        `llamada` debe marcar en `medicion` cuándo el request está en vuelo; `en_pausa(modelo)`
+        indica si el modelo está en back-off por 429.
+        Retorna (resultado, modelo_que_respondio). Propaga la excepción si todo falla.
+        """
+        agente = agente or modelo
+        respaldo = self.respaldos.get(modelo) or modelo
+        clave = (modelo, agente)
+        inicio = time.monotonic()
+
+        with self._lock:
+            stats = self._clave_stats(clave)
+            stats['llamadas'] += 1
+            permitido = self._breaker(modelo).permitir()
+            prueba = permitido and self._breaker(modelo).en_prueba
+            if not permitido and respaldo != modelo:
+                stats['directo_a_respaldo'] += 1
+
+        if not permitido:
+            if respaldo == modelo:
+                with self._lock:
+                    stats['errores'] += 1
+                raise CircuitoAbiertoError(f"Circuito abierto para {modelo} y sin modelo de respaldo")
+            logger.warning(f"[LLM_HEDGE] Circuito abierto para {modelo}. Usando respaldo {respaldo}.")
+            try:
+                resultado = llamada(respaldo, MedicionVuelo())
+            except Exception:
+                with self._lock:
+                    stats['errores'] += 1
+                raise
+            with self._lock:
+                stats['latencia_efectiva'].append(time.monotonic() - inicio)
+            return resultado, respaldo
+
+        if not (self.enabled and hedge):
+            try:
+                resultado = self._llamar_medido(llamada, modelo, agente, MedicionVuelo(), prueba)
+            except Exception:
+                with self._lock:
+                    stats['errores'] += 1
+                raise
+            latencia = time.monotonic() - inicio
+            with self._lock:
+                stats['latencia_efectiva'].append(latencia)
+                stats['latencia_principal'].append(latencia)
+            return resultado, modelo
+
+        principal, medicion = self._lanzar(llamada, modelo, agente, clave_stats=clave, prueba=prueba)
+        retardo = self.retardo_hedge(modelo, agente)
+        pendientes = {principal: modelo}
+
+        def _pausado():
+            return bool(en_pausa) and (en_pausa(modelo) or en_pausa(respaldo))
+
+        if self._esperar_para_hedge(principal, medicion, retardo, inicio + self.timeout_total, _pausado, stats):
+            logger.info(f"[LLM_HEDGE] {modelo}/{agente} sin respuesta tras {retardo:.1f}s en vuelo. Lanzando hedge a {respaldo}.")
+            pendientes[self._lanzar(llamada, respaldo, agente)[0]] = respaldo
+            with self._lock:
+                stats['hedges'] += 1
+
+        ultimo_error = None
+        while pendientes:
+            restante = self.timeout_total - (time.monotonic() - inicio)
+            if restante <= 0:
+                break
+            listos, _ = wait(list(pendientes), timeout=restante, return_when=FIRST_COMPLETED)
+            if not listos:
+                break
+            for futuro in listos:
+                modelo_futuro = pendientes.pop(futuro)
+                try:
+                    resultado = futuro.result()
+                except Exception as e:
+                    ultimo_error = e
+                    continue
+                with self._lock:
+                    stats['latencia_efectiva'].append(time.monotonic() - inicio)
+                    if futuro is not principal:
+                        stats['hedges_ganadores'] += 1
+                return resultado, modelo_futuro
+
+        with self._lock:
+            stats['errores'] += 1
+        if ultimo_error is not None and not pendientes:
+            raise ultimo_error
+        raise TimeoutError(f"Sin respuesta de {modelo} en {self.timeout_total:.0f}s")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            por_agente = {}
+            for (modelo, agente), stats in self._stats.items():
+                llamadas = stats['llamadas'] or 1
+                efectiva = list(stats['latencia_efectiva'])
+                principal = list(stats['latencia_principal'])
+                p99_efectiva = _percentil(efectiva, 0.99)
+                p99_principal = _percentil(principal, 0.99)
+                por_agente[f"{modelo}/{agente}"] = {
+                    'llamadas': stats['llamadas'],
+                    'tasa_hedge': round(stats['hedges'] / llamadas, 3),
+                    'tasa_victoria_hedge': round(stats['hedges_ganadores'] / stats['hedges'], 3) if stats['hedges'] else None,
+                    'directo_a_respaldo': stats['directo_a_respaldo'],
+                    'hedges_omitidos_429': stats['hedges_omitidos_429'],
+                    'errores': stats['errores'],
+                    'p95_efectiva_s': round(_percentil(efectiva, 0.95), 3) if efectiva else None,
+                    'p99_efectiva_s': round(p99_efectiva, 3) if efectiva else None,
+                    'p95_principal_s': round(_percentil(principal, 0.95), 3) if principal else None,
+                    'p99_principal_s': round(p99_principal, 3) if principal else None,
+                    'mejora_p99_s': round(p99_principal - p99_efectiva, 3) if efectiva and principal else None,
+                }
+            breakers = {modelo: breaker.snapshot() for modelo, breaker in self._breakers.items()}
+        return {
+            'enabled': self.enabled,
+            'percentil_hedge': self.percentil,
+            'respaldos': self.respaldos,
+            'por_agente': por_agente,
+            'breakers': breakers,
+        }
+
+
+def _respaldos_desde_config() -> dict:
+    valor = getattr(config, 'LLM_FALLBACK_MODELS_JSON', '')
+    try:
+        return json.loads(valor) if valor else {}
+    except ValueError:
+        logger.error("[LLM_HEDGE] LLM_FALLBACK_MODELS no es un JSON válido. Se ignora.")
+        return {}
+
+
+coordinador = HedgingCoordinator(
+    enabled=getattr(config, 'LLM_HEDGING_ENABLED', True),
+    percentil=getattr(config, 'LLM_HEDGE_PERCENTILE', 0.95),
+    retardo_min=getattr(config, 'LLM_HEDGE_MIN_DELAY', 1.0),
+    retardo_max=getattr(config, 'LLM_HEDGE_MAX_DELAY', 20.0),
+    retardo_default=getattr(config, 'LLM_HEDGE_DEFAULT_DELAY', 8.0),
+    timeout_total=getattr(config, 'LLM_REQUEST_TIMEOUT', 60.0),
+    respaldos=_respaldos_desde_config(),
+    breaker_kwargs={
+        'tasa_error': getattr(config, 'LLM_BREAKER_ERROR_RATE', 0.5),
+        'minimo_llamadas': getattr(config, 'LLM_BREAKER_MIN_CALLS', 10),
+        'enfriamiento': getattr(config, 'LLM_BREAKER_COOLDOWN', 30.0),
+    },
+)
@@ -0,0 +1,184 @@
+"""
+Trazas de llamadas al LLM: latencia, cola, tokens y costo por agente y por modelo.
+
+Cada intento de llamada que pasa por llm_handler.planificador (Agente Cero,
+generador, meta-agente, lector, analista de leads, resúmenes de historial y
+RevivalAgent) deja un registro con:
+- agente (agent_context), modelo, reasoning effort y prioridad
+- tiempo en cola del planificador y duración de la llamada al proveedor
+- tokens de entrada/salida/razonamiento/cacheados y costo estimado
+- resultado (ok / tipo de error)
+
+Los registros viven en un anillo acotado en memoria. Opcionalmente se escriben
+también en un JSONL rotativo (LLM_TRACE_JSONL_PATH) desde un hilo aparte, para
+no agregar I/O de disco al turno.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from collections import deque
+from threading import Lock
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+
+def _percentil(valores, p: float):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p * (len(ordenados) - 1)))))
+    return ordenados[indice]
+
+
+def _campo(objeto, nombre, default=0):
+    if objeto is None:
+        return default
+    if isinstance(objeto, dict):
+        return objeto.get(nombre, default) or default
+    return getattr(objeto, nombre, default) or default
+
+
+def extraer_uso(response) -> dict:
+    """Tokens de una respuesta de Responses API o de Chat Completions."""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {'input_tokens': 0, 'output_tokens': 0, 'reasoning_tokens': 0, 'cached_tokens': 0}
+    entrada = _campo(usage, 'input_tokens') or _campo(usage, 'prompt_tokens')
+    salida = _campo(usage, 'output_tokens') or _campo(usage, 'completion_tokens')
+    detalle_entrada = _campo(usage, 'input_tokens_details', None) or _campo(usage, 'prompt_tokens_details', None)
+    detalle_salida = _campo(usage, 'output_tokens_details', None) or _campo(usage, 'completion_tokens_details', None)
+    return {
+        'input_tokens': int(entrada),
+        'output_tokens': int(salida),
+        'reasoning_tokens': int(_campo(detalle_salida, 'reasoning_tokens')),
+        'cached_tokens': int(_campo(detalle_entrada, 'cached_tokens')),
+    }
+
+
+class LLMTracer:
+    """Anillo acotado de trazas + sink JSONL opcional + resúmenes por percentil."""
+
+    def __init__(self, capacidad: int = 2000, ruta_jsonl: str = '', max_bytes: int = 10 * 1024 * 1024,
+                 backups: int = 5, precios: dict | None = None):
+        self._anillo = deque(maxlen=max(100, int(capacidad)))
+        self._lock = Lock()
+        self.precios = precios or {}
+        self.ruta_jsonl = ruta_jsonl
+        self._sink = None
+        self._listener = None
+        if ruta_jsonl:
+            self._iniciar_sink(ruta_jsonl, max_bytes, backups)
+
+    def _iniciar_sink(self, ruta: str, max_bytes: int, backups: int):
+        try:
+            archivo = logging.handlers.RotatingFileHandler(ruta, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+            archivo.setFormatter(logging.Formatter('%(message)s'))
+            cola = queue.Queue(-1)
+            self._listener = logging.handlers.QueueListener(cola, archivo)
+            self._listener.start()
+            self._sink = logging.getLogger('llm_trace_sink')
+            self._sink.propagate = False
+            self._sink.setLevel(logging.INFO)
+            self._sink.addHandler(logging.handlers.QueueHandler(cola))
+            logger.info(f"[LLM_TRACE] Sink JSONL activo en {ruta}")
+        except Exception as e:
+            logger.error(f"[LLM_TRACE] No se pudo abrir el sink JSONL {ruta}: {e}")
+            self._sink = None
+
+    def costo_estimado(self, modelo: str, uso: dict) -> float | None:
+        """Costo en USD según LLM_PRICES (USD por millón: input, output, cached_input)."""
+        precio = self.precios.get(modelo)
+        if not precio:
+            return None
+        entrada, salida = float(precio[0]), float(precio[1])
+        cacheado = float(precio[2]) if len(precio) > 2 else entrada
+        no_cacheados = max(0, uso['input_tokens'] - uso['cached_tokens'])
+        return round((no_cacheados * entrada + uso['cached_tokens'] * cacheado + uso['output_tokens'] * salida) / 1_000_000, 6)
+
+    def registrar(self, agente: str, modelo: str, esfuerzo: str | None, prioridad: str,
+                  espera_cola_s: float, duracion_s: float, response=None, error: Exception | None = None,
+                  intento: int = 0):
+        uso = extraer_uso(response) if response is not None else extraer_uso(None)
+        traza = {
+            'ts': round(time.time(), 3),
+            'agente': agente or modelo,
+            'modelo': modelo,
+            'esfuerzo': esfuerzo,
+            'prioridad': prioridad,
+            'intento': intento,
+            'espera_cola_ms': round(espera_cola_s * 1000, 1),
+            'duracion_ms': round(duracion_s * 1000, 1),
+            **uso,
+            'costo_usd': self.costo_estimado(modelo, uso) if error is None else None,
+            'ok': error is None,
+            'error': type(error).__name__ if error is not None else None,
+        }
+        with self._lock:
+            self._anillo.append(traza)
+        if self._sink is not None:
+            try:
+                self._sink.info(json.dumps(traza, ensure_ascii=False))
+            except Exception:
+                pass
+        return traza
+
+    def recientes(self, limite: int = 50) -> list:
+        with self._lock:
+            return list(self._anillo)[-max(1, int(limite)):]
+
+    @staticmethod
+    def _resumir(trazas: list) -> dict:
+        ok = [t for t in trazas if t['ok']]
+        duraciones = [t['duracion_ms'] for t in ok]
+        esperas = [t['espera_cola_ms'] for t in trazas]
+        costos = [t['costo_usd'] for t in ok if t['costo_usd'] is not None]
+        return {
+            'llamadas': len(trazas),
+            'errores': len(trazas) - len(ok),
+            'duracion_ms': {p: _percentil(duraciones, q) for p, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+            'espera_cola_ms': {p: _percentil(esperas, q) for p, q in (('p50', 0.5), ('p95', 0.95))},
+            'tokens': {
+                campo: sum(t[campo] for t in ok)
+                for campo in ('input_tokens', 'output_tokens', 'reasoning_tokens', 'cached_tokens')
+            },
+            'tiempo_total_s': round(sum(duraciones) / 1000, 2),
+            'costo_usd': round(sum(costos), 4) if costos else None,
+        }
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            trazas = list(self._anillo)
+        por_agente, por_modelo = {}, {}
+        for traza in trazas:
+            por_agente.setdefault(traza['agente'], []).append(traza)
+            por_modelo.setdefault(traza['modelo'], []).append(traza)
+        return {
+            'capacidad_anillo': self._anillo.maxlen,
+            'trazas_en_anillo': len(trazas),
+            'sink_jsonl': self.ruta_jsonl or None,
+            'por_agente': {agente: self._resumir(lista) for agente, lista in por_agente.items()},
+            'por_modelo': {modelo: self._resumir(lista) for modelo, lista in por_modelo.items()},
+        }
+
+
+def _precios_desde_config() -> dict:
+    valor = getattr(config, 'LLM_PRICES_JSON', '')
+    try:
+        return json.loads(valor) if valor else {}
+    except ValueError:
+        logger.error("[LLM_TRACE] LLM_PRICES no es un JSON válido. Se ignora.")
+        return {}
+
+
+trazador = LLMTracer(
+    capacidad=getattr(config, 'LLM_TRACE_RING_SIZE', 2000),
+    ruta_jsonl=getattr(config, 'LLM_TRACE_JSONL_PATH', ''),
+    max_bytes=getattr(config, 'LLM_TRACE_JSONL_MAX_BYTES', 10 * 1024 * 1024),
+    backups=getattr(config, 'LLM_TRACE_JSONL_BACKUPS', 5),
+    precios=_precios_desde_config(),
+)
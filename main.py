@@ -10,6 +10,7 @@ import re # Importamos re para parsear JSON
 import mercadopago
 from datetime import datetime, timedelta, timezone
 from threading import Lock, Thread, Timer
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from collections import deque
 from flask import Flask, request, jsonify, redirect
 from waitress import serve
@@ -27,6 +28,15 @@ import hubspot_handler
 import llm_handler
 import audio_handler
 import utils
+import intent_classifier
+import history_window
+import llm_hedging
+import llm_tracing
+import lead_pipeline
+import image_preprocessor
+import media_store
+import http_transport
+import outbound_queue
 # state_manager eliminado - sus funciones se integraron directamente en main.py
 
 # Importamos los nuevos handlers para tenerlos listos.
@@ -394,6 +404,311 @@ def _normalize_message_unified(msg, author, full_payload):
         'media_id': media_id, 'caption': caption
     }
 
+# Fan-out de multimedia: pool compartido y deadline por item, contada desde que el item empieza a correr
+_multimedia_executor = ThreadPoolExecutor(max_workers=getattr(config, 'MULTIMEDIA_MAX_WORKERS', 4),
+                                          thread_name_prefix='multimedia')
+MULTIMEDIA_TURN_DEADLINE = getattr(config, 'MULTIMEDIA_TURN_DEADLINE', 25.0)
+# Tope de espera en cola del pool (ocupado por items tardíos de otros turnos) antes de dar un item por tardío
+MULTIMEDIA_QUEUE_WAIT_MAX = getattr(config, 'MULTIMEDIA_QUEUE_WAIT_MAX', MULTIMEDIA_TURN_DEADLINE)
+
+_MARCADORES_MULTIMEDIA = {
+    'audio': "[AUDIO]: (nota de voz recibida, transcripción en curso)",
+    'image': "[IMAGEN]: (imagen recibida, análisis en curso)",
+    'video': "[VIDEO]: (video recibido)",
+    'document': "[DOCUMENTO]: (documento recibido)",
+}
+
+
+def _marcador_multimedia_tardia(msg):
+    """Mensaje de texto provisorio para un item que no terminó dentro de la deadline del turno."""
+    caption = msg.get('caption', '')
+    marcador = _MARCADORES_MULTIMEDIA.get(msg.get('type'), "[MULTIMEDIA]: (archivo recibido)")
+    return {
+        'type': 'text',
+        'body': f"{marcador} {caption}".strip(),
+        'timestamp': msg.get('timestamp'),
+        'senderName': msg.get('senderName', 'Usuario'),
+        'id': f"{msg.get('id', '')}_pending"
+    }
+
+
+def _esperar_multimedia(futuros, inicios, deadline=None, espera_cola_max=None):
+    """
+    Espera los items del turno. Cada uno tiene `deadline` segundos desde que empezó a
+    correr (inicios[i], lo marca el propio item); el tiempo en la cola del pool compartido
+    no cuenta, salvo que pase `espera_cola_max`. Devuelve el set de futuros pendientes.
+    """
+    deadline = MULTIMEDIA_TURN_DEADLINE if deadline is None else deadline
+    espera_cola_max = MULTIMEDIA_QUEUE_WAIT_MAX if espera_cola_max is None else espera_cola_max
+    inicio_turno = time.monotonic()
+    indices = {futuro: i for i, futuro in enumerate(futuros)}
+
+    def _vence(futuro):
+        inicio = inicios.get(indices[futuro])
+        return inicio + deadline if inicio is not None else inicio_turno + espera_cola_max
+
+    vigentes = set(futuros)
+    while True:
+        ahora = time.monotonic()
+        vigentes = {f for f in vigentes if not f.done() and _vence(f) > ahora}
+        if not vigentes:
+            break
+        # Tope de 0.5s: un item que arranca mientras se espera cambia su vencimiento
+        wait(vigentes, timeout=min(0.5, min(_vence(f) for f in vigentes) - ahora), return_when=FIRST_COMPLETED)
+    return {f for f in futuros if not f.done()}
+
+
+def _agregar_multimedia_tardia(author, msg, futuro, contexto_item):
+    """
+    Callback de un item que terminó después de la deadline: guarda el resultado en
+    `multimedia_processed` para que _reconstruir_mensaje_usuario lo incluya en el próximo turno.
+    """
+    try:
+        mensaje_texto = futuro.result()
+    except Exception as e:
+        logger.error(f"[MULTIMEDIA_INSTANTANEO] Error en {msg.get('type')} tardío para {author}: {e}", exc_info=True)
+        return
+    if not mensaje_texto and not contexto_item:
+        return
+    try:
+        # Escritura por campo (ArrayUnion): no pisa lo que el turno en curso haya guardado entretanto
+        item = None
+        if mensaje_texto:
+            item = {
+                'type': msg.get('type'),
+                'content': mensaje_texto['body'],
+                'timestamp': msg.get('timestamp'),
+            }
+        memory.agregar_multimedia_procesada(author, item, campos_contexto=contexto_item)
+        logger.info(f"[MULTIMEDIA_INSTANTANEO] 📎 {msg.get('type')} tardío de {author} agregado al contexto del próximo turno")
+    except Exception as e:
+        logger.error(f"[MULTIMEDIA_INSTANTANEO] Error guardando {msg.get('type')} tardío para {author}: {e}")
+
+
+def _procesar_item_multimedia(author, msg, state_context):
+    """
+    Procesa UN mensaje multimedia (audio, imagen, video o documento) y lo convierte
+    en mensaje de texto. `state_context` es un dict propio del item: el llamador
+    fusiona sus cambios (p. ej. pago verificado) en el contexto de la conversación.
+    """
+    message_type = msg.get('type')
+    media_url = msg.get('media_url')
+    body_content = msg.get('body', '').strip()
+    sender_name = msg.get('senderName', 'Usuario')
+    
+    logger.info(f"[MULTIMEDIA_INSTANTANEO] Procesando {message_type} para {author}")
+    
+    processed_content = ""
+    
+    if message_type == 'audio':
+        # Manejar audio con método oficial de 360dialog
+        logger.info(f"[MULTIMEDIA_INSTANTANEO] 🎵 Procesando audio para {author}")
+        media_id = msg.get('media_id')
+        
+        # Audio reintentado/reenviado con el mismo media_id: reutilizar la transcripción guardada
+        transcribed_text = media_store.store.obtener_artefacto('transcripcion', media_id=media_id) if media_id else None
+        if transcribed_text:
+            logger.info(f"[MULTIMEDIA_INSTANTANEO] ♻️ Transcripción reutilizada del media store")
+        
+        if media_url and not transcribed_text:
+            # Opción 1: Intentar transcripción con URL temporal (rápido pero limitado a 5min)
+            # Intentar transcripción directamente (sin signal que no funciona en threads)
+            try:
+                logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔄 Intentando transcripción con URL temporal")
+                transcribed_text = audio_handler.transcribe_audio_from_url(media_url)
+                if transcribed_text and "[Error" not in transcribed_text and "[Audio recibido - timeout" not in transcribed_text:
+                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Transcripción exitosa con URL temporal")
+                else:
+                    logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Primera transcripción falló o tuvo timeout")
+                    transcribed_text = None
+            except Exception as e:
+                logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Error con URL temporal: {e}")
+                transcribed_text = None
+        
+        # Opción 2: Si falla URL temporal, usar descarga oficial de 360dialog
+        if not transcribed_text and media_id:
+            try:
+                logger.info(f"[MULTIMEDIA_INSTANTANEO] 💾 Descargando audio usando método oficial 360dialog")
+                download_result = utils.download_and_store_media(media_id, "./temp_audio")
+                
+                if download_result["success"]:
+                    filepath = download_result["filepath"]
+                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Audio descargado: {filepath}")
+                    
+                    # Si tienes transcribe_audio_from_file, úsalo:
+                    # transcribed_text = audio_handler.transcribe_audio_from_file(filepath)
+                    
+                    # Por ahora, intentar de nuevo con la URL (ya descargada es más confiable)
+                    if media_url:
+                        try:
+                            logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔄 Segundo intento con descarga+upload")
+                            transcribed_text = audio_handler.transcribe_audio_from_url_with_download(media_url)
+                            
+                            # Si aún falla, intentar una vez más con método original
+                            if not transcribed_text or "[Error" in transcribed_text:
+                                logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔄 Tercer intento con método original")
+                                transcribed_text = audio_handler.transcribe_audio_from_url(media_url)
+                                
+                        except Exception as e:
+                            logger.error(f"[MULTIMEDIA_INSTANTANEO] Error en segundo intento: {e}")
+                else:
+                    logger.error(f"[MULTIMEDIA_INSTANTANEO] ❌ Error descargando: {download_result['error']}")
+            except Exception as e:
+                logger.error(f"[MULTIMEDIA_INSTANTANEO] 💥 Error en descarga: {e}")
+        
+        # Resultado final del audio
+        if transcribed_text:
+            if media_id and not transcribed_text.startswith('['):
+                media_store.store.guardar_artefacto('transcripcion', transcribed_text, media_id=media_id)
+            processed_content = f"[AUDIO]: {transcribed_text}"
+            logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Audio transcrito exitosamente")
+        else:
+            # Aún registrar que se recibió un audio aunque no se pueda transcribir
+            processed_content = f"[AUDIO]: (nota de voz recibida - ID: {media_id})"
+            logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Audio recibido pero no transcribible")
+    
+    elif message_type == 'image':
+        # Manejar imagen con método oficial - DEBE pasar por el lector
+        logger.info(f"[MULTIMEDIA_INSTANTANEO] 🖼️ Procesando imagen para {author}")
+        caption = msg.get('caption', '')
+        media_id = msg.get('media_id')
+        
+        image_description = media_store.store.obtener_artefacto('vision', media_id=media_id) if media_id else None
+        if image_description:
+            logger.info(f"[MULTIMEDIA_INSTANTANEO] ♻️ Análisis de imagen reutilizado del media store")
+        
+        if media_url and not image_description:
+            # Descargar y analizar imagen con el lector
+            try:
+                logger.info(f"[MULTIMEDIA_INSTANTANEO] 📥 Descargando imagen para análisis")
+                from llm_handler import llamar_agente_lector
+                
+                # IMPORTANTE: Agregar headers de autorización para 360dialog
+                headers = {}
+                if media_url and 'waba-v2.360dialog.io' in media_url:
+                    headers = {"D360-API-KEY": os.getenv('D360_API_KEY')}
+                    logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔑 Usando API key para descargar imagen de 360dialog")
+
+                # Descarga en streaming al media store; el SHA-256 sale de la misma pasada
+                entrada = media_store.store.descargar(media_url, headers=headers, media_id=media_id, timeout=45)
+                
+                analisis_previo = (media_store.store.obtener_artefacto('vision', sha256=entrada.sha256)
+                                   or image_preprocessor.preprocesador.analisis_cacheado(entrada.sha256))
+                if analisis_previo:
+                    # Misma imagen ya analizada (p. ej. comprobante reenviado)
+                    image_description = analisis_previo
+                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ♻️ Imagen repetida, reutilizando análisis previo")
+                else:
+                    # Decodificar, orientar, reducir y re-codificar antes del lector
+                    imagen = image_preprocessor.preprocesador.preparar(entrada.leer(), entrada.sha256)
+                    if len(imagen.contenido) > 5 * 1024 * 1024:
+                        logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Imagen demasiado grande para {author}")
+                        image_description = "Imagen demasiado grande para procesar"
+                    else:
+                        image_content_for_lector = [imagen.parte_lector()]
+
+                        # Llamar al lector para analizar la imagen
+                        logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔍 Analizando imagen con agente lector")
+                        image_description = llamar_agente_lector(image_content_for_lector).strip()
+                        image_preprocessor.preprocesador.guardar_analisis(imagen.sha256, image_description)
+                        if image_description and not image_description.startswith("Lo siento"):
+                            media_store.store.guardar_artefacto('vision', image_description, sha256=entrada.sha256)
+                        logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Imagen analizada exitosamente")
+            except media_store.MediaDemasiadoGrandeError as e:
+                logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Imagen demasiado grande para {author}: {e}")
+                image_description = "Imagen demasiado grande para procesar"
+            except Exception as e:
+                logger.error(f"[MULTIMEDIA_INSTANTANEO] ❌ Error analizando imagen: {e}")
+        
+        # Resultado final de la imagen (quirúrgico para comprobantes)
+        # Si el lector devuelve el formato estricto de comprobante, conservarlo tal cual; si no, no forzar mensaje de comprobante
+        if image_description and image_description.strip().upper().startswith("COMPROBANTE DE PAGO:"):
+            # Mensaje concreto de detección de comprobante; no anteponer "Descripción"
+            processed_content = image_description.strip()
+            logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Comprobante de pago detectado por lector: '{processed_content}'")
+            
+            # NUEVO: Registrar automáticamente el pago como verificado
+            try:
+                # Extraer el monto del comprobante
+                import re
+                monto_match = re.search(r'\$\s*([\d.,]+)', processed_content)
+                if monto_match:
+                    monto_detectado = monto_match.group(1).replace(',', '').replace('.', '')
+                    try:
+                        monto_numerico = int(monto_detectado)
+                        # Registrar el pago como verificado
+                        state_context['payment_verified'] = True
+                        state_context['payment_amount'] = monto_numerico
+                        state_context['payment_status'] = f'VERIFICADO - ${monto_numerico:,}'
+                        state_context['payment_verification_timestamp'] = datetime.now().isoformat()
+                        
+                        # Limpiar restricciones de pago
+                        state_context['payment_restriction_active'] = False
+                        state_context['requires_payment_first'] = False
+                        state_context['blocked_action'] = None
+                        
+                        # CORRECCIÓN V10: NO cambiar estado automáticamente
+                        # El usuario debe usar "SALIR DE PAGO" para cambiar estado
+                        # Solo marcar pago como verificado, mantener flujo actual
+                        logger.info(f"[PAGO_VERIFICADO] ✅ Pago verificado pero manteniendo flujo actual para comandos explícitos")
+                        
+                        logger.info(f"[PAGO_VERIFICADO] ✅ Pago registrado automáticamente: ${monto_numerico:,} para {author}")
+                        logger.info(f"[PAGO_VERIFICADO] 🔓 Restricciones de pago removidas para {author}")
+                    except ValueError:
+                        logger.warning(f"[PAGO_VERIFICADO] ⚠️ No se pudo convertir monto a número: {monto_detectado}")
+                else:
+                    logger.warning(f"[PAGO_VERIFICADO] ⚠️ No se pudo extraer monto del comprobante: {processed_content}")
+            except Exception as e:
+                logger.error(f"[PAGO_VERIFICADO] ❌ Error registrando pago: {e}")
+        elif image_description and image_description.strip() != "N/A":
+            # Otros casos donde el lector describa la imagen (opcional): registramos como descripción genérica
+            if caption:
+                processed_content = f"[IMAGEN]: {caption} - Descripción: {image_description.strip()}"
+            else:
+                processed_content = f"[IMAGEN]: {image_description.strip()}"
+            logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Imagen procesada con descripción genérica")
+        else:
+            # Fallback si no se puede analizar o no es comprobante
+            if caption:
+                processed_content = f"[IMAGEN]: {caption}"
+            else:
+                processed_content = f"[IMAGEN]: (imagen enviada - ID: {media_id})"
+            logger.info(f"[MULTIMEDIA_INSTANTANEO] ℹ️ Imagen recibida sin comprobante detectado")
+    
+    elif message_type == 'video':
+        caption = msg.get('caption', '')
+        if caption:
+            processed_content = f"[VIDEO]: {caption}"
+        elif body_content:
+            processed_content = f"[VIDEO]: {body_content}"
+        else:
+            processed_content = "[VIDEO]: (video enviado)"
+        logger.info(f"[MULTIMEDIA_INSTANTANEO] Video procesado: '{processed_content}'")
+    
+    elif message_type == 'document':
+        caption = msg.get('caption', '')
+        if caption:
+            processed_content = f"[DOCUMENTO]: {caption}"
+        elif body_content:
+            processed_content = f"[DOCUMENTO]: {body_content}"
+        else:
+            processed_content = "[DOCUMENTO]: (documento enviado)"
+        logger.info(f"[MULTIMEDIA_INSTANTANEO] Documento procesado: '{processed_content}'")
+    
+    # NUEVA LÓGICA: Crear mensaje de texto con el contenido procesado
+    if processed_content:
+        mensaje_texto = {
+            'type': 'text',
+            'body': processed_content,
+            'timestamp': msg.get('timestamp'),
+            'senderName': sender_name,
+            'id': f"{msg.get('id', '')}_processed"  # ID único para evitar duplicados
+        }
+        logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Contenido multimedia convertido a mensaje de texto: '{processed_content}'")
+        return mensaje_texto
+    return None
+
+
 def _procesar_multimedia_instantaneo(author, media_messages, state_context=None):
     """
     NUEVA FUNCIÓN: Procesa multimedia al instante y lo agrega al buffer como mensajes de texto.
@@ -404,6 +719,8 @@ def _procesar_multimedia_instantaneo(author, media_messages, state_context=None)
     # Inicializar state_context si es None
     if state_context is None:
         state_context = {}
+    # multimedia_processed se modifica solo por campo (ArrayUnion/ArrayRemove): no reescribirlo acá
+    state_context.pop('multimedia_processed', None)
     
     # Preparar lista para devolver siempre, incluso ante errores
     mensajes_texto_procesados = []
@@ -411,205 +728,35 @@ def _procesar_multimedia_instantaneo(author, media_messages, state_context=None)
         # Lista para almacenar mensajes de texto procesados
         mensajes_texto_procesados = []
         
-        # Procesar cada mensaje multimedia
-        for msg in media_messages:
-            message_type = msg.get('type')
-            media_url = msg.get('media_url')
-            body_content = msg.get('body', '').strip()
-            sender_name = msg.get('senderName', 'Usuario')
-            
-            logger.info(f"[MULTIMEDIA_INSTANTANEO] Procesando {message_type} para {author}")
-            
-            processed_content = ""
-            
-            if message_type == 'audio':
-                # Manejar audio con método oficial de 360dialog
-                logger.info(f"[MULTIMEDIA_INSTANTANEO] 🎵 Procesando audio para {author}")
-                media_id = msg.get('media_id')
-                
-                transcribed_text = None
-                
-                if media_url:
-                    # Opción 1: Intentar transcripción con URL temporal (rápido pero limitado a 5min)
-                    # Intentar transcripción directamente (sin signal que no funciona en threads)
-                    try:
-                        logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔄 Intentando transcripción con URL temporal")
-                        transcribed_text = audio_handler.transcribe_audio_from_url(media_url)
-                        if transcribed_text and "[Error" not in transcribed_text and "[Audio recibido - timeout" not in transcribed_text:
-                            logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Transcripción exitosa con URL temporal")
-                        else:
-                            logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Primera transcripción falló o tuvo timeout")
-                            transcribed_text = None
-                    except Exception as e:
-                        logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Error con URL temporal: {e}")
-                        transcribed_text = None
-                
-                # Opción 2: Si falla URL temporal, usar descarga oficial de 360dialog
-                if not transcribed_text and media_id:
-                    try:
-                        logger.info(f"[MULTIMEDIA_INSTANTANEO] 💾 Descargando audio usando método oficial 360dialog")
-                        download_result = utils.download_and_store_media(media_id, "./temp_audio")
-                        
-                        if download_result["success"]:
-                            filepath = download_result["filepath"]
-                            logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Audio descargado: {filepath}")
-                            
-                            # Si tienes transcribe_audio_from_file, úsalo:
-                            # transcribed_text = audio_handler.transcribe_audio_from_file(filepath)
-                            
-                            # Por ahora, intentar de nuevo con la URL (ya descargada es más confiable)
-                            if media_url:
-                                try:
-                                    logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔄 Segundo intento con descarga+upload")
-                                    transcribed_text = audio_handler.transcribe_audio_from_url_with_download(media_url)
-                                    
-                                    # Si aún falla, intentar una vez más con método original
-                                    if not transcribed_text or "[Error" in transcribed_text:
-                                        logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔄 Tercer intento con método original")
-                                        transcribed_text = audio_handler.transcribe_audio_from_url(media_url)
-                                        
-                                except Exception as e:
-                                    logger.error(f"[MULTIMEDIA_INSTANTANEO] Error en segundo intento: {e}")
-                        else:
-                            logger.error(f"[MULTIMEDIA_INSTANTANEO] ❌ Error descargando: {download_result['error']}")
-                    except Exception as e:
-                        logger.error(f"[MULTIMEDIA_INSTANTANEO] 💥 Error en descarga: {e}")
-                
-                # Resultado final del audio
-                if transcribed_text:
-                    processed_content = f"[AUDIO]: {transcribed_text}"
-                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Audio transcrito exitosamente")
-                else:
-                    # Aún registrar que se recibió un audio aunque no se pueda transcribir
-                    processed_content = f"[AUDIO]: (nota de voz recibida - ID: {media_id})"
-                    logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Audio recibido pero no transcribible")
-            
-            elif message_type == 'image':
-                # Manejar imagen con método oficial - DEBE pasar por el lector
-                logger.info(f"[MULTIMEDIA_INSTANTANEO] 🖼️ Procesando imagen para {author}")
-                caption = msg.get('caption', '')
-                media_id = msg.get('media_id')
-                
-                image_description = None
-                
-                if media_url:
-                    # Descargar y analizar imagen con el lector
-                    try:
-                        logger.info(f"[MULTIMEDIA_INSTANTANEO] 📥 Descargando imagen para análisis")
-                        import requests
-                        import base64
-                        from llm_handler import llamar_agente_lector
-                        
-                        # IMPORTANTE: Agregar headers de autorización para 360dialog
-                        headers = {}
-                        if media_url and 'waba-v2.360dialog.io' in media_url:
-                            headers = {"D360-API-KEY": os.getenv('D360_API_KEY')}
-                            logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔑 Usando API key para descargar imagen de 360dialog")
-
-                        response = requests.get(media_url, headers=headers, timeout=45)
-                        response.raise_for_status()
-                        
-                        if len(response.content) > 5 * 1024 * 1024:
-                            logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⚠️ Imagen demasiado grande para {author}")
-                            image_description = "Imagen demasiado grande para procesar"
-                        else:
-                            # Convertir a base64 y preparar para el lector
-                            image_base64 = base64.b64encode(response.content).decode('utf-8')
-                            image_content_for_lector = [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}]
-                            
-                            # Llamar al lector para analizar la imagen
-                            logger.info(f"[MULTIMEDIA_INSTANTANEO] 🔍 Analizando imagen con agente lector")
-                            image_description = llamar_agente_lector(image_content_for_lector).strip()
-                            logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Imagen analizada exitosamente")
-                    except Exception as e:
-                        logger.error(f"[MULTIMEDIA_INSTANTANEO] ❌ Error analizando imagen: {e}")
-                
-                # Resultado final de la imagen (quirúrgico para comprobantes)
-                # Si el lector devuelve el formato estricto de comprobante, conservarlo tal cual; si no, no forzar mensaje de comprobante
-                if image_description and image_description.strip().upper().startswith("COMPROBANTE DE PAGO:"):
-                    # Mensaje concreto de detección de comprobante; no anteponer "Descripción"
-                    processed_content = image_description.strip()
-                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Comprobante de pago detectado por lector: '{processed_content}'")
-                    
-                    # NUEVO: Registrar automáticamente el pago como verificado
-                    try:
-                        # Extraer el monto del comprobante
-                        import re
-                        monto_match = re.search(r'\$\s*([\d.,]+)', processed_content)
-                        if monto_match:
-                            monto_detectado = monto_match.group(1).replace(',', '').replace('.', '')
-                            try:
-                                monto_numerico = int(monto_detectado)
-                                # Registrar el pago como verificado
-                                state_context['payment_verified'] = True
-                                state_context['payment_amount'] = monto_numerico
-                                state_context['payment_status'] = f'VERIFICADO - ${monto_numerico:,}'
-                                state_context['payment_verification_timestamp'] = datetime.now().isoformat()
-                                
-                                # Limpiar restricciones de pago
-                                state_context['payment_restriction_active'] = False
-                                state_context['requires_payment_first'] = False
-                                state_context['blocked_action'] = None
-                                
-                                # CORRECCIÓN V10: NO cambiar estado automáticamente
-                                # El usuario debe usar "SALIR DE PAGO" para cambiar estado
-                                # Solo marcar pago como verificado, mantener flujo actual
-                                logger.info(f"[PAGO_VERIFICADO] ✅ Pago verificado pero manteniendo flujo actual para comandos explícitos")
-                                
-                                logger.info(f"[PAGO_VERIFICADO] ✅ Pago registrado automáticamente: ${monto_numerico:,} para {author}")
-                                logger.info(f"[PAGO_VERIFICADO] 🔓 Restricciones de pago removidas para {author}")
-                            except ValueError:
-                                logger.warning(f"[PAGO_VERIFICADO] ⚠️ No se pudo convertir monto a número: {monto_detectado}")
-                        else:
-                            logger.warning(f"[PAGO_VERIFICADO] ⚠️ No se pudo extraer monto del comprobante: {processed_content}")
-                    except Exception as e:
-                        logger.error(f"[PAGO_VERIFICADO] ❌ Error registrando pago: {e}")
-                elif image_description and image_description.strip() != "N/A":
-                    # Otros casos donde el lector describa la imagen (opcional): registramos como descripción genérica
-                    if caption:
-                        processed_content = f"[IMAGEN]: {caption} - Descripción: {image_description.strip()}"
-                    else:
-                        processed_content = f"[IMAGEN]: {image_description.strip()}"
-                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Imagen procesada con descripción genérica")
-                else:
-                    # Fallback si no se puede analizar o no es comprobante
-                    if caption:
-                        processed_content = f"[IMAGEN]: {caption}"
-                    else:
-                        processed_content = f"[IMAGEN]: (imagen enviada - ID: {media_id})"
-                    logger.info(f"[MULTIMEDIA_INSTANTANEO] ℹ️ Imagen recibida sin comprobante detectado")
-            
-            elif message_type == 'video':
-                caption = msg.get('caption', '')
-                if caption:
-                    processed_content = f"[VIDEO]: {caption}"
-                elif body_content:
-                    processed_content = f"[VIDEO]: {body_content}"
-                else:
-                    processed_content = "[VIDEO]: (video enviado)"
-                logger.info(f"[MULTIMEDIA_INSTANTANEO] Video procesado: '{processed_content}'")
-            
-            elif message_type == 'document':
-                caption = msg.get('caption', '')
-                if caption:
-                    processed_content = f"[DOCUMENTO]: {caption}"
-                elif body_content:
-                    processed_content = f"[DOCUMENTO]: {body_content}"
-                else:
-                    processed_content = "[DOCUMENTO]: (documento enviado)"
-                logger.info(f"[MULTIMEDIA_INSTANTANEO] Documento procesado: '{processed_content}'")
-            
-            # NUEVA LÓGICA: Crear mensaje de texto con el contenido procesado
-            if processed_content:
-                mensaje_texto = {
-                    'type': 'text',
-                    'body': processed_content,
-                    'timestamp': msg.get('timestamp'),
-                    'senderName': sender_name,
-                    'id': f"{msg.get('id', '')}_processed"  # ID único para evitar duplicados
-                }
+        # Fan-out: cada item en el pool acotado; los resultados se juntan en el orden original
+        contextos = [{} for _ in media_messages]
+        inicios = {}
+
+        def _item(i, msg):
+            inicios[i] = time.monotonic()
+            return _procesar_item_multimedia(author, msg, contextos[i])
+
+        futuros = [_multimedia_executor.submit(_item, i, msg) for i, msg in enumerate(media_messages)]
+        pendientes = _esperar_multimedia(futuros, inicios)
+        
+        for msg, futuro, contexto_item in zip(media_messages, futuros, contextos):
+            if futuro in pendientes:
+                # Pasó la deadline del turno: marcador ahora, resultado real al contexto del próximo turno
+                logger.warning(f"[MULTIMEDIA_INSTANTANEO] ⏰ {msg.get('type')} de {author} no terminó en "
+                               f"{MULTIMEDIA_TURN_DEADLINE:.0f}s. Se agregará al próximo turno.")
+                mensajes_texto_procesados.append(_marcador_multimedia_tardia(msg))
+                futuro.add_done_callback(
+                    lambda f, m=msg, c=contexto_item: _agregar_multimedia_tardia(author, m, f, c)
+                )
+                continue
+            try:
+                mensaje_texto = futuro.result()
+            except Exception as e:
+                logger.error(f"[MULTIMEDIA_INSTANTANEO] Error procesando {msg.get('type')} para {author}: {e}", exc_info=True)
+                continue
+            state_context.update(contexto_item)
+            if mensaje_texto:
                 mensajes_texto_procesados.append(mensaje_texto)
-                logger.info(f"[MULTIMEDIA_INSTANTANEO] ✅ Contenido multimedia convertido a mensaje de texto: '{processed_content}'")
         
         # Nota: Ya no agregamos al buffer local. El caller persistirá en Firestore.
         if mensajes_texto_procesados:
@@ -634,18 +781,20 @@ def _procesar_multimedia_instantaneo(author, media_messages, state_context=None)
     return mensajes_texto_procesados
 
 
-def _reconstruir_mensaje_usuario(messages_to_process, author):
+def _reconstruir_mensaje_usuario(messages_to_process, author, multimedia_previa=None):
     logger.info(f"[RECONSTRUIR] Iniciando reconstrucción de mensaje para {author} - {len(messages_to_process)} mensajes")
     
-    # Obtener contexto actual para incluir multimedia procesada previamente
-    history, _, current_state, state_context = memory.get_conversation_data(phone_number=author)
+    # Multimedia procesada previamente: la que ya leyó el turno o, si no se pasa, la del contexto actual
+    if multimedia_previa is None:
+        _, _, _, state_context = memory.get_conversation_data(phone_number=author)
+        multimedia_previa = (state_context or {}).get('multimedia_processed') or []
     
     ordered_user_content = []
     user_message_for_history = ""
     
     # NUEVO: Incluir contenido multimedia procesado previamente desde el contexto
-    if state_context and 'multimedia_processed' in state_context:
-        for multimedia_item in state_context['multimedia_processed']:
+    if multimedia_previa:
+        for multimedia_item in multimedia_previa:
             content = multimedia_item.get('content', '')
             if content:
                 ordered_user_content.append(content)
@@ -1895,35 +2044,29 @@ def _formatear_transcripcion(historial: list) -> str:
         transcripcion += f"{rol}: {contenido}\n\n"
     return transcripcion.strip()
 
-def procesar_leads_inactivos():
-    if not LEAD_PROCESSING_LOCK.acquire(blocking=False): return
+def _parsear_lead_analista(respuesta_analista: str, autor: str) -> dict:
+    datos_lead = utils.parse_json_from_llm(respuesta_analista, context=f"analista_leads_{autor}")
+    if datos_lead and "email" in datos_lead and ("vacío" in datos_lead["email"] or "@" not in datos_lead["email"]):
+        del datos_lead["email"]
+    return datos_lead
+
+def procesar_leads_inactivos() -> bool:
+    """Procesa el backlog de leads inactivos. Retorna True si quedaron pendientes por presupuesto de tiempo."""
+    if not LEAD_PROCESSING_LOCK.acquire(blocking=False): return False
     logger.info("--- [LEAD_GEN] Iniciando chequeo de conversaciones inactivas ---")
     try:
         hace_una_hora = datetime.now(timezone.utc) - timedelta(hours=1)
         conversaciones_inactivas = memory.get_inactive_conversations(hace_una_hora)
         if not conversaciones_inactivas:
             logger.info("[LEAD_GEN] No hay conversaciones inactivas para procesar.")
-            return
-        for autor, datos_conv in conversaciones_inactivas.items():
-            try:
-                historial = datos_conv.get('history', [])
-                sender_name = datos_conv.get('senderName', '')
-                if not historial: continue
-                transcripcion = _formatear_transcripcion(historial)
-                respuesta_analista = llm_handler.llamar_analista_leads(transcripcion)
-                datos_lead = utils.parse_json_from_llm(respuesta_analista, context=f"analista_leads_{autor}")
-                if not datos_lead: continue
-                if datos_lead and "email" in datos_lead and ("vacío" in datos_lead["email"] or "@" not in datos_lead["email"]):
-                    del datos_lead["email"]
-                hubspot_handler.update_hubspot_contact(
-                    phone_number=autor.split('@')[0], name=sender_name,
-                    last_message="", lead_data=datos_lead
-                )
-                memory.marcar_lead_como_procesado(autor)
-            except Exception as e:
-                logger.error(f"[LEAD_GEN] Error procesando el lead de {autor}: {e}", exc_info=True)
+            return False
+        resumen = lead_pipeline.pipeline.procesar(
+            conversaciones_inactivas, _formatear_transcripcion, _parsear_lead_analista, marcar=True
+        )
+        return resumen.get('pendientes', 0) > 0
     except Exception as e:
         logger.error(f"[LEAD_GEN] Error catastrófico durante el chequeo de leads: {e}", exc_info=True)
+        return False
     finally:
         LEAD_PROCESSING_LOCK.release()
 
@@ -1934,11 +2077,13 @@ def process_buffered_messages(author):
     logger.info(f"Procesamiento finalizado para {author}.")
 def lead_checker_daemon():
     while True:
+        quedan_pendientes = False
         try:
-            procesar_leads_inactivos()
+            quedan_pendientes = procesar_leads_inactivos()
         except Exception as e:
             logger.error(f"[LEAD_DAEMON] Error en el ciclo del demonio de leads: {e}", exc_info=True)
-        time.sleep(900)
+        # Si el ciclo agotó su presupuesto con backlog, retomar pronto en vez de esperar el tick completo
+        time.sleep(config.LEAD_BACKLOG_RETRY_SLEEP if quedan_pendientes else 900)
 
 
 
@@ -1970,6 +2115,29 @@ def webhook():
         # RESPONDER INMEDIATAMENTE para evitar reintentos de 360dialog
         return "OK", 200
 
+def _bufferizar_multimedia(author, media_messages):
+    """Procesa un lote de multimedia del mismo autor (en paralelo) y lo persiste en el buffer cross-proceso."""
+    # NUEVO: Obtener contexto para permitir registro de pagos
+    try:
+        _, _, _, current_state_context = memory.get_conversation_data(phone_number=author)
+        procesados = _procesar_multimedia_instantaneo(author, media_messages, current_state_context) or []
+    except Exception as e:
+        logger.warning(f"[WEBHOOK] Error obteniendo contexto para multimedia: {e}")
+        procesados = _procesar_multimedia_instantaneo(author, media_messages) or []
+    token = _persist_buffer_and_get_token(author, procesados)
+    # Reiniciar/iniciar timer local coordinado por token persistido
+    with buffer_lock:
+        prev_local = user_timers.get(author)
+        if prev_local:
+            try:
+                prev_local.cancel()
+            except Exception:
+                pass
+        t = Timer(BUFFER_WAIT_TIME, _process_if_valid_callback, args=(author, token))
+        user_timers[author] = t
+        t.start()
+        logger.info(f"[WEBHOOK] Timer coordinado iniciado para {author} (token {token})")
+
 # NUEVA FUNCIÓN: Procesar webhook de forma asíncrona
 def _process_webhook_async(data):
     """Procesa el webhook en background para responder rápido a 360dialog"""
@@ -1984,6 +2152,7 @@ def _process_webhook_async(data):
                 value = change.get('value', {})
                 
                 if 'messages' in value:
+                    lotes_multimedia = {}
                     for msg in value.get('messages', []):
                         if not msg.get("from"): 
                             continue
@@ -2067,29 +2236,13 @@ def _process_webhook_async(data):
                                 logger.warning(f"[WEBHOOK] No se pudo registrar reacción en Chatwoot: {e}")
                             continue
                         if message_type in ['image', 'audio', 'video', 'document']:
-                            # Procesar multimedia instantáneamente y persistir en buffer cross-proceso
+                            # Multimedia: se junta por autor y se procesa en paralelo al cerrar el lote
                             logger.info(f"[WEBHOOK] Media ({message_type}) detectada. Procesando contenido.")
-                            # NUEVO: Obtener contexto para permitir registro de pagos
-                            try:
-                                _, _, _, current_state_context = memory.get_conversation_data(phone_number=author)
-                                procesados = _procesar_multimedia_instantaneo(author, [normalized_message], current_state_context) or []
-                            except Exception as e:
-                                logger.warning(f"[WEBHOOK] Error obteniendo contexto para multimedia: {e}")
-                                procesados = _procesar_multimedia_instantaneo(author, [normalized_message]) or []
-                            token = _persist_buffer_and_get_token(author, procesados)
-                            # Reiniciar/iniciar timer local coordinado por token persistido
-                            with buffer_lock:
-                                prev_local = user_timers.get(author)
-                                if prev_local:
-                                    try:
-                                        prev_local.cancel()
-                                    except Exception:
-                                        pass
-                                t = Timer(BUFFER_WAIT_TIME, _process_if_valid_callback, args=(author, token))
-                                user_timers[author] = t
-                                t.start()
-                                logger.info(f"[WEBHOOK] Timer coordinado iniciado para {author} (token {token})")
+                            lotes_multimedia.setdefault(author, []).append(normalized_message)
                         else:
+                            # La multimedia anterior de este autor va primero para conservar el orden
+                            if author in lotes_multimedia:
+                                _bufferizar_multimedia(author, lotes_multimedia.pop(author))
                             # Texto o botón - agregar al buffer normalmente
                             # Persistir mensaje textual en buffer cross-proceso y coordinar timer
                             token = _persist_buffer_and_get_token(author, [normalized_message])
@@ -2104,10 +2257,38 @@ def _process_webhook_async(data):
                                 user_timers[author] = t
                                 t.start()
                                 logger.info(f"[WEBHOOK] Mensaje agregado y timer coordinado para {author} (token {token})")
+                    
+                    for author, lote in lotes_multimedia.items():
+                        _bufferizar_multimedia(author, lote)
                                 
     except Exception as e:
         logger.error(f"[WEBHOOK] Error procesando webhook asíncrono: {e}", exc_info=True)
 
+@app.route('/webhook/assemblyai', methods=['POST'])
+def webhook_assemblyai():
+    """Callback de AssemblyAI al terminar una transcripción (modo webhook)."""
+    if not audio_handler.cliente_transcripcion.validar_token_webhook(request.headers.get('X-Webhook-Token')):
+        return "Token inválido", 403
+    data = request.get_json(silent=True) or {}
+    transcript_id = data.get('transcript_id')
+    if not transcript_id:
+        return "Falta transcript_id", 400
+    encontrado = audio_handler.cliente_transcripcion.notificar_webhook(transcript_id, data.get('status', ''))
+    if not encontrado:
+        logger.info(f"[ASSEMBLYAI_WEBHOOK] Transcripción {transcript_id} no es de este worker: señal para el worker dueño")
+    return "OK", 200
+
+@app.route('/transcription-stats')
+def transcription_stats():
+    """
+    Endpoint de diagnóstico del cliente de transcripción: trabajos en vuelo, latencia y consultas.
+    """
+    try:
+        return jsonify(audio_handler.cliente_transcripcion.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de transcripción: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/webhook-humano', methods=['POST'])
 def webhook_humano():
     token_recibido = request.args.get('token')
@@ -2295,6 +2476,194 @@ def cache_stats():
         logger.error(f"Error obteniendo estadísticas del caché: {e}")
         return f"Error obteniendo estadísticas del caché: {e}", 500
 
+@app.route('/intent-fastpath-stats')
+def intent_fastpath_stats():
+    """
+    Endpoint de diagnóstico del clasificador rápido de intenciones (fracción de turnos sin LLM).
+    """
+    try:
+        return jsonify(intent_classifier.clasificador.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del fast-path: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/history-window-stats')
+def history_window_stats():
+    """
+    Endpoint de diagnóstico de la ventana de historial: tokens y latencia ahorrados por agente.
+    """
+    try:
+        return jsonify(history_window.ventanas.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de ventana de historial: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/llm-scheduler-stats')
+def llm_scheduler_stats():
+    """
+    Endpoint de diagnóstico del planificador LLM: cupos, espera en cola, TPM y 429 por modelo.
+    """
+    try:
+        return jsonify(llm_handler.planificador.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del planificador LLM: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/llm-hedging-stats')
+def llm_hedging_stats():
+    """
+    Endpoint de diagnóstico de hedged requests: tasa de hedge, victorias, mejora de cola y breakers.
+    """
+    try:
+        return jsonify(llm_hedging.coordinador.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de hedging LLM: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/llm-trace-stats')
+def llm_trace_stats():
+    """
+    Endpoint de diagnóstico de trazas LLM: percentiles de latencia, cola, tokens y costo por agente y modelo.
+    Con ?recientes=N incluye además las últimas N trazas.
+    """
+    try:
+        stats = llm_tracing.trazador.get_stats()
+        recientes = request.args.get('recientes', type=int)
+        if recientes:
+            stats['recientes'] = llm_tracing.trazador.recientes(recientes)
+        return jsonify(stats), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo trazas LLM: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/llm-backend-stats')
+def llm_backend_stats():
+    """
+    Endpoint de diagnóstico del backend LLM activo (openai / record / replay) y su cassette.
+    """
+    try:
+        if llm_handler.backend is None:
+            return jsonify({"backend": None}), 200
+        return jsonify(llm_handler.backend.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estado del backend LLM: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/lead-pipeline-stats')
+def lead_pipeline_stats():
+    """
+    Endpoint de diagnóstico del pipeline de leads: último ciclo, totales y leads en enfriamiento.
+    """
+    try:
+        return jsonify(lead_pipeline.pipeline.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del pipeline de leads: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/image-preprocessing-stats')
+def image_preprocessing_stats():
+    """
+    Endpoint de diagnóstico del pre-procesamiento de imágenes: bytes ahorrados y caché de análisis.
+    """
+    try:
+        return jsonify(image_preprocessor.preprocesador.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de pre-procesamiento de imágenes: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/media-store-stats')
+def media_store_stats():
+    """
+    Endpoint de diagnóstico del media store: bytes en disco, deduplicación y artefactos reutilizados.
+    """
+    try:
+        return jsonify(media_store.store.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del media store: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/http-transport-stats')
+def http_transport_stats():
+    """
+    Endpoint de diagnóstico del transporte HTTP saliente: latencia, estados y reintentos por endpoint.
+    """
+    try:
+        return jsonify(http_transport.transporte.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del transporte HTTP: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/outbound-queue-stats')
+def outbound_queue_stats():
+    """
+    Endpoint de diagnóstico de la cola de salida: pendientes, dead-letter y latencias de pensamiento vs. entrega.
+    """
+    try:
+        return jsonify(outbound_queue.cola.get_stats()), 200
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de la cola de salida: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/chatwoot-mirror-stats')
+def chatwoot_mirror_stats():
+    """Estado del espejado a Chatwoot en segundo plano: backlog pendiente, fallos y latencia."""
+    try:
+        from chatwoot_integration import espejo
+        return jsonify(espejo.get_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del espejo de Chatwoot: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/whatsapp-templates-stats')
+def whatsapp_templates_stats():
+    """Plantillas interactivas compiladas y tiempo de serialización por envío."""
+    try:
+        return jsonify(msgio_handler.get_template_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de plantillas: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/calendar-mirror-stats')
+def calendar_mirror_stats():
+    """Estado de los espejos de calendario: eventos, último sync, syncs completos/incrementales y resyncs por 410."""
+    try:
+        from calendar_services.espejo_calendario import get_mirror_stats
+        return jsonify(get_mirror_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de espejos de calendario: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/availability-prefetch-stats')
+def availability_prefetch_stats():
+    """Turnos precalculados por día: cantidad, antigüedad, días obsoletos y aciertos del prefetch."""
+    try:
+        if 'SCHEDULING' not in config.ENABLED_AGENTS:
+            return jsonify({'activo': False, 'motivo': 'SCHEDULING deshabilitado'})
+        return jsonify(agendamiento_handler.turnos_precalculados.get_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del prefetch de turnos: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/slot-holds-stats')
+def slot_holds_stats():
+    """Holds de turnos: retenciones, conversiones, liberaciones y tasa de conflictos."""
+    try:
+        import slot_holds
+        return jsonify(slot_holds.reservas.get_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas de holds de turnos: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/calendar-client-stats')
+def calendar_client_stats():
+    """Clientes de Google Calendar del worker: origen del discovery, vencimiento del token y refrescos."""
+    try:
+        from calendar_services.cliente_google import get_client_stats
+        return jsonify(get_client_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas del cliente de calendario: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/clear-cache')
 def clear_cache():
     """Limpia todas las cachés del sistema."""
@@ -3216,15 +3585,10 @@ def _construir_context_info_completo(detalles, state_context, mensaje_completo_u
     logger.info(f"[CONTEXT_INFO] Context_info completo construido: {list(context_info.keys())}")
     return context_info
 
-def _llamar_agente_cero_directo(history, context_info):
+def _construir_prompt_agente_cero(history, context_info):
     """
-    Agente Cero mejorado: Recibe context_info completo como el generador.
-    RESPONSABILIDADES:
-    1. Resolver preguntando (respuesta directa)
-    2. Pasar al Meta-Agente (cuando detecta intención de agenda/pago)
+    Construye el prompt completo del Agente Cero a partir de context_info e historial.
     """
-    logger.info("[AGENTE_CERO] Llamando con context_info completo...")
-    
     # Extraer información del contexto enriquecido
     mensaje_usuario = context_info.get('ultimo_mensaje_usuario', '')
     intencion = context_info.get('intencion', 'desconocida')
@@ -3331,12 +3695,18 @@ def _llamar_agente_cero_directo(history, context_info):
 **Significado:** Estado actual de la conversación en el sistema.
 """
 
-    # Formatear historial para mayor claridad
+    # Ventana de historial con presupuesto de tokens (turnos viejos plegados en un resumen)
+    ventana = history_window.ventanas.construir(history, 'agente_cero', context_info.get('author'))
     historial_formateado = ""
-    for msg in history:
-        rol = msg.get('role', msg.get('name', 'asistente'))
-        contenido = msg.get('content', '')
-        historial_formateado += f"{rol}: {contenido}\n"
+    for msg in ventana['mensajes']:
+        historial_formateado += f"{history_window.formatear_mensaje(msg)}\n"
+
+    if ventana['resumen']:
+        prompt_completo += f"""
+---
+### RESUMEN DE LA CONVERSACIÓN ANTERIOR:
+{ventana['resumen']}
+"""
 
     prompt_completo += f"""
 ---
@@ -3368,7 +3738,10 @@ El usuario debe usar estos comandos EXACTOS para navegar:
 ---
 **RESPONDE AL USUARIO:**
 """
-    
+    return prompt_completo
+
+def _invocar_agente_cero(prompt_completo):
+    """Llama al modelo del Agente Cero con un prompt ya construido."""
     # Llamar a la API de OpenAI con el contexto enriquecido
     try:
         import llm_handler
@@ -3380,7 +3753,8 @@ El usuario debe usar estos comandos EXACTOS para navegar:
             messages=messages, 
             model=config.AGENTE_CERO_MODEL, 
             temperature=1.0,  # GPT-5 solo soporta temperature=1.0
-            max_completion_tokens=500
+            max_completion_tokens=500,
+            agent_context="agente_cero"
         )
         
         return respuesta
@@ -3388,6 +3762,17 @@ El usuario debe usar estos comandos EXACTOS para navegar:
         logger.error(f"[AGENTE_CERO] Error llamando al LLM: {e}", exc_info=True)
         return "Error en el procesamiento. Pasando al departamento."
 
+def _llamar_agente_cero_directo(history, context_info):
+    """
+    Agente Cero mejorado: Recibe context_info completo como el generador.
+    RESPONSABILIDADES:
+    1. Resolver preguntando (respuesta directa)
+    2. Pasar al Meta-Agente (cuando detecta intención de agenda/pago)
+    """
+    logger.info("[AGENTE_CERO] Llamando con context_info completo...")
+    prompt_completo = _construir_prompt_agente_cero(history, context_info)
+    return _invocar_agente_cero(prompt_completo)
+
 def _agente_cero_decision(mensaje_completo_usuario, history, state_context):
     """
     Agente Cero: Capa de inteligencia desechable que filtra el primer contacto.
@@ -3596,16 +3981,23 @@ def process_message_logic(author, messages_to_process):
     Este es el ORQUESTADOR PRINCIPAL.
     """
     logger.info(f"[CHECKPOINT] INICIO process_message_logic para {author}")
+    # Desde acá corre la latencia de "pensamiento"; la de entrega la mide la cola de salida
+    inicio_turno = time.monotonic()
     
     with buffer_lock:
         if author in PROCESSING_USERS:
             return
         PROCESSING_USERS.add(author)
 
+    # Las consultas al fast-path de este hilo cuentan como un solo turno en la métrica sin LLM
+    intent_classifier.clasificador.iniciar_turno()
     try:
         # Obtener contexto ANTES de reconstruir mensaje para incluir multimedia procesada
         history, _, current_state, state_context = memory.get_conversation_data(phone_number=author)
         logger.info(f"[CONTEXTO] Contexto leído para {author}: {state_context}")
+        # Se saca del contexto local para que los guardados del turno no reescriban el array
+        # (un item tardío puede agregarse con ArrayUnion en cualquier momento)
+        multimedia_previa = (state_context or {}).pop('multimedia_processed', None) or []
 
         # Enforzar lock de departamento cuando hay flujo activo para evitar llamar Agente Cero
         try:
@@ -3632,16 +4024,17 @@ def process_message_logic(author, messages_to_process):
         except Exception:
             pass
         
-        mensaje_completo_usuario, user_message_for_history = _reconstruir_mensaje_usuario(messages_to_process, author)
+        mensaje_completo_usuario, user_message_for_history = _reconstruir_mensaje_usuario(
+            messages_to_process, author, multimedia_previa=multimedia_previa)
         if not mensaje_completo_usuario or "(no disponible)" in mensaje_completo_usuario:
             logger.warning(f"Procesamiento detenido para {author} por falta de contenido útil.")
             return
 
-        # NUEVO: Limpiar multimedia procesada DESPUÉS de usarla para evitar duplicaciones futuras
-        if state_context and 'multimedia_processed' in state_context:
+        # NUEVO: Limpiar multimedia procesada DESPUÉS de usarla para evitar duplicaciones futuras.
+        # Solo los items consumidos: los que llegaron tarde después de la lectura quedan para el próximo turno.
+        if multimedia_previa:
             logger.info(f"[BUFFER] Limpiando multimedia procesada del contexto después de usar para {author}")
-            del state_context['multimedia_processed']
-            memory.update_conversation_state(author, current_state, context=_clean_context_for_firestore(state_context))
+            memory.quitar_multimedia_procesada(author, multimedia_previa)
         
         sender_name = messages_to_process[-1].get('senderName', 'Usuario')
         last_message_type = messages_to_process[-1].get('type')
@@ -3664,15 +4057,16 @@ def process_message_logic(author, messages_to_process):
                 if resultado_medico:
                     mensaje_respuesta, contexto_actualizado, botones = resultado_medico
                     if botones:
-                        msgio_handler.send_whatsapp_message(
+                        msgio_handler.enqueue_whatsapp_message(
                             phone_number=author,
                             message=mensaje_respuesta,
                             options=[{"id": b.get("id", ""), "title": b.get("title", "")} for b in botones],
                             list_title="Opciones",
-                            section_title="Seleccioná"
+                            section_title="Seleccioná",
+                            inicio_turno=inicio_turno
                         )
                     else:
-                        msgio_handler.send_whatsapp_message(phone_number=author, message=mensaje_respuesta)
+                        msgio_handler.enqueue_whatsapp_message(phone_number=author, message=mensaje_respuesta, inicio_turno=inicio_turno)
                     memory.update_conversation_state(author, contexto_actualizado.get('current_state', current_state), context=_clean_context_for_firestore(contexto_actualizado))
                     return
             except Exception as e:
@@ -3681,10 +4075,8 @@ def process_message_logic(author, messages_to_process):
         # Inicio automático del flujo médico por intención
         if BALLESTER_V11_ENABLED:
             try:
-                texto_lower = (mensaje_completo_usuario or "").lower()
-                if any(k in texto_lower for k in [
-                    'quiero agendar', 'consultar cobertura', 'obra social', 'neurologia', 'ecografia', 'eeg', 'cardiologia'
-                ]):
+                # Fast-path compilado (texto normalizado y sin acentos)
+                if intent_classifier.clasificador.intencion_resuelta(mensaje_completo_usuario or "", 'inicio_medico'):
                     context_medico = (state_context or {}).copy()
                     context_medico['verification_state'] = context_medico.get('verification_state') or 'IDENTIFICAR_PRACTICA'
                     orchestrator = verification_handler.MedicalVerificationOrchestrator()
@@ -3692,15 +4084,16 @@ def process_message_logic(author, messages_to_process):
                     if resultado_medico:
                         mensaje_respuesta, contexto_actualizado, botones = resultado_medico
                         if botones:
-                            msgio_handler.send_whatsapp_message(
+                            msgio_handler.enqueue_whatsapp_message(
                                 phone_number=author,
                                 message=mensaje_respuesta,
                                 options=[{"id": b.get("id", ""), "title": b.get("title", "")} for b in botones],
                                 list_title="Opciones",
-                                section_title="Seleccioná"
+                                section_title="Seleccioná",
+                                inicio_turno=inicio_turno
                             )
                         else:
-                            msgio_handler.send_whatsapp_message(phone_number=author, message=mensaje_respuesta)
+                            msgio_handler.enqueue_whatsapp_message(phone_number=author, message=mensaje_respuesta, inicio_turno=inicio_turno)
                         memory.update_conversation_state(author, contexto_actualizado.get('current_state', current_state), context=_clean_context_for_firestore(contexto_actualizado))
                         return
             except Exception as e:
@@ -4012,14 +4405,14 @@ def process_message_logic(author, messages_to_process):
                     # Importante: no sobrescribir el estado actual si la acción ya movió a AGENDA
                     estado_guard = (sc_latest or {}).get('current_state', current_state)
                     memory.update_conversation_state(author, estado_guard, context=contexto_limpio)
-                    msgio_handler.send_whatsapp_message(phone_number=author.split('@')[0], message=respuesta_final)
+                    msgio_handler.enqueue_whatsapp_message(phone_number=author.split('@')[0], message=respuesta_final, inicio_turno=inicio_turno)
                     memory.add_to_conversation_history(author, "user", sender_name, user_message_for_history, context=contexto_limpio, history=history)
                     memory.add_to_conversation_history(author, "assistant", "RODI", respuesta_final, name="RODI", context=contexto_limpio, history=history)
                     reply_sent = True
             except Exception as e:
                 logger.error(f"[REPLY_GUARD] Error aplicando guard: {e}")
                 # Fallback: enviar igualmente y registrar
-                msgio_handler.send_whatsapp_message(phone_number=author.split('@')[0], message=respuesta_final)
+                msgio_handler.enqueue_whatsapp_message(phone_number=author.split('@')[0], message=respuesta_final, inicio_turno=inicio_turno)
                 contexto_limpio = _clean_context_for_firestore(nuevo_contexto)
                 memory.add_to_conversation_history(author, "user", sender_name, user_message_for_history, context=contexto_limpio, history=history)
                 memory.add_to_conversation_history(author, "assistant", "RODI", respuesta_final, name="RODI", context=contexto_limpio, history=history)
@@ -4095,6 +4488,7 @@ def process_message_logic(author, messages_to_process):
     except Exception as e:
         logger.error(f"Error catastrófico en process_message_logic para {author}: {e}", exc_info=True)
     finally:
+        intent_classifier.clasificador.terminar_turno()
         with buffer_lock:
             PROCESSING_USERS.discard(author)
         logger.info(f"Procesamiento finalizado para {author}.")
@@ -4186,6 +4580,7 @@ def chatwoot_status():
             'account_id': chatwoot.account_id,
             'inbox_id': chatwoot.inbox_id,
             'api_token_present': bool(chatwoot.api_token),
+            'id_cache': chatwoot.ids.get_stats(),
             'timestamp': datetime.now().isoformat()
         }
         
@@ -4237,7 +4632,8 @@ def chatwoot_test():
                     phone='1234567890',  # Número de prueba
                     user_message='Mensaje de prueba desde OptiAtiende-IA',
                     bot_response='Respuesta de prueba del bot',
-                    sender_name='Test User'
+                    sender_name='Test User',
+                    sincronico=True
                 )
                 test_result['test_message_sent'] = True
                 test_result['test_result'] = result
@@ -4287,7 +4683,7 @@ def debug_360dialog():
             
             logger.info(f"[360DIALOG DEBUG] Probando conectividad con {test_url}")
             
-            response = requests.get(test_url, headers=headers, timeout=5)
+            response = utils.resolvedor_media.session.get(test_url, headers=headers, timeout=5)
             
             debug_info["connectivity_test"] = {
                 "status_code": response.status_code,
@@ -4318,6 +4714,9 @@ def debug_360dialog():
             "endpoint_correcto": "/{media_id} NO /media/{media_id}"
         }
         
+        # Caché de resolución media_id -> URL (evita repetir GET /{media_id} dentro de la validez)
+        debug_info["media_url_cache"] = utils.resolvedor_media.get_stats()
+        
         return {
             "status": "success",
             "debug_info": debug_info,
@@ -4391,7 +4790,7 @@ def chatwoot_debug():
         test_url = f"{chatwoot_url}/api/v1/accounts/{account_id}/conversations?inbox_id={inbox_id}&per_page=5"
         
         try:
-            response = requests.get(test_url, timeout=10)
+            response = http_transport.transporte.get(test_url, timeout=10)
             conversations_status = f"API Status: {response.status_code}"
             conversations_data = response.json() if response.status_code == 200 else "Error"
         except Exception as e:
@@ -4496,6 +4895,20 @@ def webhook_chatwoot_reply():
         data = request.get_json()
         logger.debug(f"[CHATWOOT-REPLY] Webhook recibido: {data}")
         
+        # Cambios de estado de la conversación: invalidar los IDs cacheados
+        if data and data.get('event') in ('conversation_status_changed', 'conversation_resolved'):
+            conversacion = data.get('data', data)
+            telefono_evento = (conversacion.get('meta', {}).get('sender', {}).get('phone_number') or '')
+            telefono_evento = telefono_evento.replace('+', '').replace('-', '').replace(' ', '')
+            status_conv = conversacion.get('status')
+            invalidados = chatwoot.ids.invalidar(
+                telefono=telefono_evento or None,
+                conversation_id=conversacion.get('id'),
+                solo_conversacion=True  # el contacto y su source_id siguen siendo válidos
+            )
+            logger.debug(f"[CHATWOOT-REPLY] Conversación {conversacion.get('id')} -> {status_conv}: {invalidados} entradas invalidadas")
+            return jsonify({'status': 'cache_invalidated', 'invalidated': invalidados}), 200
+        
         if not data or data.get('event') != 'message_created':
             logger.debug(f"[CHATWOOT-REPLY] Evento ignorado: {data.get('event', 'unknown')}")
             return jsonify({'status': 'event_ignored'}), 200
@@ -4868,6 +5281,13 @@ except ImportError:
 except Exception as e:
     logger.warning(f"⚠️ Error registrando sistema de revival: {e}")
 
+# Prefetch de disponibilidad de los próximos días (un hilo por worker)
+if 'SCHEDULING' in config.ENABLED_AGENTS:
+    try:
+        agendamiento_handler.turnos_precalculados.iniciar()
+    except Exception as e:
+        logger.warning(f"⚠️ Error iniciando prefetch de turnos: {e}")
+
 if __name__ == '__main__':
     logger.info(f"Iniciando servidor para el inquilino: {config.TENANT_NAME}")
     
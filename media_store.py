@@ -0,0 +1,339 @@
+"""
+Almacén de multimedia direccionado por contenido.
+
+- Descargas en streaming (por bloques) directo a disco, con tope de tamaño por
+  archivo: nunca se carga el archivo entero en memoria.
+- Cada blob se guarda una sola vez bajo su SHA-256 (blobs/ab/abcdef...), así que
+  la misma imagen o audio reenviado no ocupa espacio dos veces.
+- Índice SQLite: media_id de 360dialog -> sha256, tamaño y último acceso.
+- Presupuesto total de bytes (MEDIA_STORE_MAX_BYTES) con desalojo LRU. Los
+  workers comparten el directorio: el total sale del índice bajo un lock de
+  archivo, y no se desalojan blobs en uso ni accedidos hace menos de
+  MEDIA_STORE_EVICTION_GRACE segundos.
+- Artefactos derivados (transcripción, resumen de visión) se guardan como JSON
+  junto al blob (<sha256>.<tipo>.json). Si la misma media (por media_id o por
+  hash) vuelve a llegar, el artefacto se reutiliza sin reprocesar.
+  Cuando todavía no hay blob (p. ej. audio transcripto directo por URL), el
+  artefacto se guarda por media_id en artefactos/.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:  # Windows (desarrollo local): solo lock entre hilos
+    fcntl = None
+
+import config
+import http_transport
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+BLOQUE_DESCARGA = 64 * 1024
+
+
+class MediaDemasiadoGrandeError(Exception):
+    """La descarga superó el tamaño máximo permitido por archivo."""
+
+
+class EntradaMedia:
+    __slots__ = ('sha256', 'ruta', 'bytes', 'mime', 'cache_hit')
+
+    def __init__(self, sha256, ruta, bytes_, mime, cache_hit):
+        self.sha256 = sha256
+        self.ruta = ruta
+        self.bytes = bytes_
+        self.mime = mime
+        self.cache_hit = cache_hit
+
+    def leer(self) -> bytes:
+        with open(self.ruta, 'rb') as f:
+            return f.read()
+
+
+class MediaStore:
+    """Blobs por SHA-256 con índice SQLite, presupuesto LRU y artefactos derivados."""
+
+    def __init__(self, raiz: str, max_total_bytes: int = 1024 ** 3, max_bytes_archivo: int = 32 * 1024 ** 2,
+                 gracia_desalojo: float = 300.0):
+        self.raiz = os.path.abspath(raiz)
+        self.max_total_bytes = int(max_total_bytes)
+        self.max_bytes_archivo = int(max_bytes_archivo)
+        self.gracia_desalojo = float(gracia_desalojo)
+        self._lock = Lock()
+        self._en_uso = {}   # sha256 -> referencias activas en este proceso
+        os.makedirs(os.path.join(self.raiz, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(self.raiz, 'tmp'), exist_ok=True)
+        os.makedirs(os.path.join(self.raiz, 'artefactos'), exist_ok=True)
+        self._archivo_lock = open(os.path.join(self.raiz, 'index.lock'), 'a')
+        self._db = sqlite3.connect(os.path.join(self.raiz, 'index.sqlite3'), check_same_thread=False, timeout=10)
+        with self._bloqueo_indice():
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, bytes INTEGER, mime TEXT, ultimo_acceso REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS media_ids (media_id TEXT PRIMARY KEY, sha256 TEXT)")
+            self._db.commit()
+        self._stats = {'descargas': 0, 'hits_media_id': 0, 'dedupe_hash': 0, 'rechazadas_tamano': 0,
+                       'desalojados': 0, 'protegidos_desalojo': 0, 'bytes_descargados': 0,
+                       'artefactos_hit': 0, 'artefactos_miss': 0}
+
+    @contextmanager
+    def _bloqueo_indice(self):
+        """Lock entre hilos + lock de archivo entre workers para altas y desalojos."""
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._archivo_lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._archivo_lock.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def en_uso(self, sha256: str):
+        """Referencia activa a un blob mientras se lee: no se desaloja en este proceso."""
+        with self._lock:
+            self._en_uso[sha256] = self._en_uso.get(sha256, 0) + 1
+            self._tocar(sha256)
+        try:
+            yield
+        finally:
+            with self._lock:
+                if self._en_uso.get(sha256, 0) <= 1:
+                    self._en_uso.pop(sha256, None)
+                else:
+                    self._en_uso[sha256] -= 1
+                self._tocar(sha256)
+
+    # --- Rutas ---
+
+    def ruta_blob(self, sha256: str) -> str:
+        return os.path.join(self.raiz, 'blobs', sha256[:2], sha256)
+
+    def _ruta_artefacto(self, clave: str, tipo: str, es_blob: bool) -> str:
+        if es_blob:
+            return f"{self.ruta_blob(clave)}.{tipo}.json"
+        seguro = ''.join(c for c in clave if c.isalnum() or c in '-_.')
+        return os.path.join(self.raiz, 'artefactos', f"{seguro}.{tipo}.json")
+
+    # --- Índice ---
+
+    def _total_bytes(self) -> int:
+        """Total según el índice compartido (lo que escribieron todos los workers)."""
+        return self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM blobs").fetchone()[0]
+
+    def _tocar(self, sha256: str):
+        self._db.execute("UPDATE blobs SET ultimo_acceso = ? WHERE sha256 = ?", (time.time(), sha256))
+        self._db.commit()
+
+    def buscar_por_media_id(self, media_id: str) -> EntradaMedia | None:
+        if not media_id:
+            return None
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT b.sha256, b.bytes, b.mime FROM media_ids m JOIN blobs b ON b.sha256 = m.sha256 WHERE m.media_id = ?",
+                (media_id,)
+            ).fetchone()
+            if fila is None or not os.path.exists(self.ruta_blob(fila[0])):
+                return None
+            self._tocar(fila[0])
+            self._stats['hits_media_id'] += 1
+        return EntradaMedia(fila[0], self.ruta_blob(fila[0]), fila[1], fila[2], True)
+
+    # --- Descarga en streaming ---
+
+    def descargar(self, url: str, headers: dict | None = None, media_id: str | None = None,
+                  mime: str | None = None, session=None, timeout: float = 30) -> EntradaMedia:
+        """Descarga por bloques a disco calculando el SHA-256. Reutiliza el blob si ya existe."""
+        existente = self.buscar_por_media_id(media_id)
+        if existente is not None:
+            return existente
+
+        cliente = session or http_transport.transporte
+        hasher = hashlib.sha256()
+        total = 0
+        fd, ruta_tmp = tempfile.mkstemp(dir=os.path.join(self.raiz, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as destino:
+                with cliente.get(url, headers=headers or {}, timeout=timeout, stream=True) as response:
+                    response.raise_for_status()
+                    declarado = int(response.headers.get('Content-Length') or 0)
+                    if declarado > self.max_bytes_archivo:
+                        raise MediaDemasiadoGrandeError(f"{declarado} bytes (máx. {self.max_bytes_archivo})")
+                    mime = mime or (response.headers.get('Content-Type') or '').split(';')[0] or None
+                    for bloque in response.iter_content(chunk_size=BLOQUE_DESCARGA):
+                        if not bloque:
+                            continue
+                        total += len(bloque)
+                        if total > self.max_bytes_archivo:
+                            raise MediaDemasiadoGrandeError(f"más de {self.max_bytes_archivo} bytes")
+                        hasher.update(bloque)
+                        destino.write(bloque)
+        except MediaDemasiadoGrandeError:
+            with self._lock:
+                self._stats['rechazadas_tamano'] += 1
+            os.unlink(ruta_tmp)
+            raise
+        except Exception:
+            os.unlink(ruta_tmp)
+            raise
+
+        sha256 = hasher.hexdigest()
+        ruta = self.ruta_blob(sha256)
+        with self._bloqueo_indice():
+            self._stats['descargas'] += 1
+            self._stats['bytes_descargados'] += total
+            ya_existia = os.path.exists(ruta)
+            if ya_existia:
+                os.unlink(ruta_tmp)
+                self._stats['dedupe_hash'] += 1
+            else:
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                os.replace(ruta_tmp, ruta)
+                self._db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)", (sha256, total, mime, time.time()))
+            if media_id:
+                self._db.execute("INSERT OR REPLACE INTO media_ids VALUES (?, ?)", (media_id, sha256))
+            self._tocar(sha256)
+            self._aplicar_presupuesto(proteger=sha256)
+        if media_id:
+            self._migrar_artefactos_media_id(media_id, sha256)
+        logger.info(f"[MEDIA_STORE] {'♻️ Duplicado' if ya_existia else '💾 Guardado'} {sha256[:12]} ({total // 1024}KB)")
+        return EntradaMedia(sha256, ruta, total, mime, ya_existia)
+
+    def _aplicar_presupuesto(self, proteger: str | None = None):
+        """
+        Desaloja blobs (y sus artefactos) menos usados hasta entrar en el presupuesto.
+        Requiere _bloqueo_indice(). Se saltean los blobs en uso y los accedidos hace
+        menos de gracia_desalojo (otro worker puede estar usándolos).
+        """
+        total = self._total_bytes()
+        if total <= self.max_total_bytes:
+            return
+        reciente = time.time() - self.gracia_desalojo
+        protegidos = 0
+        for sha256, bytes_, ultimo_acceso in self._db.execute(
+                "SELECT sha256, bytes, ultimo_acceso FROM blobs ORDER BY ultimo_acceso ASC").fetchall():
+            if total <= self.max_total_bytes:
+                break
+            if sha256 == proteger or sha256 in self._en_uso or (ultimo_acceso or 0) > reciente:
+                protegidos += 1
+                continue
+            ruta = self.ruta_blob(sha256)
+            directorio = os.path.dirname(ruta)
+            for nombre in os.listdir(directorio) if os.path.isdir(directorio) else []:
+                if nombre.startswith(sha256):
+                    try:
+                        os.unlink(os.path.join(directorio, nombre))
+                    except OSError:
+                        pass
+            self._db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            self._db.execute("DELETE FROM media_ids WHERE sha256 = ?", (sha256,))
+            total -= bytes_
+            self._stats['desalojados'] += 1
+        self._db.commit()
+        if total > self.max_total_bytes:
+            self._stats['protegidos_desalojo'] += protegidos
+            logger.warning(f"[MEDIA_STORE] Presupuesto excedido ({total // 1024 ** 2}MB): "
+                           f"{protegidos} blobs en uso o recientes no se desalojaron")
+
+    # --- Artefactos derivados ---
+
+    def _resolver(self, sha256: str | None, media_id: str | None):
+        """(clave, es_blob) donde guardar/buscar el artefacto."""
+        if sha256 and os.path.exists(self.ruta_blob(sha256)):
+            return sha256, True
+        if media_id:
+            with self._lock:
+                fila = self._db.execute("SELECT sha256 FROM media_ids WHERE media_id = ?", (media_id,)).fetchone()
+            if fila and os.path.exists(self.ruta_blob(fila[0])):
+                return fila[0], True
+            return media_id, False
+        return None, False
+
+    def obtener_artefacto(self, tipo: str, sha256: str | None = None, media_id: str | None = None):
+        candidatos = []
+        clave, es_blob = self._resolver(sha256, media_id)
+        if clave:
+            candidatos.append(self._ruta_artefacto(clave, tipo, es_blob))
+        if media_id and es_blob:
+            candidatos.append(self._ruta_artefacto(media_id, tipo, False))
+        for ruta in candidatos:
+            try:
+                with open(ruta, 'r', encoding='utf-8') as f:
+                    valor = json.load(f).get('valor')
+                with self._lock:
+                    self._stats['artefactos_hit'] += 1
+                return valor
+            except (OSError, ValueError):
+                continue
+        with self._lock:
+            self._stats['artefactos_miss'] += 1
+        return None
+
+    def guardar_artefacto(self, tipo: str, valor, sha256: str | None = None, media_id: str | None = None):
+        clave, es_blob = self._resolver(sha256, media_id)
+        if not clave or valor is None:
+            return
+        ruta = self._ruta_artefacto(clave, tipo, es_blob)
+        try:
+            tmp = f"{ruta}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'valor': valor, 'guardado_en': time.time()}, f, ensure_ascii=False)
+            os.replace(tmp, ruta)
+        except OSError as e:
+            logger.warning(f"[MEDIA_STORE] No se pudo guardar el artefacto {tipo} de {clave[:12]}: {e}")
+
+    def _migrar_artefactos_media_id(self, media_id: str, sha256: str):
+        """Artefactos guardados por media_id antes de tener blob pasan a vivir junto al blob."""
+        prefijo = ''.join(c for c in media_id if c.isalnum() or c in '-_.') + '.'
+        directorio = os.path.join(self.raiz, 'artefactos')
+        for nombre in os.listdir(directorio):
+            if nombre.startswith(prefijo) and nombre.endswith('.json'):
+                tipo = nombre[len(prefijo):-len('.json')]
+                try:
+                    os.replace(os.path.join(directorio, nombre), self._ruta_artefacto(sha256, tipo, True))
+                except OSError:
+                    pass
+
+    def limpiar_artefactos_sueltos(self, max_edad_horas: float = 24):
+        """Borra artefactos por media_id (sin blob) más viejos que max_edad_horas."""
+        directorio = os.path.join(self.raiz, 'artefactos')
+        limite = time.time() - max_edad_horas * 3600
+        for nombre in os.listdir(directorio):
+            ruta = os.path.join(directorio, nombre)
+            try:
+                if os.path.getmtime(ruta) < limite:
+                    os.unlink(ruta)
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            blobs = self._db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+            media_ids = self._db.execute("SELECT COUNT(*) FROM media_ids").fetchone()[0]
+            stats = dict(self._stats)
+            total = self._total_bytes()
+        return {
+            'raiz': self.raiz,
+            'blobs': blobs,
+            'media_ids': media_ids,
+            'bytes_totales': total,
+            'presupuesto_bytes': self.max_total_bytes,
+            'max_bytes_archivo': self.max_bytes_archivo,
+            **stats,
+        }
+
+
+store = MediaStore(
+    getattr(config, 'MEDIA_STORE_DIR', './media_store'),
+    max_total_bytes=getattr(config, 'MEDIA_STORE_MAX_BYTES', 1024 ** 3),
+    max_bytes_archivo=getattr(config, 'MEDIA_MAX_FILE_BYTES', 32 * 1024 ** 2),
+    gracia_desalojo=getattr(config, 'MEDIA_STORE_EVICTION_GRACE', 300.0),
+)
@@ -335,6 +335,44 @@ def update_conversation_state(phone_number: str, new_state: str, context: dict =
     except Exception as e:
         logger.error(f"Error al actualizar el estado de la conversación para {phone_number}: {e}", exc_info=True)
 
+def agregar_multimedia_procesada(phone_number: str, item: dict = None, campos_contexto: dict = None):
+    """
+    Agrega un item a state_context.multimedia_processed (ArrayUnion) y actualiza
+    campos puntuales del contexto, sin leer ni reescribir el resto del documento.
+    Lo usan los items multimedia que terminan después de la deadline del turno.
+    """
+    if db is None:
+        logger.error("Firestore no está disponible. No se puede agregar multimedia procesada.")
+        return
+    doc_id = sanitize_and_recover_doc_id(phone_number)
+    if not doc_id:
+        logger.error("No se pudo agregar multimedia procesada: phone_number inválido.")
+        return
+    data_to_update = {f'state_context.{k}': v for k, v in _clean_context_for_firestore(campos_contexto or {}).items()}
+    if item:
+        data_to_update['state_context.multimedia_processed'] = firestore.ArrayUnion([_clean_context_for_firestore(item)])
+    if not data_to_update:
+        return
+    data_to_update['last_updated'] = datetime.now(timezone.utc)
+    try:
+        db.collection(FIRESTORE_COLLECTION_NAME).document(doc_id).update(data_to_update)
+    except Exception as e:
+        logger.error(f"Error agregando multimedia procesada para {phone_number}: {e}", exc_info=True)
+
+def quitar_multimedia_procesada(phone_number: str, items: list):
+    """Quita de state_context.multimedia_processed solo los items ya consumidos (ArrayRemove)."""
+    if db is None or not items:
+        return
+    doc_id = sanitize_and_recover_doc_id(phone_number)
+    if not doc_id:
+        logger.error("No se pudo limpiar multimedia procesada: phone_number inválido.")
+        return
+    try:
+        db.collection(FIRESTORE_COLLECTION_NAME).document(doc_id).update(
+            {'state_context.multimedia_processed': firestore.ArrayRemove(list(items))})
+    except Exception as e:
+        logger.error(f"Error limpiando multimedia procesada para {phone_number}: {e}", exc_info=True)
+
 # ¡FUNCIÓN CRÍTICA MODIFICADA V9!
 def get_conversation_data(phone_number: str, context: dict = None, history: list = None) -> tuple[list, datetime | None, str, dict]:
     """
@@ -494,6 +532,40 @@ def marcar_lead_como_procesado(phone_number: str, context: dict = None, history:
         logger.error(f"Error al marcar lead como procesado para {phone_number}: {e}", exc_info=True)
 
 
+def marcar_leads_como_procesados(phone_numbers: list) -> list:
+    """Marca varios leads como procesados con escrituras en lote (máx. 500 por batch).
+
+    Retorna la lista de phone_numbers efectivamente marcados.
+    """
+    if db is None or not phone_numbers:
+        return []
+    marcados = []
+    lote, ids_lote = db.batch(), []
+    for phone_number in phone_numbers:
+        doc_id = sanitize_and_recover_doc_id(phone_number)
+        if not doc_id:
+            logger.error(f"No se pudo marcar lead como procesado: phone_number inválido ({phone_number}).")
+            continue
+        lote.update(db.collection(FIRESTORE_COLLECTION_NAME).document(doc_id), {'lead_processed': True})
+        ids_lote.append(phone_number)
+        if len(ids_lote) >= 500:
+            marcados.extend(_commit_lote_leads(lote, ids_lote))
+            lote, ids_lote = db.batch(), []
+    if ids_lote:
+        marcados.extend(_commit_lote_leads(lote, ids_lote))
+    return marcados
+
+
+def _commit_lote_leads(lote, ids_lote: list) -> list:
+    try:
+        lote.commit()
+        logger.info(f"{len(ids_lote)} leads marcados como procesados en lote.")
+        return list(ids_lote)
+    except Exception as e:
+        logger.error(f"Error al marcar {len(ids_lote)} leads como procesados en lote: {e}", exc_info=True)
+        return []
+
+
 def get_phone_by_reference(external_reference: str) -> str | None:
     """Devuelve el número telefónico asociado a un external_reference."""
     if db is None:
@@ -892,6 +964,42 @@ def upsert_vendor_label(phone_number: str, vendor_owner: str, agent_label: str |
         logger.error(f"Error guardando vendor_owner para {phone_number}: {e}")
         return False
 
+# --- RESUMEN INCREMENTAL DEL HISTORIAL (ventana de tokens) ---
+
+def get_history_summary(phone_number: str) -> dict | None:
+    """Obtiene el resumen acumulado de los mensajes que quedaron fuera de la ventana."""
+    try:
+        if db is None:
+            return None
+        doc_id = sanitize_and_recover_doc_id(phone_number)
+        if not doc_id:
+            return None
+        doc = db.collection(FIRESTORE_COLLECTION_NAME).document(doc_id).get()
+        if doc.exists:
+            return (doc.to_dict() or {}).get('history_summary') or None
+        return None
+    except Exception as e:
+        logger.warning(f"Error obteniendo history_summary para {phone_number}: {e}")
+        return None
+
+def save_history_summary(phone_number: str, summary: dict) -> bool:
+    """
+    Persiste el resumen acumulado en el nivel raíz del documento (no en state_context,
+    para que sobreviva a los reseteos de contexto al salir de flujos).
+    """
+    if db is None:
+        return False
+    try:
+        doc_id = sanitize_and_recover_doc_id(phone_number)
+        if not doc_id:
+            return False
+        db.collection(FIRESTORE_COLLECTION_NAME).document(doc_id).set({'history_summary': summary}, merge=True)
+        logger.info(f"[HISTORY_WINDOW] Resumen de historial actualizado para {phone_number}")
+        return True
+    except Exception as e:
+        logger.error(f"Error guardando history_summary para {phone_number}: {e}")
+        return False
+
 # =============================================================================
 # SISTEMA DE REVIVAL DE CONVERSACIONES
 # =============================================================================
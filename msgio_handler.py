@@ -3,6 +3,12 @@
 import requests
 import logging
 import json
+import re
+import string
+import time
+from collections import deque
+from threading import Lock
+import http_transport
 from config import D360_API_KEY, D360_WHATSAPP_PHONE_ID, D360_BASE_URL
 
 # Configuración del logger
@@ -32,25 +38,50 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
     Returns:
         bool: True si se envió correctamente, False en caso contrario
     """
-    logger.info(f"[D360] === INICIO send_whatsapp_message UNIFICADA ===")
-    logger.info(f"[D360] 📱 Número de teléfono: {phone_number}")
-    logger.info(f"[D360] 📝 Mensaje: {message[:100] if message else 'None'}...")
-    logger.info(f"[D360] 🔘 Botones: {buttons}")
-    logger.info(f"[D360] 📋 Lista: {list_title} - {len(options) if options else 0} opciones")
-    logger.info(f"[D360] 🔄 Interactive payload: {'SÍ' if interactive_payload else 'NO'}")
+    logger.debug(f"[D360] send_whatsapp_message -> {phone_number}: {message[:100] if message else 'None'} | "
+                 f"botones={len(buttons) if buttons else 0} lista={list_title} ({len(options) if options else 0} opciones) "
+                 f"interactive={'SÍ' if interactive_payload else 'NO'}")
 
+    payload = build_whatsapp_payload(phone_number, message, interactive_payload, buttons, list_title, options, section_title)
+    if payload is None:
+        return False
+    enviado, _ = post_whatsapp_payload(payload, reintentos=None)
+    return enviado
+
+
+def enqueue_whatsapp_message(phone_number: str, message: str = None, interactive_payload: dict = None, buttons: list = None, list_title: str = None, options: list = None, section_title: str = "Opciones", inicio_turno: float = None) -> bool:
+    """
+    Igual que send_whatsapp_message pero sin esperar a 360dialog: valida, construye el payload
+    y lo deja en la cola de salida (orden FIFO por destinatario, reintentos y dead-letter).
+
+    Returns:
+        bool: True si el mensaje quedó encolado, False si los parámetros no son válidos
+    """
+    import outbound_queue
+    payload = build_whatsapp_payload(phone_number, message, interactive_payload, buttons, list_title, options, section_title)
+    if payload is None:
+        return False
+    outbound_queue.cola.encolar(payload["to"], payload, inicio_turno=inicio_turno)
+    return True
+
+
+def build_whatsapp_payload(phone_number: str, message: str = None, interactive_payload: dict = None, buttons: list = None, list_title: str = None, options: list = None, section_title: str = "Opciones") -> dict | None:
+    """
+    Valida los parámetros y construye el payload de Meta/WhatsApp Business API.
+    Retorna None si algún parámetro no cumple los límites de WhatsApp.
+    """
     # Validación de parámetros
     if not phone_number:
         logger.error(f"[D360] ❌ ERROR: Número de teléfono vacío")
-        return False
+        return None
     
     if not D360_API_KEY:
         logger.error(f"[D360] ❌ ERROR: D360_API_KEY no configurado")
-        return False
+        return None
     
     if not D360_WHATSAPP_PHONE_ID:
         logger.error(f"[D360] ❌ ERROR: D360_WHATSAPP_PHONE_ID no configurado")
-        return False
+        return None
 
     # Limpiar y formatear número de teléfono
     clean_phone = phone_number.strip()
@@ -59,17 +90,7 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
     if clean_phone.endswith('@c.us'):
         clean_phone = clean_phone.replace('@c.us', '')  # Remover sufijo de WhatsApp
     
-    logger.info(f"[D360] 📱 Número limpio: {clean_phone}")
-
-    # Headers para autenticación con 360dialog (SOLO D360-API-Key)
-    headers = {
-        'D360-API-Key': D360_API_KEY,
-        'Content-Type': 'application/json'
-    }
-    
-    # Log adicional para depuración del header
-    logger.info(f"[D360] 🔑 API Key (primeros 10 chars): {D360_API_KEY[:10] if D360_API_KEY else 'VACÍA'}...")
-    # logger.info(f"[D360] 🔑 API Key completa: {D360_API_KEY}") # REMOVED FOR SECURITY REASONS IN PRODUCTION
+    logger.debug(f"[D360] 📱 Número limpio: {clean_phone}")
 
     # Decodificar secuencias visibles si quedaran escapadas desde capas anteriores
     if isinstance(message, str) and message:
@@ -81,7 +102,7 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
     # DETERMINAR TIPO DE MENSAJE Y CONSTRUIR PAYLOAD
     if interactive_payload:
         # CASO 1: Re-envío de payload interactivo (para "forzar interacción")
-        logger.info(f"[D360] 🔄 Re-enviando payload interactivo existente")
+        logger.debug(f"[D360] 🔄 Re-enviando payload interactivo existente")
         
         # CORRECCIÓN: Si el interactive_payload ya tiene estructura completa, usarlo tal como está
         if 'messaging_product' in interactive_payload:
@@ -98,21 +119,21 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
         
     elif buttons:
         # CASO 2: Mensaje con botones
-        logger.info(f"[D360] 🔘 Enviando mensaje con botones")
+        logger.debug(f"[D360] 🔘 Enviando mensaje con botones")
         
         # Validar límites de caracteres
         if message and len(message) > 1024:
             logger.error(f"[D360] ❌ ERROR: Mensaje demasiado largo ({len(message)} > 1024)")
-            return False
+            return None
         
         if len(buttons) > 3:
             logger.error(f"[D360] ❌ ERROR: Demasiados botones ({len(buttons)} > 3)")
-            return False
+            return None
         
         for button in buttons:
             if len(button.get('title', '')) > 20:
                 logger.error(f"[D360] ❌ ERROR: Título de botón demasiado largo: {button.get('title', '')}")
-                return False
+                return None
         
         # Estructura JSON correcta para botones
         payload = {
@@ -142,27 +163,27 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
             
     elif options and list_title:
         # CASO 3: Mensaje con lista
-        logger.info(f"[D360] 📋 Enviando mensaje con lista")
+        logger.debug(f"[D360] 📋 Enviando mensaje con lista")
         
         # Validar límites de caracteres
         if message and len(message) > 1024:
             logger.error(f"[D360] ❌ ERROR: Mensaje demasiado largo ({len(message)} > 1024)")
-            return False
+            return None
         
         if len(list_title) > 24:
             logger.error(f"[D360] ❌ ERROR: Título de lista demasiado largo ({len(list_title)} > 24)")
-            return False
+            return None
         if len(section_title) > 24:
             logger.error(f"[D360] ❌ ERROR: Título de sección demasiado largo ({len(section_title)} > 24)")
-            return False
+            return None
         
         for option in options:
             if len(option.get('title', '')) > 24:
                 logger.error(f"[D360] ❌ ERROR: Título de opción demasiado largo: {option.get('title', '')}")
-                return False
+                return None
             if 'description' in option and len(option.get('description', '')) > 72:
                 logger.error(f"[D360] ❌ ERROR: Descripción de opción demasiado larga: {option.get('description', '')}")
-                return False
+                return None
         
         # Estructura JSON correcta para lista
         payload = {
@@ -205,11 +226,11 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
             
     else:
         # CASO 4: Mensaje de texto simple
-        logger.info(f"[D360] 📝 Enviando mensaje de texto simple")
+        logger.debug(f"[D360] 📝 Enviando mensaje de texto simple")
         
         if not message:
             logger.error(f"[D360] ❌ ERROR: Mensaje vacío")
-            return False
+            return None
         
         # Payload estándar de WhatsApp Business API para texto
         payload = {
@@ -221,21 +242,274 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
             }
         }
 
-    logger.info(f"[D360] 🔗 Payload final: {json.dumps(payload, indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"[D360] 🔗 Payload final: {json.dumps(payload, indent=2)}")
+    return payload
+
+
+# ==== Plantillas interactivas precompiladas ====
+# Los menús fijos (botones de confirmación, "no hay turnos", etc.) se validan y
+# serializan una sola vez; cada envío solo concatena bytes con el destinatario y
+# los valores de los placeholders ({fecha}, ...) escapados como JSON.
+
+_CENTINELA = re.compile(rb'\\u0000(\w+)\\u0000')
+_metricas_lock = Lock()
+_serializacion_us = deque(maxlen=1000)
+_envios_por_plantilla = {}
+
+
+def _limpiar_destinatario(phone_number: str) -> str:
+    clean_phone = phone_number.strip()
+    if clean_phone.startswith('+'):
+        clean_phone = clean_phone[1:]
+    if clean_phone.endswith('@c.us'):
+        clean_phone = clean_phone.replace('@c.us', '')
+    return clean_phone
+
+
+def _escapar_json(valor) -> bytes:
+    return json.dumps(str(valor), ensure_ascii=False)[1:-1].encode('utf-8')
+
+
+def serializar_payload(payload: dict) -> bytes:
+    """JSON compacto en UTF-8, midiendo el tiempo de serialización."""
+    inicio = time.perf_counter()
+    cuerpo = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    _registrar_serializacion(None, inicio)
+    return cuerpo
+
+
+def _registrar_serializacion(nombre, inicio: float):
+    with _metricas_lock:
+        _serializacion_us.append((time.perf_counter() - inicio) * 1_000_000)
+        if nombre:
+            _envios_por_plantilla[nombre] = _envios_por_plantilla.get(nombre, 0) + 1
+
+
+class PayloadCompilado:
+    """Payload ya serializado listo para POST. `to` y `tipo` quedan a mano para la cola y los logs."""
+    __slots__ = ('to', 'tipo', 'cuerpo')
+
+    def __init__(self, to: str, tipo: str, cuerpo: bytes):
+        self.to = to
+        self.tipo = tipo
+        self.cuerpo = cuerpo
+
+    def __getitem__(self, clave):
+        if clave == 'to':
+            return self.to
+        raise KeyError(clave)
+
+    def como_dict(self) -> dict:
+        return json.loads(self.cuerpo)
+
+
+class PlantillaInteractiva:
+    """Payload validado y serializado una vez, partido en fragmentos de bytes y placeholders."""
+
+    def __init__(self, nombre: str, payload: dict, campos: tuple, limite_cuerpo: int | None = None):
+        self.nombre = nombre
+        self.tipo = (payload.get('interactive') or {}).get('type') or payload.get('type')
+        self.campos = campos
+        self.limite_cuerpo = limite_cuerpo
+        partes = _CENTINELA.split(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        # partes alterna literal, campo, literal, campo, ..., literal
+        self._literales = partes[0::2]
+        self._campos = [campo.decode() for campo in partes[1::2]]
+
+    def render(self, phone_number: str, **valores) -> PayloadCompilado | None:
+        inicio = time.perf_counter()
+        to = _limpiar_destinatario(phone_number)
+        valores['to'] = to
+        try:
+            escapados = [_escapar_json(valores[campo]) for campo in self._campos]
+        except KeyError as e:
+            logger.error(f"[D360] ❌ Plantilla '{self.nombre}': falta el valor {e}")
+            return None
+        if self.limite_cuerpo is not None and sum(len(str(valores[c])) for c in self.campos) > self.limite_cuerpo:
+            logger.error(f"[D360] ❌ Plantilla '{self.nombre}': cuerpo demasiado largo")
+            return None
+        fragmentos = [self._literales[0]]
+        for valor, literal in zip(escapados, self._literales[1:]):
+            fragmentos.append(valor)
+            fragmentos.append(literal)
+        cuerpo = b''.join(fragmentos)
+        _registrar_serializacion(self.nombre, inicio)
+        return PayloadCompilado(to, self.tipo, cuerpo)
+
+
+_plantillas = {}
+
+
+def _centinela(campo: str) -> str:
+    return f"\x00{campo}\x00"
+
+
+def registrar_plantilla(nombre: str, message: str = None, buttons: list = None, list_title: str = None,
+                        options: list = None, section_title: str = "Opciones") -> PlantillaInteractiva | None:
+    """
+    Compila un menú fijo. `message` puede tener placeholders estilo format ({fecha}).
+    Valida con las mismas reglas que build_whatsapp_payload una sola vez; si no cumple,
+    lo registra como None y los envíos con esa plantilla fallan igual que antes.
+    """
+    campos = tuple(c for _, c, _, _ in string.Formatter().parse(message or '') if c)
+    mensaje = message.format(**{c: _centinela(c) for c in campos}) if message else message
+    payload = build_whatsapp_payload('0', mensaje, None, buttons, list_title, options, section_title)
+    if payload is None:
+        logger.error(f"[D360] ❌ Plantilla '{nombre}' no se pudo compilar (límites de WhatsApp o credenciales D360)")
+        _plantillas[nombre] = None
+        return None
+    payload['to'] = _centinela('to')
+    limite = 1024 - sum(len(parte) for parte, *_ in string.Formatter().parse(message)) if campos else None
+    plantilla = PlantillaInteractiva(nombre, payload, campos, limite)
+    _plantillas[nombre] = plantilla
+    return plantilla
+
+
+_esqueletos_lista = {}
+
+
+def render_lista_rapida(phone_number: str, message: str, list_title: str, options: list,
+                        section_title: str = "Opciones") -> PayloadCompilado | None:
+    """
+    Camino rápido para listas dinámicas (turnos, servicios). El esqueleto (header, footer,
+    botón y sección) se valida y compila una vez por (list_title, section_title); de las filas
+    se valida la cantidad (máximo 10 de WhatsApp) y los textos se recortan.
+    """
+    clave = (list_title, section_title)
+    plantilla = _esqueletos_lista.get(clave)
+    if plantilla is None:
+        esqueleto = build_whatsapp_payload('0', _centinela('cuerpo'), None, None, list_title,
+                                           [{'id': '', 'title': ''}], section_title)
+        if esqueleto is None:
+            return None
+        esqueleto['to'] = _centinela('to')
+        esqueleto['interactive']['action']['sections'][0]['rows'] = _centinela('filas')
+        plantilla = _esqueletos_lista[clave] = PlantillaInteractiva(f"lista:{list_title}", esqueleto, ('cuerpo',), 1024)
+        # Las filas van como JSON crudo, no como string escapado
+        indice = plantilla._campos.index('filas')
+        plantilla._literales[indice] = plantilla._literales[indice][:-1]
+        plantilla._literales[indice + 1] = plantilla._literales[indice + 1][1:]
+    if not message or len(message) > 1024 or not options:
+        logger.error(f"[D360] ❌ Lista '{list_title}': mensaje vacío/largo o sin opciones")
+        return None
+    if len(options) > 10:
+        logger.error(f"[D360] ❌ ERROR: Demasiadas opciones en la lista '{list_title}' ({len(options)} > 10)")
+        return None
+    inicio = time.perf_counter()
+    filas = [
+        {'id': o.get('id', ''), 'title': o.get('title', '')[:24], 'description': o['description'][:72]}
+        if 'description' in o else {'id': o.get('id', ''), 'title': o.get('title', '')[:24]}
+        for o in options
+    ]
+    filas_json = json.dumps(filas, ensure_ascii=False, separators=(',', ':'))
+    to = _limpiar_destinatario(phone_number)
+    valores = {'to': to, 'cuerpo': message.replace('\\n', '\n').replace('\\t', '\t')}
+    fragmentos = [plantilla._literales[0]]
+    for campo, literal in zip(plantilla._campos, plantilla._literales[1:]):
+        fragmentos.append(filas_json.encode('utf-8') if campo == 'filas' else _escapar_json(valores[campo]))
+        fragmentos.append(literal)
+    cuerpo = b''.join(fragmentos)
+    _registrar_serializacion(plantilla.nombre, inicio)
+    return PayloadCompilado(to, 'list', cuerpo)
+
+
+def render_whatsapp_template(phone_number: str, nombre: str, **valores) -> PayloadCompilado | None:
+    if not phone_number:
+        logger.error(f"[D360] ❌ ERROR: Número de teléfono vacío")
+        return None
+    plantilla = _plantillas.get(nombre)
+    if plantilla is None:
+        logger.error(f"[D360] ❌ Plantilla '{nombre}' no registrada o inválida")
+        return None
+    return plantilla.render(phone_number, **valores)
+
+
+def send_whatsapp_template(phone_number: str, nombre: str, **valores) -> bool:
+    payload = render_whatsapp_template(phone_number, nombre, **valores)
+    if payload is None:
+        return False
+    enviado, _ = post_whatsapp_payload(payload, reintentos=None)
+    return enviado
+
+
+def enqueue_whatsapp_template(phone_number: str, nombre: str, inicio_turno: float = None, **valores) -> bool:
+    """Como enqueue_whatsapp_message, para una plantilla registrada con registrar_plantilla."""
+    import outbound_queue
+    payload = render_whatsapp_template(phone_number, nombre, **valores)
+    if payload is None:
+        return False
+    outbound_queue.cola.encolar(payload.to, payload, inicio_turno=inicio_turno)
+    return True
+
+
+def enqueue_whatsapp_list(phone_number: str, message: str, list_title: str, options: list,
+                          section_title: str = "Opciones", inicio_turno: float = None) -> bool:
+    """Encola una lista dinámica por el camino rápido (render_lista_rapida)."""
+    import outbound_queue
+    if not phone_number:
+        logger.error(f"[D360] ❌ ERROR: Número de teléfono vacío")
+        return False
+    payload = render_lista_rapida(phone_number, message, list_title, options, section_title)
+    if payload is None:
+        return False
+    outbound_queue.cola.encolar(payload.to, payload, inicio_turno=inicio_turno)
+    return True
+
+
+def get_template_stats() -> dict:
+    with _metricas_lock:
+        muestras = sorted(_serializacion_us)
+        envios = dict(_envios_por_plantilla)
+
+    def _p(q):
+        return round(muestras[min(len(muestras) - 1, int(round(q * (len(muestras) - 1))))], 1) if muestras else None
+
+    return {
+        'plantillas': {nombre: plantilla is not None for nombre, plantilla in _plantillas.items()},
+        'esqueletos_lista': len(_esqueletos_lista),
+        'envios_por_plantilla': envios,
+        'serializacion_p50_us': _p(0.5),
+        'serializacion_p95_us': _p(0.95),
+        'muestras': len(muestras),
+    }
+
+
+def post_whatsapp_payload(payload: dict, reintentos: int | None = 0) -> tuple:
+    """
+    Envía un payload ya construido a 360dialog.
+    Retorna (enviado, reintentable): reintentable es True solo si el mensaje seguro no llegó
+    (429, 503 o la conexión no se estableció), así la cola de salida puede reintentar sin
+    duplicar. Para la cola de salida (que reintenta por su cuenta) el transporte no reintenta;
+    los envíos sincrónicos pasan reintentos=None y usan los reintentos seguros del transporte.
+    """
+    if isinstance(payload, PayloadCompilado):
+        cuerpo, tipo_interactivo = payload.cuerpo, (payload.tipo if payload.tipo != 'text' else None)
+    else:
+        cuerpo, tipo_interactivo = serializar_payload(payload), (payload.get('interactive') or {}).get('type')
+
+    # Headers para autenticación con 360dialog (SOLO D360-API-Key)
+    headers = {
+        'D360-API-Key': D360_API_KEY,
+        'Content-Type': 'application/json'
+    }
+    
+    # Log adicional para depuración del header
+    logger.debug(f"[D360] 🔑 API Key (primeros 10 chars): {D360_API_KEY[:10] if D360_API_KEY else 'VACÍA'}...")
+    # logger.info(f"[D360] 🔑 API Key completa: {D360_API_KEY}") # REMOVED FOR SECURITY REASONS IN PRODUCTION
 
     try:
         # ENVIAR MENSAJE USANDO D360-API-Key (método único y correcto)
-        logger.info(f"[D360] 🌐 Enviando petición POST con D360-API-Key a {get_360dialog_api_url()}")
-        response = requests.post(
+        logger.debug(f"[D360] 🌐 Enviando petición POST con D360-API-Key a {get_360dialog_api_url()}")
+        response = http_transport.transporte.post(
             get_360dialog_api_url(), 
             headers=headers, 
-            json=payload, 
-            timeout=30
+            data=cuerpo, 
+            timeout=30,
+            reintentos=reintentos
         )
         
-        logger.info(f"[D360] 📡 Respuesta del servidor:")
-        logger.info(f"[D360]   Status Code: {response.status_code}")
-        logger.info(f"[D360]   Content: {response.text}")
+        logger.debug(f"[D360] 📡 Respuesta del servidor: {response.status_code} {response.text}")
         
         # Verificar respuesta
         if response.status_code == 200:
@@ -246,32 +520,41 @@ def send_whatsapp_message(phone_number: str, message: str = None, interactive_pa
                 logger.info(f"[D360] 🆔 Message ID: {message_id}")
                 
                 # Log específico según el tipo de mensaje
-                if buttons:
+                if tipo_interactivo == 'button':
                     logger.info(f"[D360] ✅ Mensaje con botones enviado con éxito")
-                elif options:
+                elif tipo_interactivo == 'list':
                     logger.info(f"[D360] ✅ Mensaje con lista enviado con éxito")
-                elif interactive_payload:
+                elif tipo_interactivo:
                     logger.info(f"[D360] ✅ Payload interactivo re-enviado con éxito")
                 else:
                     logger.info(f"[D360] ✅ Mensaje de texto enviado con éxito")
                 
-                return True
+                return True, False
             else:
                 logger.error(f"[D360] ❌ ERROR: Respuesta exitosa pero sin 'messages' en el JSON")
                 logger.error(f"[D360] 📄 Respuesta completa: {response_data}")
-                return False
+                return False, False
         else:
             logger.error(f"[D360] ❌ ERROR: Fallo al enviar mensaje")
             logger.error(f"[D360] 📄 Status Code: {response.status_code}")
             logger.error(f"[D360] 📄 Respuesta: {response.text}")
-            return False
+            if response.status_code in http_transport.REINTENTABLES_NO_IDEMPOTENTES:
+                return False, True
+            if response.status_code >= 500:
+                # 500/502/504: 360dialog pudo haber entregado el mensaje; reintentar lo duplicaría
+                logger.error(f"[D360] ⚠️ HTTP {response.status_code}: fallo con posible entrega, no se reintenta")
+            return False, False
             
-    except requests.exceptions.Timeout:
-        logger.error(f"[D360] ❌ ERROR: Timeout al enviar mensaje")
-        return False
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        if http_transport.no_enviado(e):
+            logger.error(f"[D360] ❌ ERROR: No se pudo conectar para enviar el mensaje: {e}")
+            return False, True
+        # Timeout de lectura o conexión cortada: el mensaje pudo haber llegado, no se reintenta
+        logger.error(f"[D360] ⚠️ ERROR: {type(e).__name__} al enviar mensaje, posible entrega, no se reintenta: {e}")
+        return False, False
     except requests.exceptions.RequestException as e:
         logger.error(f"[D360] ❌ ERROR: Error de red al enviar mensaje: {e}")
-        return False
+        return False, False
     except Exception as e:
         logger.error(f"[D360] ❌ ERROR: Error inesperado al enviar mensaje: {e}")
-        return False
+        return False, False
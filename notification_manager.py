@@ -8,7 +8,7 @@ import config
 import msgio_handler
 import utils
 from datetime import datetime
-import requests
+import http_transport
 
 logger = logging.getLogger(config.TENANT_NAME)
 
@@ -40,7 +40,7 @@ def _enviar_notificacion_directa(phone_number: str, mensaje: str) -> bool:
             }
         }
         
-        response = requests.post(
+        response = http_transport.transporte.post(
             f"{config.D360_BASE_URL}/messages",
             headers=headers,
             json=payload,
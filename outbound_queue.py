@@ -0,0 +1,169 @@
+"""
+Cola de salida asíncrona para mensajes de WhatsApp (360dialog).
+
+process_message_logic y los handlers encolan con
+msgio_handler.enqueue_whatsapp_message y siguen: el estado se persiste en
+Firestore sin esperar la respuesta de 360dialog.
+
+- Orden FIFO por destinatario: un texto y la lista interactiva que lo sigue
+  nunca se invierten. Cada destinatario tiene su deque y a lo sumo un worker
+  drenándolo a la vez.
+- Concurrencia global acotada (OUTBOUND_MAX_CONCURRENCY) entre destinatarios.
+- Reintentos con backoff exponencial + jitter solo cuando el envío seguro no
+  llegó (429, 503, conexión no establecida); el resto va directo a dead-letter.
+  Es la única capa que reintenta estos envíos (el transporte va sin reintentos).
+- Dead-letter en JSONL (OUTBOUND_DEAD_LETTER_PATH) con payload, error e intentos.
+- Latencias separadas: "pensamiento" (inicio del turno -> encolado) y
+  "entrega" (encolado -> 200 de 360dialog).
+"""
+
+import json
+import logging
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import config
+import msgio_handler
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+
+def _percentil(valores, p: float):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p * (len(ordenados) - 1)))))
+    return ordenados[indice]
+
+
+class _Envio:
+    __slots__ = ('destinatario', 'payload', 'encolado_en', 'intentos')
+
+    def __init__(self, destinatario: str, payload: dict):
+        self.destinatario = destinatario
+        self.payload = payload
+        self.encolado_en = time.monotonic()
+        self.intentos = 0
+
+
+class OutboundQueue:
+    """Cola de salida con orden por destinatario, concurrencia acotada, reintentos y dead-letter."""
+
+    def __init__(self, enviar=None, max_concurrencia: int = 8, max_reintentos: int = 4,
+                 backoff_base: float = 0.5, backoff_max: float = 15.0, ruta_dead_letter: str = 'outbound_dead_letter.jsonl',
+                 ventana_metricas: int = 1000):
+        # enviar(payload) -> (enviado, reintentable)
+        self.enviar = enviar or msgio_handler.post_whatsapp_payload
+        self.max_concurrencia = max(1, int(max_concurrencia))
+        self.max_reintentos = max(0, int(max_reintentos))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.ruta_dead_letter = ruta_dead_letter
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrencia, thread_name_prefix='outbound')
+        self._lock = Lock()
+        self._colas = {}        # destinatario -> deque de _Envio pendientes
+        self._activos = set()   # destinatarios con un worker drenando su cola
+        self._dead_letter_lock = Lock()
+        self._pensamiento_ms = deque(maxlen=ventana_metricas)
+        self._entrega_ms = deque(maxlen=ventana_metricas)
+        self._stats = {'encolados': 0, 'entregados': 0, 'reintentos': 0, 'dead_letter': 0}
+
+    def encolar(self, destinatario: str, payload: dict, inicio_turno: float | None = None):
+        """Agrega el payload al final de la cola del destinatario. No bloquea."""
+        envio = _Envio(destinatario, payload)
+        with self._lock:
+            self._stats['encolados'] += 1
+            if inicio_turno is not None:
+                self._pensamiento_ms.append((time.monotonic() - inicio_turno) * 1000)
+            self._colas.setdefault(destinatario, deque()).append(envio)
+            if destinatario in self._activos:
+                return
+            self._activos.add(destinatario)
+        self._pool.submit(self._drenar, destinatario)
+
+    def _drenar(self, destinatario: str):
+        """Envía en orden los mensajes del destinatario hasta vaciar su cola."""
+        while True:
+            with self._lock:
+                cola = self._colas.get(destinatario)
+                if not cola:
+                    self._colas.pop(destinatario, None)
+                    self._activos.discard(destinatario)
+                    return
+                envio = cola.popleft()
+            try:
+                self._entregar(envio)
+            except Exception as e:
+                logger.error(f"[OUTBOUND] Error inesperado entregando a {destinatario}: {e}", exc_info=True)
+                self._a_dead_letter(envio, str(e))
+
+    def _entregar(self, envio: _Envio):
+        while True:
+            envio.intentos += 1
+            enviado, reintentable = self.enviar(envio.payload)
+            if enviado:
+                with self._lock:
+                    self._stats['entregados'] += 1
+                    self._entrega_ms.append((time.monotonic() - envio.encolado_en) * 1000)
+                return
+            if not reintentable or envio.intentos > self.max_reintentos:
+                self._a_dead_letter(envio, 'reintentos agotados' if reintentable else 'error no reintentable')
+                return
+            espera = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (envio.intentos - 1))))
+            with self._lock:
+                self._stats['reintentos'] += 1
+            logger.warning(f"[OUTBOUND] Reintento {envio.intentos}/{self.max_reintentos} para {envio.destinatario} en {espera:.2f}s")
+            time.sleep(espera)
+
+    def _a_dead_letter(self, envio: _Envio, motivo: str):
+        with self._lock:
+            self._stats['dead_letter'] += 1
+        logger.error(f"[OUTBOUND] ☠️ Mensaje a {envio.destinatario} a dead-letter tras {envio.intentos} intentos: {motivo}")
+        payload = envio.payload.como_dict() if isinstance(envio.payload, msgio_handler.PayloadCompilado) else envio.payload
+        registro = {'destinatario': envio.destinatario, 'payload': payload, 'motivo': motivo,
+                    'intentos': envio.intentos, 'ts': time.time()}
+        try:
+            with self._dead_letter_lock:
+                with open(self.ruta_dead_letter, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logger.error(f"[OUTBOUND] No se pudo escribir el dead-letter en {self.ruta_dead_letter}: {e}")
+
+    def pendientes(self) -> int:
+        with self._lock:
+            return sum(len(cola) for cola in self._colas.values())
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            pensamiento = list(self._pensamiento_ms)
+            entrega = list(self._entrega_ms)
+            pendientes = sum(len(cola) for cola in self._colas.values())
+            destinatarios_activos = len(self._activos)
+
+        def _resumen(valores):
+            return {'p50_ms': round(_percentil(valores, 0.5), 1) if valores else None,
+                    'p95_ms': round(_percentil(valores, 0.95), 1) if valores else None,
+                    'muestras': len(valores)}
+
+        return {
+            'max_concurrencia': self.max_concurrencia,
+            'pendientes': pendientes,
+            'destinatarios_activos': destinatarios_activos,
+            'dead_letter_path': self.ruta_dead_letter,
+            'latencia_pensamiento': _resumen(pensamiento),
+            'latencia_entrega': _resumen(entrega),
+            **stats,
+        }
+
+
+cola = OutboundQueue(
+    max_concurrencia=getattr(config, 'OUTBOUND_MAX_CONCURRENCY', 8),
+    max_reintentos=getattr(config, 'OUTBOUND_MAX_RETRIES', 4),
+    backoff_base=getattr(config, 'OUTBOUND_RETRY_BASE', 0.5),
+    backoff_max=getattr(config, 'OUTBOUND_RETRY_MAX', 15.0),
+    ruta_dead_letter=getattr(config, 'OUTBOUND_DEAD_LETTER_PATH', 'outbound_dead_letter.jsonl'),
+)
@@ -27,6 +27,17 @@ def detectar_proveedor_pago(mensaje_usuario: str) -> str:
 
 logger = logging.getLogger(config.TENANT_NAME)
 
+# Menú fijo compilado una vez (ver msgio_handler.registrar_plantilla)
+msgio_handler.registrar_plantilla(
+    'pago_confirmar_servicio',
+    message="Seleccionaste '{nombre}' por ${precio}. ¿Es correcto?\n\n"
+            + config.COMMAND_TIPS['EXIT_PAGO'].replace('{', '{{').replace('}', '}}'),
+    buttons=[
+        {"id": "confirmar_si", "title": "✅ Sí, es correcto"},
+        {"id": "confirmar_no", "title": "❌ No, cambiar"}
+    ]
+)
+
 
 def asegurar_author(context, detalles, history=None):
     from pago_handler import is_valid_doc_id  # Importación segura para evitar ciclos
@@ -850,7 +861,7 @@ def mostrar_servicios_pago(history, detalles, state_context=None, mensaje_comple
         interactive_payload["action"]["sections"][0]["rows"].append(row)
     
     # Enviar mensaje interactivo usando función unificada
-    success = msgio_handler.send_whatsapp_message(
+    success = msgio_handler.enqueue_whatsapp_list(
         phone_number=author,
         message=mensaje_principal,
         list_title=titulo_lista,
@@ -1003,11 +1014,7 @@ def confirmar_servicio_pago(history, detalles, state_context=None, mensaje_compl
     # Obtener el número de teléfono del autor
     author = state_context.get('author', '')
     if author:
-        success = msgio_handler.send_whatsapp_message(
-            phone_number=author,
-            message=mensaje_confirmacion,
-            buttons=botones_confirmacion
-        )
+        success = msgio_handler.enqueue_whatsapp_template(author, 'pago_confirmar_servicio', nombre=nombre, precio=precio)
         
         if success:
             logger.info(f"[CONFIRMAR_SERVICIO] Mensaje de confirmación con botones enviado exitosamente")
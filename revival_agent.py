@@ -57,11 +57,7 @@ class RevivalAgent:
         if not self.api_key:
             raise RevivalAgentError("OPENAI_API_KEY no configurado")
         
-        # Configurar cliente OpenAI (nueva API v1.0+ con Responses API para GPT-5)
-        self.client = openai.OpenAI(
-            api_key=self.api_key,
-            organization=self.organization
-        )
+        # Sin cliente propio: las llamadas salen por el backend y el planificador de llm_handler
         
         logger.info(f"🤖 Revival Agent inicializado - Modelo: {self.model}")
 
@@ -209,7 +205,7 @@ Responde ÚNICAMENTE con un objeto JSON válido que contenga:
             logger.info(f"🤖 Enviando análisis a OpenAI - Modelo: {self.model}")
             
             # Usar Responses API para GPT-5-NANO (según README)
-            response = self.client.responses.create(
+            peticion = dict(
                 model=self.model,
                 input=[{
                     "type": "message",
@@ -219,6 +215,16 @@ Responde ÚNICAMENTE con un objeto JSON válido que contenga:
                 reasoning={"effort": "low"},  # Economizar en reasoning para costo
                 text={"verbosity": "low"}     # Configuración económica y eficiente
             )
+
+            # Backend compartido (openai/record/replay) por el planificador, con prioridad de fondo
+            # para no competir con los turnos interactivos (cupos por modelo, TPM, 429 y reintentos)
+            import llm_handler
+            response = llm_handler.planificador.ejecutar(
+                self.model, lambda: llm_handler.backend.responses_create(**peticion),
+                prioridad=llm_handler.PRIORIDAD_FONDO,
+                tokens_estimados=len(full_prompt) // 4 + 500,
+                agente="revival", esfuerzo="low"
+            )
             
             # Extraer contenido de la respuesta
             content = response.output_text.strip()
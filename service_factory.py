@@ -1,7 +1,27 @@
+from threading import Lock
+
 from config import CALENDAR_PROVIDER
 
+# Un servicio de calendario por worker: sin estado por usuario, comparten el cliente de Google
+_calendar_service = None
+_calendar_service_lock = Lock()
+
 
 def get_calendar_service():
+    global _calendar_service
+    if _calendar_service is not None:
+        return _calendar_service
+    with _calendar_service_lock:
+        if _calendar_service is None:
+            servicio = _crear_calendar_service()
+            # Si el cliente de Google no se pudo construir, reintentar en la próxima llamada
+            if getattr(servicio, 'service', True) is None:
+                return servicio
+            _calendar_service = servicio
+        return _calendar_service
+
+
+def _crear_calendar_service():
     if CALENDAR_PROVIDER == "GOOGLE":
         from calendar_services.google_calendar_service import GoogleCalendarService
         return GoogleCalendarService()
@@ -0,0 +1,301 @@
+"""
+Reservas temporales (holds) de turnos para evitar dobles reservas.
+
+Entre que mostrar_opciones_turnos ofrece un turno y finalizar_cita_automatico
+crea el evento pasan una ronda de LLM y un par de llamadas al calendario. Sin
+reserva, dos usuarios pueden elegir el mismo horario y uno falla recién al
+final. Con holds:
+
+- Al ofrecer turnos se retienen por SLOT_HOLD_TTL segundos para ese usuario;
+  los que ya retiene otro usuario no se ofrecen.
+- get_available_slots_for_user descarta los turnos retenidos por otros.
+- Al confirmar, el hold pasa a 'confirmando' (SLOT_HOLD_CONFIRM_TTL) en una
+  operación atómica; si otro usuario lo tiene, la confirmación se rechaza antes
+  de tocar el calendario. Con el evento creado el hold se convierte: queda
+  'reservado' por SLOT_HOLD_BOOKED_TTL, más que lo que tardan el espejo del
+  calendario y el índice de disponibilidad en ver el evento nuevo (no se
+  borra, o esa ventana permitiría una doble reserva), y se sueltan los demás
+  ofrecidos.
+- Los holds vencidos no bloquean a nadie: se pisan en la siguiente retención.
+
+Backends: Firestore con transacciones (SLOT_HOLDS_BACKEND='firestore', el que
+sirve con varios workers) o un diccionario en memoria ('local', un solo nodo).
+El campo expira_en es un datetime UTC para poder usar la política TTL de
+Firestore como limpieza.
+"""
+
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+from threading import Lock
+
+import config
+
+logger = logging.getLogger(config.TENANT_NAME)
+
+
+def _llave(clave: str, slot_iso: str) -> str:
+    # IDs de documento de Firestore: sin '/'
+    return f"{clave}|{slot_iso}".replace('/', '_')
+
+
+class _AlmacenLocal:
+    """Holds en memoria del proceso (modo de un solo nodo)."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._holds = {}   # llave -> {'titular', 'clave', 'slot_iso', 'estado', 'expira_en' (epoch)}
+
+    def tomar(self, registros, titular, ttl, estado):
+        """Toma todos los registros libres o propios. Devuelve (tomadas, conflictos, vencidas)."""
+        ahora = time.time()
+        tomadas, conflictos, vencidas = [], [], 0
+        with self._lock:
+            for llave, clave, slot_iso in registros:
+                actual = self._holds.get(llave)
+                if actual and actual['titular'] != titular:
+                    if actual['expira_en'] > ahora:
+                        conflictos.append(slot_iso)
+                        continue
+                    vencidas += 1
+                self._holds[llave] = {'titular': titular, 'clave': clave, 'slot_iso': slot_iso,
+                                      'estado': estado, 'expira_en': ahora + ttl}
+                tomadas.append(slot_iso)
+        return tomadas, conflictos, vencidas
+
+    def soltar(self, llaves, titular):
+        soltadas = 0
+        with self._lock:
+            for llave in llaves:
+                actual = self._holds.get(llave)
+                if actual and actual['titular'] == titular:
+                    del self._holds[llave]
+                    soltadas += 1
+        return soltadas
+
+    def activos(self, clave):
+        """{slot_iso: titular} de los holds vigentes del calendario."""
+        ahora = time.time()
+        with self._lock:
+            for llave in [k for k, h in self._holds.items() if h['expira_en'] <= ahora]:
+                del self._holds[llave]
+            return {h['slot_iso']: h['titular'] for h in self._holds.values() if h['clave'] == clave}
+
+
+class _AlmacenFirestore:
+    """Holds en una colección de Firestore; tomar y soltar son transaccionales."""
+
+    def __init__(self, db, coleccion, ttl_lectura=2.0):
+        from firebase_admin import firestore
+        self._firestore = firestore
+        self.db = db
+        self.coleccion = coleccion
+        self.ttl_lectura = float(ttl_lectura)
+        self._lock = Lock()
+        self._activos = {}   # clave -> (leido_en, {slot_iso: titular})
+
+    def _ref(self, llave):
+        return self.db.collection(self.coleccion).document(llave)
+
+    def tomar(self, registros, titular, ttl, estado):
+        ahora = datetime.now(timezone.utc)
+        expira_en = ahora + timedelta(seconds=ttl)
+        refs = [(self._ref(llave), clave, slot_iso) for llave, clave, slot_iso in registros]
+
+        @self._firestore.transactional
+        def _tomar(transaction):
+            tomadas, conflictos, vencidas = [], [], 0
+            # Todas las lecturas antes de cualquier escritura (requisito de la transacción)
+            actuales = [ref.get(transaction=transaction) for ref, _, _ in refs]
+            for (ref, clave, slot_iso), snapshot in zip(refs, actuales):
+                actual = snapshot.to_dict() if snapshot.exists else None
+                if actual and actual.get('titular') != titular:
+                    if actual.get('expira_en') and actual['expira_en'] > ahora:
+                        conflictos.append(slot_iso)
+                        continue
+                    vencidas += 1
+                transaction.set(ref, {'titular': titular, 'clave': clave, 'slot_iso': slot_iso,
+                                      'estado': estado, 'expira_en': expira_en})
+                tomadas.append(slot_iso)
+            return tomadas, conflictos, vencidas
+
+        resultado = _tomar(self.db.transaction())
+        self._olvidar_lectura(registros)
+        return resultado
+
+    def soltar(self, llaves, titular):
+        refs = [self._ref(llave) for llave in llaves]
+
+        @self._firestore.transactional
+        def _soltar(transaction):
+            actuales = [ref.get(transaction=transaction) for ref in refs]
+            soltadas = 0
+            for ref, snapshot in zip(refs, actuales):
+                if snapshot.exists and (snapshot.to_dict() or {}).get('titular') == titular:
+                    transaction.delete(ref)
+                    soltadas += 1
+            return soltadas
+
+        soltadas = _soltar(self.db.transaction())
+        with self._lock:
+            self._activos.clear()
+        return soltadas
+
+    def _olvidar_lectura(self, registros):
+        with self._lock:
+            for _, clave, _ in registros:
+                self._activos.pop(clave, None)
+
+    def activos(self, clave):
+        # Lectura cacheada unos segundos: la confirmación transaccional es la que garantiza exclusividad
+        with self._lock:
+            cacheado = self._activos.get(clave)
+            if cacheado and time.monotonic() - cacheado[0] < self.ttl_lectura:
+                return cacheado[1]
+        consulta = self.db.collection(self.coleccion).where(
+            filter=self._firestore.FieldFilter('expira_en', '>', datetime.now(timezone.utc)))
+        activos = {}
+        for doc in consulta.stream():
+            datos = doc.to_dict() or {}
+            if datos.get('clave') == clave:
+                activos[datos.get('slot_iso')] = datos.get('titular')
+        with self._lock:
+            self._activos[clave] = (time.monotonic(), activos)
+        return activos
+
+
+class SlotHolds:
+    """Retención, confirmación y liberación de turnos, con métricas de conflicto."""
+
+    def __init__(self, almacen, ttl=180, ttl_confirmacion=60, ttl_reservado=150):
+        # Instancia o fábrica sin argumentos: la fábrica se llama en el primer uso, porque
+        # memory importa (vía pago_handler) a agendamiento_handler y este a slot_holds
+        self._almacen = almacen
+        self.ttl = float(ttl)
+        self.ttl_confirmacion = float(ttl_confirmacion)
+        self.ttl_reservado = float(ttl_reservado)
+        self._lock = Lock()
+        self._stats = {'retenciones_pedidas': 0, 'retenciones_tomadas': 0, 'conflictos_al_ofrecer': 0,
+                       'confirmaciones': 0, 'conflictos_al_confirmar': 0, 'conversiones': 0,
+                       'liberadas': 0, 'vencidas_reutilizadas': 0, 'errores': 0}
+
+    @property
+    def almacen(self):
+        if callable(self._almacen):
+            with self._lock:
+                if callable(self._almacen):
+                    self._almacen = self._almacen()
+        return self._almacen
+
+    def _contar(self, **incrementos):
+        with self._lock:
+            for nombre, valor in incrementos.items():
+                self._stats[nombre] += valor
+
+    def retener(self, titular, clave, slots_iso):
+        """
+        Retiene para `titular` los turnos que va a ver. Devuelve los que quedaron
+        retenidos (los que retiene otro usuario se omiten). Si el almacén falla no
+        se bloquea el flujo: se devuelven todos.
+        """
+        slots_iso = [s for s in slots_iso if s]
+        if not slots_iso:
+            return []
+        try:
+            tomadas, conflictos, vencidas = self.almacen.tomar(
+                [(_llave(clave, s), clave, s) for s in slots_iso], titular, self.ttl, 'ofrecido')
+        except Exception as e:
+            self._contar(errores=1)
+            logger.error(f"[SLOT_HOLDS] Error reteniendo turnos para {titular}: {e}")
+            return slots_iso
+        self._contar(retenciones_pedidas=len(slots_iso), retenciones_tomadas=len(tomadas),
+                     conflictos_al_ofrecer=len(conflictos), vencidas_reutilizadas=vencidas)
+        if conflictos:
+            logger.info(f"[SLOT_HOLDS] {len(conflictos)} turno(s) retenidos por otro usuario, no se ofrecen a {titular}: {conflictos}")
+        return tomadas
+
+    def retenidos_por_otros(self, titular, clave):
+        """slot_iso de los turnos con hold vigente de otro usuario."""
+        try:
+            return {slot_iso for slot_iso, retenido_por in self.almacen.activos(clave).items() if retenido_por != titular}
+        except Exception as e:
+            self._contar(errores=1)
+            logger.error(f"[SLOT_HOLDS] Error leyendo holds activos: {e}")
+            return set()
+
+    def confirmar(self, titular, clave, slot_iso):
+        """
+        Paso previo a crear el evento: el hold pasa a 'confirmando' solo si está libre,
+        vencido o ya es de `titular`. False = otro usuario lo tiene.
+        """
+        self._contar(confirmaciones=1)
+        try:
+            tomadas, conflictos, vencidas = self.almacen.tomar(
+                [(_llave(clave, slot_iso), clave, slot_iso)], titular, self.ttl_confirmacion, 'confirmando')
+        except Exception as e:
+            self._contar(errores=1)
+            logger.error(f"[SLOT_HOLDS] Error confirmando hold de {slot_iso} para {titular}: {e}")
+            return True
+        self._contar(vencidas_reutilizadas=vencidas)
+        if conflictos:
+            self._contar(conflictos_al_confirmar=1)
+            logger.warning(f"[SLOT_HOLDS] ⚠️ Conflicto: {slot_iso} está retenido por otro usuario, {titular} no puede confirmarlo")
+            return False
+        return True
+
+    def convertir(self, titular, clave, slot_iso, ofrecidos=()):
+        """
+        Evento creado: el hold pasa a 'reservado' por ttl_reservado (hasta que el espejo y el
+        índice reflejen el evento) y se sueltan los demás turnos ofrecidos.
+        """
+        self._contar(conversiones=1)
+        try:
+            self.almacen.tomar([(_llave(clave, slot_iso), clave, slot_iso)], titular, self.ttl_reservado, 'reservado')
+        except Exception as e:
+            self._contar(errores=1)
+            logger.error(f"[SLOT_HOLDS] Error marcando como reservado {slot_iso} de {titular}: {e}")
+        self.liberar(titular, clave, [s for s in ofrecidos if s != slot_iso])
+
+    def liberar(self, titular, clave, slots_iso):
+        llaves = list(dict.fromkeys(_llave(clave, s) for s in slots_iso if s))
+        if not llaves:
+            return 0
+        try:
+            soltadas = self.almacen.soltar(llaves, titular)
+        except Exception as e:
+            self._contar(errores=1)
+            logger.error(f"[SLOT_HOLDS] Error liberando holds de {titular}: {e}")
+            return 0
+        self._contar(liberadas=soltadas)
+        return soltadas
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            'backend': type(self.almacen).__name__,
+            'ttl_segundos': self.ttl,
+            'ttl_confirmacion_segundos': self.ttl_confirmacion,
+            'ttl_reservado_segundos': self.ttl_reservado,
+            'tasa_conflicto_al_ofrecer': round(stats['conflictos_al_ofrecer'] / stats['retenciones_pedidas'], 4) if stats['retenciones_pedidas'] else None,
+            'tasa_conflicto_al_confirmar': round(stats['conflictos_al_confirmar'] / stats['confirmaciones'], 4) if stats['confirmaciones'] else None,
+            **stats,
+        }
+
+
+def _crear_almacen():
+    backend = getattr(config, 'SLOT_HOLDS_BACKEND', 'firestore')
+    if backend == 'firestore':
+        import memory
+        if memory.db is not None:
+            return _AlmacenFirestore(memory.db, getattr(config, 'SLOT_HOLDS_COLLECTION', 'slot_holds'))
+        logger.warning("[SLOT_HOLDS] Firestore no disponible, holds en memoria local (solo válido con un worker)")
+    return _AlmacenLocal()
+
+
+reservas = SlotHolds(
+    _crear_almacen,
+    ttl=getattr(config, 'SLOT_HOLD_TTL', 180),
+    ttl_confirmacion=getattr(config, 'SLOT_HOLD_CONFIRM_TTL', 60),
+    ttl_reservado=getattr(config, 'SLOT_HOLD_BOOKED_TTL', 150),
+)
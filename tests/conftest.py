@@ -0,0 +1,13 @@
+"""
+Configuración común de los tests: variables de entorno mínimas para importar
+config.py sin credenciales reales y la raíz del repo en sys.path.
+"""
+
+import os
+import sys
+
+for _variable in ('TENANT_NAME', 'OPENAI_API_KEY', 'PROMPT_LECTOR', 'D360_API_KEY',
+                  'D360_WHATSAPP_PHONE_ID', 'ASSEMBLYAI_API_KEY'):
+    os.environ.setdefault(_variable, 'test')
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,108 @@
+import pytest
+
+from chatwoot_integration import ChatwootIdCache
+
+
+def _par_de_workers(tmp_path):
+    ruta = str(tmp_path / 'ids.sqlite')
+    return ChatwootIdCache(ruta=ruta), ChatwootIdCache(ruta=ruta)
+
+
+def test_hit_en_memoria_sin_persistencia():
+    cache = ChatwootIdCache()
+    cache.guardar_contacto('549111', 10, 'src')
+    cache.guardar_conversacion('549111', 77)
+    assert cache.obtener('549111')['conversation_id'] == 77
+    assert cache.get_stats()['hits_memoria'] == 1
+
+
+def test_invalidacion_de_otro_worker_descarta_la_copia_en_memoria(tmp_path):
+    a, b = _par_de_workers(tmp_path)
+    a.guardar_contacto('549111', 10, 'src')
+    a.guardar_conversacion('549111', 77)
+    assert b.obtener('549111')['conversation_id'] == 77   # b la carga en su LRU
+    assert a.invalidar(conversation_id=77) == 1
+    assert b.obtener('549111') is None
+
+
+def test_invalidacion_solo_conversacion_se_ve_en_otro_worker(tmp_path):
+    a, b = _par_de_workers(tmp_path)
+    a.guardar_contacto('549111', 10, 'src')
+    a.guardar_conversacion('549111', 77)
+    assert b.obtener('549111')['conversation_id'] == 77
+    a.invalidar(conversation_id=77, solo_conversacion=True)
+    entrada = b.obtener('549111')
+    assert entrada['contact_id'] == 10 and entrada['conversation_id'] is None
+
+
+def test_reescritura_de_otro_worker_reemplaza_la_copia_en_memoria(tmp_path):
+    a, b = _par_de_workers(tmp_path)
+    a.guardar_contacto('549111', 10, 'src')
+    a.guardar_conversacion('549111', 77)
+    assert b.obtener('549111')['conversation_id'] == 77
+    a.guardar_conversacion('549111', 78)
+    assert b.obtener('549111')['conversation_id'] == 78
+    assert a.obtener('549111')['conversation_id'] == 78
+    assert a.get_stats()['hits_memoria'] == 1
+
+
+class _ClienteFalso:
+    """Chatwoot que falla `fallas` veces con el estado dado y después publica."""
+
+    enabled = True
+
+    def __init__(self, fallas, estado=None):
+        self.fallas = fallas
+        self.estado = estado
+        self.publicados = []
+        self._ultimo_estado = None
+
+    def resolver_conversacion(self, telefono, remitente):
+        return 1
+
+    def publicar_mensaje(self, conversation_id, contenido, tipo):
+        if self.fallas > 0:
+            self.fallas -= 1
+            self._ultimo_estado = self.estado
+            return False
+        self.publicados.append(contenido)
+        return True
+
+    def olvidar_conversacion(self, telefono):
+        pass
+
+    def fallo_permanente(self):
+        from chatwoot_integration import ESTADOS_RECHAZO_PERMANENTE
+        return self._ultimo_estado in ESTADOS_RECHAZO_PERMANENTE
+
+
+def _espejo(tmp_path, cliente):
+    from chatwoot_integration import ChatwootMirror
+    return ChatwootMirror(cliente, max_workers=1, max_reintentos=1000, backoff_base=0.0, backoff_max=0.0,
+                          descartar_tras=3, ruta_backlog=str(tmp_path / 'backlog.sqlite3'))
+
+
+def _esperar(condicion, segundos=5.0):
+    import time
+    limite = time.monotonic() + segundos
+    while not condicion() and time.monotonic() < limite:
+        time.sleep(0.01)
+    return condicion()
+
+
+@pytest.mark.parametrize('estado', [None, 500, 503, 429])
+def test_caida_larga_no_descarta_mensajes(tmp_path, estado):
+    cliente = _ClienteFalso(fallas=50, estado=estado)
+    espejo = _espejo(tmp_path, cliente)
+    espejo.registrar('549111', [('hola', 'incoming', 'Ana'), ('respuesta', 'outgoing', 'bot')])
+    assert _esperar(lambda: len(cliente.publicados) == 2)
+    assert cliente.publicados == ['hola', 'respuesta']
+    assert espejo.get_stats()['descartados'] == 0
+
+
+def test_rechazo_permanente_descarta_tras_varios_intentos(tmp_path):
+    cliente = _ClienteFalso(fallas=3, estado=422)
+    espejo = _espejo(tmp_path, cliente)
+    espejo.registrar('549111', [('invalido', 'incoming', 'Ana'), ('siguiente', 'outgoing', 'bot')])
+    assert _esperar(lambda: cliente.publicados == ['siguiente'])
+    assert espejo.get_stats()['descartados'] == 1
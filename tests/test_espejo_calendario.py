@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from calendar_services.espejo_calendario import CalendarMirror, FakeEventsAPI
+
+TZ = timezone(timedelta(hours=-3))
+CAL = 'cal@test'
+
+
+def _evento(ev_id, dias, hora=10, minutos=30, **extra):
+    inicio = (datetime.now(TZ) + timedelta(days=dias)).replace(hour=hora, minute=0, second=0, microsecond=0)
+    return {'id': ev_id, 'start': {'dateTime': inicio.isoformat()},
+            'end': {'dateTime': (inicio + timedelta(minutes=minutos)).isoformat()}, **extra}
+
+
+def _dia(dias):
+    inicio = (datetime.now(TZ) + timedelta(days=dias)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return inicio, inicio + timedelta(days=1)
+
+
+@pytest.fixture
+def api():
+    return FakeEventsAPI(tam_pagina=2)
+
+
+@pytest.fixture
+def cambios():
+    return []
+
+
+@pytest.fixture
+def espejo(api, cambios):
+    return CalendarMirror(api, CAL, TZ, intervalo_sync=3600, dias_futuros=7, dias_margen=7,
+                          al_cambiar=cambios.append, iniciar_hilo=False)
+
+
+def test_sync_completo_pagina_todos_los_eventos(api, espejo):
+    for i in range(5):
+        api.insertar(CAL, _evento(f"e{i}", 1, hora=8 + i))
+    espejo.sincronizar()
+    assert api.llamadas == 3
+    assert len(espejo.intervalos(*_dia(1))) == 5
+    assert espejo.get_stats()['sync_completos'] == 1
+
+
+def test_incremental_aplica_cambios_y_cancelados(api, espejo, cambios):
+    api.insertar(CAL, _evento('a', 1))
+    api.insertar(CAL, _evento('b', 2))
+    espejo.sincronizar()
+    api.borrar(CAL, 'a')
+    api.actualizar(CAL, _evento('b', 2, hora=15))
+    api.insertar(CAL, _evento('c', 3))
+    espejo.sincronizar()
+    assert espejo.intervalos(*_dia(1)) == []
+    assert [i.hour for i, _ in espejo.intervalos(*_dia(2))] == [15]
+    assert len(espejo.intervalos(*_dia(3))) == 1
+    stats = espejo.get_stats()
+    assert stats['sync_completos'] == 1 and stats['sync_incrementales'] == 1
+    assert {_dia(d)[0].date().isoformat() for d in (1, 2, 3)} <= set().union(*cambios)
+
+
+def test_token_vencido_rehace_el_sync_completo(api, espejo):
+    api.insertar(CAL, _evento('a', 1))
+    espejo.sincronizar()
+    api.borrar(CAL, 'a')
+    api.insertar(CAL, _evento('b', 1, hora=12))
+    api.expirar_tokens()
+    espejo.sincronizar()
+    stats = espejo.get_stats()
+    assert stats['resync_410'] == 1 and stats['sync_completos'] == 2
+    assert [i.hour for i, _ in espejo.intervalos(*_dia(1))] == [12]
+
+
+def test_escrituras_propias_se_aplican_sin_sync(api, espejo, cambios):
+    espejo.sincronizar()
+    llamadas = api.llamadas
+    espejo.aplicar_escritura(dict(_evento('propio', 2), status='confirmed'))
+    assert len(espejo.intervalos(*_dia(2))) == 1
+    assert cambios[-1] == {_dia(2)[0].date().isoformat()}
+    espejo.quitar('propio')
+    assert espejo.intervalos(*_dia(2)) == []
+    assert api.llamadas == llamadas
+
+
+def test_sync_completo_acotado_por_time_max(api, espejo):
+    api.insertar(CAL, _evento('cerca', 2))
+    api.insertar(CAL, _evento('lejos', 60))
+    espejo.sincronizar()
+    assert espejo.get_stats()['eventos'] == 1
+    # Una consulta más allá del horizonte extiende el sync completo en vez de leer un espejo vacío
+    assert len(espejo.intervalos(*_dia(60))) == 1
+    assert espejo.get_stats()['sync_completos'] == 2
+
+
+def test_horizonte_consumido_rehace_el_completo(api, espejo):
+    espejo.sincronizar()
+    espejo._horizonte -= timedelta(days=8)
+    espejo.sincronizar()
+    assert espejo.get_stats()['sync_completos'] == 2
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from history_window import HistoryWindowBuilder
+
+BASE = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _msg(i, con_ts=True, largo=200):
+    msg = {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"m{i} " + 'x' * largo}
+    if con_ts:
+        msg['timestamp'] = (BASE + timedelta(minutes=i)).isoformat()
+    return msg
+
+
+@pytest.fixture
+def builder(monkeypatch):
+    b = HistoryWindowBuilder({'agente_cero': 200}, max_mensajes=40)
+    b.resumen = None
+    b.plegados = []
+    monkeypatch.setattr(b, 'obtener_resumen', lambda author, marca=None: b.resumen)
+    monkeypatch.setattr(b, '_programar_plegado',
+                        lambda author, pendientes, resumen_previo, marca=None: b.plegados.append(list(pendientes)))
+    return b
+
+
+def _contenidos(ventana):
+    return [m['content'].split()[0] for m in ventana['mensajes']]
+
+
+def test_sin_resumen_los_mensajes_fuera_del_presupuesto_siguen_en_la_ventana(builder):
+    history = [_msg(i) for i in range(10)]
+    ventana = builder.construir(history, 'agente_cero', 'ana')
+    assert _contenidos(ventana) == [f"m{i}" for i in range(10)]
+    assert builder.plegados and builder.plegados[0][0] is history[0]
+
+
+def test_los_cubiertos_por_el_resumen_salen_de_la_ventana(builder):
+    history = [_msg(i) for i in range(10)]
+    builder.resumen = {'texto': 'resumen', 'hasta_ts': history[5]['timestamp']}
+    ventana = builder.construir(history, 'agente_cero', 'ana')
+    assert _contenidos(ventana) == [f"m{i}" for i in range(6, 10)]
+    assert ventana['resumen'] == 'resumen'
+
+
+def test_mensaje_sin_timestamp_no_cuenta_como_cubierto(builder):
+    history = [_msg(i) for i in range(6)] + [_msg(6, con_ts=False)] + [_msg(i) for i in range(7, 10)]
+    builder.resumen = {'texto': 'resumen', 'hasta_ts': history[5]['timestamp']}
+    ventana = builder.construir(history, 'agente_cero', 'ana')
+    assert 'm6' in _contenidos(ventana)
+
+
+def test_sin_timestamp_antes_de_uno_cubierto_si_esta_cubierto(builder):
+    history = [_msg(0), _msg(1, con_ts=False), _msg(2)] + [_msg(i) for i in range(3, 6)]
+    builder.resumen = {'texto': 'resumen', 'hasta_ts': history[2]['timestamp']}
+    ventana = builder.construir(history, 'agente_cero', 'ana')
+    assert _contenidos(ventana) == ['m3', 'm4', 'm5']
+
+
+def test_no_se_pliega_una_cola_sin_timestamp(builder):
+    history = [_msg(i, con_ts=False) for i in range(10)]
+    ventana = builder.construir(history, 'agente_cero', 'ana')
+    assert len(ventana['mensajes']) == 10
+    assert builder.plegados == []
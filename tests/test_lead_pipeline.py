@@ -0,0 +1,32 @@
+import lead_pipeline
+from lead_pipeline import LeadPipeline
+
+
+def _sin_hubspot(monkeypatch):
+    monkeypatch.setattr(lead_pipeline.hubspot_handler, 'batch_upsert_contacts', lambda contactos: [])
+
+
+def test_fallidos_entran_en_enfriamiento(monkeypatch):
+    _sin_hubspot(monkeypatch)
+    pipeline = LeadPipeline(concurrencia=2, enfriamiento_fallo_s=3600)
+    conversaciones = {f"54911{i}@c.us": {'history': []} for i in range(3)}
+    resumen = pipeline.procesar(conversaciones, formatear=str, parsear=lambda r, a: None, marcar=False)
+    assert resumen['sin_datos'] == 3
+    resumen = pipeline.procesar(conversaciones, formatear=str, parsear=lambda r, a: None, marcar=False)
+    assert resumen['candidatos'] == 0 and resumen['en_enfriamiento'] == 3
+
+
+def test_fallidos_vencidos_se_podan(monkeypatch):
+    _sin_hubspot(monkeypatch)
+    reloj = [1000.0]
+    monkeypatch.setattr(lead_pipeline.time, 'time', lambda: reloj[0])
+    pipeline = LeadPipeline(concurrencia=2, enfriamiento_fallo_s=60)
+    viejos = {f"54911{i}@c.us": {'history': []} for i in range(5)}
+    pipeline.procesar(viejos, formatear=str, parsear=lambda r, a: None, marcar=False)
+    assert pipeline.get_stats()['en_enfriamiento'] == 5
+
+    reloj[0] += 61
+    # Los autores viejos ya no aparecen en el ciclo: igual se olvidan al vencer su enfriamiento
+    pipeline.procesar({'549220@c.us': {'history': []}}, formatear=str, parsear=lambda r, a: None, marcar=False)
+    assert set(pipeline._fallidos) == {'549220@c.us'}
+    assert pipeline.get_stats()['en_enfriamiento'] == 1
@@ -0,0 +1,26 @@
+from llm_backends import huella_request
+
+
+def _request(modelo, texto, fecha='lunes 19 de octubre 2026, 10:00'):
+    return {'model': modelo, 'input': f"FECHA Y HORA ACTUAL: {fecha}\n\nUsuario: {texto}"}
+
+
+def test_requests_distintos_tienen_huellas_distintas():
+    assert huella_request('responses', _request('gpt-5', 'hola')) != huella_request('responses', _request('gpt-5-mini', 'chau'))
+    assert huella_request('responses', _request('gpt-5', 'hola')) != huella_request('responses', _request('gpt-5', 'chau'))
+    assert huella_request('responses', _request('gpt-5', 'hola')) != huella_request('responses', _request('gpt-5-mini', 'hola'))
+
+
+def test_solo_se_ignora_la_linea_de_fecha():
+    a = huella_request('responses', _request('gpt-5', 'hola', fecha='lunes 19 de octubre 2026, 10:00'))
+    b = huella_request('responses', _request('gpt-5', 'hola', fecha='martes 20 de octubre 2026, 18:45'))
+    assert a == b
+
+
+def test_fecha_en_mensajes_anidados():
+    mensajes = lambda fecha, texto: {'model': 'gpt-4o-mini', 'messages': [
+        {'role': 'system', 'content': f"FECHA Y HORA ACTUAL: {fecha}\n\nSos el lector"},
+        {'role': 'user', 'content': texto},
+    ]}
+    assert huella_request('chat', mensajes('lunes', 'x')) == huella_request('chat', mensajes('martes', 'x'))
+    assert huella_request('chat', mensajes('lunes', 'x')) != huella_request('chat', mensajes('lunes', 'y'))
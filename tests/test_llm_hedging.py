@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from llm_hedging import CircuitBreaker, CircuitoAbiertoError, HedgingCoordinator
+
+
+def _breaker_abierto(enfriamiento=0.05):
+    breaker = CircuitBreaker(tasa_error=0.5, minimo_llamadas=2, enfriamiento=enfriamiento, ventana=4)
+    breaker.registrar(False)
+    breaker.registrar(False)
+    return breaker
+
+
+def test_abre_al_superar_la_tasa_de_error():
+    breaker = CircuitBreaker(tasa_error=0.5, minimo_llamadas=4, enfriamiento=60, ventana=4)
+    for exito in (True, False, True):
+        breaker.registrar(exito)
+    assert breaker.permitir()
+    breaker.registrar(False)
+    assert breaker.snapshot()['estado'] == CircuitBreaker.ABIERTO
+    assert not breaker.permitir()
+    assert breaker.rechazos == 1
+
+
+def test_semiabierto_deja_pasar_una_sola_prueba():
+    breaker = _breaker_abierto()
+    time.sleep(0.06)
+    assert breaker.permitir()
+    assert breaker.en_prueba
+    assert not breaker.permitir()
+
+
+def test_prueba_exitosa_cierra():
+    breaker = _breaker_abierto()
+    time.sleep(0.06)
+    breaker.permitir()
+    breaker.registrar(True)
+    assert breaker.snapshot()['estado'] == CircuitBreaker.CERRADO
+    assert breaker.permitir()
+
+
+def test_prueba_fallida_reabre():
+    breaker = _breaker_abierto()
+    time.sleep(0.06)
+    breaker.permitir()
+    breaker.registrar(False)
+    assert breaker.snapshot()['estado'] == CircuitBreaker.ABIERTO
+    assert breaker.aperturas == 2
+    assert not breaker.permitir()
+
+
+def test_liberar_prueba_permite_otra():
+    breaker = _breaker_abierto()
+    time.sleep(0.06)
+    assert breaker.permitir()
+    breaker.liberar_prueba()
+    assert breaker.snapshot()['estado'] == CircuitBreaker.SEMIABIERTO
+    assert breaker.permitir()
+
+
+def _coordinador_semiabierto(hedge_enabled):
+    coordinador = HedgingCoordinator(enabled=hedge_enabled, retardo_default=5, timeout_total=5,
+                                     breaker_kwargs={'tasa_error': 0.5, 'minimo_llamadas': 2, 'enfriamiento': 0.05})
+    for _ in range(2):
+        coordinador._registrar_resultado('m', 'a', False, None)
+    time.sleep(0.06)
+    return coordinador
+
+
+@pytest.mark.parametrize('hedge_enabled', [False, True])
+@pytest.mark.parametrize('despachar', [False, True])
+def test_prueba_sin_resultado_del_modelo_no_traba_el_breaker(hedge_enabled, despachar):
+    """Timeout de cola (sin despachar) o timeout local: la prueba se libera en vez de quedar en curso."""
+    coordinador = _coordinador_semiabierto(hedge_enabled)
+
+    def llamada(modelo, medicion):
+        if despachar:
+            medicion.iniciar()
+            medicion.terminar()
+        raise TimeoutError('local')
+
+    with pytest.raises(TimeoutError):
+        coordinador.ejecutar('m', llamada, agente='a')
+    breaker = coordinador._breaker('m')
+    assert breaker.snapshot()['estado'] == CircuitBreaker.SEMIABIERTO
+    assert not breaker.en_prueba
+
+    def exitosa(modelo, medicion):
+        medicion.iniciar()
+        medicion.terminar()
+        return 'ok'
+
+    assert coordinador.ejecutar('m', exitosa, agente='a') == ('ok', 'm')
+    assert breaker.snapshot()['estado'] == CircuitBreaker.CERRADO
+
+
+def test_circuito_abierto_sin_respaldo():
+    coordinador = HedgingCoordinator(breaker_kwargs={'tasa_error': 0.5, 'minimo_llamadas': 2, 'enfriamiento': 60})
+    for _ in range(2):
+        coordinador._registrar_resultado('m', 'a', False, None)
+    with pytest.raises(CircuitoAbiertoError):
+        coordinador.ejecutar('m', lambda modelo, medicion: 'ok', agente='a')
@@ -0,0 +1,18 @@
+import json
+
+from msgio_handler import render_lista_rapida
+
+
+def _opciones(n):
+    return [{'id': f"t{i}", 'title': f"Turno {i}"} for i in range(n)]
+
+
+def test_lista_rapida_con_diez_filas():
+    payload = render_lista_rapida('5491111', 'Elegí un turno', 'Ver turnos', _opciones(10))
+    assert payload is not None
+    filas = json.loads(payload.cuerpo)['interactive']['action']['sections'][0]['rows']
+    assert [f['id'] for f in filas] == [f"t{i}" for i in range(10)]
+
+
+def test_lista_rapida_rechaza_mas_de_diez_filas():
+    assert render_lista_rapida('5491111', 'Elegí un turno', 'Ver turnos', _opciones(11)) is None
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import agendamiento_handler
+from agendamiento_handler import TIMEZONE, PrefetchTurnos
+
+
+def _fechas(n):
+    hoy = datetime.now(TIMEZONE).date()
+    return [(hoy + timedelta(days=d)).isoformat() for d in range(n)]
+
+
+def _indice_que_invalida(monkeypatch, prefetch, invalidar):
+    """Índice falso: un turno por día; `invalidar` llega mientras se calcula."""
+    def turnos(calendar_service, desde, hasta):
+        if invalidar is not None:
+            prefetch._al_invalidar('cal', invalidar)
+        dia = desde.date()
+        resultado = []
+        while dia < hasta.date():
+            resultado.append(SimpleNamespace(fecha=dia.isoformat()))
+            dia += timedelta(days=1)
+        return resultado
+    monkeypatch.setattr(agendamiento_handler.utils.indice_disponibilidad, 'turnos', turnos)
+
+
+def test_calculo_sin_invalidaciones_queda_vigente(monkeypatch):
+    prefetch = PrefetchTurnos(dias=3)
+    fechas = _fechas(3)
+    _indice_que_invalida(monkeypatch, prefetch, None)
+    prefetch._calcular(None, fechas)
+    assert prefetch._pendientes() == []
+
+
+def test_invalidacion_durante_el_calculo_no_se_pisa(monkeypatch):
+    prefetch = PrefetchTurnos(dias=3)
+    fechas = _fechas(3)
+    _indice_que_invalida(monkeypatch, prefetch, {fechas[1]})
+    por_dia = prefetch._calcular(None, fechas)
+    assert len(por_dia[fechas[1]]) == 1          # el llamador igual recibe el resultado
+    assert prefetch._pendientes() == [fechas[1]]  # pero el día no quedó guardado como vigente
+    assert prefetch.get_stats()['calculos_descartados'] == 1
+
+
+def test_invalidacion_de_entrada_existente_la_deja_obsoleta(monkeypatch):
+    prefetch = PrefetchTurnos(dias=2)
+    fechas = _fechas(2)
+    _indice_que_invalida(monkeypatch, prefetch, None)
+    prefetch._calcular(None, fechas)
+    _indice_que_invalida(monkeypatch, prefetch, set())   # invalidación global
+    prefetch._calcular(None, fechas)
+    assert prefetch._pendientes() == fechas
+    assert all(e['obsoleto'] for e in prefetch.get_stats()['dias'].values())
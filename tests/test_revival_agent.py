@@ -0,0 +1,33 @@
+import json
+from types import SimpleNamespace
+
+import llm_handler
+from revival_agent import RevivalAgent
+
+
+def test_analisis_sale_por_el_planificador_y_el_backend_compartido(monkeypatch):
+    peticiones, agendadas = [], []
+
+    class _Backend:
+        nombre = 'openai'
+
+        def responses_create(self, **kwargs):
+            peticiones.append(kwargs)
+            return SimpleNamespace(output_text=json.dumps({'action': 'TAG_ONLY', 'tag': 'frio'}))
+
+    ejecutar_real = llm_handler.planificador.ejecutar
+
+    def ejecutar(modelo, llamada, **kwargs):
+        agendadas.append((modelo, kwargs.get('prioridad'), kwargs.get('agente')))
+        return ejecutar_real(modelo, llamada, **kwargs)
+
+    monkeypatch.setattr(llm_handler, 'backend', _Backend())
+    monkeypatch.setattr(llm_handler.planificador, 'ejecutar', ejecutar)
+    agente = RevivalAgent()
+    assert not hasattr(agente, 'client')
+
+    resultado = agente._call_openai_api("user: hola")
+
+    assert resultado['action'] == 'TAG_ONLY'
+    assert agendadas == [(agente.model, llm_handler.PRIORIDAD_FONDO, 'revival')]
+    assert peticiones and peticiones[0]['model'] == agente.model
@@ -0,0 +1,40 @@
+from slot_holds import SlotHolds, _AlmacenLocal
+
+
+def test_convertir_deja_el_turno_reservado_y_suelta_los_demas():
+    holds = SlotHolds(_AlmacenLocal(), ttl=180, ttl_confirmacion=60, ttl_reservado=150)
+    holds.retener('ana', 'cal', ['10:00', '11:00', '12:00'])
+    assert holds.confirmar('ana', 'cal', '10:00')
+    holds.convertir('ana', 'cal', '10:00', ['10:00', '11:00', '12:00'])
+
+    # Mientras el espejo/índice no vea el evento, el turno sigue bloqueado para otros
+    assert holds.retenidos_por_otros('beto', 'cal') == {'10:00'}
+    assert not holds.confirmar('beto', 'cal', '10:00')
+    assert holds.retener('beto', 'cal', ['10:00', '11:00']) == ['11:00']
+
+
+def test_reservado_vence_con_su_ttl(monkeypatch):
+    import slot_holds
+    reloj = [1000.0]
+    monkeypatch.setattr(slot_holds.time, 'time', lambda: reloj[0])
+    holds = SlotHolds(_AlmacenLocal(), ttl_reservado=150)
+    holds.confirmar('ana', 'cal', '10:00')
+    holds.convertir('ana', 'cal', '10:00')
+    reloj[0] += 149
+    assert holds.retenidos_por_otros('beto', 'cal') == {'10:00'}
+    reloj[0] += 2
+    assert holds.confirmar('beto', 'cal', '10:00')
+
+
+def test_almacen_se_crea_en_el_primer_uso():
+    creados = []
+
+    def fabrica():
+        creados.append(_AlmacenLocal())
+        return creados[-1]
+
+    holds = SlotHolds(fabrica)
+    assert creados == []
+    holds.retener('ana', 'cal', ['10:00'])
+    holds.retener('beto', 'cal', ['11:00'])
+    assert len(creados) == 1 and holds.almacen is creados[0]
@@ -9,10 +9,121 @@ from datetime import datetime, timedelta
 from functools import lru_cache
 from threading import Lock
 import requests
+from concurrent.futures import Future
 import config
+import http_transport
+import media_store
 
 logger = logging.getLogger(config.TENANT_NAME)
 
+# --- RESOLUCIÓN DE MEDIA DE 360DIALOG CON CACHÉ TTL ---
+
+class MediaUrlResolver:
+    """
+    Caché media_id -> metadatos de 360dialog (URL de descarga, mime_type, tamaño).
+
+    Las URLs temporales valen ~5 minutos, así que cada entrada vive MEDIA_URL_TTL
+    segundos (por debajo de esa ventana). Consultas concurrentes por el mismo id
+    se coalescen en una sola llamada (single-flight) y todas usan una sesión HTTP
+    compartida con pool de conexiones (http_transport).
+    """
+
+    def __init__(self, ttl: float = 240.0, max_entradas: int = 1024):
+        self.ttl = float(ttl)
+        self.max_entradas = max(1, int(max_entradas))
+        self.session = http_transport.transporte
+        self._cache = {}       # media_id -> (metadatos, expira_en)
+        self._en_vuelo = {}    # media_id -> Future de la consulta en curso
+        self._lock = Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalescidas': 0, 'errores': 0, 'invalidadas': 0}
+
+    def _consultar(self, media_id: str) -> dict:
+        api_key = os.getenv('D360_API_KEY')
+        response = self.session.get(f"https://waba-v2.360dialog.io/{media_id}",
+                                    headers={'D360-API-KEY': api_key}, timeout=10)
+        response.raise_for_status()
+        media_data = response.json()
+        facebook_url = media_data.get('url')
+        if facebook_url:
+            # Reemplazar dominio de Facebook por 360dialog
+            media_data['download_url'] = facebook_url.replace(
+                'https://lookaside.fbsbx.com', 'https://waba-v2.360dialog.io'
+            )
+        return media_data
+
+    def resolver(self, media_id: str) -> dict:
+        """Metadatos del media (con 'download_url'). Propaga las excepciones de requests."""
+        ahora = time.time()
+        with self._lock:
+            entrada = self._cache.get(media_id)
+            if entrada is not None and entrada[1] > ahora:
+                self._stats['hits'] += 1
+                return dict(entrada[0])
+            vuelo = self._en_vuelo.get(media_id)
+            lider = vuelo is None
+            if lider:
+                vuelo = Future()
+                self._en_vuelo[media_id] = vuelo
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalescidas'] += 1
+        if not lider:
+            return dict(vuelo.result(timeout=30))
+
+        try:
+            media_data = self._consultar(media_id)
+        except Exception as e:
+            with self._lock:
+                self._stats['errores'] += 1
+                self._en_vuelo.pop(media_id, None)
+            vuelo.set_exception(e)
+            raise
+        with self._lock:
+            if len(self._cache) >= self.max_entradas:
+                for clave in [k for k, (_, expira) in self._cache.items() if expira <= ahora]:
+                    del self._cache[clave]
+                while len(self._cache) >= self.max_entradas:
+                    del self._cache[next(iter(self._cache))]
+            self._cache[media_id] = (media_data, time.time() + self.ttl)
+            self._en_vuelo.pop(media_id, None)
+        vuelo.set_result(media_data)
+        return dict(media_data)
+
+    def vigente(self, media_id: str) -> dict | None:
+        """Metadatos cacheados y vigentes, sin consultar a 360dialog."""
+        with self._lock:
+            entrada = self._cache.get(media_id)
+            if entrada is not None and entrada[1] > time.time():
+                return dict(entrada[0])
+        return None
+
+    def invalidar(self, media_id: str):
+        """Descarta la entrada (p. ej. si la URL venció antes de lo esperado)."""
+        with self._lock:
+            if self._cache.pop(media_id, None) is not None:
+                self._stats['invalidadas'] += 1
+
+    def get_stats(self) -> dict:
+        ahora = time.time()
+        with self._lock:
+            vigentes = sum(1 for _, expira in self._cache.values() if expira > ahora)
+            stats = dict(self._stats)
+            en_vuelo = len(self._en_vuelo)
+        consultas = stats['hits'] + stats['misses'] + stats['coalescidas']
+        return {
+            'ttl_s': self.ttl,
+            'entradas_vigentes': vigentes,
+            'en_vuelo': en_vuelo,
+            'hit_rate': round((stats['hits'] + stats['coalescidas']) / consultas, 3) if consultas else None,
+            **stats,
+        }
+
+
+resolvedor_media = MediaUrlResolver(
+    ttl=getattr(config, 'MEDIA_URL_TTL', 240.0),
+    max_entradas=getattr(config, 'MEDIA_URL_CACHE_SIZE', 1024),
+)
+
 def get_media_url(media_id):
     """
     Obtiene la URL temporal de un archivo multimedia desde 360dialog.
@@ -36,40 +147,17 @@ def get_media_url(media_id):
             logger.error("[MEDIA] D360_API_KEY no configurada")
             return None
         
-        # Headers con autenticación según 360dialog
-        headers = {
-            'D360-API-KEY': api_key
-        }
-        
-        # PASO 1: Obtener metadatos - ENDPOINT CORRECTO según 360dialog
-        media_info_url = f"https://waba-v2.360dialog.io/{media_id}"
-        
+        # PASO 1: Obtener metadatos - ENDPOINT CORRECTO según 360dialog (GET /{media_id}, cacheado)
         logger.info(f"[MEDIA] 🔍 Obteniendo metadatos para media ID: {media_id}")
-        logger.info(f"[MEDIA] 🌐 URL endpoint: {media_info_url}")
-        
-        response = requests.get(media_info_url, headers=headers, timeout=10)
-        
-        logger.info(f"[MEDIA] 📊 Response status: {response.status_code}")
-        
-        response.raise_for_status()
-        
-        media_data = response.json()
+        media_data = resolvedor_media.resolver(media_id)
         logger.info(f"[MEDIA] 📄 Metadatos recibidos: {media_data}")
         
-        # PASO 2: Extraer URL de Facebook del campo "url"
-        facebook_url = media_data.get('url')
+        # PASO 2 y 3: URL de Facebook del campo "url" con el dominio reemplazado por 360dialog
+        modified_url = media_data.get('download_url')
         
-        if not facebook_url:
+        if not modified_url:
             logger.error(f"[MEDIA] ❌ Campo 'url' no encontrado en metadatos: {media_data}")
             return None
-            
-        logger.info(f"[MEDIA] 🔗 URL original de Facebook: {facebook_url}")
-        
-        # PASO 3: Reemplazar dominio según especificación exacta de 360dialog
-        modified_url = facebook_url.replace(
-            'https://lookaside.fbsbx.com', 
-            'https://waba-v2.360dialog.io'
-        )
         
         logger.info(f"[MEDIA] ✅ URL modificada para 360dialog: {modified_url}")
         
@@ -107,12 +195,17 @@ def get_media_url_alternative(media_id):
             logger.error("[MEDIA] D360_API_KEY no configurada")
             return None
             
+        # Si el media ya se resolvió y la URL sigue vigente, no volver a consultar
+        vigente = resolvedor_media.vigente(media_id)
+        if vigente and vigente.get('download_url'):
+            return vigente['download_url']
+            
         # Construir URL con API key
         media_url = f"https://waba-v2.360dialog.io/media/{media_id}?access_token={api_key}"
         
         # Verificar si la URL es válida
         headers = {'D360-API-KEY': api_key}
-        response = requests.head(media_url, headers=headers, timeout=5)
+        response = resolvedor_media.session.head(media_url, headers=headers, timeout=5)
         
         if response.status_code == 200:
             logger.info(f"[MEDIA] URL alternativa válida para {media_id}")
@@ -135,63 +228,61 @@ def download_and_store_media(media_id, output_dir="./downloads"):
     """
     if not media_id:
         return {"success": False, "error": "Media ID no proporcionado"}
-        
+
     try:
+        # Si este media_id ya está en el media store, no volver a pedirlo a 360dialog
+        existente = media_store.store.buscar_por_media_id(media_id)
+        if existente is not None:
+            logger.info(f"[MEDIA DOWNLOAD] ♻️ {media_id} ya descargado ({existente.sha256[:12]})")
+            return {
+                "success": True,
+                "filepath": existente.ruta,
+                "mime_type": existente.mime,
+                "file_size": existente.bytes,
+                "sha256": existente.sha256,
+                "media_id": media_id,
+                "cache_hit": True
+            }
+
         api_key = os.getenv('D360_API_KEY')
         if not api_key:
             return {"success": False, "error": "D360_API_KEY no configurada"}
         
-        # PASO 1: Obtener metadatos del media (usando endpoint correcto)
-        url = f"https://waba-v2.360dialog.io/{media_id}"
+        # PASO 1: Obtener metadatos del media (usando endpoint correcto, cacheado por TTL)
         headers = {"D360-API-KEY": api_key}
         
         logger.info(f"[MEDIA DOWNLOAD] 🔍 Obteniendo metadatos para: {media_id}")
         
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        media_data = response.json()
+        media_data = resolvedor_media.resolver(media_id)
         logger.info(f"[MEDIA DOWNLOAD] 📊 Metadatos: {media_data}")
         
-        # PASO 2: Procesar la URL de descarga según 360dialog
-        facebook_url = media_data["url"]
-        
-        # Reemplazar dominio de Facebook por 360dialog
-        download_url = facebook_url.replace(
-            "https://lookaside.fbsbx.com", 
-            "https://waba-v2.360dialog.io"
-        )
+        # PASO 2: URL de descarga con el dominio de Facebook reemplazado por 360dialog
+        download_url = media_data["download_url"]
         
         logger.info(f"[MEDIA DOWNLOAD] 🔗 URL de descarga: {download_url}")
         
-        # PASO 3: Descargar el archivo
-        download_response = requests.get(download_url, headers=headers, timeout=30)
-        download_response.raise_for_status()
-        
-        # Crear directorio si no existe
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Generar nombre de archivo usando mime_type
-        file_extension = media_data["mime_type"].split("/")[1] if "/" in media_data["mime_type"] else "bin"
-        filename = f"{media_id}.{file_extension}"
-        filepath = os.path.join(output_dir, filename)
-        
-        # Guardar archivo
-        with open(filepath, "wb") as f:
-            f.write(download_response.content)
-        
-        logger.info(f"[MEDIA DOWNLOAD] ✅ Archivo descargado: {filepath}")
-        
+        # PASO 3: Descargar el archivo en streaming al media store (direccionado por SHA-256).
+        # output_dir se mantiene en la firma por compatibilidad; los archivos viven en el store.
+        entrada = media_store.store.descargar(
+            download_url, headers=headers, media_id=media_id, mime=media_data.get("mime_type"),
+            session=resolvedor_media.session
+        )
+
+        logger.info(f"[MEDIA DOWNLOAD] ✅ Archivo descargado: {entrada.ruta}")
+
         return {
             "success": True,
-            "filepath": filepath,
+            "filepath": entrada.ruta,
             "mime_type": media_data["mime_type"],
-            "file_size": media_data["file_size"],
-            "sha256": media_data.get("sha256"),
-            "media_id": media_id
+            "file_size": media_data.get("file_size", entrada.bytes),
+            "sha256": entrada.sha256,
+            "media_id": media_id,
+            "cache_hit": entrada.cache_hit
         }
         
     except requests.exceptions.HTTPError as e:
+        # La URL pudo vencer antes del TTL: que el próximo intento vuelva a resolverla
+        resolvedor_media.invalidar(media_id)
         if e.response and e.response.status_code == 404:
             error_msg = f"Media ID {media_id} no encontrado (posible expiración >5min)"
         else:
@@ -208,6 +299,11 @@ def download_and_store_media(media_id, output_dir="./downloads"):
         error_msg = f"Campo faltante en respuesta: {str(e)}"
         logger.error(f"[MEDIA DOWNLOAD] 🔑 {error_msg}")
         return {"success": False, "error": error_msg}
+
+    except media_store.MediaDemasiadoGrandeError as e:
+        error_msg = f"Archivo demasiado grande: {str(e)}"
+        logger.error(f"[MEDIA DOWNLOAD] 📦 {error_msg}")
+        return {"success": False, "error": error_msg}
         
     except Exception as e:
         error_msg = f"Error inesperado: {str(e)}"
@@ -221,7 +317,14 @@ def cleanup_old_media_files(directory='/tmp/whatsapp_media', max_age_hours=24):
     """
     import time
     from pathlib import Path
-    
+
+    # Los blobs del media store se desalojan por presupuesto LRU; acá solo
+    # se limpian los artefactos huérfanos (sin blob) más viejos que max_age_hours.
+    try:
+        media_store.store.limpiar_artefactos_sueltos(max_age_hours)
+    except Exception as e:
+        logger.warning(f"[MEDIA] Error limpiando artefactos del media store: {e}")
+
     try:
         path = Path(directory)
         if not path.exists():
@@ -794,15 +897,14 @@ def reconstruir_mensaje_completo(messages_to_process, author=""):
                 
             try:
                 logger.info(f"[UTILS] Descargando imagen para {author}")
-                import requests
-                import base64
-                response = requests.get(image_url, timeout=45)
+                response = http_transport.transporte.get(image_url, timeout=45)
                 response.raise_for_status()
-                if len(response.content) > 5 * 1024 * 1024:
+                import image_preprocessor
+                imagen = image_preprocessor.preprocesador.preparar(response.content)
+                if len(imagen.contenido) > 5 * 1024 * 1024:
                     logger.warning(f"La imagen de {author} es demasiado grande. Se ignorará.")
                     continue 
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
-                image_content_for_lector.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}})
+                image_content_for_lector.append(imagen.parte_lector())
                 ordered_user_content.append("[[IMAGEN_ANALIZADA]]")
             except Exception as e:
                 logger.error(f"Error al descargar imagen para {author}: {e}")
@@ -1095,8 +1197,8 @@ def get_available_slots_catalog(author, fecha_deseada=None, max_slots=5, hora_es
                     logger.warning(f"[CATALOGO] Slot en posición {i} no tiene slot_iso")
                     continue
                 
-                fecha_hora = datetime.fromisoformat(slot_iso)
-                fecha_formateada = format_fecha_espanol(fecha_hora)
+                # Los turnos de get_available_slots_for_user ya traen la fecha formateada
+                fecha_formateada = slot.get('fecha_formateada') or format_fecha_espanol(datetime.fromisoformat(slot_iso))
                 
                 # NUEVA MEJORA: Preservar todos los campos originales del slot
                 # y solo agregar los campos adicionales necesarios
@@ -1210,123 +1312,304 @@ def get_selected_slot_from_context(state_context):
         # VALOR SEGURO: Devolver None en caso de error para evitar que el bot se rompa
         return None
     
-# --- SISTEMA DE CACHÉ CON EXPIRACIÓN PARA TURNOS ---
+# --- ÍNDICE GLOBAL DE DISPONIBILIDAD (compartido entre usuarios) ---
 import time
 from threading import Lock
 
-# Caché para turnos disponibles con expiración
-_slots_cache = {}
-_slots_cache_lock = Lock()
-_SLOTS_CACHE_TTL = 60  # 60 segundos de tiempo de vida
+_SLOTS_CACHE_TTL = getattr(config, 'AVAILABILITY_INDEX_TTL', 60)  # segundos hasta refrescar un día
+
+
+def clave_calendario(calendar_service):
+    """Identifica el calendario detrás de un servicio: proveedor + ID del calendario principal."""
+    calendario = getattr(calendar_service, 'MAIN_CAL_ID', None) or getattr(calendar_service, 'CALENDAR_ID', None) or ''
+    return f"{type(calendar_service).__name__}:{calendario}"
+
+
+_DIAS_ABREVIADOS = ('Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom')
+
 
-def _get_cache_key(author, fecha_deseada=None, max_slots=5, preferencia_horaria=None, hora_especifica=None):
+class Turno:
     """
-    Genera una clave única para el caché de turnos.
-    CORRECCIÓN CRÍTICA: Ahora incluye hora_especifica para evitar mezclas de datos.
+    Un turno libre: minuto epoch + calendario. Los campos de presentación en español
+    se calculan la primera vez que se piden y quedan memorizados; como los turnos se
+    internan por (calendario, minuto), el formateo ocurre una vez por turno y no una
+    vez por usuario y consulta.
     """
-    # Normalizar parámetros para evitar claves duplicadas por diferencias menores
-    fecha_normalizada = fecha_deseada if fecha_deseada else "default"
-    preferencia_normalizada = preferencia_horaria if preferencia_horaria else "default"
-    hora_normalizada = hora_especifica if hora_especifica else "default"
-    
-    # Crear clave única que incluya todos los parámetros de búsqueda
-    cache_key = f"slots:{author}:{fecha_normalizada}:{preferencia_normalizada}:{hora_normalizada}:{max_slots}"
-    
-    logger.debug(f"[CACHE] Clave generada: {cache_key}")
-    return cache_key
+    __slots__ = ('minuto', 'calendario', 'tz', '_momento', '_slot_iso', '_fecha', '_hora',
+                 '_fecha_formateada', '_fecha_para_titulo', '_fecha_completa_legible')
+
+    def __init__(self, minuto, calendario, tz):
+        self.minuto = minuto
+        self.calendario = calendario
+        self.tz = tz
+        self._momento = self._slot_iso = self._fecha = self._hora = None
+        self._fecha_formateada = self._fecha_para_titulo = self._fecha_completa_legible = None
+
+    @property
+    def momento(self):
+        if self._momento is None:
+            self._momento = datetime.fromtimestamp(self.minuto * 60, self.tz)
+        return self._momento
+
+    @property
+    def slot_iso(self):
+        if self._slot_iso is None:
+            self._slot_iso = self.momento.isoformat()
+        return self._slot_iso
+
+    @property
+    def fecha(self):
+        if self._fecha is None:
+            self._fecha = self.momento.strftime('%Y-%m-%d')  # Formato YYYY-MM-DD para lógica interna
+        return self._fecha
+
+    @property
+    def hora(self):
+        if self._hora is None:
+            self._hora = self.momento.strftime('%H:%M')  # Formato HH:MM para lógica interna
+        return self._hora
+
+    @property
+    def fecha_formateada(self):
+        if self._fecha_formateada is None:
+            self._fecha_formateada = format_fecha_espanol(self.momento)
+        return self._fecha_formateada
+
+    @property
+    def fecha_para_titulo(self):
+        # Título corto para lista interactiva. Ej: "Jue 31/07 - 10:00"
+        if self._fecha_para_titulo is None:
+            momento = self.momento
+            self._fecha_para_titulo = f"{_DIAS_ABREVIADOS[momento.weekday()]} {momento.strftime('%d/%m - %H:%M')}"
+        return self._fecha_para_titulo
+
+    @property
+    def fecha_completa_legible(self):
+        if self._fecha_completa_legible is None:
+            self._fecha_completa_legible = self.momento.strftime('%A %d de %B a las %H:%M hs')
+        return self._fecha_completa_legible
+
+    def como_dict(self):
+        """El dict que guardan el contexto de agendamiento y Firestore."""
+        return {
+            'slot_iso': self.slot_iso,
+            'fecha_formateada': self.fecha_formateada,
+            'fecha_para_titulo': self.fecha_para_titulo,
+            'fecha': self.fecha,
+            'hora': self.hora,
+            'fecha_completa_legible': self.fecha_completa_legible,
+        }
 
-def _is_cache_valid(cache_entry):
+    def __repr__(self):
+        return f"Turno({self.calendario}, {self.slot_iso})"
+
+
+class AvailabilityIndex:
     """
-    Verifica si una entrada del caché sigue siendo válida.
+    Disponibilidad por calendario y día como bitmap de minutos (bit m = hay un turno
+    que empieza en el minuto m del día local). La disponibilidad es la misma para
+    todos los usuarios: un día se consulta a Google una vez (ventanas menos ocupado,
+    lo que ya hace get_available_slots del servicio) y las búsquedas por fecha,
+    preferencia u hora exacta filtran en memoria.
+
+    Los días se refrescan pasado el TTL y se invalidan al crear, reprogramar o
+    cancelar eventos.
     """
-    if not cache_entry:
-        return False
-    return time.time() - cache_entry.get('timestamp', 0) < _SLOTS_CACHE_TTL
+
+    def __init__(self, ttl=60, timezone=None):
+        self.ttl = float(ttl)
+        self.timezone = timezone
+        self._lock = Lock()
+        self._dias = {}            # (clave, 'YYYY-MM-DD') -> (bitmap, construido_en)
+        self._turnos = {}          # (clave, minuto epoch) -> Turno, compartido entre consultas y refrescos
+        self._turnos_dia = {}      # (clave, 'YYYY-MM-DD') -> (bitmap, tuple de Turno) ya materializados
+        self._llenando = {}        # clave -> Lock: un solo fetch por calendario a la vez
+        self._suscriptores = []    # callbacks(clave, fechas) ante cada invalidación
+        self._stats = {'dias_hit': 0, 'dias_miss': 0, 'consultas_calendario': 0, 'invalidaciones': 0}
+
+    def _lock_calendario(self, clave):
+        with self._lock:
+            return self._llenando.setdefault(clave, Lock())
+
+    def _faltantes(self, clave, dias):
+        ahora = time.time()
+        with self._lock:
+            return [d for d in dias if (entrada := self._dias.get((clave, d))) is None or ahora - entrada[1] >= self.ttl]
+
+    def slots_iso(self, calendar_service, start_date, end_date):
+        """Turnos libres en [start_date, end_date) como ISO, en el mismo formato que el servicio."""
+        return [turno.slot_iso for turno in self.turnos(calendar_service, start_date, end_date)]
+
+    def turnos(self, calendar_service, start_date, end_date):
+        """Turnos libres en [start_date, end_date) como registros Turno compartidos."""
+        tz = self.timezone or start_date.tzinfo
+        clave = clave_calendario(calendar_service)
+        primero = start_date.astimezone(tz).date()
+        cantidad = max(1, (end_date.astimezone(tz).date() - primero).days)
+        dias = [(primero + timedelta(days=i)).isoformat() for i in range(cantidad)]
+
+        faltantes = self._faltantes(clave, dias)
+        if faltantes:
+            with self._lock_calendario(clave):
+                # Otro hilo pudo haber llenado estos días mientras esperábamos
+                faltantes = self._faltantes(clave, dias)
+                if faltantes:
+                    self._llenar(calendar_service, clave, faltantes, tz)
+        with self._lock:
+            self._stats['dias_hit'] += len(dias) - len(faltantes)
+            self._stats['dias_miss'] += len(faltantes)
+            bitmaps = [(d, self._dias.get((clave, d), (0, 0))[0]) for d in dias]
+
+        resultado = []
+        for dia, bitmap in bitmaps:
+            if bitmap:
+                resultado.extend(self._materializar(clave, dia, bitmap, tz))
+        return resultado
+
+    def _materializar(self, clave, dia, bitmap, tz):
+        """Turnos del día para este bitmap; si el bitmap no cambió se reutiliza la misma tupla."""
+        with self._lock:
+            previo = self._turnos_dia.get((clave, dia))
+            if previo is not None and previo[0] == bitmap:
+                return previo[1]
+        base = datetime.strptime(dia, '%Y-%m-%d')
+        turnos = []
+        restante = bitmap
+        while restante:
+            bit = restante & -restante
+            restante ^= bit
+            momento = base + timedelta(minutes=bit.bit_length() - 1)
+            momento = tz.localize(momento) if hasattr(tz, 'localize') else momento.replace(tzinfo=tz)
+            minuto = int(momento.timestamp()) // 60
+            with self._lock:
+                turno = self._turnos.get((clave, minuto))
+                if turno is None:
+                    turno = self._turnos[(clave, minuto)] = Turno(minuto, clave, tz)
+            turnos.append(turno)
+        turnos = tuple(turnos)
+        with self._lock:
+            self._turnos_dia[(clave, dia)] = (bitmap, turnos)
+        return turnos
+
+    def _olvidar_turnos_pasados(self):
+        """Los turnos de días anteriores ya no se muestran: liberar sus registros."""
+        limite = int(time.time()) // 60 - 24 * 60
+        with self._lock:
+            for llave in [k for k in self._turnos if k[1] < limite]:
+                del self._turnos[llave]
+            for llave in [k for k, (_, turnos) in self._turnos_dia.items() if turnos[-1].minuto < limite]:
+                del self._turnos_dia[llave]
+
+    def _llenar(self, calendar_service, clave, faltantes, tz):
+        """Un solo round trip por el tramo contiguo que cubre los días faltantes."""
+        desde = datetime.strptime(faltantes[0], '%Y-%m-%d')
+        hasta = datetime.strptime(faltantes[-1], '%Y-%m-%d') + timedelta(days=1)
+        if hasattr(tz, 'localize'):
+            desde, hasta = tz.localize(desde), tz.localize(hasta)
+        else:
+            desde, hasta = desde.replace(tzinfo=tz), hasta.replace(tzinfo=tz)
+        with self._lock:
+            self._stats['consultas_calendario'] += 1
+        logger.info(f"[DISPONIBILIDAD] Consultando {clave} para {len(faltantes)} día(s): {faltantes[0]} -> {faltantes[-1]}")
+        slots = calendar_service.get_available_slots((desde, hasta)) or []
+        nuevos = {(clave, d): 0 for d in faltantes}
+        for slot_iso in slots:
+            try:
+                momento = datetime.fromisoformat(slot_iso).astimezone(tz)
+            except (TypeError, ValueError):
+                logger.warning(f"[DISPONIBILIDAD] Slot con formato inválido: {slot_iso}")
+                continue
+            llave = (clave, momento.date().isoformat())
+            if llave in nuevos:
+                nuevos[llave] |= 1 << (momento.hour * 60 + momento.minute)
+        construido_en = time.time()
+        with self._lock:
+            for llave, bitmap in nuevos.items():
+                self._dias[llave] = (bitmap, construido_en)
+        self._olvidar_turnos_pasados()
+
+    def suscribir(self, callback):
+        """callback(clave, fechas) tras cada invalidación (clave/fechas None = todo)."""
+        self._suscriptores.append(callback)
+
+    def invalidar(self, clave=None, fechas=None):
+        """Descarta días del índice: los de `fechas` ('YYYY-MM-DD') o todos los del calendario/índice."""
+        with self._lock:
+            llaves = [k for k in self._dias
+                      if (clave is None or k[0] == clave) and (not fechas or k[1] in fechas)]
+            for llave in llaves:
+                del self._dias[llave]
+            self._stats['invalidaciones'] += 1
+        logger.info(f"[DISPONIBILIDAD] Índice invalidado ({clave or 'todos'}, {sorted(fechas) if fechas else 'todas las fechas'}): {len(llaves)} día(s)")
+        for callback in list(self._suscriptores):
+            try:
+                callback(clave, fechas)
+            except Exception as e:
+                logger.warning(f"[DISPONIBILIDAD] Error notificando invalidación: {e}")
+
+    def get_stats(self):
+        ahora = time.time()
+        with self._lock:
+            total = len(self._dias)
+            registrados = len(self._turnos)
+            vigentes = sum(1 for _, construido_en in self._dias.values() if ahora - construido_en < self.ttl)
+            stats = dict(self._stats)
+        consultas = stats['dias_hit'] + stats['dias_miss']
+        return {
+            'total_entries': total,
+            'valid_entries': vigentes,
+            'expired_entries': total - vigentes,
+            'cache_ttl_seconds': self.ttl,
+            'hit_rate': round(stats['dias_hit'] / consultas, 3) if consultas else None,
+            'turnos_registrados': registrados,
+            **stats,
+        }
+
+
+indice_disponibilidad = AvailabilityIndex(ttl=_SLOTS_CACHE_TTL)
+
+
+def invalidar_disponibilidad(calendar_service=None, fechas_iso=None):
+    """
+    Invalida el índice tras crear/reprogramar/cancelar. `fechas_iso` acepta ISO de
+    fecha o fecha-hora; sin fechas invalida el calendario completo.
+    """
+    clave = clave_calendario(calendar_service) if calendar_service is not None else None
+    fechas = {str(f)[:10] for f in (fechas_iso or []) if f} or None
+    indice_disponibilidad.invalidar(clave, fechas)
+
 
 def get_available_slots_catalog_with_cache(author, fecha_deseada=None, max_slots=5, preferencia_horaria=None, hora_especifica=None):
     """
-    NUEVO: Versión con caché de get_available_slots_catalog.
-    CORRECCIÓN CRÍTICA: Ahora incluye hora_especifica para filtrado inteligente.
+    Turnos para un usuario. La disponibilidad sale del índice global
+    (indice_disponibilidad); el filtrado por fecha, preferencia, hora y max_slots
+    es en memoria, así que no hace falta un caché por usuario.
     """
-    cache_key = _get_cache_key(author, fecha_deseada, max_slots, preferencia_horaria, hora_especifica)
-    
-    with _slots_cache_lock:
-        # Verificar si hay una entrada válida en caché
-        if cache_key in _slots_cache and _is_cache_valid(_slots_cache[cache_key]):
-            cached_data = _slots_cache[cache_key]
-            logger.info(f"[CACHE] Turnos servidos desde caché para {author} (TTL: {_SLOTS_CACHE_TTL}s)")
-            return cached_data['slots']
-    
-    # Si no hay caché válido, obtener datos frescos
-    try:
-        logger.info(f"[CACHE] Obteniendo turnos frescos para {author} con fecha: {fecha_deseada}, hora: {hora_especifica}")
-        fresh_slots = get_available_slots_catalog(author, fecha_deseada, max_slots, hora_especifica, preferencia_horaria)
-        
-        # Guardar en caché con timestamp
-        with _slots_cache_lock:
-            _slots_cache[cache_key] = {
-                'slots': fresh_slots,
-                'timestamp': time.time()
-            }
-        
-        logger.info(f"[CACHE] Turnos frescos guardados en caché para {author}")
-        return fresh_slots
-        
-    except Exception as e:
-        logger.error(f"[CACHE] Error obteniendo turnos frescos para {author}: {e}")
-        # Intentar devolver datos del caché aunque estén expirados como fallback
-        with _slots_cache_lock:
-            if cache_key in _slots_cache:
-                expired_data = _slots_cache[cache_key]
-                logger.warning(f"[CACHE] Usando datos expirados como fallback para {author}")
-                return expired_data['slots']
-        
-        # Si no hay nada en caché, devolver lista vacía
-        return []
+    return get_available_slots_catalog(author, fecha_deseada, max_slots, hora_especifica, preferencia_horaria)
 
 def clear_slots_cache():
     """
     NUEVO: Función para limpiar el caché de turnos (útil para testing o mantenimiento).
     """
-    with _slots_cache_lock:
-        _slots_cache.clear()
-        logger.info("[CACHE] Caché de turnos limpiado")
+    indice_disponibilidad.invalidar()
+    logger.info("[CACHE] Caché de turnos limpiado")
 
 def get_slots_cache_stats():
     """
     NUEVO: Función para obtener estadísticas del caché de turnos.
     """
-    with _slots_cache_lock:
-        total_entries = len(_slots_cache)
-        valid_entries = sum(1 for entry in _slots_cache.values() if _is_cache_valid(entry))
-        expired_entries = total_entries - valid_entries
-        
-        return {
-            'total_entries': total_entries,
-            'valid_entries': valid_entries,
-            'expired_entries': expired_entries,
-            'cache_ttl_seconds': _SLOTS_CACHE_TTL
-        }
+    return indice_disponibilidad.get_stats()
 
 def clear_user_slots_cache(author):
     """
-    NUEVO: Limpia todas las entradas de caché para un usuario específico.
-    Se llama después de agendar o reprogramar para evitar datos obsoletos.
+    Compatibilidad: la disponibilidad ya no se cachea por usuario. Se llamaba tras
+    agendar o reprogramar, así que invalida el índice global completo.
     """
     if not author:
         logger.warning("[CACHE] No se puede limpiar caché: author es requerido")
         return
-    
-    with _slots_cache_lock:
-        # Crear una lista de claves a borrar para no modificar el dict mientras se itera
-        keys_to_delete = [key for key in _slots_cache if key.startswith(f"slots:{author}:")]
-        
-        if keys_to_delete:
-            for key in keys_to_delete:
-                del _slots_cache[key]
-            logger.info(f"[CACHE] Caché de turnos limpiado para el usuario {author} ({len(keys_to_delete)} entradas eliminadas)")
-        else:
-            logger.debug(f"[CACHE] No se encontraron entradas de caché para el usuario {author}")
+    indice_disponibilidad.invalidar()
+
 
 def acortar_titulo_servicio(nombre_servicio, precio, max_caracteres=24):
     """